@@ -0,0 +1,204 @@
+# admission.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Admission control for the ingest path. When the DB or the email service slows
+down, requests used to pile up in the threadpool until everything timed out.
+Here we bound the number of requests being worked on at once plus the number
+allowed to wait for a slot, and rate limit each device with a token bucket.
+Anything over those limits is turned away right away with a 'retry after' hint
+so latency degrades gracefully rather than collapsing.
+
+Admission is async (see main.admit_reading()), so it happens on the event loop
+before a request is handed to the threadpool; requests waiting for a slot hold
+no threads, and a full ingest queue cannot starve the other endpoints. A device's
+token bucket is dropped once it has been idle long enough to have refilled, as a
+new bucket would be the same, so there is not one kept for every device ever seen.
+"""
+
+import asyncio
+import threading
+import time
+import math
+
+
+BUCKET_SWEEP_SECS = 60          # how often idle token buckets are dropped
+
+
+class TokenBucket:
+    """
+    Classic token bucket; holds up to 'burst' tokens and refills at 'rate' tokens per second.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+
+    def is_full(self, now):
+        """
+        True if the bucket has refilled completely by now; it can then be dropped and recreated as needed.
+        """
+        return self.tokens + (max(0.0, now - self.last_refill) * self.rate) >= self.burst
+
+    def try_take(self, now):
+        """
+        Attempt to take a single token from the bucket.
+
+        Args:
+            now (float):    Current time.monotonic() value
+
+        Returns:
+            Tuple of (True, 0) if a token was taken; else (False, seconds until a token is available)
+        """
+        elapsed = max(0.0, now - self.last_refill)
+        self.tokens = min(self.burst, self.tokens + (elapsed * self.rate))
+        self.last_refill = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, 0
+        else:
+            return False, (1 - self.tokens) / self.rate
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is not admitted; retry_after is the number of seconds the
+    caller should wait before trying again.
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the number of in-flight ingest requests, the number queued waiting on a slot, and
+    the per-device request rate.
+    """
+
+    def __init__(self, max_in_flight, max_queued, queue_timeout, device_rate, device_burst):
+        """
+        Args:
+            max_in_flight (int):      Max number of requests being processed at once
+            max_queued (int):         Max number of requests allowed to wait for a processing slot
+            queue_timeout (float):    Max seconds a request will wait for a slot
+            device_rate (float):      Sustained requests per second allowed per device; 0 disables
+            device_burst (int):       Number of requests a device may send in a burst
+        """
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.device_rate = device_rate
+        self.device_burst = device_burst
+
+        self._slots = asyncio.BoundedSemaphore(max_in_flight)      # only used on the event loop
+        self._lock = threading.Lock()
+        self._num_queued = 0
+        self._buckets = {}      # dev_id -> TokenBucket; only for devices that have not been idle a while
+        self._last_sweep = time.monotonic()
+
+        # Simple counters; handy to see if we are shedding load
+        self.num_admitted = 0
+        self.num_rejected_rate_limited = 0
+        self.num_rejected_queue_full = 0
+        self.num_rejected_queue_timeout = 0
+
+    def _check_device_rate(self, dev_id):
+        """
+        Take a token from the device's bucket; raises AdmissionRejected if the device is over its rate.
+        """
+        if self.device_rate <= 0:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep >= BUCKET_SWEEP_SECS:
+                self._sweep_buckets(now)
+            bucket = self._buckets.get(dev_id)
+            if bucket is None:
+                bucket = TokenBucket(self.device_rate, self.device_burst)
+                self._buckets[dev_id] = bucket
+            ok, wait_secs = bucket.try_take(now)
+            if not ok:
+                self.num_rejected_rate_limited += 1
+        if not ok:
+            raise AdmissionRejected('device rate limit exceeded', wait_secs)
+
+    def _sweep_buckets(self, now):
+        """
+        Drop the buckets that have refilled completely. Called with the lock held.
+        """
+        self._buckets = {dev_id: bucket for dev_id, bucket in self._buckets.items() if not bucket.is_full(now)}
+        self._last_sweep = now
+
+    async def acquire(self, dev_id):
+        """
+        Admit a request from device dev_id or raise AdmissionRejected. Every successful
+        acquire() must be paired with a release(). Must be called on the event loop.
+
+        Args:
+            dev_id (str):   ID of the device sending the request
+
+        Returns:
+            None
+        """
+        self._check_device_rate(dev_id)
+
+        # Fast path; a slot is free so no need to queue
+        if not self._slots.locked():
+            await self._slots.acquire()     # returns at once
+            with self._lock:
+                self.num_admitted += 1
+            return
+
+        # No free slot; wait in the queue if there is room in it
+        with self._lock:
+            if self._num_queued >= self.max_queued:
+                self.num_rejected_queue_full += 1
+                raise AdmissionRejected('ingest queue full', self.queue_timeout)
+            self._num_queued += 1
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            admitted = True
+        except asyncio.TimeoutError:
+            admitted = False
+        finally:
+            with self._lock:
+                self._num_queued -= 1
+
+        with self._lock:
+            if admitted:
+                self.num_admitted += 1
+            else:
+                self.num_rejected_queue_timeout += 1
+        if not admitted:
+            raise AdmissionRejected('timed out waiting in ingest queue', self.queue_timeout)
+
+    def release(self):
+        """
+        Release the processing slot obtained by acquire(). Must be called on the event loop.
+        """
+        self._slots.release()
+
+    def retry_after_header(self, rejection):
+        """
+        Format the Retry-After header value (whole seconds, at least 1) for a rejection.
+        """
+        return str(max(1, int(math.ceil(rejection.retry_after))))
+
+    def stats(self):
+        """
+        Returns:
+            Dict of the admission counters
+        """
+        with self._lock:
+            return {'num_admitted': self.num_admitted,
+                    'num_queued': self._num_queued,
+                    'num_device_buckets': len(self._buckets),
+                    'num_rejected_rate_limited': self.num_rejected_rate_limited,
+                    'num_rejected_queue_full': self.num_rejected_queue_full,
+                    'num_rejected_queue_timeout': self.num_rejected_queue_timeout}
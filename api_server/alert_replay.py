@@ -0,0 +1,276 @@
+# alert_replay.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Vectorized (NumPy) evaluation of our alert rule over a history of readings. This is
+the same rule post_readings() applies one reading at a time:
+
+  - an alert is raised when the most recent N readings are all out of range
+  - an alert is cleared when the most recent N readings are all in range, and with a
+    hysteresis, inside the range by at least the hysteresis
+  - anything in between continues the current state
+  - until a device has N readings, everything is treated as in range
+  - a reading standing for several (repeat_count > 1, e.g. a deadband heartbeat)
+    counts as that many readings
+
+Rather than replaying readings one at a time, the rule is evaluated for a whole
+history in a handful of array operations; a window sum of the out of range flags
+gives the all in / all out determination, and a forward fill carries the alert
+state through the 'mixed' readings. Used by the offline tools that import, rebuild
+and simulate alert state.
+
+All functions expect the readings sorted by device then timestamp, with devices
+identified by integer codes (e.g. from pandas.factorize()).
+"""
+
+import numpy as np
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def out_of_range_flags(values, range_min, range_max):
+    """
+    Args:
+        values (ndarray):     Reading values
+        range_min:            Min in range value
+        range_max:            Max in range value
+
+    Returns:
+        Boolean ndarray; True where the reading is out of range
+    """
+    return (values < range_min) | (values > range_max)
+
+
+def clear_flags(values, clear_min, clear_max):
+    """
+    Args:
+        values (ndarray):     Reading values
+        clear_min:            Min value counting towards clearing an alert; the range min plus the hysteresis
+        clear_max:            Max value counting towards clearing an alert; the range max less the hysteresis
+
+    Returns:
+        Boolean ndarray; True where the reading counts towards clearing an alert
+    """
+    return (values >= clear_min) & (values <= clear_max)
+
+
+def repeat_index(repeat_counts, num_readings):
+    """
+    Index arrays for evaluating readings that stand for several readings, as the live rule does
+    (see device_state.window_flags()): each reading is repeated repeat_count times, but at most N
+    times, as more repeats give the same result.
+
+    Args:
+        repeat_counts (ndarray):  repeat_count per reading; at least 1
+        num_readings (int):       Number of continuous readings to check (N)
+
+    Returns:
+        Tuple of (index of the reading each repeat is of, index of each reading's last repeat)
+    """
+    repeats = np.minimum(repeat_counts, num_readings)
+    return np.repeat(np.arange(len(repeats)), repeats), np.cumsum(repeats) - 1
+
+
+def alert_state(dev_codes, out_of_range, num_readings, clear=None, repeat_counts=None):
+    """
+    Evaluate the alert rule for every reading.
+
+    Args:
+        dev_codes (ndarray):      Integer device code per reading
+        out_of_range (ndarray):   Boolean out of range flag per reading
+        num_readings (int):       Number of continuous readings to check (N)
+        clear (ndarray):          Boolean flag per reading; True where it counts towards clearing (see
+                                  clear_flags()). If not given, every in range reading does
+        repeat_counts (ndarray):  repeat_count per reading, if any stand for more than one
+
+    Returns:
+        Boolean ndarray; True where the device is in an alert state after processing that reading
+    """
+    if (repeat_counts is not None) and np.any(repeat_counts > 1):
+        expanded, last = repeat_index(repeat_counts, num_readings)
+        return alert_state(dev_codes[expanded], out_of_range[expanded], num_readings,
+                           None if clear is None else clear[expanded])[last]
+
+    count = len(out_of_range)
+    if count == 0:
+        return np.zeros(0, dtype=bool)
+
+    # Position of each reading within its device's readings
+    positions = np.arange(count)
+    device_start = np.r_[True, dev_codes[1:] != dev_codes[:-1]]
+    position_in_device = positions - np.maximum.accumulate(np.where(device_start, positions, 0))
+
+    # Number of out of range readings in the window of the N most recent readings, and of those counting
+    #  towards clearing
+    window_start = np.maximum(positions + 1 - num_readings, 0)
+    cumulative = np.r_[0, np.cumsum(out_of_range, dtype=np.int64)]
+    window_sum = cumulative[1:] - cumulative[window_start]
+    if clear is None:
+        all_clear = window_sum == 0
+    else:
+        cumulative = np.r_[0, np.cumsum(clear, dtype=np.int64)]
+        all_clear = (cumulative[1:] - cumulative[window_start]) == num_readings
+
+    # 1 = raise / continue alert, 0 = clear / no alert, -1 = mixed (keep the previous state). A device
+    #  starts with no alert, so its first reading is never 'mixed'; with N of 1 and a hysteresis, it would
+    #  otherwise be when within the hysteresis, and the forward fill would carry the previous device's state.
+    full_window = position_in_device >= (num_readings - 1)
+    event = np.full(count, -1, dtype=np.int8)
+    event[all_clear | ~full_window] = 0
+    event[full_window & (window_sum == num_readings)] = 1
+    event[device_start & (event < 0)] = 0
+
+    last_defined = np.maximum.accumulate(np.where(event >= 0, positions, 0))
+    return event[last_defined] == 1
+
+
+def alert_state_matrix(out_of_range, num_readings, clear=None, repeat_counts=None):
+    """
+    Evaluate the alert rule for many candidate rule settings over a single device's readings at once;
+    row k of the inputs / output is candidate k. Used to compare candidate thresholds.
+
+    Args:
+        out_of_range (ndarray):   Boolean (candidates x readings) out of range flags
+        num_readings (ndarray):   Number of continuous readings to check (N) per candidate
+        clear (ndarray):          Boolean (candidates x readings) flags; True where the reading counts
+                                  towards clearing. If not given, every in range reading does
+        repeat_counts (ndarray):  repeat_count per reading, if any stand for more than one
+
+    Returns:
+        Boolean (candidates x readings) ndarray; True where the candidate is in an alert state
+    """
+    if (repeat_counts is not None) and np.any(repeat_counts > 1):
+        # Repeated up to the largest N; for the candidates with a smaller N, the extra repeats change nothing
+        expanded, last = repeat_index(repeat_counts, int(np.max(num_readings)))
+        return alert_state_matrix(out_of_range[:, expanded], num_readings,
+                                  None if clear is None else clear[:, expanded])[:, last]
+
+    num_candidates, count = out_of_range.shape
+    if count == 0:
+        return np.zeros((num_candidates, 0), dtype=bool)
+
+    positions = np.arange(count)
+    num_readings = np.asarray(num_readings).reshape(-1, 1)
+
+    # Window sums, each row with its own window length
+    cumulative = np.concatenate([np.zeros((num_candidates, 1), dtype=np.int64),
+                                 np.cumsum(out_of_range, axis=1, dtype=np.int64)], axis=1)
+    window_start = np.maximum(positions[np.newaxis, :] + 1 - num_readings, 0)
+    window_sum = cumulative[:, 1:] - np.take_along_axis(cumulative, window_start, axis=1)
+    if clear is None:
+        all_clear = window_sum == 0
+    else:
+        cumulative = np.concatenate([np.zeros((num_candidates, 1), dtype=np.int64),
+                                     np.cumsum(clear, axis=1, dtype=np.int64)], axis=1)
+        all_clear = (cumulative[:, 1:] - np.take_along_axis(cumulative, window_start, axis=1)) == num_readings
+
+    # Same event / forward fill as alert_state(); the first reading is never 'mixed'
+    full_window = positions[np.newaxis, :] >= (num_readings - 1)
+    event = np.full((num_candidates, count), -1, dtype=np.int8)
+    event[all_clear | ~full_window] = 0
+    event[full_window & (window_sum == num_readings)] = 1
+    event[:, 0] = np.maximum(event[:, 0], 0)
+
+    last_defined = np.maximum.accumulate(np.where(event >= 0, positions[np.newaxis, :], 0), axis=1)
+    return np.take_along_axis(event, last_defined, axis=1) == 1
+
+
+def alert_episodes(dev_codes, timestamps, values, state):
+    """
+    Turn per-reading alert state into alert episodes.
+
+    Args:
+        dev_codes (ndarray):      Integer device code per reading
+        timestamps (ndarray):     datetime64 timestamp per reading
+        values (ndarray):         Reading values
+        state (ndarray):          Boolean alert state per reading; from alert_state()
+
+    Returns:
+        Dict of equal length ndarrays, one entry per episode:
+            'dev_code', 'start_idx' (reading that raised the alert),
+            'end_idx' (reading that cleared the alert; -1 if still active),
+            'stop_idx' (end_idx if cleared, else one past the device's last reading),
+            'originated', 'cleared' (datetime64; NaT if still active),
+            'duration_minutes' (-1 if still active), 'max_value', 'min_value'
+    """
+    device_start = np.r_[True, dev_codes[1:] != dev_codes[:-1]][:len(state)]
+    previous = np.r_[False, state[:-1]][:len(state)]
+    previous[device_start] = False
+
+    starts = np.flatnonzero(state & ~previous)
+    ends = np.flatnonzero(~state & previous)        # never the first reading of a device, since previous is False there
+
+    # Episodes alternate start / end within a device; the first end after a start closes it if it
+    #  belongs to the same device, otherwise the episode is still active
+    end_pos = np.searchsorted(ends, starts)
+    has_end = end_pos < len(ends)
+    end_idx = np.full(len(starts), -1, dtype=np.int64)
+    end_idx[has_end] = ends[end_pos[has_end]]
+    closed = has_end.copy()
+    closed[has_end] = dev_codes[end_idx[has_end]] == dev_codes[starts[has_end]]
+    end_idx[~closed] = -1
+
+    device_first_idx = np.flatnonzero(device_start)
+    device_stop_idx = np.r_[device_first_idx[1:], len(state)]
+    stop_idx = np.where(closed, end_idx, device_stop_idx[np.cumsum(device_start)[starts] - 1])
+
+    # Peak values over the readings in each episode (raise reading through the reading before the clear)
+    episode_id = np.cumsum(state & ~previous) - 1
+    in_episode = state
+    limits = np.iinfo(values.dtype) if np.issubdtype(values.dtype, np.integer) else np.finfo(values.dtype)
+    max_value = np.full(len(starts), limits.min, dtype=values.dtype)
+    min_value = np.full(len(starts), limits.max, dtype=values.dtype)
+    np.maximum.at(max_value, episode_id[in_episode], values[in_episode])
+    np.minimum.at(min_value, episode_id[in_episode], values[in_episode])
+
+    originated = timestamps[starts]
+    cleared = np.full(len(starts), np.datetime64('NaT'), dtype=timestamps.dtype)
+    cleared[closed] = timestamps[end_idx[closed]]
+    duration_minutes = np.full(len(starts), -1, dtype=np.int64)
+    duration_minutes[closed] = (cleared[closed] - originated[closed]) // np.timedelta64(1, 'm')
+
+    return {'dev_code': dev_codes[starts],
+            'start_idx': starts,
+            'end_idx': end_idx,
+            'stop_idx': stop_idx,
+            'originated': originated,
+            'cleared': cleared,
+            'duration_minutes': duration_minutes,
+            'max_value': max_value,
+            'min_value': min_value}
+
+
+def notification_times(timestamps, start_idx, stop_idx, delay_minutes):
+    """
+    Work out when notifications were (or would be) sent for an alert episode; the initial alert
+    notification plus each renotification. A renotification goes out on the first reading at least
+    delay_minutes after the previous notification, for readings up to but not including the one that
+    cleared the alert.
+
+    Args:
+        timestamps (ndarray):     datetime64 timestamp per reading
+        start_idx (int):          Index of the reading that raised the alert
+        stop_idx (int):           Episode's 'stop_idx' from alert_episodes()
+        delay_minutes (int):      alert_renotification_delay
+
+    Returns:
+        List of datetime64 notification times; the first is the initial notification
+    """
+    episode_ts = timestamps[start_idx:stop_idx]
+    delay = np.timedelta64(int(delay_minutes), 'm')
+
+    # Each renotification is a binary search from the previous one, so this is O(notifications * log(readings))
+    notifications = [episode_ts[0]]
+    while True:
+        i = int(np.searchsorted(episode_ts, notifications[-1] + delay, side='left'))
+        if i >= len(episode_ts):
+            break
+        notifications.append(episode_ts[i])
+    return notifications
+
+
+def format_timestamp(ts):
+    """
+    Format a numpy datetime64 the way the server stores timestamps; e.g. 2020-06-18T11:06:00Z.
+    """
+    return np.datetime_as_string(ts, unit='s') + 'Z'
@@ -0,0 +1,146 @@
+# anomaly.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Optional streaming anomaly detection. Alongside the fixed range check, we keep a
+rolling mean and variance per device / reading type and flag a reading whose
+z-score is too large. The statistics are updated in O(1) per reading from the
+reading alone; no history is queried.
+
+The statistics live in the device's state doc (<type>_stats; see device_state.py),
+and are scored and updated by the same atomic update as the alert state, so however
+many server processes there are, each reading is folded in exactly once, in order,
+and a reading that is turned away (e.g. with a 429) is never folded in at all. The
+sharded ingest workers (see ingest_workers.py) update them in memory along with the
+rest of the state. stats_update() builds the pipeline expression and update_stats()
+does the same in memory.
+
+The mean and variance are exponentially weighted. Until a device has seen 1/alpha
+readings we use a weight of 1/count instead, which is exactly Welford's running
+mean / (population) variance; this gives sensible statistics from the very first
+readings then smoothly hands over to the exponentially weighted form.
+"""
+
+import math
+
+
+class RunningStats:
+    """
+    Exponentially weighted mean and variance, warmed up with Welford's algorithm.
+    """
+    __slots__ = ('count', 'mean', 'var', 'since_anomaly')
+
+    def __init__(self, count=0, mean=0.0, var=0.0, since_anomaly=None):
+        self.count = count
+        self.mean = mean
+        self.var = var
+        self.since_anomaly = since_anomaly      # readings since the last anomaly; None if never
+
+    def update(self, value, alpha):
+        self.count += 1
+        weight = max(alpha, 1.0 / self.count)
+        diff = value - self.mean
+        increment = weight * diff
+        self.mean += increment
+        self.var = (1.0 - weight) * (self.var + (diff * increment))
+
+    def zscore(self, value, min_std):
+        return (value - self.mean) / max(math.sqrt(self.var), min_std)
+
+
+class AnomalyDetector:
+    """
+    Per device / reading type z-score anomaly detector; its settings, as the statistics are kept
+    in the state docs. A stats doc holds count, mean, var and since_anomaly (see RunningStats).
+    """
+
+    def __init__(self, alpha, z_threshold, min_samples, min_std):
+        """
+        Args:
+            alpha (float):            Weight given to each new reading once warmed up; ~1/alpha readings of memory
+            z_threshold (float):      A reading further than this many standard deviations from the mean is anomalous
+            min_samples (int):        Readings needed for a device before anything is flagged
+            min_std (float):          Floor for the standard deviation; our readings are integers so a steady
+                                        device would otherwise have a std of 0 and flag every 1 degree change
+        """
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.min_samples = min_samples
+        self.min_std = min_std
+
+    def update_stats(self, stats, value):
+        """
+        Score a reading against a device's statistics, then fold it into them.
+
+        Args:
+            stats (dict):     The stats doc; None for a device / reading type not seen yet
+            value (int):      The reading
+
+        Returns:
+            The new stats doc; its since_anomaly is 0 if this reading is anomalous (see verdict())
+        """
+        stats = stats or {}
+        running = RunningStats(stats.get('count', 0), stats.get('mean', 0.0), stats.get('var', 0.0),
+                               stats.get('since_anomaly'))
+        is_anomalous = (running.count >= self.min_samples) and \
+                       (abs(running.zscore(value, self.min_std)) > self.z_threshold)
+        if is_anomalous:
+            running.since_anomaly = 0
+        elif running.since_anomaly is not None:
+            running.since_anomaly += 1
+        running.update(value, self.alpha)
+        return {'count': running.count,
+                'mean': running.mean,
+                'var': running.var,
+                'since_anomaly': running.since_anomaly}
+
+    def stats_update(self, stats_field, value):
+        """
+        The aggregation expression doing what update_stats() does, for device_state.reading_update();
+        the same operations in the same order, so both come to the same doubles.
+
+        Args:
+            stats_field (str):    Name of the state doc's stats field; e.g. 'temp_stats'
+            value (int):          The reading
+
+        Returns:
+            Expression evaluating to the new stats doc
+        """
+        new_stats = {'count': 0, 'mean': 0.0, 'var': 0.0, 'since_anomaly': None}
+        std = {'$max': [{'$sqrt': '$$stats.var'}, self.min_std]}
+        is_anomalous = {'$and': [{'$gte': ['$$stats.count', self.min_samples]},
+                                 {'$gt': [{'$abs': {'$divide': ['$$diff', std]}}, self.z_threshold]}]}
+        since_anomaly = {'$cond': ['$$is_anomalous', 0,
+                                   {'$cond': [{'$eq': ['$$stats.since_anomaly', None]}, None,
+                                              {'$add': ['$$stats.since_anomaly', 1]}]}]}
+        result = {'count': '$$count',
+                  'mean': {'$add': ['$$stats.mean', '$$increment']},
+                  'var': {'$multiply': [{'$subtract': [1.0, '$$weight']},
+                                        {'$add': ['$$stats.var', {'$multiply': ['$$diff', '$$increment']}]}]},
+                  'since_anomaly': since_anomaly}
+        return {'$let': {
+            'vars': {'stats': {'$ifNull': ['$' + stats_field, new_stats]}},
+            'in': {'$let': {
+                'vars': {'count': {'$add': ['$$stats.count', 1]},
+                         'diff': {'$subtract': [value, '$$stats.mean']}},
+                'in': {'$let': {
+                    'vars': {'weight': {'$max': [self.alpha, {'$divide': [1.0, '$$count']}]},
+                             'is_anomalous': is_anomalous},
+                    'in': {'$let': {
+                        'vars': {'increment': {'$multiply': ['$$weight', '$$diff']}},
+                        'in': result}}}}}}}}
+
+    @staticmethod
+    def verdict(stats, num_readings_to_clear):
+        """
+        The detector's verdict on the reading last folded into a stats doc.
+
+        Args:
+            stats (dict):                 The stats doc, from update_stats()
+            num_readings_to_clear (int):  Number of non-anomalous readings after an anomaly before the
+                                            device is no longer considered recently anomalous
+
+        Returns:
+            Tuple of (the reading is anomalous, an anomaly occurred within the last num_readings_to_clear readings)
+        """
+        since_anomaly = stats['since_anomaly']
+        return since_anomaly == 0, (since_anomaly is not None) and (since_anomaly < num_readings_to_clear)
@@ -0,0 +1,287 @@
+# benchmark_hot_path.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Micro-benchmarks for the server's hot path, to check performance claims for a change
+locally. The server runs in this process against an in-memory stand-in for MongoDB
+(mongomock; pip install mongomock), with SendGrid's client replaced by a stub, so no
+network is involved and nothing is emailed. It measures:
+
+    validate                  ReadingsMsgBody validation of a posted reading
+    alert_rule/<scenario>     the alert rule for one reading (the device's compiled
+                              device_state.AlertRules and evaluate_reading(); what used to be
+                              recent_readings_range_check())
+    alert_handlers            raising then clearing an alert; active_alerts, alert_history and
+                              the (stubbed) notification emails
+    post_readings/<scenario>  post_readings() end to end: admission, storing the reading and
+                              its sketch, the state doc update and whatever alerts it causes
+    http/<scenario>           the same through the HTTP stack (FastAPI's TestClient)
+
+for the scenarios:
+
+    steady      20 devices, every reading in range
+    storm       every device goes out of range at once, raising an alert each
+    flapping    5 devices going out of and back into range every 4 readings
+
+As the DB is mongomock, the times are of our code plus the stand-in, not of a real
+deployment; they are for comparing before / after a change on the same machine. Save
+a baseline before the change, then compare after it; a benchmark whose median time is
+more than --threshold slower than the baseline is a regression, and the exit status is 1:
+
+    python benchmark_hot_path.py --save-baseline
+    python benchmark_hot_path.py [-n <runs>] [--readings <n>] [--threshold 0.2] [-b <benchmark prefix>]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+
+DEFAULT_BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+SCENARIOS = ['steady', 'storm', 'flapping']
+
+
+class StubSendGrid:
+    """
+    Stands in for sendgrid.SendGridAPIClient; counts the emails rather than sending them.
+    """
+    num_sent = 0
+
+    def __init__(self, api_key):
+        pass
+
+    def send(self, message):
+        StubSendGrid.num_sent += 1
+
+
+def start_in_memory_server():
+    """
+    Start the server in this process against mongomock, with the stub email transport. The device
+    rate limit is switched off, as the benchmarks send readings far faster than a device would.
+
+    Returns:
+        Tuple of (the main module, a started fastapi.testclient.TestClient)
+    """
+    import mongomock
+    import pymongo
+    import pymongo.errors
+    import sendgrid
+
+    os.environ.setdefault('sendgrid_api_key', 'benchmark')
+    os.environ.setdefault('mongodb_server_url', 'mongodb://benchmark')
+
+    # One in-memory DB, whatever connects to it
+    client = mongomock.MongoClient()
+    client.close = lambda: None
+    pymongo.MongoClient = lambda *args, **kwargs: client
+
+    def no_change_streams(*args, **kwargs):
+        raise pymongo.errors.OperationFailure('Change streams are not supported')       # as on a standalone mongod
+    mongomock.collection.Collection.watch = no_change_streams
+    sendgrid.SendGridAPIClient = StubSendGrid
+
+    import main
+    from fastapi.testclient import TestClient
+
+    load_config = main.load_config
+
+    def benchmark_config():
+        load_config()
+        main.CONFIG_DATA['device_rate_limit_per_sec'] = 0
+    main.load_config = benchmark_config
+    main.TRACE_MESSAGE_PROCESSING = False
+
+    test_client = TestClient(main.app)
+    test_client.__enter__()
+    while not main.READINESS['ready']:
+        time.sleep(0.01)
+    return main, test_client
+
+
+def wipe(main):
+    """
+    Empty the in-memory DB and the server's in-memory state, so each benchmark starts afresh.
+    """
+    db = main.get_db()
+    for collection_name in db.list_collection_names():
+        db[collection_name].delete_many({})
+    main.SCHEDULER.cancel_where(lambda key: True)
+    main.FLEET_SUMMARY.invalidate()
+
+
+def scenario_readings(scenario, num_readings):
+    """
+    The readings for a scenario, in the order they are posted.
+
+    Args:
+        scenario (str):       One of SCENARIOS
+        num_readings (int):   Number of readings
+
+    Returns:
+        List of dicts, as posted to readings/
+    """
+    readings = []
+
+    def add(dev_id, temp, humidity):
+        minute = len(readings)
+        readings.append({'dev_id': 'bench_{}'.format(dev_id),
+                         'ts': '2020-06-{:02d}T{:02d}:{:02d}:00Z'.format(1 + minute // 1440, (minute // 60) % 24,
+                                                                        minute % 60),
+                         'temp': temp,
+                         'humidity': humidity})
+
+    if scenario == 'steady':
+        for i in range(num_readings):
+            add(i % 20, 66 + i % 4, 42 + i % 7)
+    elif scenario == 'storm':
+        # Every device sends 4 readings in range, then 4 out of range; the last round raises all the alerts
+        num_devices = max(num_readings // 8, 1)
+        for temp in [68] * 4 + [80] * 4:
+            for dev_id in range(num_devices):
+                add(dev_id, temp, 45)
+    else:
+        for i in range(num_readings):
+            add(i % 5, 80 if (i // 5) % 8 < 4 else 68, 45)
+    return readings[:num_readings]
+
+
+def time_calls(func, items):
+    """
+    Call func on each item, timing each call.
+
+    Returns:
+        List of seconds per call
+    """
+    samples = []
+    for item in items:
+        started = time.perf_counter()
+        func(item)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def benchmarks(main, test_client, num_readings):
+    """
+    The benchmarks, as (name, setup, func, items) tuples; setup() is run before each run, then func(item)
+    timed for each item.
+    """
+    import datetime
+    import device_state
+
+    def alert_rule(states):
+        def evaluate(reading):
+            now = datetime.datetime.now()
+            type_updates = main.DEVICE_CONFIG.rules(reading['dev_id']).type_updates(
+                {'temp': reading['temp'], 'humidity': reading['humidity']}, 1, now)
+            state = states.setdefault(reading['dev_id'], {'dev_id': reading['dev_id']})
+            device_state.evaluate_reading(state, now.strftime(main.TIMESTAMP_FORMAT), type_updates)
+        return evaluate
+
+    def alert_handlers(dev_id):
+        db = main.get_db()
+        alert = device_state.new_alert(datetime.datetime.now().strftime(main.TIMESTAMP_FORMAT), 80)
+        main.handle_alert_raised(db, dev_id, 'temp', alert)
+        main.handle_alert_cleared(db, dev_id, 'temp', alert, 68)
+
+    def post_readings(reading):
+        main.post_readings(main.ReadingsMsgBody(**reading), traceparent=None)
+
+    def http_post_readings(reading):
+        response = test_client.post('/readings/', json=reading)
+        assert response.status_code == 200, response.text
+
+    states = {}
+    result = [('validate', lambda: None, lambda reading: main.ReadingsMsgBody(**reading),
+               scenario_readings('steady', num_readings))]
+    for scenario in SCENARIOS:
+        result.append(('alert_rule/' + scenario, states.clear, alert_rule(states), scenario_readings(scenario, num_readings)))
+    result.append(('alert_handlers', lambda: wipe(main), alert_handlers,
+                   ['bench_{}'.format(i % 20) for i in range(max(num_readings // 10, 1))]))
+    for scenario in SCENARIOS:
+        result.append(('post_readings/' + scenario, lambda: wipe(main), post_readings,
+                       scenario_readings(scenario, num_readings)))
+    for scenario in SCENARIOS:
+        result.append(('http/' + scenario, lambda: wipe(main), http_post_readings,
+                       scenario_readings(scenario, num_readings)))
+    return result
+
+
+def summarize(samples):
+    """
+    Returns:
+        Dict of median and p95 microseconds per call, and calls per second
+    """
+    ordered = sorted(samples)
+    return {'median_us': statistics.median(ordered) * 1e6,
+            'p95_us': ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1e6,
+            'ops_per_sec': len(ordered) / sum(ordered)}
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with a baseline.
+
+    Args:
+        results (dict):       Benchmark name -> summarize() dict
+        baseline (dict):      The same, for the baseline
+        threshold (float):    Max fractional increase in median time; e.g. 0.2 for 20%
+
+    Returns:
+        Dict of benchmark name -> fractional change in median time, and list of the names that regressed
+    """
+    changes = {}
+    regressions = []
+    for name, result in results.items():
+        if name in baseline:
+            changes[name] = result['median_us'] / baseline[name]['median_us'] - 1
+            if changes[name] > threshold:
+                regressions.append(name)
+    return changes, regressions
+
+
+if __name__ == '__main__':
+    my_parser = argparse.ArgumentParser(description='Micro-benchmarks for the server hot path, against an in-memory DB')
+    my_parser.add_argument('-n', '--runs', type=int, default=3, help='number of runs of each benchmark (default 3)')
+    my_parser.add_argument('--readings', type=int, default=1000, help='readings per run (default 1000)')
+    my_parser.add_argument('-b', '--benchmark', action='append', help='only benchmarks starting with this; may be repeated')
+    my_parser.add_argument('--baseline', default=DEFAULT_BASELINE_FILE, help='baseline file (default benchmark_baseline.json)')
+    my_parser.add_argument('--save-baseline', action='store_true', help='save the results as the baseline')
+    my_parser.add_argument('--threshold', type=float, default=0.2,
+                           help='max fractional increase in median time before a regression (default 0.2)')
+    args = my_parser.parse_args()
+
+    main, test_client = start_in_memory_server()
+    results = {}
+    for name, setup, func, items in benchmarks(main, test_client, args.readings):
+        if args.benchmark and not any(name.startswith(prefix) for prefix in args.benchmark):
+            continue
+        samples = []
+        emails_before = StubSendGrid.num_sent
+        for run in range(args.runs):
+            setup()
+            samples.extend(time_calls(func, items))
+        results[name] = dict(summarize(samples), emails_per_run=(StubSendGrid.num_sent - emails_before) // args.runs)
+    test_client.__exit__(None, None, None)
+
+    baseline = {}
+    if (not args.save_baseline) and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    changes, regressions = compare(results, baseline, args.threshold)
+
+    print('{:<24} {:>12} {:>12} {:>12} {:>8} {:>10}'.format('benchmark', 'ops/sec', 'median us', 'p95 us', 'emails',
+                                                         'vs base'))
+    for name, result in results.items():
+        print('{:<24} {:>12.0f} {:>12.1f} {:>12.1f} {:>8} {:>10}{}'.format(
+            name, result['ops_per_sec'], result['median_us'], result['p95_us'], result['emails_per_run'],
+            '{:+.1%}'.format(changes[name]) if name in changes else '-', '  REGRESSION' if name in regressions else ''))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Baseline saved to {}'.format(args.baseline))
+    elif regressions:
+        print('{} regression(s) beyond {:.0%}: {}'.format(len(regressions), args.threshold, ', '.join(regressions)))
+        sys.exit(1)
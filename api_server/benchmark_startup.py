@@ -0,0 +1,160 @@
+# benchmark_startup.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Startup time benchmark for the server, for tuning how fast a new worker can start
+serving. For each run it measures:
+
+    import        seconds to import main.py, in a fresh interpreter
+    live          seconds from starting uvicorn until the liveness probe (GET live/) answers
+    ready         seconds from starting uvicorn until the readiness probe (GET ready/) answers 200
+    first GET     latency of the first GET readings/counts/ once ready
+    warm GET      median latency of the next few
+    first POST    latency of the first POST readings/ once ready (readings for device
+                  'startup_benchmark', deleted again afterwards)
+    warm POST     median latency of the next few
+
+The server runs on localhost, with the same environment variables as usual (so the
+ready / first request times include reaching the real database). It can be run as:
+
+    python benchmark_startup.py [-n <runs>] [--port <port>] [--import-only] [--max-first-request-ms 50]
+
+Once ready, the first requests should cost about what later ones do; anything still
+being imported or connected on first use (rather than by the warm-up) shows up as the
+difference. If a first request is more than --max-first-request-ms slower than the warm
+ones, in any run, it is reported and the exit status is 1.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import requests
+
+
+BENCHMARK_DEV_ID = 'startup_benchmark'
+NUM_WARM_REQUESTS = 5
+
+
+def time_import():
+    """
+    Seconds to import main.py in a fresh interpreter; measured inside it, so interpreter startup
+    is not included.
+    """
+    code = 'import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)'
+    output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def wait_for(url, started, timeout, status_code=200):
+    """
+    Poll a URL until it answers with the given status; returns the seconds since started.
+    """
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == status_code:
+                return time.perf_counter() - started
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.005)
+    raise TimeoutError('{} did not answer {} within {}s'.format(url, status_code, timeout))
+
+
+def time_request(method, url, **kwargs):
+    """
+    Send a request, which must succeed; returns its latency in seconds.
+    """
+    started = time.perf_counter()
+    response = requests.request(method, url, **kwargs)
+    latency = time.perf_counter() - started
+    assert response.status_code == 200, response.text
+    return latency
+
+
+def slow_first_requests(times, max_first_request_ms):
+    """
+    The first requests of a run more than max_first_request_ms slower than the warm ones.
+
+    Returns:
+        List of messages; empty if there are none
+    """
+    messages = []
+    for method in ['GET', 'POST']:
+        extra_ms = (times['first ' + method] - times['warm ' + method]) * 1000
+        if extra_ms > max_first_request_ms:
+            messages.append('first {} took {:.1f}ms longer than the warm ones'.format(method, extra_ms))
+    return messages
+
+
+def time_server(port, timeout):
+    """
+    Start the server and time it up to its first requests.
+
+    Returns:
+        Dict of the times, in seconds
+    """
+    base_url = 'http://127.0.0.1:{}'.format(port)
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-W', 'ignore', '-m', 'uvicorn', '--port', str(port), '--log-level',
+                               'warning', 'main:app'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL)
+    try:
+        times = {'live': wait_for(base_url + '/live/', started, timeout),
+                 'ready': wait_for(base_url + '/ready/', started, timeout)}
+
+        latencies = [time_request('get', base_url + '/readings/counts/', params={'dev-id': BENCHMARK_DEV_ID})
+                     for _ in range(NUM_WARM_REQUESTS + 1)]
+        times['first GET'], times['warm GET'] = latencies[0], statistics.median(latencies[1:])
+
+        reading = {'dev_id': BENCHMARK_DEV_ID,
+                   'ts': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'temp': 68,
+                   'humidity': 45}
+        latencies = [time_request('post', base_url + '/readings/', json=reading) for _ in range(NUM_WARM_REQUESTS + 1)]
+        times['first POST'], times['warm POST'] = latencies[0], statistics.median(latencies[1:])
+
+        requests.delete(base_url + '/readings/', params={'dev-id': BENCHMARK_DEV_ID})
+        return times
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def print_summary(name, samples):
+    print('{:<12} min {:8.1f}ms   median {:8.1f}ms   max {:8.1f}ms'.format(
+        name, min(samples) * 1000, statistics.median(samples) * 1000, max(samples) * 1000))
+
+
+if __name__ == '__main__':
+    my_parser = argparse.ArgumentParser(description='Time server startup: import, liveness, readiness and first requests')
+    my_parser.add_argument('-n', '--runs', type=int, default=5, help='number of runs (default 5)')
+    my_parser.add_argument('--port', type=int, default=8765, help='port to run the server on (default 8765)')
+    my_parser.add_argument('--timeout', type=float, default=60, help='max seconds to wait for the server (default 60)')
+    my_parser.add_argument('--import-only', action='store_true', help='only time the import; needs no database')
+    my_parser.add_argument('--max-first-request-ms', type=float, default=50,
+                           help='max ms a first request may take over the warm ones (default 50)')
+    args = my_parser.parse_args()
+
+    results = {}
+    slow = []
+    for run in range(args.runs):
+        results.setdefault('import', []).append(time_import())
+        if not args.import_only:
+            times = time_server(args.port, args.timeout)
+            for name, secs in times.items():
+                results.setdefault(name, []).append(secs)
+            slow.extend('run {}: {}'.format(run + 1, message)
+                        for message in slow_first_requests(times, args.max_first_request_ms))
+
+    print('{} runs'.format(args.runs))
+    for name, samples in results.items():
+        print_summary(name, samples)
+    if slow:
+        print('First requests more than {:g}ms slower than the warm ones:'.format(args.max_first_request_ms))
+        for message in slow:
+            print('  ' + message)
+        sys.exit(1)
@@ -0,0 +1,298 @@
+# config_store.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Per-device configuration (alert thresholds, renotification delay, offline timeout,
+email addresses). Each metric of metrics.py has its own range settings.
+
+Devices run in rooms with different targets, so any of the DEVICE_CONFIG_KEYS settings
+can be overridden per device. Overrides are stored in the device_config collection,
+one doc per device; a doc with dev_id DEFAULTS_DEV_ID overrides the global defaults
+(which otherwise come from the server's CONFIG_DATA).
+
+The whole collection is small, so it is held in memory as a snapshot of fully merged
+per-device configs; looking up a device's config on the ingest path is a dict lookup
+and never touches the DB. The snapshot is rebuilt in the background whenever the
+collection changes (via a MongoDB change stream, where the server supports them) and
+in any case every ttl_secs, so changes made by another server process are picked up
+without a restart. Each config is compiled into its alert rules (see
+device_state.AlertRules) as the snapshot is built, so readings never recompile them.
+"""
+
+import threading
+import time
+from device_state import AlertRules
+from metrics import METRICS, metric_config_keys
+
+
+# Settings that may be overridden per device, with their types. The per-metric settings may be left
+#  unset (None); a metric without a range does not alert
+GENERAL_CONFIG_KEYS = {'num_continuous_readings_to_check': int,
+                       'alert_renotification_delay': int,
+                       'device_offline_minutes': int,
+                       'device_heartbeat_minutes': int,
+                       'email_from': str,
+                       'email_to': str}
+DEVICE_CONFIG_KEYS = dict(GENERAL_CONFIG_KEYS, **metric_config_keys())
+
+DEFAULTS_DEV_ID = '*'       # dev_id of the doc overriding the global defaults
+
+
+def validate_config(config):
+    """
+    Check a (merged) config makes sense.
+
+    Args:
+        config (dict):    Config to check
+
+    Raises:
+        ValueError describing the first problem found
+    """
+    for key, value in config.items():
+        if key not in DEVICE_CONFIG_KEYS:
+            raise ValueError('Unknown config setting \'{}\''.format(key))
+        if value is None:
+            continue
+        expected_type = (int, float) if DEVICE_CONFIG_KEYS[key] is float else DEVICE_CONFIG_KEYS[key]
+        if not isinstance(value, expected_type):
+            raise ValueError('Config setting \'{}\' must be of type {}'.format(key, DEVICE_CONFIG_KEYS[key].__name__))
+    for reading_type in METRICS:
+        range_min = config.get('{}_range_min'.format(reading_type))
+        range_max = config.get('{}_range_max'.format(reading_type))
+        hysteresis = config.get('{}_hysteresis'.format(reading_type)) or 0
+        if (range_min is None) != (range_max is None):
+            raise ValueError('{}_range_min and {}_range_max must be set together'.format(reading_type, reading_type))
+        if (range_min is not None) and (range_max is not None) and (range_min > range_max):
+            raise ValueError('{}_range_min must not be greater than {}_range_max'.format(reading_type, reading_type))
+        if hysteresis < 0:
+            raise ValueError('{}_hysteresis must not be negative'.format(reading_type))
+        if (range_min is not None) and (range_max is not None) and (range_min + hysteresis > range_max - hysteresis):
+            raise ValueError('{}_hysteresis must leave some of the range to clear alerts in'.format(reading_type))
+        num_readings = config.get('{}_num_readings'.format(reading_type))
+        if (num_readings is not None) and (num_readings < 1):
+            raise ValueError('{}_num_readings must be at least 1'.format(reading_type))
+    if config.get('num_continuous_readings_to_check', 1) < 1:
+        raise ValueError('num_continuous_readings_to_check must be at least 1')
+    if config.get('alert_renotification_delay', 0) < 0:
+        raise ValueError('alert_renotification_delay must not be negative')
+    if config.get('device_offline_minutes', 0) < 0:
+        raise ValueError('device_offline_minutes must not be negative')
+    # A device in deadband mode may go a whole heartbeat interval between readings, and the offline timer is
+    #  armed as the previous reading is processed, so a timeout near the interval races the heartbeat
+    offline_minutes, heartbeat_minutes = config.get('device_offline_minutes'), config.get('device_heartbeat_minutes')
+    if offline_minutes and heartbeat_minutes and (offline_minutes < 2 * heartbeat_minutes):
+        raise ValueError('device_offline_minutes must be 0 or at least twice device_heartbeat_minutes')
+
+
+class DeviceConfigStore:
+    """
+    In-memory, hot-reloadable per-device config; see the module docstring.
+    """
+
+    def __init__(self, defaults, ttl_secs=60):
+        """
+        Args:
+            defaults (dict):      Global defaults; only the DEVICE_CONFIG_KEYS settings are used, and
+                                  the per-metric ones may be left out
+            ttl_secs (float):     Max seconds between full refreshes of the snapshot
+        """
+        self.base_defaults = {key: defaults[key] if key in GENERAL_CONFIG_KEYS else defaults.get(key)
+                              for key in DEVICE_CONFIG_KEYS}
+        self.ttl_secs = ttl_secs
+
+        # The snapshot; replaced as a whole, never modified, so readers need no lock
+        self.defaults = dict(self.base_defaults)
+        self.overrides = {}         # dev_id -> that device's override doc (without dev_id / _id)
+        self.configs = {}           # dev_id -> merged config; only for devices with overrides
+        self.default_rules = AlertRules(self.defaults)
+        self.device_rules = {}      # dev_id -> AlertRules of its merged config; only for devices with overrides
+        self.loaded_at = None
+
+        self.load_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def get(self, dev_id):
+        """
+        Effective config for a device. The returned dict must not be modified.
+
+        Args:
+            dev_id (str):     Device ID
+
+        Returns:
+            Dict of setting -> value, for every DEVICE_CONFIG_KEYS setting
+        """
+        return self.configs.get(dev_id, self.defaults)
+
+    def rules(self, dev_id):
+        """
+        The alert rules compiled from a device's effective config.
+
+        Args:
+            dev_id (str):     Device ID
+
+        Returns:
+            device_state.AlertRules
+        """
+        return self.device_rules.get(dev_id, self.default_rules)
+
+    def get_overrides(self, dev_id):
+        """
+        The settings overridden for a device (or for the defaults, if dev_id is DEFAULTS_DEV_ID).
+
+        Returns:
+            Dict of setting -> value; empty if none are overridden
+        """
+        return dict(self.overrides.get(dev_id, {}))
+
+    def load(self, db):
+        """
+        Rebuild the snapshot from the device_config collection.
+
+        Args:
+            db:       Connection to our MongoDB database
+
+        Returns:
+            None
+        """
+        with self.load_lock:
+            overrides = {}
+            for doc in db.device_config.find({}, {'_id': False}):
+                dev_id = doc.pop('dev_id')
+                overrides[dev_id] = {key: value for key, value in doc.items() if key in DEVICE_CONFIG_KEYS}
+
+            defaults = dict(self.base_defaults, **overrides.get(DEFAULTS_DEV_ID, {}))
+            configs = {dev_id: dict(defaults, **values) for dev_id, values in overrides.items()
+                       if dev_id != DEFAULTS_DEV_ID}
+
+            default_rules = AlertRules(defaults)
+            device_rules = {dev_id: AlertRules(config) for dev_id, config in configs.items()}
+
+            self.defaults, self.overrides, self.configs = defaults, overrides, configs
+            self.default_rules, self.device_rules = default_rules, device_rules
+            self.loaded_at = time.time()
+
+    def set_overrides(self, db, dev_id, values):
+        """
+        Add to / change the settings overridden for a device (or the defaults, if dev_id is
+        DEFAULTS_DEV_ID). A value of None removes that override.
+
+        Args:
+            db:               Connection to our MongoDB database
+            dev_id (str):     Device ID
+            values (dict):    Setting -> value
+
+        Returns:
+            The device's effective config after the change
+
+        Raises:
+            ValueError if the change would leave the config invalid; nothing is changed
+        """
+        overrides = dict(self.overrides.get(dev_id, {}), **values)
+        overrides = {key: value for key, value in overrides.items() if value is not None}
+        if dev_id == DEFAULTS_DEV_ID:
+            # New defaults must also make sense for every device overriding only some settings
+            defaults = dict(self.base_defaults, **overrides)
+            validate_config(defaults)
+            for device_dev_id, device_overrides in self.overrides.items():
+                if device_dev_id != DEFAULTS_DEV_ID:
+                    validate_config(dict(defaults, **device_overrides))
+        else:
+            validate_config(dict(self.defaults, **overrides))
+
+        update = {}
+        to_set = {key: value for key, value in values.items() if value is not None}
+        to_unset = {key: '' for key, value in values.items() if value is None}
+        if to_set:
+            update['$set'] = to_set
+        if to_unset:
+            update['$unset'] = to_unset
+        if update:
+            db.device_config.update_one({'dev_id': dev_id}, update, upsert=True)
+
+        # Apply here and now rather than waiting on the background refresh
+        self.load(db)
+        return self.get(dev_id) if dev_id != DEFAULTS_DEV_ID else self.defaults
+
+    def delete_overrides(self, db, dev_id):
+        """
+        Remove all of a device's overrides; it goes back to using the defaults.
+
+        Returns:
+            Number of docs deleted
+        """
+        num_deleted = db.device_config.delete_many({'dev_id': dev_id}).deleted_count
+        self.load(db)
+        return num_deleted
+
+    def start(self, mongodb_url, database_name):
+        """
+        Load the snapshot, then start the background thread keeping it up to date.
+
+        Args:
+            mongodb_url (str):        MongoDB connection string
+            database_name (str):      Name of our database
+
+        Returns:
+            None
+        """
+        import pymongo      # imported on first use; see the note on imports in main.py
+        mongodb = pymongo.MongoClient(mongodb_url)
+        self.load(mongodb[database_name])
+        mongodb.close()
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(mongodb_url, database_name),
+                                       name='device_config_refresh', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self, mongodb_url, database_name):
+        """
+        Background thread; reloads on change notifications and at least every ttl_secs.
+        """
+        import pymongo.errors
+        mongodb = pymongo.MongoClient(mongodb_url)
+        db = mongodb[database_name]
+        use_change_stream = True
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    if use_change_stream:
+                        self.watch_changes(db)
+                    else:
+                        self.stop_event.wait(self.ttl_secs)
+                        self.load(db)
+                except pymongo.errors.OperationFailure:
+                    # Change streams need a replica set (Atlas always is one); poll on the TTL instead
+                    use_change_stream = False
+                except pymongo.errors.PyMongoError:
+                    # Lost the DB for a bit; keep serving the snapshot we have and try again later
+                    self.stop_event.wait(self.ttl_secs)
+        finally:
+            mongodb.close()
+
+    def watch_changes(self, db):
+        """
+        Reload whenever the device_config collection changes, and every ttl_secs regardless.
+        Returns when stopped, or raises if the change stream fails.
+        """
+        with db.device_config.watch(max_await_time_ms=1000) as stream:
+            # Reload after opening the stream, so no change can slip in between
+            self.load(db)
+            next_refresh = time.monotonic() + self.ttl_secs
+            while (not self.stop_event.is_set()) and stream.alive:
+                change = stream.try_next()
+                if (change is not None) or (time.monotonic() >= next_refresh):
+                    # Drain whatever else is pending; one reload covers the lot
+                    while (change is not None) and stream.alive:
+                        change = stream.try_next()
+                    self.load(db)
+                    next_refresh = time.monotonic() + self.ttl_secs
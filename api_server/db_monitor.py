@@ -0,0 +1,234 @@
+# db_monitor.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+MongoDB command monitoring. A pymongo CommandListener times every command the driver
+sends and keeps a latency histogram per (collection, command, query shape), so we can
+see which of the several queries made per reading is the expensive one. Commands
+slower than a threshold are also logged, with the shape of their filter (field names
+and operators) but never the values.
+
+The listener is registered globally with pymongo.monitoring.register(), so it covers
+every MongoClient created afterwards. Given a tenant_func, the stats are also kept
+per tenant (see tenants.py), so one tenant's slow queries can be told from another's.
+Each operation also counts the servers its commands went to, which shows whether reads
+sent to secondaries (see the read_preference setting in main.py) actually go there.
+"""
+
+import collections
+import datetime
+import json
+import threading
+import pymongo.monitoring
+
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is everything slower
+LATENCY_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# Fields of each command holding its query, and whether they are lists of statements (update / delete)
+COMMAND_QUERY_FIELDS = {'find': ['filter', 'sort'],
+                        'aggregate': ['pipeline'],
+                        'findAndModify': ['query', 'sort'],
+                        'count': ['query'],
+                        'distinct': ['key', 'query'],
+                        'update': ['updates'],
+                        'delete': ['deletes']}
+
+MAX_DISTINCT_SHAPES = 1000      # beyond this, new shapes are lumped together as '(other)'
+
+
+def server_name(connection_id):
+    """
+    A command's server as 'host:port', from its event's connection_id (a (host, port) tuple).
+    """
+    if isinstance(connection_id, (list, tuple)) and (len(connection_id) == 2):
+        return '{}:{}'.format(*connection_id)
+    return str(connection_id)
+
+
+def value_shape(value, keep_values=False):
+    """
+    The shape of a query; the same structure with every value replaced by '?'.
+
+    Args:
+        value:                The query, or part of it
+        keep_values (bool):   Keep scalar values; used for sort specs, which hold no data
+
+    Returns:
+        The shape
+    """
+    if isinstance(value, dict):
+        return {key: value_shape(item, keep_values or key in ('$sort', 'sort')) for key, item in value.items()}
+    elif isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, dict) for item in value):
+            return [value_shape(item, keep_values) for item in value]       # e.g. pipeline stages, $or clauses
+        return ['?'] if value else []                                       # e.g. $in lists
+    elif keep_values:
+        return value
+    return '?'
+
+
+def command_shape(command_name, command):
+    """
+    The shape of a command's query, as a string; '' for commands without one (e.g. insert).
+    """
+    shape = {}
+    for field in COMMAND_QUERY_FIELDS.get(command_name, []):
+        if field not in command:
+            continue
+        if field in ('updates', 'deletes'):
+            statements = command[field]
+            if statements:
+                shape['q'] = value_shape(statements[0].get('q', {}))
+        elif field == 'key':
+            shape[field] = command[field]       # a field name
+        else:
+            shape[field] = value_shape(command[field], keep_values=(field == 'sort'))
+    return json.dumps(shape, default=str) if shape else ''
+
+
+class OperationStats:
+    """
+    Latency histogram for one (collection, command, shape).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.num_failed = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.servers = collections.Counter()   # 'host:port' -> number of commands sent to it
+
+    def add(self, duration_ms, failed, server=None):
+        self.count += 1
+        if server is not None:
+            self.servers[server] += 1
+        self.num_failed += 1 if failed else 0
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if duration_ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, p):
+        """
+        Estimated percentile; the upper bound of the bucket it falls in (max for the last bucket).
+        """
+        target = p / 100.0 * self.count
+        running = 0
+        for i, count in enumerate(self.buckets):
+            running += count
+            if (running >= target) and (count > 0):
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def summary(self):
+        return {'count': self.count,
+                'failed': self.num_failed,
+                'total_ms': round(self.total_ms, 3),
+                'mean_ms': round(self.total_ms / self.count, 3) if self.count else None,
+                'p50_ms': self.percentile(50),
+                'p95_ms': self.percentile(95),
+                'p99_ms': self.percentile(99),
+                'max_ms': round(self.max_ms, 3),
+                'servers': dict(self.servers),
+                'histogram': {('<={}'.format(bound) if i < len(LATENCY_BUCKETS_MS) else
+                               '>{}'.format(LATENCY_BUCKETS_MS[-1])): count
+                              for i, (bound, count) in enumerate(zip(LATENCY_BUCKETS_MS + [None], self.buckets))
+                              if count > 0}}
+
+
+class CommandMonitor(pymongo.monitoring.CommandListener):
+    """
+    Command listener collecting the stats; see the module docstring.
+    """
+
+    def __init__(self, slow_op_ms=100, slow_op_log_size=100, verbose=True, tenant_func=None):
+        """
+        Args:
+            slow_op_ms (float):       Commands taking longer than this are logged
+            slow_op_log_size (int):   Number of the most recent slow commands kept
+            verbose (bool):           If True, slow commands are also printed
+            tenant_func:              Returns the tenant a command is for; called on the thread sending it.
+                                      None to not tag the stats with a tenant
+        """
+        self.slow_op_ms = slow_op_ms
+        self.verbose = verbose
+        self.tenant_func = tenant_func
+        self.lock = threading.Lock()
+        self.in_flight = {}             # (connection, request id) -> (tenant, collection, command name, shape)
+        self.stats = {}                 # (tenant, collection, command name, shape) -> OperationStats
+        self.slow_ops = collections.deque(maxlen=slow_op_log_size)
+        self.since = datetime.datetime.now()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.slow_ops.clear()
+            self.since = datetime.datetime.now()
+
+    def started(self, event):
+        command_name = event.command_name
+        if command_name == 'getMore':
+            collection = event.command.get('collection')
+        else:
+            collection = event.command.get(command_name)
+        if not isinstance(collection, str):
+            collection = ''             # e.g. admin commands such as ping / hello
+        tenant = self.tenant_func() if self.tenant_func is not None else None
+        key = (tenant, collection, command_name, command_shape(command_name, event.command))
+        with self.lock:
+            self.in_flight[(event.connection_id, event.request_id)] = key
+
+    def succeeded(self, event):
+        self.finished(event, failed=False)
+
+    def failed(self, event):
+        self.finished(event, failed=True)
+
+    def finished(self, event, failed):
+        duration_ms = event.duration_micros / 1000.0
+        with self.lock:
+            key = self.in_flight.pop((event.connection_id, event.request_id), None)
+            if key is None:
+                return
+            stats = self.stats.get(key)
+            if stats is None:
+                if len(self.stats) >= MAX_DISTINCT_SHAPES:
+                    key = (key[0], key[1], key[2], '(other)')
+                    stats = self.stats.get(key)
+                if stats is None:
+                    stats = self.stats[key] = OperationStats()
+            stats.add(duration_ms, failed, server_name(event.connection_id))
+
+            if duration_ms >= self.slow_op_ms:
+                slow_op = {'ts': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                           'tenant': key[0],
+                           'collection': key[1],
+                           'command': key[2],
+                           'shape': key[3],
+                           'server': server_name(event.connection_id),
+                           'duration_ms': round(duration_ms, 3),
+                           'failed': failed}
+                self.slow_ops.append(slow_op)
+        if (duration_ms >= self.slow_op_ms) and self.verbose:
+            print('SLOW DB OP: {}'.format(json.dumps(slow_op)), flush=True)
+
+    def report(self):
+        """
+        Returns:
+            Dict with the per-operation stats (slowest total time first) and the recent slow operations
+        """
+        with self.lock:
+            operations = [dict(tenant=tenant, collection=collection, command=command_name, shape=shape,
+                               **stats.summary())
+                          for (tenant, collection, command_name, shape), stats in self.stats.items()]
+            slow_ops = list(self.slow_ops)
+            since = self.since
+        operations.sort(key=lambda operation: operation['total_ms'], reverse=True)
+        return {'since': since.strftime('%Y-%m-%dT%H:%M:%S'),
+                'slow_op_ms': self.slow_op_ms,
+                'operations': operations,
+                'slow_ops': slow_ops}
@@ -0,0 +1,451 @@
+# device_state.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Per-device alert state, kept in one device_state doc per device and updated with a
+single atomic find_one_and_update() per reading.
+
+Deciding whether to raise, continue, renotify or clear an alert used to take a query
+of the device's recent readings plus several active_alerts lookups and updates per
+reading (5-8 round trips), and with more than one server process, two readings for
+a device arriving at once could both decide to raise the same alert. Here the state
+doc holds what those queries were for, per reading type:
+
+    <type>_window       flags of the most recent readings, oldest first; true if out of
+                        range, false if in range, null if back in range but not by the
+                        metric's hysteresis (counts towards neither raising nor clearing)
+    <type>_alert        the active alert (originated_ts, notification_ts, max_value,
+                        min_value, last_value, and cause: 'anomaly' if the anomaly detector
+                        raised it and the range check would not have); null if none
+    <type>_stats        the anomaly detector's running statistics, when it is enabled (see
+                        anomaly.py)
+    <type>_transition   what the last update did: 'raised', 'renotified', 'cleared' or null
+    <type>_cleared      the alert cleared by the last update, for its alert history record
+
+plus last_seen, the (server) time of the device's last reading, and an offline_alert
+(raised by the scheduler, cleared by the next reading). The update is an aggregation
+pipeline, so the new flags are appended, the alert rule evaluated and the alert
+updated by the DB itself, atomically, and the doc comes back with the transitions
+to act on. Each transition is seen by exactly one request, whatever the number of
+server processes, so exactly one alert and one email result.
+
+The pipeline sticks to expression operators common to MongoDB 4.2+ (pipeline updates).
+
+evaluate_reading() applies the same update to a state doc held in memory, for the
+sharded ingest workers (see ingest_workers.py), each of which owns its devices' state.
+
+The reading types are the metrics of metrics.py; a reading updates the state of those
+it carries. AlertRules compiles a device's config into the per-metric rules once, so a
+reading's updates for all its metrics are worked out in one pass.
+"""
+
+import datetime
+from metrics import METRICS
+
+
+STATE_READING_TYPES = list(METRICS)             # evaluated per reading; 'offline' is handled by the scheduler
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+MIN_WINDOW_SIZE = 32        # flags kept per type; more than needed, so num_continuous_readings_to_check can be raised
+                            #  without losing history
+
+
+def window_flags(out_of_range, repeat_count, num_readings):
+    """
+    The flags to append to a window for one reading message.
+
+    Args:
+        out_of_range (bool):  Whether the reading is out of range; None within the hysteresis (see range_flag())
+        repeat_count (int):   Number of readings the message stands for (see ReadingsMsgBody)
+        num_readings (int):   Number of continuous readings to check
+
+    Returns:
+        List of flags
+    """
+    return [out_of_range] * min(repeat_count, max(num_readings, MIN_WINDOW_SIZE))
+
+
+def metric_rule(config, metric):
+    """
+    A metric's alert rule settings, from a device's config.
+
+    Args:
+        config (dict):    The device's config (see config_store.py)
+        metric (str):     Metric name; see metrics.py
+
+    Returns:
+        Dict with range_min, range_max, clear_min, clear_max (the range a reading must be in to count
+        towards clearing; the range narrowed by the hysteresis) and num_readings; None if the config
+        has no range for the metric
+    """
+    range_min = config.get('{}_range_min'.format(metric))
+    range_max = config.get('{}_range_max'.format(metric))
+    if (range_min is None) or (range_max is None):
+        return None
+    hysteresis = config.get('{}_hysteresis'.format(metric)) or 0
+    return {'range_min': range_min,
+            'range_max': range_max,
+            'clear_min': range_min + hysteresis,
+            'clear_max': range_max - hysteresis,
+            'num_readings': config.get('{}_num_readings'.format(metric)) or config['num_continuous_readings_to_check']}
+
+
+def range_flag(rule, value):
+    """
+    A reading's window flag; True if out of range, False if in range, None if in range but within
+    the hysteresis of its edge.
+    """
+    if (value < rule['range_min']) or (value > rule['range_max']):
+        return True
+    if (value < rule['clear_min']) or (value > rule['clear_max']):
+        return None
+    return False
+
+
+def type_update(config, reading_type, current_value, repeat_count, now, anomaly=None):
+    """
+    What a reading contributes to its device's state doc for one reading type. AlertRules does the
+    same for all of a reading's metrics at once.
+
+    Args:
+        config (dict):                The device's config (see config_store.py)
+        reading_type (str):           Type of reading; a metric of metrics.py with a range in the config
+        current_value (int):          The reading's value
+        repeat_count (int):           Number of readings the message stands for (deadband heartbeats)
+        now (datetime):               Current time
+        anomaly (AnomalyDetector):    If given, the anomaly detector weighs in too (see anomaly.py)
+
+    Returns:
+        Dict for reading_update() / evaluate_reading()
+    """
+    rule = metric_rule(config, reading_type)
+    renotify_before = now - datetime.timedelta(minutes=config['alert_renotification_delay'])
+    return {'flags': window_flags(range_flag(rule, current_value), repeat_count, rule['num_readings']),
+            'value': current_value,
+            'num_readings': rule['num_readings'],
+            'anomaly': anomaly,
+            'renotify_before': renotify_before.strftime(TIMESTAMP_FORMAT)}
+
+
+class AlertRules:
+    """
+    A device's alert rules for every metric, compiled from its config once (see
+    config_store.DeviceConfigStore.rules()) rather than looked up setting by setting for each
+    metric of each reading.
+    """
+
+    def __init__(self, config):
+        """
+        Args:
+            config (dict):    The device's config (see config_store.py)
+        """
+        self.renotification_delay = datetime.timedelta(minutes=config['alert_renotification_delay'])
+        self.rules = []         # (metric, range_min, range_max, clear_min, clear_max, num_readings, max_flags)
+        for metric in STATE_READING_TYPES:
+            rule = metric_rule(config, metric)
+            if rule is not None:
+                self.rules.append((metric, rule['range_min'], rule['range_max'], rule['clear_min'], rule['clear_max'],
+                                   rule['num_readings'], max(rule['num_readings'], MIN_WINDOW_SIZE)))
+
+    def type_updates(self, values, repeat_count, now, anomaly=None):
+        """
+        What a reading contributes to its device's state doc; the same as type_update() for each metric
+        the reading carries that has a rule.
+
+        Args:
+            values (dict):        Metric -> the reading's value
+            repeat_count (int):   Number of readings the message stands for (deadband heartbeats)
+            now (datetime):       Current time
+            anomaly:              If given, the AnomalyDetector; it weighs in too (see anomaly.py)
+
+        Returns:
+            Dict of metric -> dict, for reading_update() / evaluate_reading()
+        """
+        renotify_before = (now - self.renotification_delay).strftime(TIMESTAMP_FORMAT)
+        updates = {}
+        for metric, range_min, range_max, clear_min, clear_max, num_readings, max_flags in self.rules:
+            value = values.get(metric)
+            if value is None:
+                continue
+            if (value < range_min) or (value > range_max):
+                flag = True
+            elif (value < clear_min) or (value > clear_max):
+                flag = None
+            else:
+                flag = False
+            updates[metric] = {'flags': [flag] * min(repeat_count, max_flags),
+                               'value': value,
+                               'num_readings': num_readings,
+                               'anomaly': anomaly,
+                               'renotify_before': renotify_before}
+        return updates
+
+
+def reading_update(now_ts, type_updates):
+    """
+    Build the pipeline update applying one reading to a device's state doc.
+
+    Args:
+        now_ts (str):         Current timestamp; stored as last_seen and alert timestamps
+        type_updates (dict):  Reading type -> dict with:
+                                flags (list):             from window_flags()
+                                value (int):              the reading's value
+                                num_readings (int):       number of continuous readings to check
+                                anomaly (AnomalyDetector):  None unless the anomaly detector weighs in
+                                renotify_before (str):    timestamp; renotify if the last notification
+                                                          was at or before this
+
+    Returns:
+        List of pipeline stages, for update_one() / find_one_and_update()
+    """
+    # Stage 1: append the new flags; missing alerts become null so they compare equal to None below
+    normalize = {'last_seen': now_ts,
+                 'offline_alert': {'$ifNull': ['$offline_alert', None]}}
+    for reading_type, update in type_updates.items():
+        window_size = max(update['num_readings'], MIN_WINDOW_SIZE)
+        normalize['{}_window'.format(reading_type)] = \
+            {'$slice': [{'$concatArrays': [{'$ifNull': ['${}_window'.format(reading_type), []]}, update['flags']]},
+                        -window_size]}
+        normalize['{}_alert'.format(reading_type)] = {'$ifNull': ['${}_alert'.format(reading_type), None]}
+        if update['anomaly'] is not None:
+            # Scored against, and folded into, the statistics before this reading
+            normalize['{}_stats'.format(reading_type)] = update['anomaly'].stats_update('{}_stats'.format(reading_type),
+                                                                                      update['value'])
+
+    # Stage 2: evaluate the alert rule (see alert_replay.py) and decide the transition
+    range_out, anomalous = {}, {}
+    decide = {'offline_transition': {'$cond': [{'$ne': ['$offline_alert', None]}, 'cleared', None]}}
+    for reading_type, update in type_updates.items():
+        alert = '${}_alert'.format(reading_type)
+        recent = {'$slice': ['${}_window'.format(reading_type), -update['num_readings']]}
+        full_window = {'$gte': [{'$size': recent}, update['num_readings']]}
+        # A null flag (within the hysteresis) counts towards neither
+        range_out[reading_type] = {'$and': [full_window, {'$eq': [{'$in': [False, recent]}, False]},
+                                            {'$eq': [{'$in': [None, recent]}, False]}]}
+        # Until a device has enough readings, treat everything as in range
+        all_out = range_out[reading_type]
+        all_in = {'$or': [{'$eq': [full_window, False]},
+                          {'$and': [{'$eq': [{'$in': [True, recent]}, False]},
+                                    {'$eq': [{'$in': [None, recent]}, False]}]}]}
+        if update['anomaly'] is not None:
+            # An anomalous reading counts as out of range, and until num_readings normal readings have
+            #  followed it, the metric is not in range for long enough to clear; a 'mixed' condition
+            since_anomaly = {'$ifNull': ['${}_stats.since_anomaly'.format(reading_type), -1]}
+            anomalous[reading_type] = {'$eq': [since_anomaly, 0]}
+            recently_anomalous = {'$and': [{'$gte': [since_anomaly, 0]},
+                                           {'$lt': [since_anomaly, update['num_readings']]}]}
+            all_out = {'$or': [anomalous[reading_type], all_out]}
+            all_in = {'$and': [{'$eq': [recently_anomalous, False]}, all_in]}
+        decide['{}_transition'.format(reading_type)] = {'$switch': {
+            'branches': [{'case': {'$and': [all_out, {'$eq': [alert, None]}]}, 'then': 'raised'},
+                         {'case': {'$and': [all_in, {'$ne': [alert, None]}]}, 'then': 'cleared'},
+                         {'case': {'$and': [{'$ne': [alert, None]},
+                                            {'$lte': ['{}.notification_ts'.format(alert), update['renotify_before']]}]},
+                          'then': 'renotified'}],
+            'default': None}}
+
+    # Stage 3: apply the transition to the alert
+    apply = {'offline_cleared': {'$cond': [{'$eq': ['$offline_transition', 'cleared']}, '$offline_alert', None]},
+             'offline_alert': None}
+    for reading_type, update in type_updates.items():
+        alert = '${}_alert'.format(reading_type)
+        transition = '${}_transition'.format(reading_type)
+        apply['{}_cleared'.format(reading_type)] = {'$cond': [{'$eq': [transition, 'cleared']}, alert, None]}
+        cause = None
+        if update['anomaly'] is not None:
+            cause = {'$cond': [{'$and': [anomalous[reading_type], {'$eq': [range_out[reading_type], False]}]},
+                               'anomaly', '$$REMOVE']}
+        apply['{}_alert'.format(reading_type)] = {'$switch': {
+            'branches': [{'case': {'$eq': [transition, 'raised']},
+                          'then': new_alert(now_ts, update['value'], cause)},
+                         {'case': {'$eq': [transition, 'cleared']}, 'then': None},
+                         {'case': {'$ne': [alert, None]},
+                          'then': {'originated_ts': '{}.originated_ts'.format(alert),
+                                   'notification_ts': {'$cond': [{'$eq': [transition, 'renotified']}, now_ts,
+                                                                 '{}.notification_ts'.format(alert)]},
+                                   'max_value': {'$max': ['{}.max_value'.format(alert), update['value']]},
+                                   'min_value': {'$min': ['{}.min_value'.format(alert), update['value']]},
+                                   'last_value': update['value'],
+                                   'cause': '{}.cause'.format(alert)}}],
+            'default': None}}
+
+    return [{'$set': normalize}, {'$set': decide}, {'$set': apply}]
+
+
+def new_alert(now_ts, value, cause=None):
+    """
+    A new active alert, as stored in the state doc. cause is 'anomaly' for an alert raised by the
+    anomaly detector alone; range check (and offline) alerts have none.
+    """
+    alert = {'originated_ts': now_ts,
+             'notification_ts': now_ts,
+             'max_value': value,
+             'min_value': value,
+             'last_value': value}
+    if cause is not None:
+        alert['cause'] = cause
+    return alert
+
+
+def apply_reading(collection, dev_id, now_ts, type_updates):
+    """
+    Apply one reading to a device's state doc; one round trip. The doc is created for a new device.
+
+    Args:
+        collection:           The device_state collection
+        dev_id (str):         Device ID
+        now_ts (str):         Current timestamp
+        type_updates (dict):  See reading_update()
+
+    Returns:
+        List of (reading type, transition, alert) tuples; the alert is the one cleared for 'cleared'
+    """
+    import pymongo      # imported on first use; see the note on imports in main.py
+    projection = {'{}_{}'.format(reading_type, field): False for reading_type in type_updates
+                  for field in ['window', 'stats']}
+    doc = collection.find_one_and_update({'dev_id': dev_id}, reading_update(now_ts, type_updates),
+                                         projection=projection, upsert=True,
+                                         return_document=pymongo.ReturnDocument.AFTER)
+    return transitions(doc, list(type_updates) + ['offline'])
+
+
+def evaluate_reading(state, now_ts, type_updates):
+    """
+    Apply one reading to a state doc held in memory; the same rule as reading_update(), for a
+    process that owns the device. The state is updated in place (the transition fields are not
+    kept; the transitions are returned instead).
+
+    Args:
+        state (dict):         The device's state doc
+        now_ts (str):         Current timestamp
+        type_updates (dict):  See reading_update()
+
+    Returns:
+        List of (reading type, transition, alert) tuples, as for apply_reading()
+    """
+    changes = []
+    state['last_seen'] = now_ts
+    for reading_type, update in type_updates.items():
+        window_size = max(update['num_readings'], MIN_WINDOW_SIZE)
+        window = ((state.get('{}_window'.format(reading_type)) or []) + update['flags'])[-window_size:]
+        state['{}_window'.format(reading_type)] = window
+
+        recent = window[-update['num_readings']:]
+        full_window = len(recent) >= update['num_readings']
+        range_out = full_window and all(flag is True for flag in recent)
+        anomalous, recently_anomalous = False, False
+        if update['anomaly'] is not None:
+            stats = update['anomaly'].update_stats(state.get('{}_stats'.format(reading_type)), update['value'])
+            state['{}_stats'.format(reading_type)] = stats
+            anomalous, recently_anomalous = update['anomaly'].verdict(stats, update['num_readings'])
+        all_out = anomalous or range_out
+        all_in = (not recently_anomalous) and ((not full_window) or all(flag is False for flag in recent))
+
+        alert = state.get('{}_alert'.format(reading_type))
+        if all_out and (alert is None):
+            alert = new_alert(now_ts, update['value'], None if range_out else 'anomaly')
+            changes.append((reading_type, 'raised', alert))
+        elif all_in and (alert is not None):
+            changes.append((reading_type, 'cleared', alert))
+            alert = None
+        elif alert is not None:
+            alert = dict(alert,
+                         max_value=max(value for value in [alert.get('max_value'), update['value']] if value is not None),
+                         min_value=min(value for value in [alert.get('min_value'), update['value']] if value is not None),
+                         last_value=update['value'])
+            if alert['notification_ts'] <= update['renotify_before']:
+                alert['notification_ts'] = now_ts
+                changes.append((reading_type, 'renotified', alert))
+        state['{}_alert'.format(reading_type)] = alert
+
+    if state.get('offline_alert') is not None:
+        changes.append(('offline', 'cleared', state['offline_alert']))
+    state['offline_alert'] = None
+    return changes
+
+
+def transitions(doc, reading_types):
+    """
+    The transitions recorded in a state doc by its last update.
+
+    Returns:
+        List of (reading type, transition, alert) tuples; the alert is the one cleared for 'cleared'
+    """
+    result = []
+    for reading_type in reading_types:
+        transition = doc.get('{}_transition'.format(reading_type))
+        if transition == 'cleared':
+            result.append((reading_type, transition, doc['{}_cleared'.format(reading_type)]))
+        elif transition is not None:
+            result.append((reading_type, transition, doc['{}_alert'.format(reading_type)]))
+    return result
+
+
+def active_alerts(doc):
+    """
+    The active alerts in a state doc.
+
+    Returns:
+        List of (reading type, alert) tuples
+    """
+    return [(reading_type, doc['{}_alert'.format(reading_type)]) for reading_type in STATE_READING_TYPES + ['offline']
+            if doc.get('{}_alert'.format(reading_type)) is not None]
+
+
+def renotify(collection, dev_id, reading_type, alert, now_ts):
+    """
+    Claim a renotification for an active alert, for renotifications sent by the scheduler; only
+    succeeds if the alert has not been renotified (or cleared) since it was read, so a reading and
+    the scheduler, or the schedulers of two server processes, do not both send it.
+
+    Args:
+        collection:           The device_state collection
+        dev_id (str):         Device ID
+        reading_type (str):   Type of reading
+        alert (dict):         The active alert, as read
+        now_ts (str):         Current timestamp; the new notification_ts
+
+    Returns:
+        True if the renotification should be sent
+    """
+    query = {'dev_id': dev_id,
+             '{}_alert.notification_ts'.format(reading_type): alert['notification_ts']}
+    update = {'$set': {'{}_alert.notification_ts'.format(reading_type): now_ts}}
+    return collection.update_one(query, update).modified_count == 1
+
+
+def raise_offline(collection, dev_id, offline_before, now_ts, minutes):
+    """
+    Raise an offline alert for a device, unless it has one already or has been seen since
+    offline_before (e.g. by another server process).
+
+    Args:
+        collection:           The device_state collection
+        dev_id (str):         Device ID
+        offline_before (str): Timestamp; the device is offline if last seen at or before this
+        now_ts (str):         Current timestamp
+        minutes (int):        Minutes without a reading, for the alert's values
+
+    Returns:
+        The new alert; None if not raised
+    """
+    alert = new_alert(now_ts, minutes)
+    query = {'dev_id': dev_id,
+             'last_seen': {'$lte': offline_before},
+             'offline_alert': None}
+    if collection.update_one(query, {'$set': {'offline_alert': alert}}).modified_count == 1:
+        return alert
+    return None
+
+
+def reset(collection, query, windows=False, alerts=False):
+    """
+    Reset the windows (and anomaly statistics) and / or alerts of the state docs matching query; for
+    when the readings or active alerts they are derived from are deleted.
+    """
+    update = {}
+    if windows:
+        update.update({'{}_window'.format(reading_type): [] for reading_type in STATE_READING_TYPES})
+        update.update({'{}_stats'.format(reading_type): None for reading_type in STATE_READING_TYPES})
+    if alerts:
+        update.update({'{}_alert'.format(reading_type): None for reading_type in STATE_READING_TYPES + ['offline']})
+    if update:
+        collection.update_many(query, {'$set': update})
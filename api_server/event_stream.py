@@ -0,0 +1,127 @@
+# event_stream.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+In-process publish/subscribe for pushing new readings and alert transitions out to
+dashboards as they happen, rather than dashboards polling the count resources.
+
+Publishers are the (synchronous) message processing functions, which FastAPI runs in
+its threadpool. Subscribers are the streaming endpoints, which run on the event loop.
+Each subscriber gets its own bounded queue; when a subscriber cannot keep up, the
+oldest events in its queue are dropped so a slow consumer never blocks ingest or
+grows memory without bound.
+"""
+
+import asyncio
+import threading
+import datetime
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class Subscriber:
+    """
+    A single consumer of the event stream, optionally filtered to a set of device IDs.
+    """
+
+    def __init__(self, loop, dev_ids, max_queue_size):
+        self.loop = loop
+        self.dev_ids = set(dev_ids) if dev_ids else None     # None means all devices
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.num_dropped = 0        # events dropped since the consumer last caught up
+
+    def wants(self, dev_id):
+        return (self.dev_ids is None) or (dev_id in self.dev_ids)
+
+    def _put(self, event):
+        """
+        Queue an event; must be run on the subscriber's event loop. If the queue is full,
+        the oldest event is dropped to make room.
+        """
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.num_dropped += 1
+        self.queue.put_nowait(event)
+
+    async def next_event(self, timeout):
+        """
+        Wait for the next event.
+
+        Args:
+            timeout (float):  Max seconds to wait
+
+        Returns:
+            The next event dict; None if the timeout expired. If events were dropped since the
+            last call, an 'events_dropped' event is returned first.
+        """
+        if self.num_dropped > 0:
+            event = {'type': 'events_dropped', 'count': self.num_dropped}
+            self.num_dropped = 0
+            return event
+
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBroker:
+    """
+    Fans events out to all interested subscribers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self, dev_ids=None, max_queue_size=100):
+        """
+        Register a new subscriber; must be called from the event loop the subscriber will be read on.
+
+        Args:
+            dev_ids (list):           Device IDs to receive events for; None or empty for all devices
+            max_queue_size (int):     Max number of events held for a subscriber that is not keeping up
+
+        Returns:
+            The new Subscriber
+        """
+        subscriber = Subscriber(asyncio.get_event_loop(), dev_ids, max_queue_size)
+        with self._lock:
+            self._subscribers = self._subscribers + [subscriber]
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s is not subscriber]
+
+    def num_subscribers(self):
+        return len(self._subscribers)
+
+    def publish(self, event_type, dev_id, **data):
+        """
+        Publish an event to all subscribers interested in dev_id. Safe to call from any thread,
+        and cheap when nobody is subscribed.
+
+        Args:
+            event_type (str):     Type of event; e.g. 'reading', 'alert_raised'
+            dev_id (str):         Device the event is for
+            **data:               Additional event content
+
+        Returns:
+            None
+        """
+        subscribers = self._subscribers     # copy-on-write list; safe to iterate without the lock
+        if not subscribers:
+            return
+
+        event = {'type': event_type,
+                 'dev_id': dev_id,
+                 'event_ts': datetime.datetime.now().strftime(TIMESTAMP_FORMAT)}
+        event.update(data)
+        for subscriber in subscribers:
+            if subscriber.wants(dev_id):
+                try:
+                    subscriber.loop.call_soon_threadsafe(subscriber._put, event)
+                except RuntimeError:
+                    # The subscriber's loop has been closed; it will be cleaned up when its endpoint exits
+                    pass
@@ -0,0 +1,210 @@
+# export_data.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Columnar (Parquet) export of readings and alert history for offline analytics.
+
+Query results are streamed as raw BSON batches straight into Arrow record batches
+using pymongoarrow, skipping the per-document Python dicts pymongo would otherwise
+build; that is where nearly all the time goes in a naive export. If pymongoarrow is
+not installed, we fall back to building the Arrow columns from projected documents.
+Batches are written to Parquet one row group at a time, so memory use is bounded by
+the row group size rather than the size of the export.
+
+Used by the server's export resources; it can also be run directly:
+
+    python export_data.py <readings|alert_history> <output-file> [options]
+
+Examples:
+
+    python export_data.py readings readings_2020.parquet --start-ts 2020-01-01T00:00:00Z --end-ts 2021-01-01T00:00:00Z
+    python export_data.py alert_history history.parquet -d RazPi_01 --compression zstd
+    python export_data.py readings readings.parquet --compare-naive
+"""
+
+import argparse
+import time
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+try:
+    from pymongoarrow.api import Schema, PyMongoArrowContext
+except ImportError:
+    PyMongoArrowContext = None
+from metrics import METRICS
+
+
+# Columns exported for each collection; the name of the timestamp field used for time range filters. Readings
+#  have a column per metric of metrics.py, null where a reading does not carry it, and the number of readings
+#  each stands for (repeat_count; see main.py); alert values may be decimals
+EXPORT_SCHEMAS = {
+    'readings': pa.schema([('dev_id', pa.string()),
+                           ('ts', pa.string())] +
+                          [(metric, pa.int64() if definition['type'] is int else pa.float64())
+                           for metric, definition in METRICS.items()] +
+                          [('repeat_count', pa.int64())]),
+    'alert_history': pa.schema([('dev_id', pa.string()),
+                                ('reading_type', pa.string()),
+                                ('originated_ts', pa.string()),
+                                ('cleared_ts', pa.string()),
+                                ('duration_minutes', pa.int64()),
+                                ('max_value', pa.float64()),
+                                ('min_value', pa.float64())])
+}
+EXPORT_TS_FIELDS = {'readings': 'ts',
+                    'alert_history': 'originated_ts'}
+
+# Values exported where a doc lacks the field; repeat_count is only stored when it is not 1
+EXPORT_DEFAULTS = {'repeat_count': 1}
+
+
+def build_query(collection_name, dev_id=None, start_ts=None, end_ts=None):
+    """
+    Build the query for an export.
+
+    Args:
+        collection_name (str):    'readings' or 'alert_history'
+        dev_id (str):             Only export this device, if given
+        start_ts (str):           Only export docs at or after this time, if given
+        end_ts (str):             Only export docs before this time, if given
+
+    Returns:
+        Query dict
+    """
+    query = {}
+    if dev_id is not None:
+        query['dev_id'] = dev_id
+    if (start_ts is not None) or (end_ts is not None):
+        ts_field = EXPORT_TS_FIELDS[collection_name]
+        query[ts_field] = {}
+        if start_ts is not None:
+            query[ts_field]['$gte'] = start_ts
+        if end_ts is not None:
+            query[ts_field]['$lt'] = end_ts
+    return query
+
+
+def iter_arrow_tables(collection, query, schema, batch_size):
+    """
+    Generator streaming query results as Arrow tables of (roughly) batch_size rows each.
+
+    Args:
+        collection:           Collection to export from
+        query (dict):         Query selecting the docs to export
+        schema:               pyarrow schema of the columns to export
+        batch_size (int):     Docs per batch fetched from the DB
+
+    Returns:
+        Generator of pyarrow Tables
+    """
+    projection = {field.name: True for field in schema}
+    projection['_id'] = False
+
+    if PyMongoArrowContext is not None:
+        # Decode the raw BSON batches directly into Arrow arrays
+        arrow_schema = Schema({field.name: field.type for field in schema})
+        for raw_batch in collection.find_raw_batches(query, projection, batch_size=batch_size):
+            context = PyMongoArrowContext(arrow_schema, codec_options=collection.codec_options)
+            context.process_bson_stream(raw_batch)
+            table = context.finish().select(schema.names).cast(schema)
+            for name, default in EXPORT_DEFAULTS.items():
+                if name in schema.names:
+                    table = table.set_column(schema.get_field_index(name), schema.field(name),
+                                             pc.fill_null(table.column(name), default))
+            yield table
+    else:
+        columns = {name: [] for name in schema.names}
+        for doc in collection.find(query, projection, batch_size=batch_size):
+            for name, values in columns.items():
+                values.append(doc.get(name, EXPORT_DEFAULTS.get(name)))
+            if len(columns[schema.names[0]]) >= batch_size:
+                yield pa.Table.from_pydict(columns, schema=schema)
+                columns = {name: [] for name in schema.names}
+        if columns[schema.names[0]]:
+            yield pa.Table.from_pydict(columns, schema=schema)
+
+
+def export_parquet(collection, query, schema, output, row_group_size=1000000, compression='snappy'):
+    """
+    Export query results to a Parquet file, one row group at a time.
+
+    Args:
+        collection:               Collection to export from
+        query (dict):             Query selecting the docs to export
+        schema:                   pyarrow schema of the columns to export
+        output:                   Path or writable binary file object
+        row_group_size (int):     Rows per Parquet row group
+        compression (str):        Parquet compression codec; e.g. 'snappy', 'zstd', 'gzip', 'none'
+
+    Returns:
+        Number of rows exported
+    """
+    num_rows = 0
+    pending = []            # tables not yet written; always fewer than row_group_size rows in total
+    pending_rows = 0
+    with pq.ParquetWriter(output, schema, compression=compression) as writer:
+        for table in iter_arrow_tables(collection, query, schema, batch_size=min(row_group_size, 100000)):
+            pending.append(table)
+            pending_rows += table.num_rows
+            num_rows += table.num_rows
+            if pending_rows >= row_group_size:
+                combined = pa.concat_tables(pending)
+                writer.write_table(combined.slice(0, row_group_size), row_group_size=row_group_size)
+                remainder = combined.slice(row_group_size)
+                pending = [remainder]
+                pending_rows = remainder.num_rows
+        if pending_rows > 0:
+            writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+    return num_rows
+
+
+def naive_export_rows_per_sec(collection, query, max_docs=1000000):
+    """
+    Time the naive approach, iterating documents one at a time as Python dicts, for comparison.
+
+    Returns:
+        Docs per second
+    """
+    start_time = time.monotonic()
+    num_docs = 0
+    for _ in collection.find(query).limit(max_docs):
+        num_docs += 1
+    return num_docs / max(time.monotonic() - start_time, 1e-6)
+
+
+def main_export():
+    import pymongo
+    import main
+
+    # Extract command line args
+    my_parser = argparse.ArgumentParser(description='Export readings / alert history to Parquet')
+    my_parser.add_argument('collection', choices=sorted(EXPORT_SCHEMAS.keys()))
+    my_parser.add_argument('output', help='Parquet file to write')
+    my_parser.add_argument('-d', '--dev-id', help='only export this device')
+    my_parser.add_argument('--start-ts', help='only export docs at or after this time; e.g. 2020-01-01T00:00:00Z')
+    my_parser.add_argument('--end-ts', help='only export docs before this time')
+    my_parser.add_argument('--row-group-size', type=int, default=1000000)
+    my_parser.add_argument('--compression', default='snappy')
+    my_parser.add_argument('--compare-naive', action='store_true',
+                           help='also time naive document iteration over the same query')
+    args = my_parser.parse_args()
+
+    main.load_config()
+    mongodb = pymongo.MongoClient(main.SECRET_DATA['mongodb_server_url'])
+    collection = mongodb[main.CONFIG_DATA['mongodb_database_name']][args.collection]
+    query = build_query(args.collection, args.dev_id, args.start_ts, args.end_ts)
+
+    start_time = time.monotonic()
+    num_rows = export_parquet(collection, query, EXPORT_SCHEMAS[args.collection], args.output,
+                              args.row_group_size, args.compression)
+    elapsed = time.monotonic() - start_time
+    print('Exported {} rows in {:.1f} seconds; {:.0f} rows/sec{}'.format(
+        num_rows, elapsed, num_rows / max(elapsed, 1e-6),
+        '' if PyMongoArrowContext is not None else ' (pymongoarrow not installed)'))
+
+    if args.compare_naive:
+        print('Naive document iteration: {:.0f} docs/sec'.format(naive_export_rows_per_sec(collection, query)))
+    mongodb.close()
+
+
+if __name__ == '__main__':
+    main_export()
@@ -0,0 +1,175 @@
+# fleet_summary.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Fleet summary for status pages: per device, the latest reading, last-seen time, active
+alerts by type and alert history counts, in one aggregation rather than three count
+requests plus a latest-reading lookup per device.
+
+The aggregation runs on readings and pulls in the other two collections with $unionWith
+(MongoDB 4.4+); each branch reads only indexed fields:
+
+    readings        $sort on (dev_id, ts desc) then $group taking the $first of each; this
+                    matches the readings index, so the DB jumps to the newest reading of each
+                    device (a DISTINCT_SCAN) rather than reading them all
+    device_state    one doc per device; last_seen and the active alerts
+    alert_history   $group of (dev_id, reading_type), covered by its index
+
+and a final $group by device merges the three. Summaries are cached briefly by
+SummaryCache, and the cache is invalidated whenever this process ingests a reading or
+changes alerts; changes made by other server processes show up within the cache time.
+"""
+
+import threading
+import time
+from metrics import METRICS, OFFLINE
+
+
+SUMMARY_READING_TYPES = list(METRICS) + [OFFLINE]
+
+
+def summary_pipeline():
+    """
+    Build the aggregation, to run on the readings collection.
+
+    Returns:
+        List of pipeline stages; one result doc per device, with _id the dev_id
+    """
+    latest = {'latest_{}'.format(metric): {'$first': '$' + metric} for metric in METRICS}
+    alerts = {'{}_alert'.format(reading_type): True for reading_type in SUMMARY_READING_TYPES}
+    merge = dict({'latest_{}'.format(metric): {'$max': '$latest_{}'.format(metric)} for metric in METRICS},
+                 **{'{}_alert'.format(reading_type): {'$max': '${}_alert'.format(reading_type)}
+                    for reading_type in SUMMARY_READING_TYPES})
+    return [
+        # Latest reading per device
+        {'$sort': {'dev_id': 1, 'ts': -1}},
+        {'$group': dict({'_id': '$dev_id',
+                         'latest_ts': {'$first': '$ts'}}, **latest)},
+
+        # Last seen and active alerts
+        {'$unionWith': {'coll': 'device_state',
+                        'pipeline': [{'$project': dict({'_id': '$dev_id',
+                                                        'last_seen': True}, **alerts)}]}},
+
+        # Alert history counts per reading type
+        {'$unionWith': {'coll': 'alert_history',
+                        'pipeline': [{'$sort': {'dev_id': 1, 'reading_type': 1}},
+                                     {'$project': {'_id': False, 'dev_id': True, 'reading_type': True}},
+                                     {'$group': {'_id': {'dev_id': '$dev_id', 'reading_type': '$reading_type'},
+                                                 'count': {'$sum': 1}}},
+                                     {'$project': {'_id': '$_id.dev_id',
+                                                   'history_count': {'reading_type': '$_id.reading_type',
+                                                                     'count': '$count'}}}]}},
+
+        # One doc per device; each field comes from one branch, the others leave it missing
+        {'$group': dict({'_id': '$_id',
+                         'latest_ts': {'$max': '$latest_ts'},
+                         'last_seen': {'$max': '$last_seen'},
+                         'history_counts': {'$push': '$history_count'}}, **merge)},
+        {'$sort': {'_id': 1}}]
+
+
+def device_summary(doc):
+    """
+    Format one result doc of the aggregation.
+
+    Args:
+        doc (dict):   Result doc
+
+    Returns:
+        Dict with dev_id, last_seen, latest_reading (ts, temp, humidity and any other metrics it
+        carried; None if the device has no readings), active_alerts (reading type -> alert, for the types with one) and
+        alert_history_counts (reading type -> count)
+    """
+    latest_reading = None
+    if doc.get('latest_ts') is not None:
+        latest_reading = {'ts': doc['latest_ts'],
+                          'temp': doc.get('latest_temp'),
+                          'humidity': doc.get('latest_humidity')}
+        latest_reading.update({metric: doc['latest_{}'.format(metric)] for metric in METRICS
+                               if doc.get('latest_{}'.format(metric)) is not None})
+    active_alerts = {}
+    for reading_type in SUMMARY_READING_TYPES:
+        alert = doc.get('{}_alert'.format(reading_type))
+        if alert:
+            active_alerts[reading_type] = {'originated_ts': alert.get('originated_ts'),
+                                           'notification_ts': alert.get('notification_ts'),
+                                           'max_value': alert.get('max_value'),
+                                           'min_value': alert.get('min_value')}
+    alert_history_counts = {reading_type: 0 for reading_type in SUMMARY_READING_TYPES}
+    for history_count in doc.get('history_counts') or []:
+        if history_count and (history_count.get('reading_type') is not None):
+            alert_history_counts[history_count['reading_type']] = history_count['count']
+    return {'dev_id': doc['_id'],
+            'last_seen': doc.get('last_seen'),
+            'latest_reading': latest_reading,
+            'active_alerts': active_alerts,
+            'alert_history_counts': alert_history_counts}
+
+
+def fleet_summary(db):
+    """
+    Run the aggregation.
+
+    Args:
+        db:       Connection to our MongoDB database
+
+    Returns:
+        List of device summaries (see device_summary()), ordered by dev_id
+    """
+    return [device_summary(doc) for doc in db.readings.aggregate(summary_pipeline())]
+
+
+class SummaryCache:
+    """
+    Holds the last summary for up to ttl_secs, or until invalidated. Concurrent requests on a
+    miss share one computation rather than each running the aggregation.
+    """
+
+    def __init__(self, ttl_secs):
+        self.ttl_secs = ttl_secs
+        self.lock = threading.Lock()            # guards the fields below; never held while computing
+        self.compute_lock = threading.Lock()    # one computation at a time
+        self.generation = 0                     # bumped by invalidate()
+        self.value = None
+        self.value_generation = None
+        self.expires = 0.0
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+
+    def lookup(self):
+        """
+        Returns:
+            The cached value; None if there is none, it has expired or been invalidated
+        """
+        with self.lock:
+            if (self.value is not None) and (self.value_generation == self.generation) and \
+                    (time.monotonic() < self.expires):
+                self.num_hits += 1
+                return self.value
+        return None
+
+    def get(self, compute):
+        """
+        The cached value, or if there is none, compute() run and its result cached.
+        """
+        value = self.lookup()
+        if value is not None:
+            return value
+        with self.compute_lock:
+            value = self.lookup()           # another request may have just computed it
+            if value is not None:
+                return value
+            with self.lock:
+                generation = self.generation
+                self.num_misses += 1
+            value = compute()
+            with self.lock:
+                # If invalidated meanwhile, the value may already be out of date; it is returned but not reused
+                self.value = value
+                self.value_generation = generation
+                self.expires = time.monotonic() + self.ttl_secs
+            return value
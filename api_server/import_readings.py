@@ -0,0 +1,570 @@
+# import_readings.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Offline bulk importer for historical readings (e.g. old logger data). Rather than
+POSTing readings one at a time, files are streamed in chunks and written with
+unordered bulk inserts from several writer threads. Alert state and alert history
+are then recomputed for the imported devices in a vectorized pass (see alert_replay.py)
+rather than by replaying each reading through the alert handlers. So memory stays bounded
+for large imports, the readings needed for the replay are spilled to temporary Parquet
+files, partitioned by a hash of the device ID, and replayed a partition at a time.
+The per-day percentile sketches (see reading_sketches.py) are updated from counts taken
+per chunk. No alert emails are sent; optionally a single summary email is.
+
+Input files must have columns dev_id and ts, plus a column for each metric of
+metrics.py the readings carry (e.g. temp, humidity as in the test_data/*.csv files); a
+reading without a value for a metric leaves its cell empty. An optional repeat_count
+column gives the number of readings a row stands for (see main.ReadingsMsgBody). CSV
+and Parquet are supported. It uses the same environment
+variables and configuration as the server. It is run as follows:
+
+    python import_readings.py [-v] [--email-summary] [--no-alert-replay] <file> [<file> ...]
+
+Examples:
+
+    python import_readings.py logger_2019.csv
+    python import_readings.py -v --email-summary --chunk-size 1000000 --writers 8 logger_*.parquet
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+import zlib
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pymongo
+from sendgrid import SendGridAPIClient
+from sendgrid.helpers.mail import Mail
+import main
+import alert_replay
+import device_state
+import reading_sketches
+from config_store import DeviceConfigStore
+from metrics import METRICS
+
+
+READING_COLUMNS = ['dev_id', 'ts']                          # required
+OPTIONAL_COLUMNS = list(METRICS) + ['repeat_count']         # used when present
+
+# Column types; the nullable Int64 for whole number metrics, so a missing value stays missing
+COLUMN_DTYPES = dict({metric: 'Int64' if definition['type'] is int else 'float64'
+                      for metric, definition in METRICS.items()}, repeat_count='Int64')
+
+# Max alerts listed per reading type in the summary email; the rest are only counted
+MAX_SUMMARY_EPISODES = 100
+
+# Global var for producing lots of output during execution. Overridden (i.e. set to True) via command line arg.
+verbose = False
+
+
+def read_chunks(filename, chunk_size):
+    """
+    Generator yielding a file's readings as DataFrames of at most chunk_size rows.
+
+    Args:
+        filename (str):       CSV or Parquet file to read; the type is taken from the extension
+        chunk_size (int):     Max rows per chunk
+
+    Returns:
+        Generator of DataFrames with columns dev_id, ts and whichever of OPTIONAL_COLUMNS the file has
+    """
+    if filename.lower().endswith('.parquet'):
+        parquet_file = pq.ParquetFile(filename)
+        columns = READING_COLUMNS + [column for column in OPTIONAL_COLUMNS if column in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            chunk = batch.to_pandas()
+            if pd.api.types.is_datetime64_any_dtype(chunk['ts']):
+                chunk['ts'] = chunk['ts'].dt.strftime(main.TIMESTAMP_FORMAT)
+            yield chunk.astype({column: COLUMN_DTYPES[column] for column in columns[2:]})
+    else:
+        header = pd.read_csv(filename, nrows=0).columns
+        columns = READING_COLUMNS + [column for column in OPTIONAL_COLUMNS if column in header]
+        yield from pd.read_csv(filename, usecols=columns, chunksize=chunk_size,
+                               dtype=dict({'dev_id': str, 'ts': str},
+                                          **{column: COLUMN_DTYPES[column] for column in columns[2:]}))
+
+
+def chunk_metrics(chunk):
+    """
+    The metrics of metrics.py a chunk of readings has columns for.
+    """
+    return [metric for metric in METRICS if metric in chunk.columns]
+
+
+def chunk_weights(chunk):
+    """
+    The number of readings each row of a chunk stands for; its repeat_count, else 1.
+    """
+    if 'repeat_count' in chunk.columns:
+        return chunk['repeat_count'].fillna(1).astype(np.int64)
+    return pd.Series(1, index=chunk.index, dtype=np.int64)
+
+
+def chunk_to_docs(chunk):
+    """
+    Convert a chunk of readings into the docs we store in the readings collection.
+
+    Args:
+        chunk (DataFrame):    Readings
+
+    Returns:
+        List of dicts
+    """
+    # tolist() converts to native Python types, which is both what BSON needs and much faster
+    #  than going row by row through the DataFrame
+    docs = [{'dev_id': dev_id, 'ts': ts} for dev_id, ts in zip(chunk['dev_id'].tolist(), chunk['ts'].tolist())]
+    for metric in chunk_metrics(chunk):
+        to_value = METRICS[metric]['type']
+        for doc, value, present in zip(docs, chunk[metric].tolist(), chunk[metric].notna().tolist()):
+            if present:
+                doc[metric] = to_value(value)
+    for doc, repeat_count in zip(docs, chunk_weights(chunk).tolist()):
+        if repeat_count > 1:
+            doc['repeat_count'] = repeat_count      # only stored when not the default of 1
+    return docs
+
+
+def insert_chunk(collection, docs, batch_size, executor, pending, max_pending):
+    """
+    Queue a chunk of docs for unordered bulk insert on the writer threads. Waits for earlier inserts
+    when too many are outstanding, which keeps memory bounded.
+
+    Args:
+        collection:           readings collection
+        docs (list):          Docs to insert
+        batch_size (int):     Docs per insert_many() call
+        executor:             ThreadPoolExecutor running the inserts
+        pending (set):        Futures for the outstanding inserts; updated in place
+        max_pending (int):    Max outstanding inserts
+
+    Returns:
+        None
+    """
+    for start in range(0, len(docs), batch_size):
+        while len(pending) >= max_pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                future.result()         # re-raises any insert error
+                pending.discard(future)
+        pending.add(executor.submit(collection.insert_many, docs[start:start + batch_size], ordered=False))
+
+
+def add_chunk_sketches(pending, chunk):
+    """
+    Add a chunk's readings to the sketch increments to write; counted per (device, day, value) by
+    pandas rather than reading by reading.
+
+    Args:
+        pending (dict):       (dev_id, day) -> increments; updated in place (see reading_sketches.py)
+        chunk (DataFrame):    Readings
+
+    Returns:
+        None
+    """
+    days = chunk['ts'].str.slice(0, 10)
+    weights = chunk_weights(chunk)      # a reading standing for several counts that many times
+    for (dev_id, day), count in weights.groupby([chunk['dev_id'], days]).sum().items():
+        reading_sketches.add_increments(pending, dev_id, day, {'count': int(count)})
+    for reading_type in [column for column in reading_sketches.SKETCH_READING_TYPES if column in chunk.columns]:
+        counts = weights.groupby([chunk['dev_id'], days, chunk[reading_type].astype(np.float64)]).sum()
+        for (dev_id, day, value), count in counts.items():
+            bucket = reading_sketches.bucket_key(reading_type, value)      # values may share a bucket
+            reading_sketches.add_increments(pending, dev_id, day, {'{}.{}'.format(reading_type, bucket): int(count)})
+
+
+def write_sketches(db, pending, batch_size):
+    """
+    Apply the imported readings' increments to the sketches.
+
+    Args:
+        db:                   Connection to our MongoDB database
+        pending (dict):       (dev_id, day) -> increments; from add_chunk_sketches()
+        batch_size (int):     Updates per bulk_write() call
+
+    Returns:
+        None
+    """
+    requests = [reading_sketches.sketch_update(dev_id, day, increments)
+                for (dev_id, day), increments in sorted(pending.items())]
+    for start in range(0, len(requests), batch_size):
+        db.reading_sketches.bulk_write(requests[start:start + batch_size], ordered=False)
+
+
+def compact_chunk(chunk):
+    """
+    Reduce a chunk of readings to the compact columns needed for alert replay; the metrics as
+    float64 (exact for whole numbers too), NaN where a reading lacks one.
+    """
+    compact = pd.DataFrame({'dev_id': chunk['dev_id'].astype('category'),
+                            'ts': pd.to_datetime(chunk['ts'], format=main.TIMESTAMP_FORMAT),
+                            'repeat_count': chunk_weights(chunk).astype(np.int32)})
+    for metric in chunk_metrics(chunk):
+        compact[metric] = chunk[metric].astype(np.float64)
+    return compact
+
+
+def device_partitions(dev_ids, num_partitions):
+    """
+    The replay partition of each reading; a hash of its device ID, so a device's readings all
+    land in the same partition.
+
+    Args:
+        dev_ids (Series):         Categorical device ID per reading
+        num_partitions (int):     Number of partitions
+
+    Returns:
+        ndarray of partition numbers
+    """
+    # Hashed once per distinct device; crc32 rather than hash() so it does not vary between runs
+    partitions = np.array([zlib.crc32(dev_id.encode()) % num_partitions for dev_id in dev_ids.cat.categories],
+                          dtype=np.int64)
+    return partitions[dev_ids.cat.codes.to_numpy()]
+
+
+def spill_chunk(compact, directory, num_partitions, chunk_num):
+    """
+    Write a compact chunk's readings to the replay partition files; one Parquet file per partition
+    the chunk has readings for.
+
+    Args:
+        compact (DataFrame):      Readings; from compact_chunk()
+        directory (str):          Directory for the partition files
+        num_partitions (int):     Number of partitions
+        chunk_num (int):          Number of the chunk within the import, for the file names
+
+    Returns:
+        None
+    """
+    partitions = device_partitions(compact['dev_id'], num_partitions)
+    for partition in np.unique(partitions):
+        part = compact[partitions == partition]
+        part = part.assign(dev_id=part['dev_id'].cat.remove_unused_categories())
+        part.to_parquet(os.path.join(directory, 'part{:04d}-{:06d}.parquet'.format(partition, chunk_num)),
+                        index=False)
+
+
+def read_partition(directory, partition):
+    """
+    Read back a replay partition written by spill_chunk().
+
+    Args:
+        directory (str):          Directory of the partition files
+        partition (int):          Partition number
+
+    Returns:
+        DataFrame of compact readings, or None if the partition has none
+    """
+    filenames = sorted(glob.glob(os.path.join(directory, 'part{:04d}-*.parquet'.format(partition))))
+    if not filenames:
+        return None
+    readings = pd.concat([pd.read_parquet(filename) for filename in filenames], ignore_index=True)
+    readings['dev_id'] = readings['dev_id'].astype(str).astype('category')
+    return readings
+
+
+def replay_alerts(db, readings, device_config):
+    """
+    Recompute alert state / alert history for the imported readings. Alerts that were raised and cleared
+    within the imported readings go into alert history; alerts still active at the end of the imported
+    readings become active alerts, unless the device already has an active alert of that type.
+    Each device's own thresholds (see config_store.py) are used, for each metric of metrics.py it has
+    a range for. Devices new to the server get the imported readings as their recent history in their
+    state docs (see device_state.py).
+
+    Args:
+        db:                       Connection to our MongoDB database
+        readings (DataFrame):     Compact imported readings; from compact_chunk(). All of each
+                                  device's readings must be included
+        device_config:            Loaded DeviceConfigStore
+
+    Returns:
+        Dict of reading type -> list of per-episode dicts, for the summary
+    """
+    readings = readings.sort_values(['dev_id', 'ts'], kind='stable')
+    dev_codes, dev_ids = pd.factorize(readings['dev_id'].astype(str))
+    timestamps = readings['ts'].to_numpy()
+    repeat_counts = readings['repeat_count'].to_numpy()
+
+    # Each device's own thresholds
+    configs = [device_config.get(dev_id) for dev_id in dev_ids]
+
+    all_episodes = {}
+    for reading_type in chunk_metrics(readings):
+        # Only the readings carrying the metric, of the devices with a range for it
+        rules = [device_state.metric_rule(config, reading_type) for config in configs]
+        values = readings[reading_type].to_numpy()
+        selected = np.array([rule is not None for rule in rules], dtype=bool)[dev_codes] & ~np.isnan(values)
+        if not selected.any():
+            continue
+        all_episodes[reading_type] = replay_metric(db, reading_type, dev_codes[selected], dev_ids,
+                                                   timestamps[selected], values[selected], repeat_counts[selected],
+                                                   rules, configs)
+    return all_episodes
+
+
+def replay_metric(db, reading_type, dev_codes, dev_ids, timestamps, values, repeat_counts, rules, configs):
+    """
+    Recompute alert state / alert history for one metric; see replay_alerts().
+
+    Args:
+        db:                       Connection to our MongoDB database
+        reading_type (str):       Metric; see metrics.py
+        dev_codes (ndarray):      Integer device code per reading; readings sorted by device then timestamp
+        dev_ids (Index):          Device ID per code
+        timestamps (ndarray):     datetime64 timestamp per reading
+        values (ndarray):         Value per reading
+        repeat_counts (ndarray):  Number of readings each stands for
+        rules (list):             Rule per device code (see device_state.metric_rule()); not None for
+                                  the devices with readings here
+        configs (list):           Config per device code
+
+    Returns:
+        List of per-episode dicts, for the summary
+    """
+    def rule_values(name):
+        return np.array([np.nan if rule is None else rule[name] for rule in rules])[dev_codes]
+
+    to_value = METRICS[reading_type]['type']
+    num_readings = rule_values('num_readings').astype(np.int64)
+    out_of_range = alert_replay.out_of_range_flags(values, rule_values('range_min'), rule_values('range_max'))
+    clear = alert_replay.clear_flags(values, rule_values('clear_min'), rule_values('clear_max'))
+
+    # One pass per distinct number of readings to check; selecting whole devices keeps them in order
+    state = np.zeros(len(values), dtype=bool)
+    for n in np.unique(num_readings):
+        selected = num_readings == n
+        state[selected] = alert_replay.alert_state(dev_codes[selected], out_of_range[selected], n, clear[selected],
+                                                   repeat_counts[selected])
+    episodes = alert_replay.alert_episodes(dev_codes, timestamps, values, state)
+
+    history_docs = []
+    active_docs = []
+    active_alerts = {}          # dev code -> alert, for the state docs
+    summary = []
+    for i in range(len(episodes['start_idx'])):
+        dev_code = episodes['dev_code'][i]
+        data = {'dev_id': dev_ids[dev_code],
+                'reading_type': reading_type,
+                'originated_ts': alert_replay.format_timestamp(episodes['originated'][i]),
+                'max_value': to_value(episodes['max_value'][i]),
+                'min_value': to_value(episodes['min_value'][i])}
+        summary.append(data)
+        if episodes['end_idx'][i] >= 0:
+            data = dict(data,
+                        cleared_ts=alert_replay.format_timestamp(episodes['cleared'][i]),
+                        duration_minutes=int(episodes['duration_minutes'][i]))
+            history_docs.append(data)
+        else:
+            notifications = alert_replay.notification_times(timestamps, episodes['start_idx'][i],
+                                                            episodes['stop_idx'][i],
+                                                            configs[dev_code]['alert_renotification_delay'])
+            data = dict(data, notification_ts=alert_replay.format_timestamp(notifications[-1]))
+            active_docs.append(data)
+            active_alerts[dev_code] = {'originated_ts': data['originated_ts'],
+                                       'notification_ts': data['notification_ts'],
+                                       'max_value': data['max_value'],
+                                       'min_value': data['min_value'],
+                                       'last_value': to_value(values[episodes['stop_idx'][i] - 1])}
+
+    if history_docs:
+        db.alert_history.insert_many(history_docs, ordered=False)
+    for data in active_docs:
+        # Only becomes the active alert if the device does not already have one
+        query = {'dev_id': data['dev_id'], 'reading_type': data['reading_type']}
+        db.active_alerts.update_one(query, {'$setOnInsert': data}, upsert=True)
+
+    # The window flags, each reading's repeated as the server would (see device_state.window_flags())
+    flags = np.where(out_of_range, True, np.where(clear, False, None))     # see device_state.range_flag()
+    expanded, _ = alert_replay.repeat_index(repeat_counts, np.maximum(num_readings, device_state.MIN_WINDOW_SIZE))
+    update_device_states(db, reading_type, dev_codes[expanded], dev_ids, timestamps[expanded], flags[expanded],
+                         num_readings[expanded], active_alerts)
+
+    if verbose:
+        print('{}: {} alerts in history, {} still active'.format(reading_type, len(history_docs),
+                                                                 len(active_docs)), flush=True)
+    return summary
+
+
+def update_device_states(db, column, dev_codes, dev_ids, timestamps, flags, num_readings, active_alerts):
+    """
+    Bring the imported devices' state docs up to date for one reading type; a device without recent
+    readings gets the window flags of its last imported readings, and a device without an active
+    alert gets the one still active at the end of the import, if any. One bulk write.
+
+    Args:
+        db:                       Connection to our MongoDB database
+        column (str):             Reading type; a metric of metrics.py
+        dev_codes (ndarray):      Integer device code per reading; readings sorted by device then timestamp
+        dev_ids (Index):          Device ID per code
+        timestamps (ndarray):     Timestamp per reading
+        flags (ndarray):          Window flag per reading (see device_state.range_flag())
+        num_readings (ndarray):   Number of continuous readings to check per reading
+        active_alerts (dict):     Dev code -> alert still active at the end of the import
+
+    Returns:
+        None
+    """
+    window = '{}_window'.format(column)
+    alert = '{}_alert'.format(column)
+    last_idx = np.flatnonzero(np.r_[dev_codes[1:] != dev_codes[:-1], True])
+    first_idx = np.r_[0, last_idx[:-1] + 1]
+    requests = []
+    for first, last in zip(first_idx, last_idx):
+        window_size = max(int(num_readings[last]), device_state.MIN_WINDOW_SIZE)
+        window_flags = flags[max(first, last + 1 - window_size):last + 1].tolist()
+        stage = {'last_seen': {'$ifNull': ['$last_seen', alert_replay.format_timestamp(timestamps[last])]},
+                 window: {'$cond': [{'$gt': [{'$size': {'$ifNull': ['$' + window, []]}}, 0]}, '$' + window, window_flags]}}
+        if dev_codes[last] in active_alerts:
+            stage[alert] = {'$ifNull': ['$' + alert, active_alerts[dev_codes[last]]]}
+        requests.append(pymongo.UpdateOne({'dev_id': dev_ids[dev_codes[last]]}, [{'$set': stage}], upsert=True))
+    if requests:
+        db.device_state.bulk_write(requests, ordered=False)
+
+
+def add_to_summary(summary, all_episodes):
+    """
+    Add a partition's alerts to the summary; every alert is counted, but only the first
+    MAX_SUMMARY_EPISODES of each reading type are kept for listing.
+
+    Args:
+        summary (dict):           Reading type -> {'count': int, 'episodes': list}; updated in place
+        all_episodes (dict):      From replay_alerts()
+
+    Returns:
+        None
+    """
+    for reading_type, episodes in all_episodes.items():
+        type_summary = summary.setdefault(reading_type, {'count': 0, 'episodes': []})
+        type_summary['count'] += len(episodes)
+        type_summary['episodes'].extend(episodes[:MAX_SUMMARY_EPISODES - len(type_summary['episodes'])])
+
+
+def summary_html(num_readings, num_devices, summary):
+    """
+    The body of the summary email.
+
+    Args:
+        num_readings (int):       Number of readings imported
+        num_devices (int):        Number of devices the readings were for
+        summary (dict):           From add_to_summary()
+
+    Returns:
+        HTML string
+    """
+    html_content = '<p><h2>Readings Import Summary</h2></p>'
+    html_content += '<p>Imported {} readings for {} devices.</p>'.format(num_readings, num_devices)
+    for reading_type, type_summary in summary.items():
+        html_content += '<p>{} {} alerts:</p><ul>'.format(type_summary['count'], reading_type)
+        for episode in type_summary['episodes']:
+            html_content += '<li>{} originated {} (max {}, min {})</li>'.format(episode['dev_id'],
+                                                                               episode['originated_ts'],
+                                                                               episode['max_value'],
+                                                                               episode['min_value'])
+        if type_summary['count'] > len(type_summary['episodes']):
+            html_content += '<li>... and {} more</li>'.format(type_summary['count'] - len(type_summary['episodes']))
+        html_content += '</ul>'
+    return html_content
+
+
+def send_summary_email(num_readings, num_devices, summary):
+    """
+    Send a single email summarizing the import, in place of the per-alert emails the server would send.
+
+    Args:
+        num_readings (int):       Number of readings imported
+        num_devices (int):        Number of devices the readings were for
+        summary (dict):           From add_to_summary()
+
+    Returns:
+        None
+    """
+    html_content = summary_html(num_readings, num_devices, summary)
+
+    message = Mail(from_email=main.CONFIG_DATA['email_from'],
+                   to_emails=main.CONFIG_DATA['email_to'],
+                   subject='Readings Import Summary',
+                   html_content=html_content)
+    SendGridAPIClient(main.SECRET_DATA['sendgrid_api_key']).send(message)
+
+
+def main_import():
+    global verbose     # I know, not good practice...
+
+    # Extract command line args
+    my_parser = argparse.ArgumentParser(description='Bulk import readings from CSV / Parquet files')
+    my_parser.add_argument('files', nargs='+', help='CSV or Parquet files to import')
+    my_parser.add_argument('-v', action='store_true', help='verbose mode')
+    my_parser.add_argument('--chunk-size', type=int, default=500000, help='rows read from a file at a time')
+    my_parser.add_argument('--batch-size', type=int, default=10000, help='docs per bulk insert')
+    my_parser.add_argument('--writers', type=int, default=4, help='number of concurrent insert threads')
+    my_parser.add_argument('--partitions', type=int, default=16,
+                           help='device partitions the alert replay works through one at a time')
+    my_parser.add_argument('--no-alert-replay', action='store_true', help='only import; do not recompute alerts')
+    my_parser.add_argument('--email-summary', action='store_true', help='send a single summary email')
+    args = my_parser.parse_args()
+    verbose = args.v
+
+    main.load_config()
+    mongodb = pymongo.MongoClient(main.SECRET_DATA['mongodb_server_url'], maxPoolSize=args.writers + 2)
+    db = mongodb[main.CONFIG_DATA['mongodb_database_name']]
+
+    start_time = time.monotonic()
+    num_readings = 0
+    num_chunks = 0
+    sketches = {}
+    pending = set()
+    spill_directory = tempfile.TemporaryDirectory(prefix='import_readings_')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.writers) as executor:
+        for filename in args.files:
+            for chunk in read_chunks(filename, args.chunk_size):
+                insert_chunk(db.readings, chunk_to_docs(chunk), args.batch_size, executor, pending, args.writers * 2)
+                add_chunk_sketches(sketches, chunk)
+                if not args.no_alert_replay:
+                    spill_chunk(compact_chunk(chunk), spill_directory.name, args.partitions, num_chunks)
+                num_chunks += 1
+                num_readings += len(chunk)
+                if verbose:
+                    elapsed = time.monotonic() - start_time
+                    print('{}: {} readings queued, {:.0f} readings/sec'.format(filename, num_readings,
+                                                                            num_readings / max(elapsed, 1e-6)),
+                          flush=True)
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
+    write_sketches(db, sketches, args.batch_size)
+
+    print('Imported {} readings in {:.1f} seconds'.format(num_readings, time.monotonic() - start_time), flush=True)
+    if num_readings == 0 or args.no_alert_replay:
+        spill_directory.cleanup()
+        mongodb.close()
+        return
+
+    # Each device's own thresholds
+    device_config = DeviceConfigStore(main.CONFIG_DATA)
+    device_config.load(db)
+
+    # A partition at a time; partitions never split a device, so each is replayed on its own
+    num_devices = 0
+    summary = {}
+    for partition in range(args.partitions):
+        readings = read_partition(spill_directory.name, partition)
+        if readings is None:
+            continue
+        num_devices += readings['dev_id'].nunique()
+        add_to_summary(summary, replay_alerts(db, readings, device_config))
+        if verbose:
+            print('Partition {} of {}: replayed {} readings'.format(partition + 1, args.partitions, len(readings)),
+                  flush=True)
+    spill_directory.cleanup()
+    mongodb.close()
+    print('Recomputed alerts in {:.1f} seconds'.format(time.monotonic() - start_time), flush=True)
+
+    if args.email_summary:
+        send_summary_email(num_readings, num_devices, summary)
+
+
+if __name__ == '__main__':
+    main_import()
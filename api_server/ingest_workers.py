@@ -0,0 +1,547 @@
+# ingest_workers.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Device-affinity sharded ingest. Rather than every POST /readings/ making its own round
+trips to the DB, the server (the dispatcher) hashes each reading's dev_id onto one of
+a pool of worker processes. A worker owns its devices: it keeps their state docs (see
+device_state.py) in memory, evaluates the alert rule for each reading locally with
+device_state.evaluate_reading(), and buffers the readings and changed state docs,
+writing them in batches (one insert_many() plus one bulk_write() per batch). As each
+device only ever goes to one worker, no locking across processes is needed, and
+throughput scales with the number of workers until the DB becomes the bottleneck.
+
+The dispatcher still works out what each reading contributes (range check, renotification
+cutoff; see device_state.type_update()); that part is cheap and needs the device config.
+The anomaly detector's statistics are in the state doc, so the worker scores and updates
+them with the rest of the state, and a reading the dispatcher turns away never reaches
+them. Scheduled renotifications and offline alerts are sent to the device's worker too,
+so the in-memory state is the only copy being changed.
+
+Messages to a worker go over its own multiprocessing queue, and each carries a sequence
+number. A worker acknowledges a batch's messages, along with the alert transitions they
+caused, only once the batch is in the DB. The dispatcher keeps every message until it is
+acknowledged, and if a worker dies, starts a new one and sends it the unacknowledged
+messages again. Replays are harmless: each reading has an _id assigned by the dispatcher,
+so a reading already inserted is skipped (duplicate key), and each state doc records the
+_id of the last reading applied to it. The _id is assigned as the reading is queued, with
+the dispatcher's lock held, so a device's readings reach its worker in _id order and only
+a replay can have an _id at or below the last one applied. Timer messages are idempotent
+by nature. The per-day percentile sketches (see reading_sketches.py) are batched the same
+way, each recording the _id of the last reading added to it, as their updates are
+increments.
+
+Changing the number of workers drains the pool (each worker flushes and exits) and then
+starts the new one; devices are rehashed and the new workers load their state from the
+DB as they first see each device.
+"""
+
+import datetime
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+import zlib
+import pymongo
+import pymongo.errors
+from bson import ObjectId
+import device_state
+import reading_sketches
+from admission import AdmissionRejected
+
+
+DUPLICATE_KEY_ERROR = 11000
+DB_RETRY_SECS = [0.1, 0.5, 1, 2, 5]     # backoff between retries of a failed flush; the last one repeats
+
+
+def shard_for(dev_id, num_workers):
+    """
+    The worker a device's readings go to. A CRC rather than hash(), which is salted per process.
+
+    Args:
+        dev_id (str):         Device ID
+        num_workers (int):    Number of workers
+
+    Returns:
+        Worker number, 0 to num_workers - 1
+    """
+    return zlib.crc32(dev_id.encode('utf-8')) % num_workers
+
+
+def evaluate_timer(state, reading_type, now_ts, renotify_before, offline_before, offline_minutes):
+    """
+    Handle a due timer against a state doc held in memory; the in-memory counterpart of
+    main.fire_timer(). The state is updated in place.
+
+    Args:
+        state (dict):             The device's state doc
+        reading_type (str):       Type of reading; a metric (see metrics.py) or 'offline'
+        now_ts (str):             Current timestamp
+        renotify_before (str):    Timestamp; renotify if the last notification was at or before this
+        offline_before (str):     Timestamp; for an offline timer, the device is offline if last seen
+                                  at or before this
+        offline_minutes (int):    Minutes without a reading before a device is offline; 0 if disabled
+
+    Returns:
+        List of results for the dispatcher: ('transition', reading type, transition, alert, value),
+        ('not_due', reading type, the alert's notification_ts) when the alert was notified since the
+        timer was set, or for an offline timer, ('seen', 'offline', last_seen) when the device was
+        seen since
+    """
+    alert = state.get('{}_alert'.format(reading_type))
+    if alert is not None:
+        if alert['notification_ts'] > renotify_before:
+            return [('not_due', reading_type, alert['notification_ts'])]
+        alert = dict(alert, notification_ts=now_ts)
+        state['{}_alert'.format(reading_type)] = alert
+        if reading_type == 'offline':
+            last_seen = datetime.datetime.strptime(state['last_seen'], device_state.TIMESTAMP_FORMAT)
+            now = datetime.datetime.strptime(now_ts, device_state.TIMESTAMP_FORMAT)
+            value = int((now - last_seen).total_seconds() // 60)
+        else:
+            value = alert.get('last_value', alert.get('max_value'))
+        return [('transition', reading_type, 'renotified', alert, value)]
+    elif (reading_type == 'offline') and (offline_minutes > 0):
+        if state['last_seen'] > offline_before:
+            return [('seen', reading_type, state['last_seen'])]
+        alert = device_state.new_alert(now_ts, offline_minutes)
+        state['offline_alert'] = alert
+        return [('transition', reading_type, 'raised', alert, offline_minutes)]
+    return []       # the alert has been cleared since the timer was set
+
+
+class Worker:
+    """
+    The worker process's side; see run_worker().
+    """
+
+    def __init__(self, shard, inbox, outbox, mongodb_server_url, database_name, batch_size, flush_ms):
+        self.shard = shard
+        self.inbox = inbox
+        self.outbox = outbox
+        self.mongodb_server_url = mongodb_server_url
+        self.database_name = database_name
+        self.batch_size = batch_size
+        self.flush_secs = flush_ms / 1000.0
+
+        self.mongodb = None
+        self.db = None
+        self.states = {}            # dev_id -> state doc; the devices seen so far
+        self.readings = []          # readings to insert
+        self.dirty = set()          # dev_ids of the state docs to write
+        self.sketches = {}          # (dev_id, day) -> sketch increments to write; see reading_sketches.py
+        self.sketch_ids = {}        # (dev_id, day) -> _id of the last reading in those increments
+        self.sketch_marks = {}      # dev_id -> (day, _id of the last reading added to that day's sketch)
+        self.results = []           # (dev_id, ...) results for the dispatcher; see evaluate_timer()
+        self.seqs = []              # sequence numbers of the messages in the batch
+        self.batch_started = None
+
+    def connect(self):
+        self.mongodb = pymongo.MongoClient(self.mongodb_server_url)
+        self.db = self.mongodb[self.database_name]
+
+    def state(self, dev_id):
+        """
+        The device's state doc, loaded from the DB the first time the device is seen.
+        """
+        state = self.states.get(dev_id)
+        if state is None:
+            state = self.with_retries(self.db.device_state.find_one, {'dev_id': dev_id}, {'_id': False})
+            if state is None:
+                state = {'dev_id': dev_id}
+            self.states[dev_id] = state
+        return state
+
+    def with_retries(self, func, *args, **kwargs):
+        """
+        Call a DB function, retrying DB errors (with backoff) until it succeeds; the messages stay
+        unacknowledged meanwhile, so the dispatcher's backpressure kicks in.
+        """
+        for attempt in itertools.count():
+            try:
+                return func(*args, **kwargs)
+            except pymongo.errors.PyMongoError:
+                traceback.print_exc()
+                time.sleep(DB_RETRY_SECS[min(attempt, len(DB_RETRY_SECS) - 1)])
+
+    def handle(self, message):
+        """
+        Apply one message to the in-memory state; the writes are buffered until the next flush.
+        """
+        kind, seq = message[0], message[1]
+        if kind == 'reading':
+            _, _, reading, now_ts, type_updates = message
+            dev_id = reading['dev_id']
+            state = self.state(dev_id)
+            last_reading_id = state.get('last_reading_id')
+            if (last_reading_id is None) or (reading['_id'] > last_reading_id):       # else a replay
+                self.readings.append(reading)
+                state['last_reading_id'] = reading['_id']
+                for reading_type, transition, alert in device_state.evaluate_reading(state, now_ts, type_updates):
+                    value = reading.get(reading_type)
+                    self.results.append((dev_id, 'transition', reading_type, transition, alert, value))
+                self.dirty.add(dev_id)
+            self.add_to_sketch(reading)
+        elif kind == 'timer':
+            _, _, dev_id, reading_type, now_ts, renotify_before, offline_before, offline_minutes = message
+            if (dev_id in self.states) or \
+                    (self.with_retries(self.db.device_state.count_documents, {'dev_id': dev_id}, limit=1) > 0):
+                state = self.state(dev_id)
+                results = evaluate_timer(state, reading_type, now_ts, renotify_before, offline_before, offline_minutes)
+                self.results.extend((dev_id,) + result for result in results)
+                if any(result[0] == 'transition' for result in results):
+                    self.dirty.add(dev_id)
+        self.seqs.append(seq)
+        if self.batch_started is None:
+            self.batch_started = time.monotonic()
+
+    def add_to_sketch(self, reading):
+        """
+        Buffer a reading's sketch increments, unless its sketch already has it; checked separately
+        from the state doc, as the two are written one after the other.
+        """
+        dev_id, day = reading['dev_id'], reading_sketches.bucket_for(reading['ts'])
+        mark = self.sketch_marks.get(dev_id)
+        if (mark is None) or (mark[0] != day):
+            sketch = self.with_retries(self.db.reading_sketches.find_one, {'dev_id': dev_id, 'day': day},
+                                       {'_id': False, 'last_reading_id': True})
+            mark = (day, (sketch or {}).get('last_reading_id'))
+        if (mark[1] is None) or (reading['_id'] > mark[1]):                           # else a replay
+            reading_sketches.add_increments(self.sketches, dev_id, day, reading_sketches.reading_increments(reading))
+            self.sketch_ids[(dev_id, day)] = reading['_id']
+            mark = (day, reading['_id'])
+        self.sketch_marks[dev_id] = mark
+
+    def flush(self):
+        """
+        Write the batch to the DB, then acknowledge its messages along with the transitions they caused.
+        """
+        if self.readings:
+            self.with_retries(self.insert_readings, self.readings)
+        if self.dirty:
+            requests = [pymongo.ReplaceOne({'dev_id': dev_id}, self.states[dev_id], upsert=True)
+                        for dev_id in sorted(self.dirty)]
+            self.with_retries(self.db.device_state.bulk_write, requests, ordered=False)
+        if self.sketches:
+            requests = [reading_sketches.sketch_update(dev_id, day, increments, self.sketch_ids[(dev_id, day)])
+                        for (dev_id, day), increments in sorted(self.sketches.items())]
+            self.with_retries(self.db.reading_sketches.bulk_write, requests, ordered=False)
+        if self.seqs:
+            self.outbox.put(('done', self.seqs, self.results))
+        self.readings, self.dirty, self.results, self.seqs = [], set(), [], []
+        self.sketches, self.sketch_ids = {}, {}
+        self.batch_started = None
+
+    def insert_readings(self, readings):
+        try:
+            self.db.readings.insert_many(readings, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # Readings inserted before a crash are replayed; skip them, but anything else is an error
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details.get('writeErrors', [])) or \
+                    e.details.get('writeConcernErrors'):
+                raise
+
+    def run(self):
+        self.connect()
+        while True:
+            timeout = None
+            if self.batch_started is not None:
+                timeout = max(0.0, self.batch_started + self.flush_secs - time.monotonic())
+            try:
+                message = self.inbox.get(timeout=timeout)
+            except queue.Empty:
+                self.flush()
+                continue
+
+            if message[0] in ('forget', 'stop'):
+                self.flush()
+                if message[0] == 'forget':
+                    if message[2] is None:
+                        self.states.clear()
+                        self.sketch_marks.clear()
+                    else:
+                        self.states.pop(message[2], None)
+                        self.sketch_marks.pop(message[2], None)
+                self.outbox.put(('done', [message[1]], []))
+                if message[0] == 'stop':
+                    break
+                continue
+
+            self.handle(message)
+            if len(self.seqs) >= self.batch_size:
+                self.flush()
+        self.mongodb.close()
+
+
+def run_worker(shard, inbox, outbox, mongodb_server_url, database_name, batch_size, flush_ms):
+    """
+    Worker process main function. Messages from the dispatcher:
+
+        ('reading', seq, reading doc (with _id), now_ts, type updates)  see device_state.type_update()
+        ('timer', seq, dev_id, reading type, now_ts, renotify_before, offline_before, offline_minutes)
+        ('forget', seq, dev_id or None)     flush, then drop the device's (or all) cached state; for
+                                            when the DB state is changed by someone else
+        ('stop', seq)                       flush and exit
+
+    and to the dispatcher, once the messages are done with:
+
+        ('done', [seq, ...], [(dev_id, ...) results, ...])      see evaluate_timer()
+
+    Args:
+        shard (int):                  Worker number
+        inbox (Queue):                Messages from the dispatcher
+        outbox (Queue):               Messages to the dispatcher
+        mongodb_server_url (str):     MongoDB connection string
+        database_name (str):          Database to use
+        batch_size (int):             Max messages per batch
+        flush_ms (int):               Max milliseconds a message waits for its batch to be written
+    """
+    try:
+        Worker(shard, inbox, outbox, mongodb_server_url, database_name, batch_size, flush_ms).run()
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerHandle:
+    """
+    The dispatcher's side of one worker process.
+    """
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.process = None
+        self.inbox = None
+        self.outbox = None
+        self.unacked = {}           # seq -> message; sent but not yet written to the DB
+        self.retiring = False       # sent 'stop'; not to be restarted once it has acknowledged everything
+        self.num_restarts = 0
+        self.num_done = 0
+
+
+class ShardedIngest:
+    """
+    The dispatcher; see the module docstring.
+    """
+
+    def __init__(self, num_workers, mongodb_server_url, database_name, on_results,
+                 batch_size=100, flush_ms=50, max_unacked=1000):
+        """
+        Args:
+            num_workers (int):            Number of worker processes
+            mongodb_server_url (str):     MongoDB connection string
+            database_name (str):          Database to use
+            on_results (callable):        Called (on a background thread, one per worker) with each batch's
+                                          list of (dev_id, ...) results; see evaluate_timer()
+            batch_size (int):             Max messages per batch
+            flush_ms (int):               Max milliseconds a message waits for its batch to be written
+            max_unacked (int):            Max messages waiting on a worker before new ones are rejected
+        """
+        self.num_workers = num_workers
+        self.mongodb_server_url = mongodb_server_url
+        self.database_name = database_name
+        self.on_results = on_results
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.max_unacked = max_unacked
+
+        self.context = multiprocessing.get_context('spawn')      # fork is unsafe with the server's threads
+        self.lock = threading.Lock()
+        self.acked = threading.Condition(self.lock)
+        self.counter = itertools.count()
+        self.handles = []
+        self.draining = False       # the pool is being stopped or resized; new messages are turned away
+
+    def start(self):
+        with self.lock:
+            self.handles = [WorkerHandle(shard) for shard in range(self.num_workers)]
+            for handle in self.handles:
+                self.start_worker(handle)
+
+    def stop(self, timeout=30):
+        """
+        Stop the workers once they have written what they have.
+        """
+        with self.lock:
+            self.drain(timeout)
+            self.handles = []
+            self.draining = False
+            self.acked.notify_all()
+
+    def resize(self, num_workers, timeout=30):
+        """
+        Change the number of workers; devices are rehashed across the new pool.
+        """
+        with self.lock:
+            self.drain(timeout)
+            self.num_workers = num_workers
+            self.handles = [WorkerHandle(shard) for shard in range(num_workers)]
+            for handle in self.handles:
+                self.start_worker(handle)
+            self.draining = False
+            self.acked.notify_all()
+
+    def start_worker(self, handle):
+        """
+        Start (or restart) a worker with fresh queues, and resend its unacknowledged messages.
+        Called with the lock held.
+        """
+        handle.inbox = self.context.Queue()
+        handle.outbox = self.context.Queue()
+        handle.process = self.context.Process(target=run_worker,
+                                              args=(handle.shard, handle.inbox, handle.outbox, self.mongodb_server_url,
+                                                    self.database_name, self.batch_size, self.flush_ms),
+                                              name='ingest_worker_{}'.format(handle.shard),
+                                              daemon=True)
+        handle.process.start()
+        for seq in sorted(handle.unacked):
+            handle.inbox.put(handle.unacked[seq])
+        threading.Thread(target=self.receive, args=(handle, handle.process, handle.outbox),
+                         name='ingest_results_{}'.format(handle.shard), daemon=True).start()
+
+    def drain(self, timeout):
+        """
+        Stop every worker after it has flushed, waiting for all their messages to be acknowledged.
+        Called with the lock held.
+        """
+        self.draining = True
+        for handle in self.handles:
+            # Before the 'stop', as a worker that exits first is seen by its results thread while
+            # the others are still being waited on (the wait releases the lock)
+            handle.retiring = True
+            self.send(handle, ('stop',), check_busy=False)
+        deadline = time.monotonic() + timeout
+        while any(handle.unacked for handle in self.handles) and (time.monotonic() < deadline):
+            self.acked.wait(timeout=0.5)
+        for handle in self.handles:
+            handle.process.join(timeout=max(0.0, deadline - time.monotonic()))
+            if handle.process.is_alive():
+                handle.process.terminate()
+
+    def receive(self, handle, process, outbox):
+        """
+        Results thread for one worker process; passes on its results, and restarts it if it dies.
+        """
+        while True:
+            try:
+                message = outbox.get(timeout=0.5)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                break
+            except (EOFError, OSError):
+                break
+            self.done(handle, message[1], message[2])
+
+        # Anything the worker sent before it exited has been read by now. A retiring worker is
+        # only restarted if it died before acknowledging everything, its 'stop' included.
+        with self.lock:
+            if (handle.process is not process) or (handle not in self.handles):
+                return
+            if handle.retiring and not handle.unacked:
+                return
+            print('WARNING: ingest worker {} (pid {}) exited with code {}; restarting it, '
+                  'resending {} messages'.format(handle.shard, process.pid, process.exitcode, len(handle.unacked)),
+                  flush=True)
+            handle.num_restarts += 1
+            self.start_worker(handle)
+
+    def done(self, handle, seqs, results):
+        if results:
+            try:
+                self.on_results(results)
+            except Exception:
+                traceback.print_exc()
+        with self.lock:
+            for seq in seqs:
+                handle.unacked.pop(seq, None)
+            handle.num_done += len(seqs)
+            self.acked.notify_all()
+
+    def send(self, handle, message, check_busy=True):
+        """
+        Send a message to a worker, keeping it until acknowledged. Called with the lock held.
+
+        Returns:
+            The message's sequence number
+        """
+        if check_busy and self.draining:
+            raise AdmissionRejected('ingest workers restarting', retry_after=1)
+        if check_busy and (len(handle.unacked) >= self.max_unacked):
+            raise AdmissionRejected('ingest worker busy', retry_after=1)
+        seq = next(self.counter)
+        message = (message[0], seq) + message[1:]
+        handle.unacked[seq] = message
+        handle.inbox.put(message)
+        return seq
+
+    def submit_reading(self, reading, now_ts, type_updates):
+        """
+        Queue a reading for its device's worker. Its _id is assigned here, under the lock, so that the
+        worker gets each device's readings in _id order (see the module docstring).
+
+        Args:
+            reading (dict):       The reading doc; its _id is set
+            now_ts (str):         Current timestamp
+            type_updates (dict):  Reading type -> dict from device_state.type_update()
+
+        Raises:
+            AdmissionRejected:    If the worker is too far behind
+        """
+        with self.lock:
+            handle = self.handles[shard_for(reading['dev_id'], len(self.handles))]
+            reading['_id'] = ObjectId()
+            self.send(handle, ('reading', reading, now_ts, type_updates))
+
+    def submit_timer(self, dev_id, reading_type, now_ts, renotify_before, offline_before, offline_minutes):
+        """
+        Queue a due timer for its device's worker; see evaluate_timer() for the arguments.
+
+        Raises:
+            AdmissionRejected:    If the worker is too far behind
+        """
+        with self.lock:
+            handle = self.handles[shard_for(dev_id, len(self.handles))]
+            self.send(handle, ('timer', dev_id, reading_type, now_ts, renotify_before, offline_before, offline_minutes))
+
+    def forget(self, dev_id=None, timeout=30):
+        """
+        Have the workers write out and drop their cached state for a device (or all devices), and wait
+        for them to do so; for before the state docs are changed directly in the DB (e.g. by a delete).
+        Readings submitted meanwhile may load the state again, as with any other process's updates.
+
+        Returns:
+            True if the workers were done within the timeout
+        """
+        with self.lock:
+            deadline = time.monotonic() + timeout
+            while self.draining and (time.monotonic() < deadline):
+                self.acked.wait(timeout=0.5)
+            if dev_id is None:
+                handles = self.handles
+            else:
+                handles = [self.handles[shard_for(dev_id, len(self.handles))]]
+            waits = [(handle, self.send(handle, ('forget', dev_id), check_busy=False)) for handle in handles]
+            while any(seq in handle.unacked for handle, seq in waits):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.acked.wait(timeout=remaining)
+            return True
+
+    def status(self):
+        """
+        Returns:
+            Dict with the number of workers and, per worker, its pid, whether it is alive, and its counters
+        """
+        with self.lock:
+            return {'num_workers': len(self.handles),
+                    'batch_size': self.batch_size,
+                    'flush_ms': self.flush_ms,
+                    'max_unacked': self.max_unacked,
+                    'workers': [{'shard': handle.shard,
+                                 'pid': handle.process.pid,
+                                 'alive': handle.process.is_alive(),
+                                 'unacked': len(handle.unacked),
+                                 'done': handle.num_done,
+                                 'restarts': handle.num_restarts} for handle in self.handles]}
@@ -12,13 +12,42 @@ on the FastAPI library for RESTful interfaces. It is run as follows:
 """
 
 import os
+import contextvars
 import datetime
-from fastapi import FastAPI, Query
-from pydantic import BaseModel
-import pymongo
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-import enum
+import importlib
+import itertools
+import json
+import math
+import re
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional, Union
+from fastapi import FastAPI, Query, HTTPException, Request, WebSocket, WebSocketDisconnect, Header, Depends
+from fastapi.responses import StreamingResponse, FileResponse, PlainTextResponse, JSONResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from starlette.websockets import WebSocketClose
+import tempfile
+from pydantic import BaseModel, Field, create_model, model_validator
+from bson import ObjectId
+from bson.errors import InvalidId
+from admission import AdmissionController, AdmissionRejected
+from event_stream import EventBroker
+from anomaly import AnomalyDetector
+from config_store import DeviceConfigStore, DEFAULTS_DEV_ID, DEVICE_CONFIG_KEYS
+from scheduler import TimerScheduler
+from profiler import RequestProfiler, profiled, PROFILER_MODES
+import device_state
+import reading_sketches
+from metrics import METRICS, OFFLINE, METRIC_NAME_REGEX, RESERVED_NAMES, format_value, metric_name
+from tracing import Tracer, JsonLinesExporter, traced
+from fleet_summary import SummaryCache, fleet_summary
+from tenants import DEFAULT_TENANT, CURRENT_TENANT, TenantRejected, TenantRouter, TenantLocal, tenant_scope, parse_tenants
+# Imported on first use rather than here, so a new worker answers the liveness probe sooner: pymongo (also by
+#  the modules above) and db_monitor / ingest_workers, which need it, once warm_up() gets to the database;
+#  sendgrid (pre-imported by warm_up()); and export_data (pandas / pyarrow), cProfile and pstats (profiler.py),
+#  which only the export and profiler resources use
 
 
 # =================================================================================================
@@ -31,28 +60,44 @@ app = FastAPI()         # Our FastAPI instance object; this starts the whole pro
 CONFIG_DATA = {}        # Configuration data; will load on startup
 SECRET_DATA = {}        # Secret data, keys and such; will load on startup
 
+# The per-tenant objects are TenantLocals (see tenants.py); e.g. DEVICE_CONFIG.get() is the current tenant's
+ADMISSION = None        # Per-tenant AdmissionController for the ingest path; created on startup
+EVENTS = TenantLocal(lambda tenant: EventBroker())  # Pushes readings & alert transitions to live stream subscribers
+ANOMALY_DETECTOR = None # Optional z-score AnomalyDetector (its statistics are in the state docs); created on startup if enabled
+DEVICE_CONFIG = None    # Per-tenant DeviceConfigStore of per-device thresholds etc.; created on startup
+SCHEDULER = None        # Per-tenant TimerScheduler for renotifications & device offline detection; created on startup
+PROFILER = RequestProfiler()    # Request profiler; off unless switched on via the profiler resource
+DB_MONITOR = None       # CommandMonitor timing every MongoDB command; created on startup if enabled
+TRACER = Tracer('api_server')   # Request tracing; off unless enabled in the config
+INGEST = None           # ShardedIngest worker pool for the default tenant's readings; created on startup if enabled
+FLEET_SUMMARY = None    # Per-tenant SummaryCache of the last fleet summary; created on startup
+TENANTS = None          # TenantRouter picking each request's tenant and holding their MongoClients; created on startup
+MONGODB = None          # MongoClient shared by all the default tenant's requests; created on first use (see get_db())
+MONGODB_LOCK = threading.Lock()
+READ_PREFERENCE = None  # Where the read-only resources read from (see get_read_db()); set by warm_up()
+REQUESTED_READ_PREFERENCE = contextvars.ContextVar('read_preference', default=None)    # a request's override of it
+READINESS = {'ready': False,        # True once warm_up() is done; until then requests get a 503
+             'stage': 'starting',   # what warm_up() is doing
+             'error': None,         # why its last attempt failed, if it did
+             'startup_secs': None}  # seconds from startup to ready
+
 TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
+# Read preference modes -> their class in pymongo.read_preferences
+READ_PREFERENCES = {'primary': 'Primary',
+                    'primaryPreferred': 'PrimaryPreferred',
+                    'secondary': 'Secondary',
+                    'secondaryPreferred': 'SecondaryPreferred',
+                    'nearest': 'Nearest'}
+
 TRACE_MESSAGE_PROCESSING = True         # For debugging; echos message processing calls to stdout
                                         # TODO: explore the logging library/module for this
 
 
-@enum.unique
-class ReadingType(enum.Enum):
-    TEMP = 1
-    HUMIDITY = 2
-
-    def __str__(self):
-        if self.value == 1:
-            return 'temp'
-        else:
-            return 'humidity'
-
-
-@app.on_event("startup")
-async def startup_event():
+def load_config():
     """
-    Stuff to do when the server starts up. Here we load configuration data needed throughout.
+    Load the secret and general configuration data into SECRET_DATA / CONFIG_DATA. Split out of
+    startup_event() so the offline tools (e.g. import_readings.py) can share the server's configuration.
 
     Returns:
         None
@@ -63,33 +108,827 @@ async def startup_event():
     assert SECRET_DATA['sendgrid_api_key'] is not None
     SECRET_DATA['mongodb_server_url'] = os.environ.get('mongodb_server_url')
     assert SECRET_DATA['mongodb_server_url'] is not None
+    SECRET_DATA['admin_api_key'] = os.environ.get('admin_api_key')     # optional; the admin resources are off without it
+    SECRET_DATA['tenants'] = parse_tenants(os.environ.get('tenants'))  # optional; JSON tenant definitions, see tenants.py
 
-    # Load general configuration data
-    # TODO: Find a better way to deal with this; maybe configparser or store in the MongoDB?
+    # Load general configuration data. The alert thresholds, renotification delay and email addresses
+    #  here are the global defaults; they can be overridden, globally or per device, via the device-config
+    #  resource (see config_store.py)
     CONFIG_DATA['mongodb_database_name'] = 'basement_data'
+    CONFIG_DATA['mongodb_min_pool_size'] = 4              # connections opened during warm-up and kept open
+    CONFIG_DATA['read_preference'] = 'secondaryPreferred' # where the read-only resources read; see get_read_db().
+                                                          #  A request can override it with X-Read-Preference
+    CONFIG_DATA['read_max_staleness_secs'] = 90           # max secondary lag for those reads; -1 for no limit
     CONFIG_DATA['num_continuous_readings_to_check'] = 4
     CONFIG_DATA['temp_range_min'] = 65
     CONFIG_DATA['temp_range_max'] = 70
     CONFIG_DATA['humidity_range_min'] = 40
     CONFIG_DATA['humidity_range_max'] = 50
+    CONFIG_DATA['co2_range_min'] = 0                    # the other metrics of metrics.py; ppm
+    CONFIG_DATA['co2_range_max'] = 1500
+    CONFIG_DATA['pressure_range_min'] = 950.0           # hPa
+    CONFIG_DATA['pressure_range_max'] = 1050.0
+    CONFIG_DATA['water_leak_range_min'] = 0             # any water at all
+    CONFIG_DATA['water_leak_range_max'] = 0
+    CONFIG_DATA['water_leak_num_readings'] = 1          # alert on the first reading, not after several
     CONFIG_DATA['alert_renotification_delay'] = 1440     # num minutes to wait to resend an alert notification email
+    CONFIG_DATA['device_offline_minutes'] = 150          # num minutes without a reading before an offline alert; 0 disables
+    CONFIG_DATA['device_heartbeat_minutes'] = 60         # longest a device goes without sending; its deadband heartbeat
+                                                         #  interval. device_offline_minutes must be at least twice this
     CONFIG_DATA['email_from'] = 'WadeLykkehoy@ZenDataAnalytics.com'
     CONFIG_DATA['email_to'] = ' WadeLykkehoy@gmail.com'
 
+    # Admission control / backpressure for POST /readings/
+    CONFIG_DATA['ingest_max_in_flight'] = 16           # max readings being processed at once
+    CONFIG_DATA['ingest_max_queued'] = 64              # max readings waiting for a processing slot
+    CONFIG_DATA['ingest_queue_timeout'] = 2.0          # max seconds a reading waits for a slot
+    CONFIG_DATA['device_rate_limit_per_sec'] = 2.0     # sustained readings per second per device; 0 disables
+    CONFIG_DATA['device_rate_limit_burst'] = 20        # readings a device may send in a burst
+
+    # Live event stream
+    CONFIG_DATA['stream_max_queue_size'] = 100         # events held for a slow subscriber before dropping
+    CONFIG_DATA['stream_keepalive_secs'] = 15          # idle time before sending a keep-alive
+
+    # Optional z-score anomaly detection, in addition to the fixed range check
+    CONFIG_DATA['anomaly_detection_enabled'] = False
+    CONFIG_DATA['anomaly_ewma_alpha'] = 0.01           # weight of each new reading; ~100 readings of memory
+    CONFIG_DATA['anomaly_z_threshold'] = 4.0           # num std deviations from the mean to be anomalous
+    CONFIG_DATA['anomaly_min_samples'] = 30            # readings needed for a device before flagging anything
+    CONFIG_DATA['anomaly_min_std'] = 1.0               # std deviation floor; readings are integers
+
+    # Parquet exports
+    CONFIG_DATA['export_row_group_size'] = 1000000     # rows per Parquet row group
+
+    # Per-device config
+    CONFIG_DATA['device_config_ttl_secs'] = 60         # max seconds before another process's changes are picked up
+
+    # Scheduled renotifications / offline alerts
+    CONFIG_DATA['scheduler_retry_secs'] = 60           # seconds before retrying a timer that failed (e.g. DB error)
+
+    # MongoDB command monitoring
+    CONFIG_DATA['db_monitoring_enabled'] = True
+    CONFIG_DATA['db_slow_op_ms'] = 100                 # commands taking longer are logged
+    CONFIG_DATA['db_slow_op_log_size'] = 100           # number of recent slow commands kept for the db-stats resource
+
+    # Request tracing (see tracing.py)
+    CONFIG_DATA['tracing_enabled'] = False
+    CONFIG_DATA['tracing_file'] = 'traces.jsonl'      # spans are appended here as JSON lines; None for the console
+
+    # Sharded ingest workers (see ingest_workers.py); needs a single server process as the dispatcher
+    CONFIG_DATA['ingest_workers'] = 0                  # number of worker processes; 0 processes readings in the request
+    CONFIG_DATA['ingest_batch_size'] = 100             # max readings / timers per worker DB write
+    CONFIG_DATA['ingest_flush_ms'] = 50                # max milliseconds a reading waits to be written
+    CONFIG_DATA['ingest_max_unacked'] = 1000           # max readings waiting on a worker before rejecting with 429
+
+    # Fleet summary
+    CONFIG_DATA['fleet_summary_cache_secs'] = 5        # max seconds a summary is reused; ingest invalidates it sooner
+
+    # Tenants (see tenants.py); the default tenant uses mongodb_database_name via the shared client
+    CONFIG_DATA['tenant_max_clients'] = 8              # max tenant MongoClients open at once; least recently used is closed
+    CONFIG_DATA['tenant_max_pool_size'] = 20           # max connections per tenant, unless the tenant sets its own
+    CONFIG_DATA['tenant_client_close_delay_secs'] = 30 # seconds a closed tenant client is kept for requests using it
+
+
+@app.on_event("startup")
+async def startup_event():
+    """
+    Stuff to do when the server starts up. Here we load configuration data needed throughout. Everything
+    needing the DB is done by warm_up() in the background, so the server answers the liveness probe at
+    once; it takes requests once warm_up() is done.
+
+    Returns:
+        None
+    """
+    load_config()
+
+    global ADMISSION, ANOMALY_DETECTOR, FLEET_SUMMARY, DEVICE_CONFIG, SCHEDULER, TENANTS
+    check_read_preference(CONFIG_DATA['read_preference'], CONFIG_DATA['read_max_staleness_secs'])   # set by warm_up()
+    if CONFIG_DATA['anomaly_detection_enabled']:
+        ANOMALY_DETECTOR = AnomalyDetector(alpha=CONFIG_DATA['anomaly_ewma_alpha'],
+                                           z_threshold=CONFIG_DATA['anomaly_z_threshold'],
+                                           min_samples=CONFIG_DATA['anomaly_min_samples'],
+                                           min_std=CONFIG_DATA['anomaly_min_std'])
+    TENANTS = TenantRouter(SECRET_DATA['tenants'], SECRET_DATA['mongodb_server_url'],
+                           max_clients=CONFIG_DATA['tenant_max_clients'],
+                           max_pool_size=CONFIG_DATA['tenant_max_pool_size'],
+                           close_delay_secs=CONFIG_DATA['tenant_client_close_delay_secs'])
+    # Each tenant gets its own admission control, so a noisy tenant is rejected before it slows the others
+    ADMISSION = TenantLocal(lambda tenant: AdmissionController(max_in_flight=CONFIG_DATA['ingest_max_in_flight'],
+                                                               max_queued=CONFIG_DATA['ingest_max_queued'],
+                                                               queue_timeout=CONFIG_DATA['ingest_queue_timeout'],
+                                                               device_rate=CONFIG_DATA['device_rate_limit_per_sec'],
+                                                               device_burst=CONFIG_DATA['device_rate_limit_burst']))
+    FLEET_SUMMARY = TenantLocal(lambda tenant: SummaryCache(CONFIG_DATA['fleet_summary_cache_secs']))
+    DEVICE_CONFIG = TenantLocal(new_device_config)
+    SCHEDULER = TenantLocal(new_scheduler)
+
+    threading.Thread(target=warm_up, args=(time.monotonic(),), name='warm_up', daemon=True).start()
+
+
+def warm_up(started):
+    """
+    Set up everything that needs the DB: the shared MongoDB client and its connection pool, indexes,
+    device config, device states, ingest workers and timers. Runs on its own
+    thread, retrying (e.g. while the DB cannot be reached) until it succeeds, then marks the server ready.
+    Each step can be re-run, so a retry carries on from where the last attempt failed.
+
+    Args:
+        started (float):      time.monotonic() at startup
+
+    Returns:
+        None
+    """
+    global DB_MONITOR, INGEST, READ_PREFERENCE
+    for attempt in itertools.count():
+        try:
+            # Before any MongoClient is created, as listeners only apply to clients created after registering
+            if CONFIG_DATA['db_monitoring_enabled'] and (DB_MONITOR is None):
+                import pymongo.monitoring
+                from db_monitor import CommandMonitor
+                DB_MONITOR = CommandMonitor(slow_op_ms=CONFIG_DATA['db_slow_op_ms'],
+                                            slow_op_log_size=CONFIG_DATA['db_slow_op_log_size'],
+                                            verbose=TRACE_MESSAGE_PROCESSING,
+                                            tenant_func=CURRENT_TENANT.get)
+                pymongo.monitoring.register(DB_MONITOR)
+
+            if CONFIG_DATA['tracing_enabled'] and not TRACER.enabled:
+                TRACER.enable(JsonLinesExporter(CONFIG_DATA['tracing_file']))
+
+            READINESS['stage'] = 'connecting to the database'
+            READ_PREFERENCE = read_preference(CONFIG_DATA['read_preference'], CONFIG_DATA['read_max_staleness_secs'])
+            get_db().command('ping')
+
+            READINESS['stage'] = 'creating indexes'
+            ensure_indexes()
+
+            READINESS['stage'] = 'loading device config'
+            DEVICE_CONFIG.current()
+
+            READINESS['stage'] = 'loading device states'
+            backfill_device_states()
+
+            # Before the scheduler, which hands due timers to the workers
+            if (CONFIG_DATA['ingest_workers'] > 0) and (INGEST is None):
+                READINESS['stage'] = 'starting ingest workers'
+                from ingest_workers import ShardedIngest
+                ingest = ShardedIngest(CONFIG_DATA['ingest_workers'],
+                                       SECRET_DATA['mongodb_server_url'],
+                                       CONFIG_DATA['mongodb_database_name'],
+                                       handle_ingest_results,
+                                       batch_size=CONFIG_DATA['ingest_batch_size'],
+                                       flush_ms=CONFIG_DATA['ingest_flush_ms'],
+                                       max_unacked=CONFIG_DATA['ingest_max_unacked'])
+                ingest.start()
+                INGEST = ingest
+
+            READINESS['stage'] = 'loading timers'
+            load_timers()
+            if SCHEDULER.thread is None:
+                SCHEDULER.start()
+
+            # So the first alert does not pay for the import
+            importlib.import_module('sendgrid.helpers.mail')
+
+            READINESS.update(ready=True, stage='ready', error=None,
+                             startup_secs=round(time.monotonic() - started, 3))
+            if TRACE_MESSAGE_PROCESSING:
+                print('==> ready after {}s'.format(READINESS['startup_secs']), flush=True)
+            if TENANTS.tenants:
+                threading.Thread(target=activate_tenants, name='activate_tenants', daemon=True).start()
+            return
+        except Exception as e:
+            traceback.print_exc()
+            READINESS['error'] = '{}: {}'.format(type(e).__name__, e)
+            time.sleep(min(30, 2 ** attempt))
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """
+    Stuff to do when the server shuts down.
+
+    Returns:
+        None
+    """
+    if SCHEDULER is not None:
+        for scheduler in SCHEDULER.instances().values():
+            scheduler.stop()
+    if INGEST is not None:
+        INGEST.stop()
+    if DEVICE_CONFIG is not None:
+        for device_config in DEVICE_CONFIG.instances().values():
+            device_config.stop()
+    if MONGODB is not None:
+        MONGODB.close()
+    if TENANTS is not None:
+        TENANTS.close()
+    TRACER.disable()
+
+
+def get_db():
+    """
+    The current tenant's MongoDB database. The default tenant's is through a MongoClient shared by all
+    its requests and background threads. A MongoClient is thread-safe and keeps a pool of connections;
+    creating one per request meant every request paid for a new connection (TCP + TLS + auth to Atlas)
+    and monitoring threads. Other tenants each have a MongoClient of their own (see tenants.py).
+
+    Returns:
+        The pymongo Database
+    """
+    tenant = CURRENT_TENANT.get()
+    if tenant != DEFAULT_TENANT:
+        return TENANTS.database(tenant)
+
+    global MONGODB
+    if MONGODB is None:
+        with MONGODB_LOCK:
+            if MONGODB is None:
+                import pymongo
+                MONGODB = pymongo.MongoClient(SECRET_DATA['mongodb_server_url'],
+                                              minPoolSize=CONFIG_DATA['mongodb_min_pool_size'])
+    return MONGODB[CONFIG_DATA['mongodb_database_name']]
+
+
+def check_read_preference(name, max_staleness_secs):
+    """
+    Check the read preference settings; see read_preference().
+
+    Raises:
+        ValueError:   If the settings are not valid
+    """
+    if name not in READ_PREFERENCES:
+        raise ValueError('read_preference must be one of: {}'.format(', '.join(READ_PREFERENCES)))
+    if (name != 'primary') and (max_staleness_secs != -1) and (max_staleness_secs < 90):
+        raise ValueError('read_max_staleness_secs must be -1 (no limit) or at least 90')
+
+
+def read_preference(name, max_staleness_secs):
+    """
+    The pymongo read preference for the read-only resources.
+
+    Args:
+        name (str):                   'primary', 'primaryPreferred', 'secondary', 'secondaryPreferred' or 'nearest'
+        max_staleness_secs (int):     Max seconds a secondary may lag the primary and still be read from;
+                                      -1 for no limit. MongoDB needs at least 90. Ignored for 'primary'
+
+    Returns:
+        The read preference
+
+    Raises:
+        ValueError:   If the settings are not valid
+    """
+    check_read_preference(name, max_staleness_secs)
+    import pymongo.read_preferences
+    read_preference_class = getattr(pymongo.read_preferences, READ_PREFERENCES[name])
+    if name == 'primary':
+        return read_preference_class()
+    return read_preference_class(max_staleness=max_staleness_secs)
+
+
+def get_read_db():
+    """
+    The current tenant's database for the read-only resources (counts, percentiles, exports, alert
+    history). Reads go where the read_preference setting says, by default to a secondary of a replica
+    set, so dashboards polling them do not compete with the inserts and alert state updates on the
+    primary; those, and anything read in order to write, stay on get_db(). A secondary may be up to
+    read_max_staleness_secs behind, so a reading may not be counted at once; a request needing to read
+    its own writes sends X-Read-Preference: primary (see ReadPreferenceRouting). Against a standalone
+    server every read goes to it.
+
+    Returns:
+        The pymongo Database
+    """
+    return get_db().with_options(read_preference=REQUESTED_READ_PREFERENCE.get() or READ_PREFERENCE)
+
+
+class ReadPreferenceRouting:
+    """
+    ASGI middleware letting a request override the read_preference setting for its reads with header
+    X-Read-Preference (a mode of READ_PREFERENCES, with the configured max staleness); e.g. 'primary'
+    for a client that reads straight after writing. An unknown mode gets a 400.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        name = None
+        if scope['type'] == 'http':
+            for key, value in scope['headers']:
+                if key == b'x-read-preference':
+                    name = value.decode('latin-1')
+                    break
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            preference = read_preference(name, CONFIG_DATA['read_max_staleness_secs'])
+        except ValueError as e:
+            response = JSONResponse(status_code=400, content={'detail': 'X-Read-Preference: {}'.format(e)})
+            await response(scope, receive, send)
+            return
+        token = REQUESTED_READ_PREFERENCE.set(preference)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            REQUESTED_READ_PREFERENCE.reset(token)
+
+
+app.add_middleware(ReadPreferenceRouting)
+
+
+def ensure_indexes():
+    """
+    Create the indexes backing our queries. create_index() is a no-op when the index already
+    exists, so this is safe to run on every startup.
+
+    Returns:
+        None
+    """
+    import pymongo
+    db = get_db()
+
+    # Most recent readings for a device
+    db.readings.create_index([('dev_id', pymongo.ASCENDING), ('ts', pymongo.DESCENDING)])
+
+    # Active alert lookups by device / reading type
+    db.active_alerts.create_index([('dev_id', pymongo.ASCENDING), ('reading_type', pymongo.ASCENDING)])
+
+    # Alert history queries; filtered by device / reading type / time, keyset paginated on (originated_ts, _id)
+    db.alert_history.create_index([('dev_id', pymongo.ASCENDING), ('reading_type', pymongo.ASCENDING),
+                                   ('originated_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    db.alert_history.create_index([('originated_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+
+    # Per-device config overrides; one doc per device
+    db.device_config.create_index([('dev_id', pymongo.ASCENDING)], unique=True)
+
+    # Per-device alert state; one doc per device, updated on every reading
+    db.device_state.create_index([('dev_id', pymongo.ASCENDING)], unique=True)
+
+    # Per-day reading sketches for percentile queries; one doc per device / day
+    db.reading_sketches.create_index([('dev_id', pymongo.ASCENDING), ('day', pymongo.ASCENDING)], unique=True)
+    db.reading_sketches.create_index([('day', pymongo.ASCENDING)])
+
+
+# =================================================================================================
+# The following code handles the liveness / readiness probes. Until warm_up() is done, every other
+# request gets a 503 with a Retry-After header rather than failing part way through.
+# =================================================================================================
+
+READINESS_EXEMPT_PATHS = {'/live/', '/ready/', '/docs', '/redoc', '/openapi.json'}
+
+
+class ReadinessGate:
+    """
+    ASGI middleware turning requests away until the server is ready. A plain ASGI class rather than
+    @app.middleware('http'), which costs far more per request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if READINESS['ready'] or (scope['type'] != 'http') or (scope['path'] in READINESS_EXEMPT_PATHS):
+            await self.app(scope, receive, send)
+            return
+        response = JSONResponse(status_code=503,
+                                content={'detail': 'Server is starting: {}'.format(READINESS['stage'])},
+                                headers={'Retry-After': '1'})
+        await response(scope, receive, send)
+
+
+app.add_middleware(ReadinessGate)
+
+
+@app.get("/live/")
+def get_live():
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'live'; the liveness probe. Returns status 200 as long
+    as the server process is up, whether or not it is ready for requests.
+    """
+    return {'status': 'alive'}
+
+
+@app.get("/ready/")
+def get_ready():
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'ready'; the readiness probe. Returns status 200 once the
+    server is connected to the database and its caches are loaded, else status 503 with what it is
+    waiting on (and the last error, if any). Until then, other requests get status 503 too.
+    """
+    if not READINESS['ready']:
+        raise HTTPException(status_code=503,
+                            detail={'status': 'starting', 'stage': READINESS['stage'], 'error': READINESS['error']},
+                            headers={'Retry-After': '1'})
+    return {'status': 'ready',
+            'startup_secs': READINESS['startup_secs']}
+
+
+# =================================================================================================
+# The following code handles tenants (see tenants.py). Each request is for the tenant picked by its
+# X-API-Key / X-Tenant headers, and works against that tenant's database, device config, admission
+# control, timers and so on; requests without either header are for the default tenant.
+# =================================================================================================
+
+class TenantRouting:
+    """
+    ASGI middleware making a request's tenant the current tenant (CURRENT_TENANT) while it is handled.
+    Requests naming a tenant they may not use get a 401 (404 for an unknown tenant); WebSockets are
+    closed instead.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] not in ('http', 'websocket')) or (TENANTS is None) or (not TENANTS.tenants) or \
+                (scope['path'] in READINESS_EXEMPT_PATHS):
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        try:
+            tenant = TENANTS.resolve(headers.get('x-api-key'), headers.get('x-tenant'))
+        except TenantRejected as e:
+            if scope['type'] == 'websocket':
+                response = WebSocketClose(code=1008)        # policy violation
+            else:
+                response = JSONResponse(status_code=e.status_code, content={'detail': e.reason})
+            await response(scope, receive, send)
+            return
+        token = CURRENT_TENANT.set(tenant)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            CURRENT_TENANT.reset(token)
+
+
+app.add_middleware(TenantRouting)
+
+
+def tenant_database_location(tenant):
+    """
+    Returns:
+        Tuple of a tenant's MongoDB connection string and database name
+    """
+    if tenant == DEFAULT_TENANT:
+        return SECRET_DATA['mongodb_server_url'], CONFIG_DATA['mongodb_database_name']
+    return TENANTS.location(tenant)
+
+
+def new_device_config(tenant):
+    """
+    DEVICE_CONFIG factory; loads the tenant's device config and starts keeping it up to date.
+    """
+    device_config = DeviceConfigStore(CONFIG_DATA, ttl_secs=CONFIG_DATA['device_config_ttl_secs'])
+    device_config.start(*tenant_database_location(tenant))
+    return device_config
+
+
+def new_scheduler(tenant):
+    """
+    SCHEDULER factory; the tenant's timers fire for that tenant. Not started here, as load_timers() needs
+    the scheduler; see warm_up() and activate_tenants().
+    """
+    def fire_tenant_timers(keys):
+        with tenant_scope(tenant):
+            fire_timers(keys)
+    return TimerScheduler(fire_tenant_timers)
+
+
+def activate_tenants():
+    """
+    Do for each of the other tenants what warm_up() does for the default tenant: indexes, device config,
+    device states and timers. Runs on its own thread once the server is ready,
+    retrying the tenants that failed (e.g. their DB cannot be reached) until all succeed. Until a tenant
+    is done, its requests are served, but its timers wait.
+
+    Returns:
+        None
+    """
+    pending = list(TENANTS.tenants)
+    for attempt in itertools.count():
+        failed = []
+        for tenant in pending:
+            try:
+                with tenant_scope(tenant):
+                    ensure_indexes()
+                    DEVICE_CONFIG.current()
+                    backfill_device_states()
+                    load_timers()
+                    if SCHEDULER.thread is None:
+                        SCHEDULER.start()
+                if TRACE_MESSAGE_PROCESSING:
+                    print('==> tenant {} ready'.format(tenant), flush=True)
+            except Exception:
+                traceback.print_exc()
+                failed.append(tenant)
+        if not failed:
+            return
+        pending = failed
+        time.sleep(min(30, 2 ** attempt))
+
+
+def tenant_ingest():
+    """
+    The sharded ingest workers, if they serve the current tenant. They write to the default tenant's
+    database only; other tenants' readings and timers are processed in the request / scheduler thread.
+
+    Returns:
+        The ShardedIngest, or None
+    """
+    return INGEST if CURRENT_TENANT.get() == DEFAULT_TENANT else None
+
+
+# =================================================================================================
+# The following code handles the timers for scheduled renotifications and device offline alerts.
+# Each device / reading type with an active alert has a timer due at its next renotification; each
+# device also has an offline timer, pushed back by every reading, which raises an offline alert if
+# it ever fires. An offline alert then uses the same timer for its own renotifications.
+# =================================================================================================
+
+def schedule_offline_timer(dev_id):
+    """
+    (Re)start a device's offline timer; called for every reading.
+
+    Args:
+        dev_id (str):     Device ID
+
+    Returns:
+        None
+    """
+    offline_minutes = DEVICE_CONFIG.get(dev_id)['device_offline_minutes']
+    if offline_minutes > 0:
+        SCHEDULER.schedule((dev_id, OFFLINE), time.time() + (offline_minutes * 60))
+    else:
+        SCHEDULER.cancel((dev_id, OFFLINE))
+
+
+def schedule_renotification_timer(dev_id, reading_type, notification_datetime):
+    """
+    Set the timer for an active alert's next renotification. With a renotification delay of 0,
+    renotifications are only triggered by readings, so no timer is set.
+
+    Args:
+        dev_id (str):                         Device ID
+        reading_type (str):                   Type of reading
+        notification_datetime (datetime):     When the last notification was sent
+
+    Returns:
+        None
+    """
+    renotification_delay = DEVICE_CONFIG.get(dev_id)['alert_renotification_delay']
+    if renotification_delay > 0:
+        due = notification_datetime + datetime.timedelta(minutes=renotification_delay)
+        SCHEDULER.schedule((dev_id, reading_type), due.timestamp())
+    else:
+        SCHEDULER.cancel((dev_id, reading_type))
+
+
+def backfill_device_states():
+    """
+    Create state docs (see device_state.py) for devices with active alerts raised before there were
+    state docs, seeded with the device's recent readings, so the alerts carry on rather than being
+    raised again. Other devices get their state doc with their next reading.
+
+    Returns:
+        None
+    """
+    import pymongo
+    db = get_db()
+
+    now_ts = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+    for dev_id in db.active_alerts.distinct('dev_id'):
+        if db.device_state.count_documents({'dev_id': dev_id}, limit=1) > 0:
+            continue
+        config = DEVICE_CONFIG.get(dev_id)
+        readings = db.readings.find({'dev_id': dev_id}).sort('ts', pymongo.DESCENDING).limit(device_state.MIN_WINDOW_SIZE)
+        readings = list(readings)[::-1]
+        doc = {'dev_id': dev_id,
+               'last_seen': now_ts}
+        for reading_type in device_state.STATE_READING_TYPES:
+            rule = device_state.metric_rule(config, reading_type)
+            if rule is None:
+                continue
+            window = []
+            for reading in readings:
+                if reading.get(reading_type) is not None:
+                    window.extend(device_state.window_flags(device_state.range_flag(rule, reading[reading_type]),
+                                                            reading.get('repeat_count', 1), rule['num_readings']))
+            doc['{}_window'.format(reading_type)] = window[-device_state.MIN_WINDOW_SIZE:]
+        for alert in db.active_alerts.find({'dev_id': dev_id}):
+            doc['{}_alert'.format(alert['reading_type'])] = {'originated_ts': alert['originated_ts'],
+                                                             'notification_ts': alert['notification_ts'],
+                                                             'max_value': alert.get('max_value'),
+                                                             'min_value': alert.get('min_value'),
+                                                             'last_value': alert.get('last_value', alert.get('max_value'))}
+        db.device_state.update_one({'dev_id': dev_id}, {'$setOnInsert': doc}, upsert=True)
+
+
+def load_timers():
+    """
+    Set up the timers on startup: renotification timers for the active alerts, and offline timers
+    for every other device, giving each a full offline timeout from now.
+
+    Returns:
+        None
+    """
+    db = get_db()
+
+    projection = {'{}_alert'.format(reading_type): True for reading_type in device_state.STATE_READING_TYPES + [OFFLINE]}
+    projection['dev_id'] = True
+    for doc in db.device_state.find({}, projection):
+        for reading_type, alert in device_state.active_alerts(doc):
+            schedule_renotification_timer(doc['dev_id'], reading_type,
+                                          datetime.datetime.strptime(alert['notification_ts'], TIMESTAMP_FORMAT))
+        if doc.get('offline_alert') is None:
+            schedule_offline_timer(doc['dev_id'])
+
+
+def fire_timers(keys):
+    """
+    Called by the scheduler, on its own thread, with the (dev_id, reading type) keys of the timers
+    that are due.
+
+    Args:
+        keys (list):      (dev_id, reading type) tuples
+
+    Returns:
+        None
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> fire_timers({} timers)'.format(len(keys)), flush=True)
+
+    import pymongo.errors
+    db = get_db()
+    for dev_id, reading_type in keys:
+        try:
+            with TRACER.span('fire_timer', dev_id=dev_id, reading_type=reading_type, tenant=CURRENT_TENANT.get()):
+                if tenant_ingest() is not None:
+                    submit_timer(dev_id, reading_type)
+                else:
+                    fire_timer(db, dev_id, reading_type)
+        except (pymongo.errors.PyMongoError, AdmissionRejected):
+            traceback.print_exc()
+            SCHEDULER.schedule((dev_id, reading_type), time.time() + CONFIG_DATA['scheduler_retry_secs'])
+    FLEET_SUMMARY.invalidate()
+
+
+def fire_timer(db, dev_id, reading_type):
+    """
+    Handle one due timer: a renotification if the device / reading type has an active alert, else
+    for an offline timer, a device offline alert. Timers set by other server processes, or set before
+    a reading arrived at another process, may find nothing to do; they are rescheduled as needed.
+
+    Args:
+        db:                           Connection to our MongoDB database
+        dev_id (str):                 Device ID
+        reading_type (str):           Type of reading; 'offline' for the offline timer
+
+    Returns:
+        None
+    """
+    doc = db.device_state.find_one({'dev_id': dev_id})
+    if doc is None:
+        return
+    now = datetime.datetime.now()
+    last_seen_datetime = datetime.datetime.strptime(doc['last_seen'], TIMESTAMP_FORMAT)
+    alert = doc.get('{}_alert'.format(reading_type))
+
+    if alert is not None:
+        if reading_type == OFFLINE:
+            current_value = int((now - last_seen_datetime).total_seconds() // 60)
+        else:
+            current_value = alert.get('last_value', alert.get('max_value'))
+        renotify_if_due(db, dev_id, reading_type, alert, current_value)
+    elif reading_type == OFFLINE:
+        offline_minutes = DEVICE_CONFIG.get(dev_id)['device_offline_minutes']
+        if offline_minutes <= 0:
+            return
+        offline_before = now - datetime.timedelta(minutes=offline_minutes)
+        alert = device_state.raise_offline(db.device_state, dev_id, offline_before.strftime(TIMESTAMP_FORMAT),
+                                           now.strftime(TIMESTAMP_FORMAT), offline_minutes)
+        if alert is not None:
+            handle_alert_raised(db, dev_id, OFFLINE, alert)
+        else:
+            # Seen since (e.g. by another server process), or already offline; check again a full
+            #  timeout after the last reading
+            doc = db.device_state.find_one({'dev_id': dev_id}, {'last_seen': True, 'offline_alert': True})
+            if doc.get('offline_alert') is None:
+                last_seen_datetime = datetime.datetime.strptime(doc['last_seen'], TIMESTAMP_FORMAT)
+                due = last_seen_datetime + datetime.timedelta(minutes=offline_minutes)
+                SCHEDULER.schedule((dev_id, OFFLINE), max(due.timestamp(), time.time() + 1))
+    # Else the alert has been cleared since the timer was set; nothing to do
+
+
+def submit_timer(dev_id, reading_type):
+    """
+    Hand a due timer to the device's ingest worker, which owns the device's state; the outcome comes
+    back via handle_ingest_results().
+
+    Args:
+        dev_id (str):                 Device ID
+        reading_type (str):           Type of reading; 'offline' for the offline timer
+
+    Returns:
+        None
+    """
+    config = DEVICE_CONFIG.get(dev_id)
+    now = datetime.datetime.now()
+    renotify_before = now - datetime.timedelta(minutes=config['alert_renotification_delay'])
+    offline_before = now - datetime.timedelta(minutes=config['device_offline_minutes'])
+    INGEST.submit_timer(dev_id, reading_type, now.strftime(TIMESTAMP_FORMAT),
+                        renotify_before.strftime(TIMESTAMP_FORMAT), offline_before.strftime(TIMESTAMP_FORMAT),
+                        config['device_offline_minutes'])
+
+
+def handle_ingest_results(results):
+    """
+    Called by the ingest worker pool, on a background thread, once a batch of readings / timers is in the
+    DB, with what they changed; takes the same actions as process_reading() and fire_timer().
+
+    Args:
+        results (list):   (dev_id, 'transition', reading type, transition, alert, value),
+                          (dev_id, 'not_due', reading type, notification_ts) and
+                          (dev_id, 'seen', 'offline', last_seen) tuples; see ingest_workers.evaluate_timer()
+
+    Returns:
+        None
+    """
+    db = get_db()
+    changes = []
+    for result in results:
+        dev_id, kind, reading_type = result[0], result[1], result[2]
+        if kind == 'not_due':
+            # A renotification was sent since the timer was set
+            schedule_renotification_timer(dev_id, reading_type, datetime.datetime.strptime(result[3], TIMESTAMP_FORMAT))
+            continue
+        elif kind == 'seen':
+            # Seen since the offline timer was set; check again a full timeout after the last reading
+            due = datetime.datetime.strptime(result[3], TIMESTAMP_FORMAT) + \
+                datetime.timedelta(minutes=DEVICE_CONFIG.get(dev_id)['device_offline_minutes'])
+            SCHEDULER.schedule((dev_id, OFFLINE), max(due.timestamp(), time.time() + 1))
+            continue
+        transition, alert, current_value = result[3], result[4], result[5]
+        changes.append((dev_id, reading_type, transition, alert,
+                        alert['last_value'] if transition == 'raised' else current_value))
+    if changes:
+        handle_alert_changes(db, changes)      # one write per collection for the whole batch
+    FLEET_SUMMARY.invalidate()
+
 
 # =================================================================================================
 # The following code process readings related messages; post / get count / delete
 # =================================================================================================
 
-# Defines the message body that we will receive when a 'reading' message is posted
+# Query parameter regexes for the reading types; the metrics (see metrics.py), plus 'offline' for alerts
+METRIC_REGEX = '|'.join('^{}$'.format(metric) for metric in METRICS)
+READING_TYPE_REGEX = '|'.join('^{}$'.format(reading_type) for reading_type in list(METRICS) + [OFFLINE])
+
+
+# Defines the message body that we will receive when a 'reading' message is posted. A reading carries
+#  one or more metrics; temp and humidity as their own fields (as the original devices send them), any
+#  others in metrics, by name.
 class ReadingsMsgBody(BaseModel):
     dev_id: str     # a unique ID for the device
     ts: str         # reading timestamp; in UTC: "2020-06-18T11:06:00Z"
-    temp: int       # temperature in Fahrenheit
-    humidity: int   # humidity as an integer percentage (e.g. 45 for 45%)
+    temp: Optional[int] = None          # temperature in Fahrenheit
+    humidity: Optional[int] = None      # humidity as an integer percentage (e.g. 45 for 45%)
+    metrics: Dict[str, Union[int, float]] = {}      # other metrics; e.g. {"co2": 850, "pressure": 1013.2}
+    repeat_count: int = Field(1, ge=1)      # number of readings this message stands for; > 1 when the client suppressed
+                                            #  unchanged readings (deadband mode) and is reporting them in one message
+    heartbeat: bool = False     # True if this repeats the device's last reported values rather than a new value
+
+    @model_validator(mode='after')
+    def check_metrics(self):
+        if (self.temp is None) and (self.humidity is None) and not self.metrics:
+            raise ValueError('A reading must carry at least one metric')
+        for name, value in self.metrics.items():
+            if (re.match(METRIC_NAME_REGEX, name) is None) or (name in RESERVED_NAMES):
+                raise ValueError('Invalid metric name \'{}\''.format(name))
+            if (name in ('temp', 'humidity')) and (getattr(self, name) is not None):
+                raise ValueError('Metric \'{}\' is given twice'.format(name))
+            if not math.isfinite(value):
+                raise ValueError('Metric \'{}\' is not a number'.format(name))
+        return self
+
+    def values(self):
+        """
+        The reading's metrics.
+
+        Returns:
+            Dict of metric -> value
+        """
+        values = {name: value for name, value in [('temp', self.temp), ('humidity', self.humidity)] if value is not None}
+        values.update(self.metrics)
+        return values
 
 
 @app.get("/readings/counts/")
+@profiled(PROFILER)
 def get_readings_counts(dev_id: str = Query(None,
                                             alias='dev-id',
                                             description='ID of the device')):
@@ -104,9 +943,8 @@ def get_readings_counts(dev_id: str = Query(None,
     if TRACE_MESSAGE_PROCESSING:
         print('==> get_readings_counts({})'.format(dev_id), flush=True)
 
-    # Connect to the MongoDB database; note it is hosted on Mongo Atlas
-    mongodb = pymongo.MongoClient(SECRET_DATA['mongodb_server_url'])
-    db = mongodb[CONFIG_DATA['mongodb_database_name']]       # This is the database we are using
+    # Get our MongoDB database; note it is hosted on Mongo Atlas
+    db = get_read_db()
 
     # Do the count for either all or the specified device
     query = {}
@@ -114,19 +952,17 @@ def get_readings_counts(dev_id: str = Query(None,
         query['dev_id'] = dev_id
     num_docs = db.readings.count_documents(query)
 
-    # Close the MongoDB connection when we are done with it
-    mongodb.close()
-
     return num_docs
 
 
+@traced(TRACER, attributes=('dev_id', 'reading_type'))
 def send_alert_notification_email(dev_id, reading_type, current_value):
     """
     Send an alert notification email using SendGrid.
 
     Args:
         dev_id (int):                 ID of the device for which the alert occurred
-        reading_type (ReadingType):   Type of reading;
+        reading_type (str):           Type of reading; a metric (see metrics.py) or 'offline'
         current_value (int):          Current value for the reading
 
     Returns:
@@ -135,302 +971,539 @@ def send_alert_notification_email(dev_id, reading_type, current_value):
     if TRACE_MESSAGE_PROCESSING:
         print('    ==> send_alert_notification_email({}, {}, {})'.format(dev_id, reading_type, current_value))
 
-    # Connect to the SendGrid client API
-    sendgrid_client = SendGridAPIClient(SECRET_DATA['sendgrid_api_key'])
-
     # Construct the email content
-    if reading_type == ReadingType.TEMP:
-        subject = '{} - Temperature Alert'.format(dev_id)
-        html_content = '<p><h2>{} Temperature Alert</h2></p>'.format(dev_id)
-        html_content += '<p>Current temperature is {}F.</p>'.format(current_value)
+    if reading_type == OFFLINE:
+        subject = '{} - Device Offline Alert'.format(dev_id)
+        html_content = '<p><h2>{} Device Offline Alert</h2></p>'.format(dev_id)
+        html_content += '<p>No readings received for {} minutes.</p>'.format(current_value)
     else:
-        subject = '{} - Humidity Alert'.format(dev_id)
-        html_content = '<p><h2>{} Humidity Alert</h2></p>'.format(dev_id)
-        html_content += '<p>Curent humidity is {}%.</p>'.format(current_value)
+        subject = '{} - {} Alert'.format(dev_id, metric_name(reading_type))
+        html_content = '<p><h2>{} {} Alert</h2></p>'.format(dev_id, metric_name(reading_type))
+        html_content += '<p>Current {} is {}.</p>'.format(metric_name(reading_type).lower(),
+                                                          format_value(reading_type, current_value))
 
     # Package up & send off
-    message = Mail(from_email=CONFIG_DATA['email_from'],
-                   to_emails=CONFIG_DATA['email_to'],
-                   subject=subject,
-                   html_content=html_content)
-    sendgrid_client.send(message)
+    send_email(dev_id, subject, html_content)
 
 
+@traced(TRACER, attributes=('dev_id', 'reading_type'))
 def send_alert_cleared_notification_email(dev_id, reading_type, current_value):
     """
     Send an alert cleared notification email using SendGrid.
 
     Args:
         dev_id (int):                 ID of the device for which the alert occurred and is now cleared
-        reading_type (ReadingType):   Type of reading
+        reading_type (str):           Type of reading; a metric (see metrics.py) or 'offline'
         current_value (int):          Current value for the reading
 
     Returns:
         None
     """
     if TRACE_MESSAGE_PROCESSING:
-        print('    ==> send_alert_cleared_notification_email({}, {}, {})'.format(dev_id, reading_type, current_value))
-
-    if reading_type == ReadingType.TEMP:
-        subject = '{} - Temperature Alert Cleared'.format(dev_id)
-        html_content = '<p><h2>{} Temperature Alert Cleared</h2></p>'.format(dev_id)
-        html_content += '<p>Current temperature is {}F.</p>'.format(current_value)
-    else:
-        subject = '{} - Humidity Alert Cleared'.format(dev_id)
-        html_content = '<p><h2>{} Humidity Alert Cleared</h2></p>'.format(dev_id)
-        html_content += '<p>Curent humidity is {}%.</p>'.format(current_value)
+        print('    ==> send_alert_cleared_notification_email({}, {}, {})'.format(dev_id, reading_type, current_value))
+
+    if reading_type == OFFLINE:
+        subject = '{} - Device Offline Alert Cleared'.format(dev_id)
+        html_content = '<p><h2>{} Device Offline Alert Cleared</h2></p>'.format(dev_id)
+        html_content += '<p>Readings have resumed.</p>'
+    else:
+        subject = '{} - {} Alert Cleared'.format(dev_id, metric_name(reading_type))
+        html_content = '<p><h2>{} {} Alert Cleared</h2></p>'.format(dev_id, metric_name(reading_type))
+        html_content += '<p>Current {} is {}.</p>'.format(metric_name(reading_type).lower(),
+                                                          format_value(reading_type, current_value))
+
+    send_email(dev_id, subject, html_content)
+
+
+def send_email(dev_id, subject, html_content):
+    """
+    Utility function to send a notification email for a device using SendGrid. The SendGrid library is
+    imported here rather than at startup (warm_up() imports it ahead of the first alert).
+
+    Args:
+        dev_id (str):         ID of the device; its config gives the from / to addresses
+        subject (str):        Subject line
+        html_content (str):   Body
+
+    Returns:
+        None
+    """
+    from sendgrid import SendGridAPIClient
+    from sendgrid.helpers.mail import Mail
+
+    config = DEVICE_CONFIG.get(dev_id)
+    message = Mail(from_email=config['email_from'],
+                   to_emails=config['email_to'],
+                   subject=subject,
+                   html_content=html_content)
+    sendgrid = SendGridAPIClient(SECRET_DATA['sendgrid_api_key'])
+    sendgrid.send(message)
+
+
+def renotify_if_due(db, dev_id, reading_type, alert, current_value):
+    """
+    Called by the scheduler to re-send an alert notification email if the renotification delay
+    has passed since the last one, then schedule the next check. Renotifications are also sent
+    by readings (see device_state.py); the notification timestamp is only updated if it has not
+    changed since the alert was read, so only one of them sends the email.
+
+    Args:
+        db:                           Connection to our MongoDB database
+        dev_id (str):                 Device ID
+        reading_type (str):           Type of reading; a metric (see metrics.py) or 'offline'
+        alert (dict):                 The active alert, from the device's state doc
+        current_value (int):          Current value for the reading
+
+    Returns:
+        True if a notification was sent
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('    ==> renotify_if_due({}, {}, {})'.format(dev_id, reading_type, current_value))
+
+    # Calculate how much time has elapsed since a notification was sent
+    now = datetime.datetime.now()
+    notification_datetime = datetime.datetime.strptime(alert['notification_ts'], TIMESTAMP_FORMAT)
+    elapsed_time_minutes = (now - notification_datetime).total_seconds() // 60
+
+    # If the elapsed time exceeds our alert notification delay, update timestamp in DB and resend a notification
+    if elapsed_time_minutes >= DEVICE_CONFIG.get(dev_id)['alert_renotification_delay']:
+        formatted_ts = now.strftime(TIMESTAMP_FORMAT)
+        if device_state.renotify(db.device_state, dev_id, reading_type, alert, formatted_ts):
+            handle_alert_renotified(db, dev_id, reading_type, dict(alert, notification_ts=formatted_ts), current_value)
+            return True
+        notification_datetime = now         # someone else just sent one, or the alert was cleared
+
+    schedule_renotification_timer(dev_id, reading_type, notification_datetime)
+    return False
+
+
+def handle_alert_raised(db, dev_id, reading_type, alert):
+    """
+    Handles action(s) to take for a new alert: record it in active alerts and send a notification.
+
+    Args:
+        db:                           Connection to our MongoDB database
+        dev_id (str):                 Device ID the alert is for
+        reading_type (str):           Type of reading; a metric (see metrics.py) or 'offline'
+        alert (dict):                 The alert, from the device's state doc
+
+    Returns:
+        None
+    """
+    handle_alert_changes(db, [(dev_id, reading_type, 'raised', alert, alert['last_value'])])
+
+
+def handle_alert_renotified(db, dev_id, reading_type, alert, current_value):
+    """
+    Handles action(s) to take when an alert is due a renotification: resend the notification.
+
+    Args:
+        db:                           Connection to our MongoDB database
+        dev_id (str):                 Device ID the alert is for
+        reading_type (str):           Type of reading; a metric (see metrics.py) or 'offline'
+        alert (dict):                 The alert, with its new notification_ts
+        current_value (int):          Current value for the reading
+
+    Returns:
+        None
+    """
+    handle_alert_changes(db, [(dev_id, reading_type, 'renotified', alert, current_value)])
+
+
+def handle_alert_cleared(db, dev_id, reading_type, alert, current_value):
+    """
+    Handles action(s) to take when an alert is cleared: move it from active alerts to alert history
+    and send a notification.
+
+    Args:
+        db:                           Connection to our MongoDB database
+        dev_id (str):                 Device ID the alert was for
+        reading_type (str):           Type of reading; a metric (see metrics.py) or 'offline'
+        alert (dict):                 The alert cleared, from the device's state doc
+        current_value (int):          Current value for the reading
+
+    Returns:
+        None
+    """
+    handle_alert_changes(db, [(dev_id, reading_type, 'cleared', alert, current_value)])
+
+
+@traced(TRACER)
+def handle_alert_changes(db, changes):
+    """
+    Handles the actions to take for the alerts a reading (or a batch of them) raised, renotified or
+    cleared: keep active alerts and alert history up to date, with one write to each however many
+    metrics changed, then send the notifications.
+
+    Args:
+        db:               Connection to our MongoDB database
+        changes (list):   (dev_id, reading type, transition, alert, current value) tuples; transition is
+                          'raised', 'renotified' or 'cleared', and alert is from the device's state doc
+
+    Returns:
+        None
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        for dev_id, reading_type, transition, _, current_value in changes:
+            print('  ==> alert {}({}, {}, {})'.format(transition, dev_id, reading_type, current_value))
+
+    # The state doc decides; active_alerts is kept for the active-alerts resource. As only one request
+    #  sees each transition, there is only ever one record per device / reading type. The requests are
+    #  applied in order, so a batch holding an alert's raise and its clear leaves no record.
+    import pymongo
+    now = datetime.datetime.now()
+    formatted_ts = now.strftime(TIMESTAMP_FORMAT)
+    requests = []
+    history = []
+    for dev_id, reading_type, transition, alert, current_value in changes:
+        query = {'dev_id': dev_id,
+                 'reading_type': reading_type}
+        # Alerts raised by the anomaly detector alone carry their cause through to the records, so
+        #  that rebuild_alerts.py can tell them from the range check's
+        cause = {'cause': alert['cause']} if alert.get('cause') else {}
+        if transition == 'raised':
+            requests.append(pymongo.InsertOne(dict(query,
+                                                   originated_ts=alert['originated_ts'],
+                                                   notification_ts=alert['notification_ts'],
+                                                   max_value=alert['max_value'],
+                                                   min_value=alert['min_value'],
+                                                   **cause)))
+        elif transition == 'renotified':
+            requests.append(pymongo.UpdateOne(query, {'$set': {'notification_ts': alert['notification_ts'],
+                                                               'max_value': alert['max_value'],
+                                                               'min_value': alert['min_value']}}))
+        else:
+            # Put a record into our alert history. The duration and peak values are computed here, once, so
+            #  reporting on time spent in alert needs no post-processing of the timestamps.
+            originated_datetime = datetime.datetime.strptime(alert['originated_ts'], TIMESTAMP_FORMAT)
+            history.append(dict(query,
+                                originated_ts=alert['originated_ts'],
+                                cleared_ts=formatted_ts,
+                                duration_minutes=int((now - originated_datetime).total_seconds() // 60),
+                                max_value=alert.get('max_value'),
+                                min_value=alert.get('min_value'),
+                                **cause))
+            # Remove the active alert record (should be just 1, however
+            #  using delete_many is a 'DB self cleaning' tactic
+            requests.append(pymongo.DeleteMany(query))
+    if history:
+        db.alert_history.insert_many(history)
+    if requests:
+        db.active_alerts.bulk_write(requests, ordered=True)
+
+    for dev_id, reading_type, transition, alert, current_value in changes:
+        if transition == 'cleared':
+            if reading_type != OFFLINE:
+                SCHEDULER.cancel((dev_id, reading_type))     # the offline timer is rescheduled by the caller
+            send_alert_cleared_notification_email(dev_id, reading_type, current_value)
+        else:
+            send_alert_notification_email(dev_id, reading_type, current_value)
+            # Renotify on time, whether or not more readings arrive
+            schedule_renotification_timer(dev_id, reading_type,
+                                          datetime.datetime.strptime(alert['notification_ts'], TIMESTAMP_FORMAT))
+        EVENTS.publish('alert_' + transition, dev_id, reading_type=reading_type, value=current_value)
+
+
+async def admit_reading(msg_body: ReadingsMsgBody,
+                        traceparent: str = Header(None,
+                                                  description='W3C trace context of the caller, for request tracing')):
+    """
+    Dependency of POST readings/ doing its admission control (see admission.py). Being async, it runs on
+    the event loop before the request is handed to the threadpool, so readings waiting for a processing
+    slot do not hold threads that the other endpoints need. Shed load up front rather than letting requests
+    pile up in the threadpool.
+
+    Args:
+        msg_body (ReadingsMsgBody):   The reading that was posted
+        traceparent (str):            W3C trace context of the caller
+
+    Yields:
+        Milliseconds the reading waited to be admitted
+    """
+    started = time.perf_counter()
+    try:
+        await ADMISSION.acquire(msg_body.dev_id)
+    except AdmissionRejected as e:
+        with TRACER.span('POST /readings/', traceparent=traceparent, dev_id=msg_body.dev_id,
+                         tenant=CURRENT_TENANT.get()) as span:
+            raise rejected_exception(span, e)
+    try:
+        yield round((time.perf_counter() - started) * 1000, 3)
+    finally:
+        ADMISSION.release()
+
+
+@app.post("/readings/")
+@profiled(PROFILER)
+def post_readings(msg_body: ReadingsMsgBody,
+                  traceparent: str = Header(None,
+                                            description='W3C trace context of the caller, for request tracing'),
+                  admission_ms: float = Depends(admit_reading)):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a POST request for resource 'readings'.
+
+    When the server is overloaded, or the device is sending readings faster than allowed,
+    the request is rejected with status 429 and a Retry-After header giving the number
+    of seconds to wait before sending again.
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> post_readings({})'.format(msg_body.__dict__), flush=True)
 
-    message = Mail(from_email=CONFIG_DATA['email_from'],
-                   to_emails=CONFIG_DATA['email_to'],
-                   subject=subject,
-                   html_content=html_content)
-    sendgrid = SendGridAPIClient(SECRET_DATA['sendgrid_api_key'])
-    sendgrid.send(message)
+    with TRACER.span('POST /readings/', traceparent=traceparent, dev_id=msg_body.dev_id,
+                     tenant=CURRENT_TENANT.get(), admission_ms=admission_ms) as span:
+        try:
+            if tenant_ingest() is not None:
+                with TRACER.span('submit_reading'):
+                    submit_reading(msg_body)
+            else:
+                process_reading(msg_body)
+        except AdmissionRejected as e:
+            raise rejected_exception(span, e)       # the device's ingest worker is too far behind
 
 
-def is_an_existing_active_alert(db, dev_id, reading_type):
+def rejected_exception(span, rejection):
     """
-    Utility function to check if there is currently an active alert by counting
-    active alert records for this device/reading_type in the DB.
+    Utility function to build the 429 response for a reading that was not admitted.
 
     Args:
-        db:                           Connection to our MongoDB database
-        dev_id (str):                 Device ID to check for active alerts
-        reading_type (ReadingType):   Type of reading
+        span (Span):                      The request's trace span
+        rejection (AdmissionRejected):    Why it was not admitted
 
     Returns:
-        True if there is an existing alert of type reading_type for dev_id; else False
+        HTTPException
     """
-    query = {'dev_id': dev_id,
-             'reading_type': str(reading_type)}
-    num_docs = db.active_alerts.count_documents(query)
-    return num_docs > 0
+    if TRACE_MESSAGE_PROCESSING:
+        print('  <== rejected: {}'.format(rejection.reason), flush=True)
+    span.set_attribute('rejected', rejection.reason)
+    return HTTPException(status_code=429,
+                         detail=rejection.reason,
+                         headers={'Retry-After': ADMISSION.retry_after_header(rejection)})
 
 
-def renotify_if_notification_delay_exceeded(db, dev_id, reading_type, current_value):
+def reading_doc(msg_body):
     """
-    Called when we continue in an alert condition for the specified device / reading type
-    to check if we should re-send an alert notification email. To avoid being spammed with
-    email, we have a delay time between email sends.
+    Utility function to build the readings collection doc for a posted reading.
 
     Args:
-        db:                           Connection to our MongoDB database
-        dev_id (str):                 Device ID to check for active alerts
-        reading_type (ReadingType):   Type of reading
-        current_value (int):          Current value for the reading
+        msg_body (ReadingsMsgBody):   The reading that was posted
 
     Returns:
-        None
+        Dict
     """
-    if TRACE_MESSAGE_PROCESSING:
-        print('    ==> renotify_if_notification_delay_exceeded({}, {}, {})'.format(dev_id, reading_type, current_value))
-
-    # First, fetch the active alert record from the DB
-    query = {'dev_id': dev_id,
-             'reading_type': str(reading_type)}
-    doc = db.active_alerts.find_one(query)
-    assert doc is not None      # Should never happen unless I have an 'oops' in the code
-
-    # Calculate how much time has elapsed since a notification was sent
-    now = datetime.datetime.now()
-    alert_notification_datetime = datetime.datetime.strptime(doc['notification_ts'], TIMESTAMP_FORMAT)
-    elapsed_time = now - alert_notification_datetime
-    elapsed_time_minutes = elapsed_time.seconds // 60
-
-    # If the elapsed time exceeds our alert notification delay, update timestamp in DB and resend a notification
-    if elapsed_time_minutes >= CONFIG_DATA['alert_renotification_delay']:
-        formatted_ts = now.strftime(TIMESTAMP_FORMAT)
-        update = {'$set': {'notification_ts': formatted_ts}}
-        db.active_alerts.update_one(query, update)
-
-        send_alert_notification_email(dev_id, reading_type, current_value)
+    data = {'dev_id': msg_body.dev_id,
+            'ts': msg_body.ts}
+    data.update(msg_body.values())
+    if msg_body.repeat_count > 1:
+        data['repeat_count'] = msg_body.repeat_count        # only stored when not the default of 1
+    if msg_body.heartbeat:
+        data['heartbeat'] = True
+    return data
 
 
-def handle_out_of_range_condition(db, dev_id, reading_type, current_value):
+def reading_type_updates(msg_body, now):
     """
-    Handles action(s) to take for readings being out of range. If we already have an active alert,
-    treat it as a continuation of that active alert. If there is no active alert, create one.
+    Utility function to work out what a posted reading contributes to its device's state doc.
 
     Args:
-        db:                           Connection to our MongoDB database
-        dev_id (str):                 Device ID to check for active alerts
-        reading_type (ReadingType):   Type of reading
-        current_value (int):          Current value for the reading
+        msg_body (ReadingsMsgBody):   The reading that was posted
+        now (datetime):               Current time
 
     Returns:
-        None
+        Dict of reading type -> dict, for device_state.apply_reading()
     """
-    if TRACE_MESSAGE_PROCESSING:
-        print('  ==> handle_out_of_range_condition({}, {}, {})'.format(dev_id, reading_type, current_value))
-
-    if is_an_existing_active_alert(db, dev_id, reading_type):     # we are continuing an existing out of range condition
-        renotify_if_notification_delay_exceeded(db, dev_id, reading_type, current_value)
-    else:  # Is no existing alert, so insert an active alert record into the DB & send a notification
-        now = datetime.datetime.now()
-        formatted_ts = now.strftime(TIMESTAMP_FORMAT)
-        data = {'dev_id': dev_id,
-                'reading_type': str(reading_type),
-                'originated_ts': formatted_ts,
-                'notification_ts': formatted_ts}
-        db.active_alerts.insert_one(data)
-
-        send_alert_notification_email(dev_id, reading_type, current_value)
+    # The device's rules are compiled once per config change; this is a single pass over the reading's metrics.
+    #  If enabled, the anomaly detector weighs in as well, against the statistics in the state doc; so it only
+    #  sees readings that are stored, whichever server process (or ingest worker) stores them.
+    return DEVICE_CONFIG.rules(msg_body.dev_id).type_updates(msg_body.values(), msg_body.repeat_count, now,
+                                                             ANOMALY_DETECTOR)
 
 
-def handle_in_range_condition(db, dev_id, reading_type, current_value):
+def submit_reading(msg_body):
     """
-    Handles actions to take for readings being in range. If there is an active alert, cancel it. If there
-    is no active alert, no action needed.
+    Hand a reading to its device's ingest worker (see ingest_workers.py), which stores it and updates
+    the device's state; alert actions are taken by handle_ingest_results() once that is done.
 
     Args:
-        db:                           Connection to our MongoDB database
-        dev_id (str):                 Device ID to check for active alerts
-        reading_type (ReadingType):   Type of reading
-        current_value (int):          Current value for the reading
+        msg_body (ReadingsMsgBody):   The reading that was posted
 
     Returns:
         None
-    """
-    if TRACE_MESSAGE_PROCESSING:
-        print('  ==> handle_in_range_condition({}, {}, {})'.format(dev_id, reading_type, current_value))
-
-    if is_an_existing_active_alert(db, dev_id, reading_type):
-        # First, fetch the active alert record
-        query = {'dev_id': dev_id,
-                 'reading_type': str(reading_type)}
-        doc = db.active_alerts.find_one(query)
-        assert doc is not None  # Should never happen unless I have an 'oops' in the code
-
-        # Put a record into our alert history
-        now = datetime.datetime.now()
-        formatted_ts = now.strftime(TIMESTAMP_FORMAT)
-        data = {'dev_id': dev_id,
-                'reading_type': str(reading_type),
-                'originated_ts': doc['originated_ts'],
-                'cleared_ts': formatted_ts}
-        db.alert_history.insert_one(data)
-
-        # Remove the active alert record (should be just 1, however
-        #  using delete_many is a 'DB self cleaning' tactic
-        query = {'dev_id': dev_id,
-                 'reading_type': str(reading_type)}
-        db.active_alerts.delete_many(query)
 
-        # Send an email indicating an active alert was cleared
-        send_alert_cleared_notification_email(dev_id, reading_type, current_value)
+    Raises:
+        AdmissionRejected:    If the worker is too far behind
+    """
+    data = reading_doc(msg_body)
+    now = datetime.datetime.now()
+    INGEST.submit_reading(data, now.strftime(TIMESTAMP_FORMAT), reading_type_updates(msg_body, now))
+    EVENTS.publish('reading', msg_body.dev_id, ts=msg_body.ts, **msg_body.values())
+    schedule_offline_timer(msg_body.dev_id)
+    FLEET_SUMMARY.invalidate()      # the reading is written within ingest_flush_ms; alert changes invalidate again
 
 
-def handle_mixed_in_and_out_of_range_condition(db, dev_id, reading_type, current_value):
+def process_reading(msg_body):
     """
-    Handles situation where we have readings both out of range and in range. If there is an
-    active alert, treat it as a continuation of that active alert. If there is no active
-    alert, treat it as a non-alert condition, hence no additional action needed.
+    Store a reading and take whatever alert actions the recent readings call for. Besides storing the
+    reading, this is a single update of the device's state doc (see device_state.py), which says which
+    alerts, if any, were raised, renotified or cleared.
 
     Args:
-        db:                           Connection to our MongoDB database
-        dev_id (str):                 Device ID to check for active alerts
-        reading_type (ReadingType):   Type of reading
-        current_value (int):          Current value for the reading
+        msg_body (ReadingsMsgBody):   The reading that was posted
 
     Returns:
         None
     """
-    if TRACE_MESSAGE_PROCESSING:
-        print('  ==> handle_mixed_in_and_out_of_range_condition({}, {}, {})'.format(dev_id, reading_type, current_value))
+    # Get our MongoDB database
+    db = get_db()
+
+    # Store this reading into our DB, and add it to its day's percentile sketch
+    data = reading_doc(msg_body)
+    with TRACER.span('insert_reading'):
+        db.readings.insert_one(data)
+    with TRACER.span('update_sketch'):
+        reading_sketches.record_reading(db.reading_sketches, data)
+    EVENTS.publish('reading', msg_body.dev_id, ts=msg_body.ts, **msg_body.values())
+
+    # Apply the reading to the device's state; this also clears any offline alert, as we have heard from the device
+    now = datetime.datetime.now()
+    with TRACER.span('update_device_state', dev_id=msg_body.dev_id):
+        changes = device_state.apply_reading(db.device_state, msg_body.dev_id, now.strftime(TIMESTAMP_FORMAT),
+                                             reading_type_updates(msg_body, now))
 
-    if is_an_existing_active_alert(db, dev_id, reading_type):  # Check if it it time to resend notification
-        renotify_if_notification_delay_exceeded(db, dev_id, reading_type, current_value)
+    # Take appropriate action for whatever changed, for all the reading's metrics at once
+    values = msg_body.values()
+    if changes:
+        handle_alert_changes(db, [(msg_body.dev_id, reading_type, transition, alert,
+                                   alert['last_value'] if transition == 'raised' else values.get(reading_type))
+                                  for reading_type, transition, alert in changes])
+    schedule_offline_timer(msg_body.dev_id)
+    FLEET_SUMMARY.invalidate()
 
 
-def recent_readings_range_check(db, dev_id):
+def export_parquet_response(collection_name, dev_id, start_ts, end_ts, compression):
     """
-    Checks if the most recent readings (number is based on configuration value num_continuous_readings_to_check)
-    are all within range or all outside of range for temp and humidity.
+    Utility function to export a collection to Parquet and return it as a file download. The export is
+    written to a temp file (Parquet needs the whole file written before it can be read), which is removed
+    once the response has been sent.
 
     Args:
-        db:                   Connection to our MongoDB database
-        dev_id (str):         Device ID to check for active alerts
-
-    Returns:
-        4-tuple of booleans: (all temperature readings are outside of range,
-                              all temperature readings are inside range,
-                              all humidity readings are outside of range,
-                              all humidity readings are inside of range)
-    """
-    # Will build up a list of True/False values; one per reading indicating whether it is out of range
-    temp_out_of_range = []
-    humidity_out_of_range = []
-
-    # Fetch the most recent num_continuous_readings_to_check readings and check if they are in range. Note
-    #  I am using two lists that get populated with True/False values. I chose to not use list comprehensions
-    #  here as once you iterate through the MongoDB docs, you cannot re-iterate through them; you have to
-    #  re-query. Also I felt the resulting code was too dense and not as understandable.
-    query = {'dev_id': dev_id}
-    docs = db.readings.find(query).sort("ts", pymongo.DESCENDING).limit(CONFIG_DATA['num_continuous_readings_to_check'])
-    for doc in docs:
-        check_result = (doc['temp'] < CONFIG_DATA['temp_range_min']) or \
-                       (doc['temp'] > CONFIG_DATA['temp_range_max'])
-        temp_out_of_range.append(check_result)
-
-        check_result = (doc['humidity'] < CONFIG_DATA['humidity_range_min']) or \
-                       (doc['humidity'] > CONFIG_DATA['humidity_range_max'])
-        humidity_out_of_range.append(check_result)
-
-    if len(temp_out_of_range) < CONFIG_DATA['num_continuous_readings_to_check']:
-        # When we have less history than needed to make an in range / out of range determination (will
-        # only happen on initial startup of a new device), we will just treat it as though everything is in range.
-        return False, True, False, True
-    else:
-        return all(temp_out_of_range), not any(temp_out_of_range), \
-               all(humidity_out_of_range), not any(humidity_out_of_range)
+        collection_name (str):    'readings' or 'alert_history'
+        dev_id (str):             Only export this device, if given
+        start_ts (str):           Only export docs at or after this time, if given
+        end_ts (str):             Only export docs before this time, if given
+        compression (str):        Parquet compression codec
 
-
-@app.post("/readings/")
-def post_readings(msg_body: ReadingsMsgBody):
+    Returns:
+        FileResponse
+    """
+    import export_data      # pandas / pyarrow; imported on first use as they take a while
+
+    db = get_read_db()
+
+    temp_file = tempfile.NamedTemporaryFile(suffix='.parquet', delete=False)
+    temp_file.close()
+    try:
+        export_data.export_parquet(db[collection_name],
+                                   export_data.build_query(collection_name, dev_id, start_ts, end_ts),
+                                   export_data.EXPORT_SCHEMAS[collection_name],
+                                   temp_file.name,
+                                   row_group_size=CONFIG_DATA['export_row_group_size'],
+                                   compression=compression)
+    except BaseException:
+        os.remove(temp_file.name)
+        raise
+
+    return FileResponse(temp_file.name,
+                        media_type='application/vnd.apache.parquet',
+                        filename='{}.parquet'.format(collection_name),
+                        background=BackgroundTask(os.remove, temp_file.name))
+
+
+@app.get("/readings/percentiles/")
+@profiled(PROFILER)
+def get_readings_percentiles(dev_id: str = Query(None,
+                                                 alias='dev-id',
+                                                 description='ID of the device'),
+                             reading_type: str = Query('temp',
+                                                       alias='reading-type',
+                                                       regex=METRIC_REGEX,
+                                                       description='Reading type; a metric, e.g. \'temp\' or \'co2\''),
+                             start_date: str = Query(None,
+                                                     alias='start-date',
+                                                     regex='^\\d{4}-\\d{2}-\\d{2}$',
+                                                     description='First UTC day included; e.g. 2020-06-01'),
+                             end_date: str = Query(None,
+                                                   alias='end-date',
+                                                   regex='^\\d{4}-\\d{2}-\\d{2}$',
+                                                   description='First UTC day not included; e.g. 2020-07-01'),
+                             percentiles: List[float] = Query([5, 50, 95],
+                                                              alias='p',
+                                                              description='Percentiles wanted, 0 - 100; repeat '
+                                                                          'for several, e.g. p=5&p=50&p=95')):
     # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
     # that makes sense from an API end-user's perspective.
     """
-    Process a POST request for resource 'readings'.
+    Process a GET request for resource 'readings/percentiles'.
+
+    Returns percentiles of the readings of one reading type, along with their count,
+    min, max and mean. dev-id restricts them to one device; if not specified, all
+    devices' readings are included. start-date and end-date restrict them to a range
+    of whole UTC days (by reading timestamp); end-date itself is not included. The
+    percentiles are nearest-rank: the smallest value with at least p% of the readings
+    at or below it. They are exact for whole number metrics (e.g. temp, humidity);
+    for metrics with decimals (e.g. pressure) they, and the min, max and mean, are
+    within 0.05% of the exact value. They are None if there are no readings.
     """
     if TRACE_MESSAGE_PROCESSING:
-        print('==> post_readings({})'.format(msg_body.__dict__), flush=True)
+        print('==> get_readings_percentiles({}, {}, {}, {}, {})'.format(dev_id, reading_type, start_date, end_date,
+                                                                        percentiles), flush=True)
 
-    # Connect to the MongoDB server and select the database
-    mongodb = pymongo.MongoClient(SECRET_DATA['mongodb_server_url'])
-    db = mongodb[CONFIG_DATA['mongodb_database_name']]       # This is the database we are using
+    if any((percentile < 0) or (percentile > 100) for percentile in percentiles):
+        raise HTTPException(status_code=400, detail='Percentiles must be 0 - 100')
 
-    # Store this reading into our DB
-    data = {'dev_id': msg_body.dev_id,
-            'ts': msg_body.ts,
-            'temp': msg_body.temp,
-            'humidity': msg_body.humidity}
-    db.readings.insert_one(data)
-
-    # Check recent readings to see if they are all out of range / all in range
-    temp_all_out_of_range, temp_all_in_range, \
-        humidity_all_out_of_range, humidity_all_in_range = recent_readings_range_check(db, msg_body.dev_id)
-
-    # Take appropriate action for temp
-    if temp_all_out_of_range:
-        handle_out_of_range_condition(db, msg_body.dev_id, ReadingType.TEMP, msg_body.temp)
-    elif temp_all_in_range:
-        handle_in_range_condition(db, msg_body.dev_id, ReadingType.TEMP, msg_body.temp)
-    else:
-        handle_mixed_in_and_out_of_range_condition(db, msg_body.dev_id, ReadingType.TEMP, msg_body.temp)
+    # Merges one sketch per device per day (see reading_sketches.py) rather than reading the readings
+    db = get_read_db()
+    result = reading_sketches.query_sketches(db.reading_sketches, reading_type, percentiles, dev_id,
+                                             start_date, end_date)
+    result['percentiles'] = {'{:g}'.format(percentile): value for percentile, value in result['percentiles'].items()}
+    return dict({'dev_id': dev_id, 'reading_type': reading_type, 'start_date': start_date, 'end_date': end_date},
+                **result)
 
-    # Take appropriate action for humidity
-    if humidity_all_out_of_range:
-        handle_out_of_range_condition(db, msg_body.dev_id, ReadingType.HUMIDITY, msg_body.humidity)
-    elif humidity_all_in_range:
-        handle_in_range_condition(db, msg_body.dev_id, ReadingType.HUMIDITY, msg_body.humidity)
-    else:
-        handle_mixed_in_and_out_of_range_condition(db, msg_body.dev_id, ReadingType.HUMIDITY, msg_body.humidity)
 
-    # Clean up by closing our MongoDB connection
-    mongodb.close()
+@app.get("/readings/export/")
+@profiled(PROFILER)
+def get_readings_export(dev_id: str = Query(None,
+                                            alias='dev-id',
+                                            description='ID of the device'),
+                        start_ts: str = Query(None,
+                                              alias='start-ts',
+                                              regex='^\\d{4}-\\d{2}-\\d{2}T\\d{2}:\\d{2}:\\d{2}Z$',
+                                              description='Only readings at or after this UTC time; '
+                                                          'e.g. 2020-06-18T11:06:00Z'),
+                        end_ts: str = Query(None,
+                                            alias='end-ts',
+                                            regex='^\\d{4}-\\d{2}-\\d{2}T\\d{2}:\\d{2}:\\d{2}Z$',
+                                            description='Only readings before this UTC time'),
+                        compression: str = Query('snappy',
+                                                 regex='^snappy$|^zstd$|^gzip$|^none$',
+                                                 description='Parquet compression; snappy, zstd, gzip or none')):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'readings/export'; returns the readings as a Parquet file.
+
+    All parameters are optional. dev-id restricts the export to one device; start-ts and end-ts
+    restrict it to a time range. If not specified, all readings are exported.
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> get_readings_export({}, {}, {}, {})'.format(dev_id, start_ts, end_ts, compression), flush=True)
+
+    return export_parquet_response('readings', dev_id, start_ts, end_ts, compression)
 
 
 @app.delete("/readings/")
+@profiled(PROFILER)
 def delete_readings(dev_id: str = Query(None,
                                         alias='dev-id',
                                         description='ID of the device')):
@@ -445,18 +1518,30 @@ def delete_readings(dev_id: str = Query(None,
     if TRACE_MESSAGE_PROCESSING:
         print('==> delete_readings({})'.format(dev_id), flush=True)
 
-    # Connect to the MongoDB database; note it is hosted on Mongo Atlas
-    mongodb = pymongo.MongoClient(SECRET_DATA['mongodb_server_url'])
-    db = mongodb[CONFIG_DATA['mongodb_database_name']]       # This is the database we are using
+    # Get our MongoDB database; note it is hosted on Mongo Atlas
+    db = get_db()
+
+    # The ingest workers write out and drop their copies of the state docs first, so they do not
+    #  overwrite the reset below
+    if tenant_ingest() is not None:
+        INGEST.forget(dev_id)
 
     # Whack 'em; either all or for a specified device id
     query = {}
     if dev_id is not None:
         query['dev_id'] = dev_id
     db.readings.delete_many(query)
+    db.reading_sketches.delete_many(query)
+
+    # The state docs' windows of recent readings go with them
+    device_state.reset(db.device_state, query, windows=True)
 
-    # Close the MongoDB connection when we are done with it
-    mongodb.close()
+    # No readings, so nothing to go offline
+    if dev_id is not None:
+        SCHEDULER.cancel((dev_id, OFFLINE))
+    else:
+        SCHEDULER.cancel_where(lambda key: key[1] == OFFLINE)
+    FLEET_SUMMARY.invalidate()
 
     return
 
@@ -466,13 +1551,14 @@ def delete_readings(dev_id: str = Query(None,
 # =================================================================================================
 
 @app.get("/active-alerts/counts/")
+@profiled(PROFILER)
 def get_active_alerts_counts(dev_id: str = Query(None,
                                                  alias='dev-id',
                                                  description='ID of the device'),
                              reading_type: str = Query(None,
                                                        alias='reading-type',
-                                                       regex='^temp$|^humidity$',
-                                                       description='Reading type; \'temp\' or \'humidity\'')):
+                                                       regex=READING_TYPE_REGEX,
+                                                       description='Reading type; a metric, e.g. \'temp\', or \'offline\'')):
     # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
     # that makes sense from an API end-user's perspective.
     """
@@ -480,15 +1566,14 @@ def get_active_alerts_counts(dev_id: str = Query(None,
 
     The request supports two optional parameters. dev-id, is the ID for the device
     to return the count for. If not specified, a total count of active alerts is returned.
-    reading-type is the reading type (temp or humidity) to return the count for. If not
-    specified, a count of both is returned.
+    reading-type is the reading type (a metric such as temp, or offline) to return the count
+    for. If not specified, a count of all types is returned.
     """
     if TRACE_MESSAGE_PROCESSING:
         print('==> get_active_alerts_counts({}, {})'.format(dev_id, reading_type), flush=True)
 
-    # Connect to the MongoDB database; note it is hosted on Mongo Atlas
-    mongodb = pymongo.MongoClient(SECRET_DATA['mongodb_server_url'])
-    db = mongodb[CONFIG_DATA['mongodb_database_name']]       # This is the database we are using
+    # Get our MongoDB database; note it is hosted on Mongo Atlas
+    db = get_read_db()
 
     # Fetch the count
     query = {}
@@ -498,13 +1583,11 @@ def get_active_alerts_counts(dev_id: str = Query(None,
         query['reading_type'] = reading_type
     num_docs = db.active_alerts.count_documents(query)
 
-    # Close the MongoDB connection when we are done with it
-    mongodb.close()
-
     return num_docs
 
 
 @app.delete("/active-alerts/")
+@profiled(PROFILER)
 def delete_active_alerts(dev_id: str = Query(None,
                                              alias='dev-id',
                                              description='ID of the device')):
@@ -519,18 +1602,21 @@ def delete_active_alerts(dev_id: str = Query(None,
     if TRACE_MESSAGE_PROCESSING:
         print('==> delete_active_alerts({})'.format(dev_id), flush=True)
 
-    # Connect to the MongoDB database; note it is hosted on Mongo Atlas
-    mongodb = pymongo.MongoClient(SECRET_DATA['mongodb_server_url'])
-    db = mongodb[CONFIG_DATA['mongodb_database_name']]       # This is the database we are using
+    # Get our MongoDB database; note it is hosted on Mongo Atlas
+    db = get_db()
+
+    if tenant_ingest() is not None:
+        INGEST.forget(dev_id)       # as for delete_readings()
 
     # Whack 'em; either all or for a specified device id
     query = {}
     if dev_id is not None:
         query['dev_id'] = dev_id
     db.active_alerts.delete_many(query)
+    device_state.reset(db.device_state, query, alerts=True)
 
-    # Close the MongoDB connection when we are done with it
-    mongodb.close()
+    # The timers of deleted alerts find no alert when they fire, so need not be cancelled here
+    FLEET_SUMMARY.invalidate()
 
     return
 
@@ -540,13 +1626,14 @@ def delete_active_alerts(dev_id: str = Query(None,
 # =================================================================================================
 
 @app.get("/alert-history/counts/")
+@profiled(PROFILER)
 def get_alert_history_counts(dev_id: str = Query(None,
                                                  alias='dev-id',
                                                  description='ID of the device'),
                              reading_type: str = Query(None,
                                                        alias='reading-type',
-                                                       regex='^temp$|^humidity$',
-                                                       description='Reading type; \'temp\' or \'humidity\'')):
+                                                       regex=READING_TYPE_REGEX,
+                                                       description='Reading type; a metric, e.g. \'temp\', or \'offline\'')):
     # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
     # that makes sense from an API end-user's perspective.
     """
@@ -554,15 +1641,14 @@ def get_alert_history_counts(dev_id: str = Query(None,
 
     The request supports two optional parameters. dev-id, is the ID for the device
     to return the count for. If not specified, a total count of alert history is returned.
-    reading-type is the reading type (temp or humidity) to return the count for. If not
-    specified, a count of both is returned.
+    reading-type is the reading type (a metric such as temp, or offline) to return the count
+    for. If not specified, a count of all types is returned.
     """
     if TRACE_MESSAGE_PROCESSING:
         print('==> get_alert_history_counts({}, {})'.format(dev_id, reading_type), flush=True)
 
-    # Connect to the MongoDB database; note it is hosted on Mongo Atlas
-    mongodb = pymongo.MongoClient(SECRET_DATA['mongodb_server_url'])
-    db = mongodb[CONFIG_DATA['mongodb_database_name']]       # This is the database we are using
+    # Get our MongoDB database; note it is hosted on Mongo Atlas
+    db = get_read_db()
 
     # Do the count
     query = {}
@@ -572,13 +1658,150 @@ def get_alert_history_counts(dev_id: str = Query(None,
         query['reading_type'] = reading_type
     num_docs = db.alert_history.count_documents(query)
 
-    # Close the MongoDB connection when we are done with it
-    mongodb.close()
-
     return num_docs
 
 
+def encode_alert_history_cursor(doc):
+    """
+    Build the keyset pagination cursor for an alert history doc; '<originated_ts>_<_id>'.
+    """
+    return '{}_{}'.format(doc['originated_ts'], doc['_id'])
+
+
+def decode_alert_history_cursor(cursor):
+    """
+    Inverse of encode_alert_history_cursor().
+
+    Returns:
+        Tuple of (originated_ts, ObjectId); raises HTTPException (400) if the cursor is not valid
+    """
+    try:
+        originated_ts, object_id = cursor.rsplit('_', 1)
+        return originated_ts, ObjectId(object_id)
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+@app.get("/alert-history/")
+@profiled(PROFILER)
+def get_alert_history(dev_id: str = Query(None,
+                                          alias='dev-id',
+                                          description='ID of the device'),
+                      reading_type: str = Query(None,
+                                                alias='reading-type',
+                                                regex=READING_TYPE_REGEX,
+                                                description='Reading type; a metric, e.g. \'temp\', or \'offline\''),
+                      start_ts: str = Query(None,
+                                            alias='start-ts',
+                                            regex='^\\d{4}-\\d{2}-\\d{2}T\\d{2}:\\d{2}:\\d{2}Z$',
+                                            description='Only alerts originating at or after this UTC time; '
+                                                        'e.g. 2020-06-18T11:06:00Z'),
+                      end_ts: str = Query(None,
+                                          alias='end-ts',
+                                          regex='^\\d{4}-\\d{2}-\\d{2}T\\d{2}:\\d{2}:\\d{2}Z$',
+                                          description='Only alerts originating before this UTC time'),
+                      after: str = Query(None,
+                                         description='Return records following this cursor; use the '
+                                                     '\'cursor\' value of the last record of the previous page'),
+                      limit: int = Query(100,
+                                         ge=1,
+                                         le=1000,
+                                         description='Max number of records to return')):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'alert-history'.
+
+    Returns alert history records ordered by the time the alert originated, streamed as
+    newline-delimited JSON (one record per line). Each record includes the alert's duration
+    in minutes, the max and min values seen while in alert, and a 'cursor'. To fetch the next
+    page, pass the cursor of the last record received as parameter 'after'; a page with fewer
+    than 'limit' records is the last page.
+
+    All parameters are optional. dev-id and reading-type restrict the records to a device and/or
+    reading type (a metric such as temp, or offline). start-ts and end-ts restrict the records
+    to alerts that originated in that time range.
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> get_alert_history({}, {}, {}, {}, {}, {})'.format(dev_id, reading_type, start_ts, end_ts,
+                                                                      after, limit), flush=True)
+
+    query = {}
+    if dev_id is not None:
+        query['dev_id'] = dev_id
+    if reading_type is not None:
+        query['reading_type'] = reading_type
+    if (start_ts is not None) or (end_ts is not None):
+        query['originated_ts'] = {}
+        if start_ts is not None:
+            query['originated_ts']['$gte'] = start_ts
+        if end_ts is not None:
+            query['originated_ts']['$lt'] = end_ts
+    if after is not None:
+        # Keyset pagination; pick up strictly after the (originated_ts, _id) of the cursor. Note the
+        #  timestamps are fixed format strings, thus compare the same as the times they represent.
+        after_ts, after_id = decode_alert_history_cursor(after)
+        query['$or'] = [{'originated_ts': {'$gt': after_ts}},
+                        {'originated_ts': after_ts, '_id': {'$gt': after_id}}]
+
+    # Get our MongoDB database; note it is hosted on Mongo Atlas
+    import pymongo
+    db = get_read_db()
+
+    docs = db.alert_history.find(query) \
+        .sort([('originated_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]) \
+        .limit(limit)
+
+    def record_generator():
+        for doc in docs:
+            record = {'dev_id': doc['dev_id'],
+                      'reading_type': doc['reading_type'],
+                      'originated_ts': doc['originated_ts'],
+                      'cleared_ts': doc['cleared_ts'],
+                      'duration_minutes': doc.get('duration_minutes'),
+                      'max_value': doc.get('max_value'),
+                      'min_value': doc.get('min_value'),
+                      'cursor': encode_alert_history_cursor(doc)}
+            yield json.dumps(record) + '\n'
+
+    return StreamingResponse(record_generator(), media_type='application/x-ndjson')
+
+
+@app.get("/alert-history/export/")
+@profiled(PROFILER)
+def get_alert_history_export(dev_id: str = Query(None,
+                                                 alias='dev-id',
+                                                 description='ID of the device'),
+                             start_ts: str = Query(None,
+                                                   alias='start-ts',
+                                                   regex='^\\d{4}-\\d{2}-\\d{2}T\\d{2}:\\d{2}:\\d{2}Z$',
+                                                   description='Only alerts originating at or after this UTC time; '
+                                                               'e.g. 2020-06-18T11:06:00Z'),
+                             end_ts: str = Query(None,
+                                                 alias='end-ts',
+                                                 regex='^\\d{4}-\\d{2}-\\d{2}T\\d{2}:\\d{2}:\\d{2}Z$',
+                                                 description='Only alerts originating before this UTC time'),
+                             compression: str = Query('snappy',
+                                                      regex='^snappy$|^zstd$|^gzip$|^none$',
+                                                      description='Parquet compression; snappy, zstd, gzip or none')):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'alert-history/export'; returns the alert history as a Parquet file.
+
+    All parameters are optional. dev-id restricts the export to one device; start-ts and end-ts
+    restrict it to alerts that originated in that time range. If not specified, all alert history
+    is exported.
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> get_alert_history_export({}, {}, {}, {})'.format(dev_id, start_ts, end_ts, compression),
+              flush=True)
+
+    return export_parquet_response('alert_history', dev_id, start_ts, end_ts, compression)
+
+
 @app.delete("/alert-history/")
+@profiled(PROFILER)
 def delete_alert_history(dev_id: str = Query(None,
                                              alias='dev-id',
                                              description='ID of the device')):
@@ -593,17 +1816,447 @@ def delete_alert_history(dev_id: str = Query(None,
     if TRACE_MESSAGE_PROCESSING:
         print('==> delete_alert_history({})'.format(dev_id), flush=True)
 
-    # Connect to the MongoDB database; note it is hosted on Mongo Atlas
-    mongodb = pymongo.MongoClient(SECRET_DATA['mongodb_server_url'])
-    db = mongodb[CONFIG_DATA['mongodb_database_name']]       # This is the database we are using
+    # Get our MongoDB database; note it is hosted on Mongo Atlas
+    db = get_db()
 
     # Whack 'em; either all or for a specified device id
     query = {}
     if dev_id is not None:
         query['dev_id'] = dev_id
     db.alert_history.delete_many(query)
+    FLEET_SUMMARY.invalidate()
+
+    return
+
+
+# =================================================================================================
+# The following code processes the fleet summary; one call for a status page covering every device
+# =================================================================================================
+
+@app.get("/fleet-summary/")
+@profiled(PROFILER)
+def get_fleet_summary():
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'fleet-summary'.
+
+    Returns, for every device, its latest reading, the time its last reading was received
+    (last_seen), its active alerts by reading type and its alert history counts by reading
+    type. The summary may be a few seconds old.
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> get_fleet_summary()', flush=True)
+
+    def compute():
+        # From the primary; the summary is cached, and recomputed when a write invalidates it, so one
+        #  read from a lagging secondary would keep serving the state from before the write
+        with TRACER.span('fleet_summary_aggregate'):
+            devices = fleet_summary(get_db())
+        return {'generated_ts': datetime.datetime.now().strftime(TIMESTAMP_FORMAT),
+                'devices': devices}
+
+    return FLEET_SUMMARY.get(compute)
+
+
+# =================================================================================================
+# The following code processes the live event stream; new readings and alert transitions are
+# pushed to subscribers as they happen, via either Server-Sent Events or a WebSocket
+# =================================================================================================
+
+@app.get("/stream/")
+async def get_stream(request: Request,
+                     dev_ids: List[str] = Query(None,
+                                                alias='dev-id',
+                                                description='ID of a device to receive events for; may be repeated')):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'stream'; a Server-Sent Events (text/event-stream) response.
+
+    Pushes an event for each new reading ('reading') and each alert transition ('alert_raised',
+    'alert_cleared', 'alert_renotified'). The request supports one optional parameter, dev-id, which
+    may be repeated to receive events for only those devices. If not specified, events for all devices
+    are sent. If the client falls behind, the oldest events are dropped and an 'events_dropped' event
+    reports how many.
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> get_stream({})'.format(dev_ids), flush=True)
+
+    events = EVENTS.current()       # the request's tenant's
+    subscriber = events.subscribe(dev_ids, CONFIG_DATA['stream_max_queue_size'])
+
+    async def event_generator():
+        try:
+            while not await request.is_disconnected():
+                event = await subscriber.next_event(CONFIG_DATA['stream_keepalive_secs'])
+                if event is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield 'event: {}\ndata: {}\n\n'.format(event['type'], json.dumps(event))
+        finally:
+            events.unsubscribe(subscriber)
+
+    return StreamingResponse(event_generator(), media_type='text/event-stream')
+
+
+@app.websocket("/stream/ws")
+async def stream_websocket(websocket: WebSocket):
+    """
+    WebSocket flavor of resource 'stream'. Events are sent as JSON text messages; the optional
+    dev-id query parameter (may be repeated) filters events the same as for 'stream'.
+    """
+    dev_ids = websocket.query_params.getlist('dev-id')
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> stream_websocket({})'.format(dev_ids), flush=True)
+
+    await websocket.accept()
+    events = EVENTS.current()
+    subscriber = events.subscribe(dev_ids, CONFIG_DATA['stream_max_queue_size'])
+    try:
+        while True:
+            event = await subscriber.next_event(CONFIG_DATA['stream_keepalive_secs'])
+            if event is None:
+                event = {'type': 'keep_alive'}
+            await websocket.send_text(json.dumps(event))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        events.unsubscribe(subscriber)
+
+
+# =================================================================================================
+# The following code processes admin resources; these require the admin API key (environment
+# variable admin_api_key) in header X-Admin-Key, and are turned away if no key is set
+# =================================================================================================
+
+def require_admin(admin_key: str = Header(None, alias='X-Admin-Key')):
+    """
+    FastAPI dependency guarding the admin resources.
+
+    Args:
+        admin_key (str):      Value of the X-Admin-Key request header
+
+    Raises:
+        HTTPException 403 if no admin API key is configured, so the admin resources are off; 401 if the
+            header does not match it
+    """
+    if not SECRET_DATA.get('admin_api_key'):
+        raise HTTPException(status_code=403, detail='Admin resources are disabled; set admin_api_key to use them')
+    if admin_key != SECRET_DATA['admin_api_key']:
+        raise HTTPException(status_code=401, detail='Missing or invalid X-Admin-Key header')
+
+
+# Defines the message body for changing device config; settings not given are left as they are
+#  (generated from config_store.DEVICE_CONFIG_KEYS, so it has the settings for every metric of metrics.py)
+DeviceConfigMsgBody = create_model('DeviceConfigMsgBody',
+                                   **{key: (Optional[value_type], None)
+                                      for key, value_type in DEVICE_CONFIG_KEYS.items()})
+
+
+@app.get("/device-config/", dependencies=[Depends(require_admin)])
+def get_device_config(dev_id: str = Query(None,
+                                          alias='dev-id',
+                                          description='ID of the device')):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'device-config'.
+
+    The request supports one optional parameter, dev-id. If specified, the device's effective
+    config ('config') and the settings overridden for it ('overrides') are returned. If not
+    specified, the global defaults are returned along with the overrides for every device.
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> get_device_config({})'.format(dev_id), flush=True)
+
+    if dev_id is not None:
+        return {'dev_id': dev_id,
+                'config': DEVICE_CONFIG.get(dev_id),
+                'overrides': DEVICE_CONFIG.get_overrides(dev_id)}
+    else:
+        return {'defaults': DEVICE_CONFIG.defaults,
+                'overrides': DEVICE_CONFIG.overrides,
+                'loaded_at': DEVICE_CONFIG.loaded_at}
+
+
+@app.put("/device-config/", dependencies=[Depends(require_admin)])
+def put_device_config(msg_body: DeviceConfigMsgBody,
+                      dev_id: str = Query(None,
+                                          alias='dev-id',
+                                          description='ID of the device')):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a PUT request for resource 'device-config'.
+
+    Sets the settings given in the message body; settings not given are left as they are, and a
+    setting given as null goes back to the default. The request supports one optional parameter,
+    dev-id, which is the device to configure. If not specified, the global defaults are changed.
+    Changes take effect immediately; the effective config is returned. Returns status 400 if the
+    change would leave the config invalid (e.g. a range min above the range max).
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> put_device_config({}, {})'.format(dev_id, msg_body.__dict__), flush=True)
+
+    values = msg_body.model_dump(exclude_unset=True)
+
+    try:
+        config = DEVICE_CONFIG.set_overrides(get_db(), dev_id if dev_id is not None else DEFAULTS_DEV_ID, values)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {'dev_id': dev_id,
+            'config': config}
+
+
+@app.delete("/device-config/", dependencies=[Depends(require_admin)])
+def delete_device_config(dev_id: str = Query(None,
+                                             alias='dev-id',
+                                             description='ID of the device')):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a DELETE request for resource 'device-config'.
+
+    The request supports one optional parameter, dev-id, which is the device whose overrides
+    are removed; it goes back to the global defaults. If not specified, changes to the global
+    defaults are removed (device overrides are kept).
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> delete_device_config({})'.format(dev_id), flush=True)
+
+    DEVICE_CONFIG.delete_overrides(get_db(), dev_id if dev_id is not None else DEFAULTS_DEV_ID)
+
+    return
+
+
+# Defines the message body for starting the request profiler
+class ProfilerMsgBody(BaseModel):
+    routes: Optional[List[str]] = None      # e.g. ['/readings/'] or ['POST /readings/']; all if not given
+    num_requests: Optional[int] = None      # stop after this many requests; runs until stopped if not given
+    sample_rate: float = 1.0                # fraction of requests to profile
+    mode: str = 'cprofile'                  # 'cprofile' or 'sample'
+    sample_interval_ms: float = 5.0         # stack sampling interval for mode 'sample'
+    reset: bool = False                     # discard results collected before
+
+
+def profiled_endpoint_names(route_specs):
+    """
+    Utility function to map route specs to the names of the @profiled endpoint functions serving them.
+
+    Args:
+        route_specs (list):   Paths, optionally preceded by a method; e.g. '/readings/' or 'POST /readings/'
+
+    Returns:
+        Set of endpoint function names
+
+    Raises:
+        ValueError if a spec does not match any profiled route
+    """
+    names = set()
+    for route_spec in route_specs:
+        method, _, path = route_spec.strip().rpartition(' ')
+        matched = [route for route in app.routes
+                   if (getattr(route, 'path', None) == path) and hasattr(getattr(route, 'endpoint', None), '__wrapped__')
+                   and ((method == '') or (method.upper() in route.methods))]
+        if not matched:
+            raise ValueError('No profiled route matches \'{}\''.format(route_spec))
+        names.update(route.endpoint.__name__ for route in matched)
+    return names
+
+
+@app.get("/profiler/", dependencies=[Depends(require_admin)])
+def get_profiler():
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'profiler'.
+
+    Returns the request profiler's status and the routes that can be profiled.
+    """
+    status = PROFILER.status()
+    status['profiled_routes'] = sorted('{} {}'.format(','.join(sorted(route.methods)), route.path)
+                                       for route in app.routes
+                                       if hasattr(getattr(route, 'endpoint', None), '__wrapped__'))
+    return status
+
+
+@app.put("/profiler/", dependencies=[Depends(require_admin)])
+def put_profiler(msg_body: ProfilerMsgBody):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a PUT request for resource 'profiler'; switches the request profiler on.
+
+    Profiles the next num-requests requests (or a sample_rate fraction of them) to the given
+    routes. Mode 'cprofile' collects call statistics; mode 'sample' collects stack samples for
+    flame graphs. Results accumulate until reset; download them from 'profiler/stats'.
+    Returns status 400 if a route cannot be profiled or a setting is out of range.
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> put_profiler({})'.format(msg_body.__dict__), flush=True)
+
+    try:
+        targets = None if not msg_body.routes else profiled_endpoint_names(msg_body.routes)
+        if msg_body.mode not in PROFILER_MODES:
+            raise ValueError('mode must be one of {}'.format(PROFILER_MODES))
+        if msg_body.reset:
+            PROFILER.stop()
+            PROFILER.reset()
+        PROFILER.start(targets=targets,
+                       num_requests=msg_body.num_requests,
+                       sample_rate=msg_body.sample_rate,
+                       mode=msg_body.mode,
+                       sample_interval=msg_body.sample_interval_ms / 1000.0)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return PROFILER.status()
+
+
+@app.delete("/profiler/", dependencies=[Depends(require_admin)])
+def delete_profiler(reset: bool = Query(False,
+                                        description='Also discard the results collected')):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a DELETE request for resource 'profiler'; switches the request profiler off.
+
+    The results collected are kept for download unless reset is true.
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> delete_profiler({})'.format(reset), flush=True)
+
+    PROFILER.stop()
+    if reset:
+        PROFILER.reset()
+    return PROFILER.status()
+
+
+@app.get("/profiler/stats/", dependencies=[Depends(require_admin)])
+def get_profiler_stats(output_format: str = Query('text',
+                                                  alias='format',
+                                                  regex='^text$|^pstats$|^collapsed$',
+                                                  description='\'text\', \'pstats\' or \'collapsed\''),
+                       sort: str = Query('cumulative',
+                                         regex='^cumulative$|^tottime$|^ncalls$',
+                                         description='Sort order for format text'),
+                       limit: int = Query(50,
+                                          ge=1,
+                                          description='Number of functions listed for format text')):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'profiler/stats'.
+
+    Downloads the profiler results. Format 'text' is a pstats report of mode 'cprofile' results;
+    'pstats' is the same results as a binary file for pstats, snakeviz and similar tools. Format
+    'collapsed' is the mode 'sample' stack samples, one line per distinct stack, as used by
+    flamegraph.pl and speedscope. Returns status 404 if there are no results in that format.
+    """
+    if output_format == 'collapsed':
+        stacks = PROFILER.collapsed_stacks()
+        if not stacks:
+            raise HTTPException(status_code=404, detail='No stack samples collected')
+        return PlainTextResponse(stacks)
+    elif output_format == 'text':
+        report = PROFILER.text_report(sort, limit)
+        if report is None:
+            raise HTTPException(status_code=404, detail='No profile collected')
+        return PlainTextResponse(report)
+    else:
+        temp_file = tempfile.NamedTemporaryFile(suffix='.pstats', delete=False)
+        temp_file.close()
+        if not PROFILER.dump_stats(temp_file.name):
+            os.remove(temp_file.name)
+            raise HTTPException(status_code=404, detail='No profile collected')
+        return FileResponse(temp_file.name,
+                            media_type='application/octet-stream',
+                            filename='profile.pstats',
+                            background=BackgroundTask(os.remove, temp_file.name))
+
+
+@app.get("/db-stats/", dependencies=[Depends(require_admin)])
+def get_db_stats():
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'db-stats'.
+
+    Returns latency stats for the database commands the server has made, one entry per
+    collection / command / query shape (the query with its values removed), most total time
+    first, along with the most recent commands slower than the slow operation threshold.
+    Each entry counts the servers its commands went to, and read_preference says where the
+    read-only resources read from. Returns status 404 if database monitoring is not enabled.
+    """
+    if DB_MONITOR is None:
+        raise HTTPException(status_code=404, detail='Database monitoring is not enabled')
+    return dict(DB_MONITOR.report(), read_preference=READ_PREFERENCE.document)
 
-    # Close the MongoDB connection when we are done with it
-    mongodb.close()
 
+@app.delete("/db-stats/", dependencies=[Depends(require_admin)])
+def delete_db_stats():
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a DELETE request for resource 'db-stats'; starts the stats over.
+    """
+    if DB_MONITOR is not None:
+        DB_MONITOR.reset()
     return
+
+
+class IngestMsgBody(BaseModel):
+    num_workers: int        # new number of ingest worker processes; devices are rehashed across them
+
+
+@app.get("/ingest/", dependencies=[Depends(require_admin)])
+def get_ingest():
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'ingest'; returns the status of the sharded ingest
+    workers, including per worker the readings waiting to be written and the number of restarts.
+    Returns status 404 if sharded ingest is not enabled.
+    """
+    if INGEST is None:
+        raise HTTPException(status_code=404, detail='Sharded ingest is not enabled')
+    return INGEST.status()
+
+
+@app.put("/ingest/", dependencies=[Depends(require_admin)])
+def put_ingest(msg_body: IngestMsgBody):
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a PUT request for resource 'ingest'; changes the number of ingest workers.
+
+    The current workers finish writing what they have and exit, then the new ones start.
+    Readings posted meanwhile are rejected with status 429 and a Retry-After header.
+    Returns status 404 if sharded ingest is not enabled, 400 if num_workers is less than 1.
+    """
+    if TRACE_MESSAGE_PROCESSING:
+        print('==> put_ingest({})'.format(msg_body.__dict__), flush=True)
+
+    if INGEST is None:
+        raise HTTPException(status_code=404, detail='Sharded ingest is not enabled')
+    if msg_body.num_workers < 1:
+        raise HTTPException(status_code=400, detail='num_workers must be at least 1')
+    INGEST.resize(msg_body.num_workers)
+    return INGEST.status()
+
+
+@app.get("/tenants/", dependencies=[Depends(require_admin)])
+def get_tenants():
+    # Note the docstring is picked up by the OpenAPI doc tools, thus only include info
+    # that makes sense from an API end-user's perspective.
+    """
+    Process a GET request for resource 'tenants'. Returns each tenant's database name, whether
+    it has a cluster of its own, its connection pool size, whether its connection is open and
+    when it last had a request (but not its API key or connection string), along with the
+    admission counters of each tenant that has posted readings since startup.
+    """
+    status = TENANTS.status()
+    status['admission'] = {tenant: admission.stats() for tenant, admission in ADMISSION.instances().items()}
+    return status
@@ -0,0 +1,61 @@
+# metrics.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+The metrics a reading can carry. A reading posted to readings/ may carry any metrics,
+by name (see main.ReadingsMsgBody); they are all stored with the reading. The metrics
+listed in METRICS are the ones we know how to alert on: each has range settings in
+the device config (see config_store.py),
+
+    <metric>_range_min / <metric>_range_max     the in range values
+    <metric>_hysteresis                         once alerting, how far back inside the range
+                                                a reading must be to count towards clearing
+    <metric>_num_readings                       continuous readings to check for this metric;
+                                                num_continuous_readings_to_check if not set
+
+and its alert state is kept in the device's state doc (see device_state.py). Metrics
+not listed here are stored but never alert. To alert on a new metric, add it here and
+give it a range in main.load_config().
+"""
+
+
+# Metric name -> its name in notifications, the units its values are shown with, and the type of its values
+METRICS = {'temp':       {'name': 'Temperature', 'units': 'F',    'type': int},     # degrees Fahrenheit
+           'humidity':   {'name': 'Humidity',    'units': '%',    'type': int},     # percent relative humidity
+           'co2':        {'name': 'CO2',         'units': ' ppm', 'type': int},     # parts per million
+           'pressure':   {'name': 'Pressure',    'units': ' hPa', 'type': float},   # barometric pressure
+           'water_leak': {'name': 'Water Leak',  'units': '',     'type': int}}     # 1 when water is detected
+
+OFFLINE = 'offline'             # not a metric as such; the device has stopped sending readings
+
+METRIC_NAME_REGEX = '^[a-z][a-z0-9_]{0,31}$'
+RESERVED_NAMES = {'dev_id', 'ts', 'repeat_count', 'heartbeat', 'metrics', OFFLINE}     # other fields of a reading
+
+
+def metric_config_keys():
+    """
+    The per-metric device config settings, with their types.
+
+    Returns:
+        Dict of setting -> type
+    """
+    keys = {}
+    for metric, definition in METRICS.items():
+        keys['{}_range_min'.format(metric)] = definition['type']
+        keys['{}_range_max'.format(metric)] = definition['type']
+        keys['{}_hysteresis'.format(metric)] = definition['type']
+        keys['{}_num_readings'.format(metric)] = int
+    return keys
+
+
+def format_value(metric, value):
+    """
+    A metric's value for a notification; e.g. '68F'.
+    """
+    return '{}{}'.format(value, METRICS[metric]['units']) if metric in METRICS else str(value)
+
+
+def metric_name(metric):
+    """
+    A metric's name for a notification; e.g. 'Temperature'.
+    """
+    return METRICS[metric]['name'] if metric in METRICS else metric
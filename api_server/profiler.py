@@ -0,0 +1,265 @@
+# profiler.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Request profiler that can be switched on and off while the server is running, so we
+can see where the time goes in e.g. POST /readings/ without a redeploy.
+
+Endpoints opt in with the @profiled decorator. When the profiler is off (the default)
+the decorator costs one attribute check per request. When it is on, it profiles the
+next N requests to the targeted endpoints, or a random sample of them, in one of
+two modes:
+
+    'cprofile' - deterministic profiling with cProfile; results are aggregated across
+                 requests into one pstats.Stats, downloadable as text or a .pstats file.
+                 Only one request is profiled at a time (cProfile does not nest, and on
+                 newer Pythons only one can be active per process); requests arriving
+                 while one is being profiled are skipped, not counted.
+    'sample'   - a background thread samples the stacks of the requests being profiled
+                 every few milliseconds; results are collapsed stacks (the format taken
+                 by flamegraph.pl and speedscope). Lower overhead, and handles any number
+                 of concurrent requests.
+"""
+
+import collections
+import functools
+import io
+import os
+import random
+import sys
+import threading
+import time
+
+
+PROFILER_MODES = ['cprofile', 'sample']
+
+
+class RequestProfiler:
+    """
+    The profiler state and results; see the module docstring.
+    """
+
+    def __init__(self):
+        self.enabled = False        # the only thing looked at per request while off
+        self.lock = threading.Lock()
+        self.targets = None
+        self.mode = 'cprofile'
+        self.sample_rate = 1.0
+        self.sample_interval = 0.005
+        self.remaining = None
+        self.random = random.Random()
+        self.in_progress = False    # cprofile mode; a request is being profiled
+        self.active_threads = {}    # sample mode; thread ident -> endpoint name, for requests being profiled
+        self.sampler_thread = None
+        self.reset()
+
+    def reset(self):
+        """
+        Discard the results collected so far.
+        """
+        with self.lock:
+            self.stats = None
+            self.stacks = collections.Counter()
+            self.num_profiled = collections.Counter()     # endpoint name -> requests profiled
+            self.started_at = None
+
+    def start(self, targets=None, num_requests=None, sample_rate=1.0, mode='cprofile', sample_interval=0.005):
+        """
+        Start profiling. Results are added to any collected before; see reset().
+
+        Args:
+            targets (set):            Names of the endpoint functions to profile; None for all @profiled endpoints
+            num_requests (int):       Stop after profiling this many requests; None to run until stop()
+            sample_rate (float):      Fraction of the targeted requests to profile; 0 to 1
+            mode (str):               'cprofile' or 'sample'
+            sample_interval (float):  Seconds between stack samples, in 'sample' mode
+
+        Returns:
+            None
+        """
+        if mode not in PROFILER_MODES:
+            raise ValueError('mode must be one of {}'.format(PROFILER_MODES))
+        if not (0.0 < sample_rate <= 1.0):
+            raise ValueError('sample_rate must be greater than 0 and at most 1')
+        if (num_requests is not None) and (num_requests < 1):
+            raise ValueError('num_requests must be at least 1')
+
+        with self.lock:
+            self.targets = None if targets is None else set(targets)
+            self.num_requests = num_requests
+            self.remaining = num_requests
+            self.sample_rate = sample_rate
+            self.mode = mode
+            self.sample_interval = sample_interval
+            if self.started_at is None:
+                self.started_at = time.time()
+            self.enabled = True
+
+            if (mode == 'sample') and ((self.sampler_thread is None) or not self.sampler_thread.is_alive()):
+                self.sampler_thread = threading.Thread(target=self.run_sampler, name='profiler_sampler', daemon=True)
+                self.sampler_thread.start()
+
+    def stop(self):
+        """
+        Stop profiling; the results are kept.
+        """
+        with self.lock:
+            self.enabled = False
+
+    def claim(self, name):
+        """
+        Decide whether to profile a request to an endpoint, and if so count it.
+
+        Returns:
+            True if the request should be profiled
+        """
+        with self.lock:
+            if (not self.enabled) or ((self.targets is not None) and (name not in self.targets)):
+                return False
+            if (self.mode == 'cprofile') and self.in_progress:
+                return False
+            if (self.sample_rate < 1.0) and (self.random.random() >= self.sample_rate):
+                return False
+
+            if self.remaining is not None:
+                self.remaining -= 1
+                if self.remaining <= 0:
+                    self.enabled = False
+            self.num_profiled[name] += 1
+            if self.mode == 'cprofile':
+                self.in_progress = True
+            else:
+                self.active_threads[threading.get_ident()] = name
+            return True
+
+    def call(self, name, func, args, kwargs):
+        """
+        Run an endpoint function, profiling it if claim() says so.
+        """
+        if not self.claim(name):
+            return func(*args, **kwargs)
+
+        if self.mode == 'cprofile':
+            import cProfile, pstats     # imported on first use; the profiler is off unless switched on
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                with self.lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+                    self.in_progress = False
+        else:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.active_threads.pop(threading.get_ident(), None)
+
+    def run_sampler(self):
+        """
+        Sampler thread for 'sample' mode; runs until profiling stops and no profiled requests remain.
+        """
+        while True:
+            with self.lock:
+                if (not self.enabled or self.mode != 'sample') and not self.active_threads:
+                    self.sampler_thread = None
+                    return
+                active_threads = dict(self.active_threads)
+                interval = self.sample_interval
+
+            if active_threads:
+                frames = sys._current_frames()
+                samples = []
+                for ident, name in active_threads.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples.append(collapse_stack(name, frame))
+                with self.lock:
+                    self.stacks.update(samples)
+            time.sleep(interval)
+
+    def status(self):
+        """
+        Returns:
+            Dict describing the profiler's settings and what has been collected
+        """
+        with self.lock:
+            return {'enabled': self.enabled,
+                    'mode': self.mode,
+                    'targets': None if self.targets is None else sorted(self.targets),
+                    'num_requests': self.num_requests if self.started_at is not None else None,
+                    'remaining': self.remaining,
+                    'sample_rate': self.sample_rate,
+                    'num_profiled': dict(self.num_profiled),
+                    'num_stack_samples': sum(self.stacks.values()),
+                    'started_at': self.started_at}
+
+    def text_report(self, sort='cumulative', limit=50):
+        """
+        Returns:
+            The aggregated cProfile results as text; None if there are none
+        """
+        with self.lock:
+            if self.stats is None:
+                return None
+            output = io.StringIO()
+            self.stats.stream = output
+            self.stats.sort_stats(sort).print_stats(limit)
+            return output.getvalue()
+
+    def dump_stats(self, filename):
+        """
+        Write the aggregated cProfile results to a file, for loading with pstats / snakeviz etc.
+
+        Returns:
+            False if there are no results
+        """
+        with self.lock:
+            if self.stats is None:
+                return False
+            self.stats.dump_stats(filename)
+            return True
+
+    def collapsed_stacks(self):
+        """
+        Returns:
+            The stack samples in collapsed format; one 'frame;frame;... count' line per distinct stack
+        """
+        with self.lock:
+            return ''.join('{} {}\n'.format(stack, count) for stack, count in self.stacks.most_common())
+
+
+def collapse_stack(name, frame):
+    """
+    A stack as a single collapsed-format string, outermost frame first, prefixed by the endpoint name.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    names.append(name)
+    return ';'.join(reversed(names))
+
+
+def profiled(profiler):
+    """
+    Decorator for endpoint functions that may be profiled; use under the @app.get() etc. decorator.
+    FastAPI sees the endpoint's own signature (via functools.wraps).
+
+    Args:
+        profiler (RequestProfiler):   The profiler to use
+
+    Returns:
+        Decorator
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            return profiler.call(func.__name__, func, args, kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,314 @@
+# reading_sketches.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Per device, per day summaries of the readings for percentile queries (e.g. the monthly
+p5 / p50 / p95 report), so a query reads one small doc per device per day rather than
+every reading.
+
+The summary is a histogram: the number of readings in each bucket of values. That is the
+limiting case of a quantile sketch (t-digest, KLL): it merges by adding counts, and unlike a
+t-digest it can be updated in place by the DB with $inc, so concurrent writers (several server
+processes, the ingest workers) never need to read and rewrite it. How the values are bucketed
+depends on the metric's type (see metrics.py):
+
+  - Integer metrics (temperature, humidity, CO2, ...) get a bucket per whole number, so their
+    histograms keep every distinct value and their percentiles are exact. They stay small
+    because a device only reports a few dozen distinct values in a day, however many readings
+    it sends. A value sent with decimals is rounded to the nearest whole number.
+  - Decimal metrics (pressure, ...) get logarithmic buckets with a fixed relative error
+    (RELATIVE_ACCURACY; the DDSketch scheme): a bucket's value, e.g. that reported for a
+    percentile, is within 0.05% of every value in it. However many distinct values are sent,
+    the buckets cover a 1000x range of values with about 7000 of them, and a sensor's usual
+    range (e.g. 950 - 1050 hPa) with about 100.
+
+The docs, in the reading_sketches collection, look like:
+
+    {'dev_id': 'RazPi_01', 'day': '2020-06-18', 'count': 1440,
+     'temp': {'66': 210, '67': 805, '68': 425}, 'pressure': {'g6921': 1000, 'g6922': 440}}
+
+with a histogram for each metric of metrics.py the device's readings carry; count is the
+number of readings, whichever metrics they carry. The keys are the bucket_key() of the values.
+
+Readings are bucketed by the UTC day of their own timestamp, and a reading standing for
+several (repeat_count > 1) counts that many times. A percentile is the nearest-rank one:
+the smallest value with at least p% of the readings at or below it (for a decimal metric, the
+value of that value's bucket).
+
+The sketches are kept up to date as readings are stored (POST readings/, the ingest workers
+and import_readings.py). For readings stored before the sketches existed, rebuild them with:
+
+    python reading_sketches.py [--dev-id <dev_id>]
+"""
+
+import argparse
+import math
+from metrics import METRICS
+
+
+SKETCH_READING_TYPES = list(METRICS)
+
+RELATIVE_ACCURACY = 0.0005      # of the logarithmic buckets of decimal metrics
+GAMMA = (1.0 + RELATIVE_ACCURACY) / (1.0 - RELATIVE_ACCURACY)      # ratio of one bucket's upper bound to the last's
+LOG_GAMMA = math.log(GAMMA)
+
+
+def bucket_key(reading_type, value):
+    """
+    The histogram bucket of a value.
+
+    Args:
+        reading_type (str):   A metric of metrics.py; e.g. 'temp'
+        value:                The value
+
+    Returns:
+        The bucket's key in the histogram; for an integer metric the nearest whole number (e.g. '68'), for
+        a decimal metric 'g<index>' of its logarithmic bucket, prefixed by '-' for a negative value, or '0'
+    """
+    if METRICS[reading_type]['type'] is int:
+        return str(int(round(value)))
+    if value == 0:
+        return '0'
+    index = math.ceil(math.log(abs(value)) / LOG_GAMMA)
+    return '{}g{}'.format('-' if value < 0 else '', index)
+
+
+def bucket_value(reading_type, key):
+    """
+    The value of a histogram bucket; the inverse of bucket_key().
+
+    Args:
+        reading_type (str):   A metric of metrics.py; e.g. 'temp'
+        key (str):            The bucket's key
+
+    Returns:
+        For a whole number bucket, that number; for a logarithmic one, the value within RELATIVE_ACCURACY of
+        all those in it
+    """
+    sign, key = (-1, key[1:]) if key.startswith('-') else (1, key)
+    if not key.startswith('g'):
+        return sign * int(key)          # also the whole number buckets of decimal metrics kept before they had their own
+    return sign * 2.0 * math.exp(int(key[1:]) * LOG_GAMMA) / (GAMMA + 1.0)
+
+
+def bucket_for(ts):
+    """
+    The day bucket of a reading.
+
+    Args:
+        ts (str):     Reading timestamp; e.g. '2020-06-18T11:06:00Z'
+
+    Returns:
+        The UTC day; e.g. '2020-06-18'
+    """
+    return ts[:10]
+
+
+def reading_increments(reading):
+    """
+    What a reading adds to its day's sketch.
+
+    Args:
+        reading (dict):   Readings collection doc
+
+    Returns:
+        Dict for a $inc update
+    """
+    weight = reading.get('repeat_count', 1)
+    increments = {'count': weight}
+    for reading_type in SKETCH_READING_TYPES:
+        value = reading.get(reading_type)
+        if value is not None:
+            increments['{}.{}'.format(reading_type, bucket_key(reading_type, value))] = weight
+    return increments
+
+
+def add_increments(pending, dev_id, day, increments):
+    """
+    Add increments into pending, for writing several readings' increments in one update per sketch.
+
+    Args:
+        pending (dict):       (dev_id, day) -> increments; updated in place
+        dev_id (str):         ID of the device
+        day (str):            Day bucket
+        increments (dict):    From reading_increments()
+
+    Returns:
+        None
+    """
+    totals = pending.setdefault((dev_id, day), {})
+    for field, count in increments.items():
+        totals[field] = totals.get(field, 0) + count
+
+
+def sketch_update(dev_id, day, increments, last_reading_id=None):
+    """
+    The bulk_write() request applying increments to a sketch.
+
+    Args:
+        dev_id (str):             ID of the device
+        day (str):                Day bucket
+        increments (dict):        From reading_increments() / add_increments()
+        last_reading_id:          _id of the last reading included, if tracked (see ingest_workers.py)
+
+    Returns:
+        pymongo UpdateOne
+    """
+    import pymongo      # imported on first use; see the note on imports in main.py
+    update = {'$inc': increments}
+    if last_reading_id is not None:
+        update['$max'] = {'last_reading_id': last_reading_id}
+    return pymongo.UpdateOne({'dev_id': dev_id, 'day': day}, update, upsert=True)
+
+
+def record_reading(collection, reading):
+    """
+    Add a reading to its day's sketch.
+
+    Args:
+        collection:       reading_sketches collection
+        reading (dict):   Readings collection doc
+
+    Returns:
+        None
+    """
+    collection.update_one({'dev_id': reading['dev_id'], 'day': bucket_for(reading['ts'])},
+                          {'$inc': reading_increments(reading)}, upsert=True)
+
+
+def merge_counts(docs, reading_type):
+    """
+    Merge sketches into one histogram.
+
+    Args:
+        docs:                 Sketch docs
+        reading_type (str):   A metric; e.g. 'temp'
+
+    Returns:
+        Dict of bucket value -> number of readings
+    """
+    counts = {}
+    for doc in docs:
+        for key, count in (doc.get(reading_type) or {}).items():
+            value = bucket_value(reading_type, key)
+            counts[value] = counts.get(value, 0) + count
+    return counts
+
+
+def percentile_values(counts, percentiles):
+    """
+    Nearest-rank percentiles of a histogram.
+
+    Args:
+        counts (dict):        Value -> number of readings; from merge_counts()
+        percentiles (list):   Percentiles wanted, each 0 - 100
+
+    Returns:
+        Dict of percentile -> value; the values are None if there are no readings
+    """
+    total = sum(counts.values())
+    if total == 0:
+        return {percentile: None for percentile in percentiles}
+
+    values = sorted(counts)
+    results = {}
+    for percentile in sorted(percentiles):
+        rank = max(1, math.ceil(total * percentile / 100.0))
+        cumulative = 0
+        for value in values:
+            cumulative += counts[value]
+            if cumulative >= rank:
+                results[percentile] = value
+                break
+    return results
+
+
+def query_sketches(collection, reading_type, percentiles, dev_id=None, start_day=None, end_day=None):
+    """
+    Percentiles of the readings over a range of days, from the sketches alone.
+
+    Args:
+        collection:           reading_sketches collection
+        reading_type (str):   A metric; e.g. 'temp'
+        percentiles (list):   Percentiles wanted, each 0 - 100
+        dev_id (str):         Only this device, if given; else all devices
+        start_day (str):      First day included, if given; e.g. '2020-06-01'
+        end_day (str):        First day not included, if given
+
+    Returns:
+        Dict with num_buckets, count, min, max, mean and percentiles (percentile -> value)
+    """
+    query = {}
+    if dev_id is not None:
+        query['dev_id'] = dev_id
+    if (start_day is not None) or (end_day is not None):
+        query['day'] = {}
+        if start_day is not None:
+            query['day']['$gte'] = start_day
+        if end_day is not None:
+            query['day']['$lt'] = end_day
+    docs = list(collection.find(query, {'_id': False, reading_type: True}))
+
+    counts = merge_counts(docs, reading_type)
+    count = sum(counts.values())
+    return {'num_buckets': len(docs),
+            'count': count,
+            'min': min(counts) if counts else None,
+            'max': max(counts) if counts else None,
+            'mean': (sum(value * n for value, n in counts.items()) / count) if count else None,
+            'percentiles': percentile_values(counts, percentiles)}
+
+
+def rebuild(db, dev_id=None):
+    """
+    Recompute sketches from the readings; for readings stored before the sketches were kept. One
+    scan of the readings per metric, grouped by the DB. Readings stored for the devices while this runs may be
+    missed, so run it before the devices start sending.
+
+    Args:
+        db:               Connection to our MongoDB database
+        dev_id (str):     Only this device, if given; else all devices
+
+    Returns:
+        Number of sketches written
+    """
+    query = {}
+    if dev_id is not None:
+        query['dev_id'] = dev_id
+
+    sketches = {}
+    for reading_type in SKETCH_READING_TYPES:
+        pipeline = [{'$match': query},
+                    {'$group': {'_id': {'dev_id': '$dev_id',
+                                        'day': {'$substr': ['$ts', 0, 10]},
+                                        'value': '$' + reading_type},
+                                'count': {'$sum': {'$ifNull': ['$repeat_count', 1]}}}}]
+        for doc in db.readings.aggregate(pipeline, allowDiskUse=True):
+            key = (doc['_id']['dev_id'], doc['_id']['day'])
+            sketch = sketches.setdefault(key, {'dev_id': key[0], 'day': key[1], 'count': 0})
+            if reading_type == SKETCH_READING_TYPES[0]:
+                sketch['count'] += doc['count']         # every reading is in one group, with or without the metric
+            if doc['_id'].get('value') is None:       # the group of readings without the metric
+                continue
+            bucket = bucket_key(reading_type, doc['_id']['value'])      # bucketed here; values may share a bucket
+            histogram = sketch.setdefault(reading_type, {})
+            histogram[bucket] = histogram.get(bucket, 0) + doc['count']
+
+    db.reading_sketches.delete_many(query)
+    docs = list(sketches.values())
+    for start in range(0, len(docs), 1000):
+        db.reading_sketches.insert_many(docs[start:start + 1000], ordered=False)
+    return len(docs)
+
+
+if __name__ == '__main__':
+    import pymongo
+    import main
+
+    my_parser = argparse.ArgumentParser(description='Rebuild the per-day reading sketches from the readings')
+    my_parser.add_argument('--dev-id', help='only rebuild this device\'s sketches')
+    args = my_parser.parse_args()
+
+    main.load_config()
+    mongodb = pymongo.MongoClient(main.SECRET_DATA['mongodb_server_url'])
+    print('{} sketches written'.format(rebuild(mongodb[main.CONFIG_DATA['mongodb_database_name']], args.dev_id)))
+    mongodb.close()
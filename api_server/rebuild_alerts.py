@@ -0,0 +1,400 @@
+# rebuild_alerts.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Admin tool to check, and if need be rebuild, the alert state from the readings. After a
+bad deploy, or a manual delete of active alerts or alert history, active_alerts,
+alert_history and the device_state docs can disagree with what the readings imply;
+this recomputes what they should hold for every device and compares.
+
+For each device the readings are streamed from the DB (one indexed query per device)
+and our alert rule evaluated over them with alert_replay.py, for each metric, using
+the device's own thresholds and hysteresis (see config_store.py). Devices are split into batches that run on a pool
+of worker processes; a device is only ever handled by one of them, and each batch's
+fixes are written with one bulk write per collection.
+
+With --dry-run nothing is written; the differences are listed, and the exit status
+is 1 if there are any. Otherwise, for each device / reading type that differs, its
+alert history, active alert and state doc alert / window are replaced with the
+recomputed ones. Alert timestamps are compared within --tolerance-minutes, as the
+server stamps alerts with its own time while the rebuild can only use the readings'.
+
+Only the range check is rebuilt: offline alerts, and alerts raised by the optional
+anomaly detector (marked with cause 'anomaly'; see device_state.py), are not implied by
+the readings alone and are left as they are. While an anomaly alert is active, or over
+the span of one in the alert history, the range check's alerts are not expected either,
+as the server carries the one alert on rather than raising another.
+As the server holds alert state in memory (timers, ingest workers), stop it before
+rebuilding, and start it again afterwards. It uses the same environment variables
+and configuration as the server. It is run as follows:
+
+    python rebuild_alerts.py [-v] [--dry-run] [--workers <n>] [--tolerance-minutes <n>] [-d <dev_id> ...]
+
+Examples:
+
+    python rebuild_alerts.py --dry-run
+    python rebuild_alerts.py -v --workers 8 -d RazPi_01 -d RazPi_02
+"""
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pymongo
+import alert_replay
+import device_state
+from metrics import METRICS
+
+
+REBUILD_READING_TYPES = device_state.STATE_READING_TYPES
+ANOMALY_CAUSE = 'anomaly'       # see device_state.new_alert()
+
+WORKER_DB = None        # each pool process's connection to our database; see init_worker()
+
+
+def init_worker(mongodb_server_url, database_name):
+    """
+    Pool process initializer; each process has its own MongoClient.
+    """
+    global WORKER_DB
+    WORKER_DB = pymongo.MongoClient(mongodb_server_url)[database_name]
+
+
+def load_device_readings(db, dev_id):
+    """
+    Load a device's readings into arrays, oldest first; streamed in big batches.
+
+    Args:
+        db:               Connection to our MongoDB database
+        dev_id (str):     Device to load readings for
+
+    Returns:
+        Tuple of (datetime64 ndarray of timestamps, dict of reading type -> float ndarray of values,
+        NaN where a reading does not carry the metric, ndarray of repeat counts)
+    """
+    projection = dict({'_id': False, 'ts': True, 'repeat_count': True},
+                      **{reading_type: True for reading_type in REBUILD_READING_TYPES})
+    timestamps = []
+    values = {reading_type: [] for reading_type in REBUILD_READING_TYPES}
+    repeat_counts = []
+    for doc in db.readings.find({'dev_id': dev_id}, projection, batch_size=50000).sort('ts', pymongo.ASCENDING):
+        timestamps.append(doc['ts'])
+        for reading_type in REBUILD_READING_TYPES:
+            values[reading_type].append(doc.get(reading_type))
+        repeat_counts.append(doc.get('repeat_count', 1))
+
+    return pd.to_datetime(pd.Series(timestamps, dtype=str), format=alert_replay.TIMESTAMP_FORMAT).to_numpy(), \
+        {reading_type: np.array(values[reading_type], dtype=np.float64) for reading_type in REBUILD_READING_TYPES}, \
+        np.array(repeat_counts, dtype=np.int64)
+
+
+def stored_value(reading_type, value):
+    """
+    A value from load_device_readings() as the server stores it; e.g. 68 rather than 68.0 for temp.
+    """
+    return METRICS[reading_type]['type'](value)
+
+
+def expected_alerts(dev_id, reading_type, timestamps, values, repeat_counts, config):
+    """
+    What the alert state of one device / reading type should be, given its readings.
+
+    Args:
+        dev_id (str):             ID of the device
+        reading_type (str):       A metric; e.g. 'temp'
+        timestamps (ndarray):     datetime64 timestamp per reading, oldest first
+        values (ndarray):         Value per reading; NaN where the reading does not carry the metric
+        repeat_counts (ndarray):  Number of readings each stands for (see ReadingsMsgBody)
+        config (dict):            The device's config
+
+    Returns:
+        Dict with history (list of alert_history docs), active (the state doc alert; None if no
+        alert is active) and window (the state doc's flags)
+    """
+    result = {'history': [], 'active': None, 'window': []}
+    rule = device_state.metric_rule(config, reading_type)
+    if rule is None:
+        return result           # not alerted on
+    num_readings = rule['num_readings']
+    window_size = max(num_readings, device_state.MIN_WINDOW_SIZE)
+
+    # Only the readings carrying the metric; a reading standing for several counts that many times, as in
+    #  the state doc's window
+    present = ~np.isnan(values)
+    repeats = np.minimum(repeat_counts[present], window_size)
+    timestamps, values = np.repeat(timestamps[present], repeats), np.repeat(values[present], repeats)
+    out_of_range = alert_replay.out_of_range_flags(values, rule['range_min'], rule['range_max'])
+    clear = alert_replay.clear_flags(values, rule['clear_min'], rule['clear_max'])
+    result['window'] = [True if flag else (False if cleared else None)
+                        for flag, cleared in zip(out_of_range[-window_size:].tolist(), clear[-window_size:].tolist())]
+    if len(values) == 0:
+        return result
+
+    dev_codes = np.zeros(len(values), dtype=np.int64)
+    episodes = alert_replay.alert_episodes(dev_codes, timestamps, values,
+                                           alert_replay.alert_state(dev_codes, out_of_range, num_readings, clear))
+    for i in range(len(episodes['start_idx'])):
+        originated_ts = alert_replay.format_timestamp(episodes['originated'][i])
+        if episodes['end_idx'][i] >= 0:
+            result['history'].append({'dev_id': dev_id,
+                                      'reading_type': reading_type,
+                                      'originated_ts': originated_ts,
+                                      'cleared_ts': alert_replay.format_timestamp(episodes['cleared'][i]),
+                                      'duration_minutes': int(episodes['duration_minutes'][i]),
+                                      'max_value': stored_value(reading_type, episodes['max_value'][i]),
+                                      'min_value': stored_value(reading_type, episodes['min_value'][i])})
+        else:
+            notifications = alert_replay.notification_times(timestamps, episodes['start_idx'][i],
+                                                            episodes['stop_idx'][i],
+                                                            config['alert_renotification_delay'])
+            result['active'] = {'originated_ts': originated_ts,
+                                'notification_ts': alert_replay.format_timestamp(notifications[-1]),
+                                'max_value': stored_value(reading_type, episodes['max_value'][i]),
+                                'min_value': stored_value(reading_type, episodes['min_value'][i]),
+                                'last_value': stored_value(reading_type, values[-1])}
+    return result
+
+
+def actual_alerts(db, dev_id):
+    """
+    A device's alert state as stored.
+
+    Returns:
+        Dict of reading type -> dict with history (alert_history docs, by originated_ts), active
+        (active_alerts docs) and state (the state doc's alert), all of the range check's alerts only,
+        and anomaly_spans, (originated_ts, cleared_ts) of the anomaly detector's alerts; cleared_ts
+        is None for one still active
+    """
+    state = db.device_state.find_one({'dev_id': dev_id}, {'_id': False}) or {}
+    actual = {reading_type: {'history': [], 'active': [], 'state': state.get('{}_alert'.format(reading_type)),
+                             'anomaly_spans': []}
+              for reading_type in REBUILD_READING_TYPES}
+    for entry in actual.values():
+        if (entry['state'] is not None) and (entry['state'].get('cause') == ANOMALY_CAUSE):
+            entry['anomaly_spans'].append((entry['state']['originated_ts'], None))
+            entry['state'] = None
+    query = {'dev_id': dev_id, 'reading_type': {'$in': REBUILD_READING_TYPES}}
+    for doc in db.alert_history.find(query, {'_id': False}).sort('originated_ts', pymongo.ASCENDING):
+        if doc.get('cause') == ANOMALY_CAUSE:
+            actual[doc['reading_type']]['anomaly_spans'].append((doc['originated_ts'], doc['cleared_ts']))
+        else:
+            actual[doc['reading_type']]['history'].append(doc)
+    for doc in db.active_alerts.find(query, {'_id': False}):
+        if doc.get('cause') != ANOMALY_CAUSE:
+            actual[doc['reading_type']]['active'].append(doc)
+    return actual
+
+
+def during_anomaly(ts, anomaly_spans, tolerance_minutes):
+    """
+    Whether a range check alert originated at ts would have been taken up by an anomaly alert.
+    """
+    for originated_ts, cleared_ts in anomaly_spans:
+        if (same_time(ts, originated_ts, tolerance_minutes) or (ts >= originated_ts)) and \
+                ((cleared_ts is None) or (ts <= cleared_ts)):
+            return True
+    return False
+
+
+def same_time(ts, other_ts, tolerance_minutes):
+    """
+    Whether two timestamps are within tolerance_minutes of each other.
+    """
+    delta = pd.Timestamp(ts) - pd.Timestamp(other_ts)
+    return abs(delta.total_seconds()) <= tolerance_minutes * 60
+
+
+def compare(reading_type, expected, actual, tolerance_minutes):
+    """
+    Compare the expected alert state of a device / reading type with what is stored.
+
+    Args:
+        reading_type (str):           A metric; e.g. 'temp'
+        expected (dict):              From expected_alerts()
+        actual (dict):                The reading type's entry from actual_alerts()
+        tolerance_minutes (float):    Max difference for alert timestamps to count as the same
+
+    Returns:
+        List of differences, as text; empty if they agree
+    """
+    differences = []
+    anomaly_spans = actual['anomaly_spans']
+
+    # Alert history; both sorted by originated_ts, so matched up in one pass
+    expected_history = [doc for doc in expected['history']
+                        if not during_anomaly(doc['originated_ts'], anomaly_spans, tolerance_minutes)]
+    actual_history = actual['history']
+    i = j = 0
+    while (i < len(expected_history)) or (j < len(actual_history)):
+        if (i < len(expected_history)) and (j < len(actual_history)) and \
+                same_time(expected_history[i]['originated_ts'], actual_history[j]['originated_ts'], tolerance_minutes):
+            i += 1
+            j += 1
+        elif (j >= len(actual_history)) or \
+                ((i < len(expected_history)) and
+                 (expected_history[i]['originated_ts'] < actual_history[j]['originated_ts'])):
+            differences.append('{}: missing alert history originated {}'.format(
+                reading_type, expected_history[i]['originated_ts']))
+            i += 1
+        else:
+            differences.append('{}: unexpected alert history originated {}'.format(
+                reading_type, actual_history[j]['originated_ts']))
+            j += 1
+
+    # Active alert, in both active_alerts and the state doc
+    alert = expected['active']
+    if (alert is not None) and during_anomaly(alert['originated_ts'], anomaly_spans, tolerance_minutes):
+        alert = None
+    for name, stored in [('active alert', actual['active'][0] if actual['active'] else None),
+                         ('state doc alert', actual['state'])]:
+        if (alert is None) and (stored is not None):
+            differences.append('{}: unexpected {} originated {}'.format(reading_type, name, stored['originated_ts']))
+        elif (alert is not None) and (stored is None):
+            differences.append('{}: missing {} originated {}'.format(reading_type, name, alert['originated_ts']))
+        elif (alert is not None) and not same_time(alert['originated_ts'], stored['originated_ts'], tolerance_minutes):
+            differences.append('{}: {} originated {}, expected {}'.format(reading_type, name, stored['originated_ts'],
+                                                                          alert['originated_ts']))
+    if len(actual['active']) > 1:
+        differences.append('{}: {} active alert records'.format(reading_type, len(actual['active'])))
+    return differences
+
+
+def fix_requests(dev_id, reading_type, expected, actual, tolerance_minutes, requests):
+    """
+    Add the writes replacing a device / reading type's alert state with the expected one. The
+    anomaly detector's alerts are kept, along with the state doc's alert while one is active.
+
+    Args:
+        dev_id (str):                 ID of the device
+        reading_type (str):           A metric; e.g. 'temp'
+        expected (dict):              From expected_alerts()
+        actual (dict):                The reading type's entry from actual_alerts()
+        tolerance_minutes (float):    See compare()
+        requests (dict):              Collection name -> list of bulk_write() requests; updated in place
+
+    Returns:
+        None
+    """
+    anomaly_spans = actual['anomaly_spans']
+    query = {'dev_id': dev_id, 'reading_type': reading_type}
+    range_query = dict(query, cause={'$ne': ANOMALY_CAUSE})
+    requests['alert_history'].append(pymongo.DeleteMany(range_query))
+    requests['alert_history'].extend(pymongo.InsertOne(doc) for doc in expected['history']
+                                     if not during_anomaly(doc['originated_ts'], anomaly_spans, tolerance_minutes))
+
+    if any(cleared_ts is None for _, cleared_ts in anomaly_spans):
+        requests['device_state'].append(pymongo.UpdateOne({'dev_id': dev_id},
+                                                          {'$set': {'{}_window'.format(reading_type): expected['window']}},
+                                                          upsert=True))
+        return
+
+    requests['active_alerts'].append(pymongo.DeleteMany(range_query))
+    alert = expected['active']
+    if alert is not None:
+        requests['active_alerts'].append(pymongo.InsertOne(dict(query,
+                                                                originated_ts=alert['originated_ts'],
+                                                                notification_ts=alert['notification_ts'],
+                                                                max_value=alert['max_value'],
+                                                                min_value=alert['min_value'])))
+
+    requests['device_state'].append(pymongo.UpdateOne({'dev_id': dev_id},
+                                                      {'$set': {'{}_alert'.format(reading_type): alert,
+                                                                '{}_window'.format(reading_type): expected['window'],
+                                                                '{}_transition'.format(reading_type): None,
+                                                                '{}_cleared'.format(reading_type): None}},
+                                                      upsert=True))
+
+
+def rebuild_devices(devices, dry_run, tolerance_minutes):
+    """
+    Check, and unless dry_run fix, a batch of devices; run on the pool processes.
+
+    Args:
+        devices (list):               (dev_id, config) tuples
+        dry_run (bool):               Only report the differences
+        tolerance_minutes (float):    See compare()
+
+    Returns:
+        List of (dev_id, number of readings, list of differences) tuples
+    """
+    db = WORKER_DB
+    requests = {'alert_history': [], 'active_alerts': [], 'device_state': []}
+    results = []
+    for dev_id, config in devices:
+        timestamps, values, repeat_counts = load_device_readings(db, dev_id)
+        actual = actual_alerts(db, dev_id)
+        differences = []
+        for reading_type in REBUILD_READING_TYPES:
+            expected = expected_alerts(dev_id, reading_type, timestamps, values[reading_type], repeat_counts, config)
+            type_differences = compare(reading_type, expected, actual[reading_type], tolerance_minutes)
+            if type_differences and not dry_run:
+                fix_requests(dev_id, reading_type, expected, actual[reading_type], tolerance_minutes, requests)
+            differences.extend(type_differences)
+        results.append((dev_id, len(timestamps), differences))
+
+    # Ordered, as each device's deletes must go before its inserts
+    for collection_name, collection_requests in requests.items():
+        if collection_requests:
+            db[collection_name].bulk_write(collection_requests, ordered=True)
+    return results
+
+
+def main_rebuild():
+    import main
+    from config_store import DeviceConfigStore
+
+    # Extract command line args
+    my_parser = argparse.ArgumentParser(description='Check / rebuild the alert state from the readings')
+    my_parser.add_argument('-v', action='store_true', help='verbose mode')
+    my_parser.add_argument('--dry-run', action='store_true', help='only list the differences; write nothing')
+    my_parser.add_argument('-d', '--dev-id', action='append', help='only this device; may be repeated')
+    my_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    my_parser.add_argument('--devices-per-task', type=int, default=20, help='devices per batch of work')
+    my_parser.add_argument('--tolerance-minutes', type=float, default=5,
+                           help='max difference for alert timestamps to count as the same')
+    args = my_parser.parse_args()
+
+    main.load_config()
+    mongodb_server_url = main.SECRET_DATA['mongodb_server_url']
+    database_name = main.CONFIG_DATA['mongodb_database_name']
+    mongodb = pymongo.MongoClient(mongodb_server_url)
+    db = mongodb[database_name]
+    dev_ids = args.dev_id or sorted(db.readings.distinct('dev_id'))
+    device_config = DeviceConfigStore(main.CONFIG_DATA)
+    device_config.load(db)
+    mongodb.close()
+    devices = [(dev_id, device_config.get(dev_id)) for dev_id in dev_ids]
+
+    start_time = time.monotonic()
+    num_readings = 0
+    num_differing = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=init_worker,
+                                                initargs=(mongodb_server_url, database_name)) as executor:
+        futures = [executor.submit(rebuild_devices, devices[start:start + args.devices_per_task], args.dry_run,
+                                   args.tolerance_minutes)
+                   for start in range(0, len(devices), args.devices_per_task)]
+        for future in concurrent.futures.as_completed(futures):
+            for dev_id, device_readings, differences in future.result():
+                num_readings += device_readings
+                num_differing += bool(differences)
+                for difference in differences:
+                    print('{}: {}'.format(dev_id, difference), flush=True)
+                if args.v:
+                    print('{}: {} readings, {}'.format(dev_id, device_readings,
+                                                       'rebuilt' if (differences and not args.dry_run) else 'checked'),
+                          flush=True)
+
+    print('{} devices, {} readings, {} with differences{} in {:.1f} seconds'.format(
+        len(devices), num_readings, num_differing, '' if args.dry_run else ' (rebuilt)',
+        time.monotonic() - start_time), flush=True)
+    if args.dry_run and num_differing:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_rebuild()
@@ -1,6 +1,11 @@
 # This is a powershell script to run tests. Note there is a call to run each
 # individual test directly with verbose mode as well as running the entire
 # test suite via pytest.
+#
+# test_main.py sends header X-Read-Preference: primary with its count and query requests, as it
+# reads straight after writing and the server reads from a secondary by default. It posts its readings
+# as fast as it can, so when the server's per-device rate limit turns one away with a 429, it waits the
+# Retry-After seconds and resends, as the client does.
 
 
 # *** Individual generic tests; uncomment the one(s) you wish to run ***
@@ -28,6 +33,14 @@
 #clear; python test_main.py -v -t test_trigger_temp_and_humidity_alert
 
 
+# *** Individual query tests; uncomment the one(s) you wish to run ***
+#clear; python test_main.py -v -t test_alert_history_query
+
+
+# *** Individual validation tests; uncomment the one(s) you wish to run ***
+#clear; python test_main.py -v -t test_invalid_repeat_count_rejected
+
+
 # *** Run the entire test suite via pytest; uncomment to run ***
 #clear; pytest test_main.py
 clear; pytest -v test_main.py
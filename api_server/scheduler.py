@@ -0,0 +1,176 @@
+# scheduler.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Background timer scheduler. Timers are keyed (the server keys them by device ID and
+reading type) and each key has at most one pending due time; scheduling a key again
+moves its timer. When timers come due, a callback is run on the scheduler's own thread
+with the keys that are due.
+
+Timers are kept in a min-heap ordered by due time, with lazy deletion: rescheduling or
+cancelling a key just updates a dict, and stale heap entries are skipped when they reach
+the top. Scheduling, rescheduling and firing are each O(log n) in the number of timers,
+and nothing is ever scanned, so 100k+ devices are fine. The heap is rebuilt without the
+stale entries whenever they come to outnumber the live ones.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+class TimerHeap:
+    """
+    The timers themselves; not thread-safe (TimerScheduler does the locking).
+    """
+
+    def __init__(self):
+        self.heap = []              # (due time, sequence number, key); may include stale entries
+        self.entries = {}           # key -> (due time, sequence number) of its live entry
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def schedule(self, key, due):
+        """
+        Set the due time for a key, replacing any timer it already has.
+        """
+        entry = (due, next(self.counter))
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry + (key,))
+        if len(self.heap) > 2 * len(self.entries) + 1000:
+            self.compact()
+
+    def cancel(self, key):
+        """
+        Cancel a key's timer, if it has one.
+        """
+        self.entries.pop(key, None)
+
+    def cancel_where(self, predicate):
+        """
+        Cancel the timers of all keys for which predicate(key) is True. This one is O(n); it is
+        meant for rare admin operations, not the normal flow.
+        """
+        for key in [key for key in self.entries if predicate(key)]:
+            del self.entries[key]
+
+    def due_time(self, key):
+        """
+        The key's due time; None if it has no timer.
+        """
+        entry = self.entries.get(key)
+        return None if entry is None else entry[0]
+
+    def next_due(self):
+        """
+        Due time of the earliest timer; None if there are none.
+        """
+        self.drop_stale()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """
+        Remove and return the keys of all timers due at or before now, earliest first.
+        """
+        keys = []
+        self.drop_stale()
+        while self.heap and self.heap[0][0] <= now:
+            due, sequence, key = heapq.heappop(self.heap)
+            del self.entries[key]
+            keys.append(key)
+            self.drop_stale()
+        return keys
+
+    def drop_stale(self):
+        while self.heap and self.entries.get(self.heap[0][2]) != self.heap[0][:2]:
+            heapq.heappop(self.heap)
+
+    def compact(self):
+        self.heap = [(due, sequence, key) for key, (due, sequence) in self.entries.items()]
+        heapq.heapify(self.heap)
+
+
+class TimerScheduler:
+    """
+    TimerHeap plus the thread firing the timers. Due times are wall clock (time.time()) seconds,
+    as they are derived from timestamps stored in the DB.
+    """
+
+    def __init__(self, callback, clock=time.time):
+        """
+        Args:
+            callback:     Function called with a list of due keys; exceptions are printed, not raised
+            clock:        Function returning the current time in seconds
+        """
+        self.callback = callback
+        self.clock = clock
+        self.timers = TimerHeap()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, due):
+        """
+        Set the due time for a key, replacing any timer it already has. Safe to call from any thread.
+        """
+        with self.condition:
+            earliest = self.timers.next_due()
+            self.timers.schedule(key, due)
+            if (earliest is None) or (due < earliest):
+                self.condition.notify()     # the thread may be sleeping until a later time
+
+    def cancel(self, key):
+        """
+        Cancel a key's timer, if it has one. Safe to call from any thread.
+        """
+        with self.condition:
+            self.timers.cancel(key)
+
+    def cancel_where(self, predicate):
+        """
+        Cancel the timers of all keys for which predicate(key) is True; see TimerHeap.cancel_where().
+        """
+        with self.condition:
+            self.timers.cancel_where(predicate)
+
+    def due_time(self, key):
+        with self.condition:
+            return self.timers.due_time(key)
+
+    def start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='timer_scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopping:
+                    next_due = self.timers.next_due()
+                    now = self.clock()
+                    if (next_due is not None) and (next_due <= now):
+                        break
+                    self.condition.wait(None if next_due is None else next_due - now)
+                if self.stopping:
+                    return
+                keys = self.timers.pop_due(self.clock())
+
+            # Outside the lock, so the callback may schedule timers (and request threads are not held up)
+            try:
+                self.callback(keys)
+            except Exception:
+                traceback.print_exc()
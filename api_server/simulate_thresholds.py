@@ -0,0 +1,240 @@
+# simulate_thresholds.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Offline 'what-if' simulator for tuning the alert thresholds. It loads a device's
+reading history into NumPy arrays once, then evaluates our alert rule (see
+alert_replay.py) for every candidate setting of the range min / max, the hysteresis,
+the number of continuous readings to check, and the renotification delay in one
+vectorized pass. Each candidate is turned into the alert rule the server would use
+(device_state.metric_rule()), and readings standing for several (repeat_count) count
+as that many, as they do on the server. For each candidate it reports the number of alerts that would have been
+raised, how long they would have lasted, and how many renotifications they would
+have caused. No emails are sent and nothing is written to the DB.
+
+Candidates are the cross product of the values given on the command line; any
+setting not given uses the device's configured value. It uses the same environment
+variables and configuration as the server. It is run as follows:
+
+    python simulate_thresholds.py -d <dev-id> -r <metric> [options]
+
+where the metric is one of those in metrics.py (temp, humidity, co2, ...).
+
+Examples:
+
+    python simulate_thresholds.py -d RazPi_01 -r temp --range-min 62,64,65 --range-max 70,72 --num-readings 2,4,8
+    python simulate_thresholds.py -d RazPi_01 -r humidity --renotification-delay 720,1440 -o results.csv
+    python simulate_thresholds.py -d RazPi_05 -r co2 --range-max 1200,1500 --hysteresis 0,50,100
+"""
+
+import argparse
+import itertools
+import time
+import numpy as np
+import pandas as pd
+import pymongo
+import main
+import alert_replay
+import device_state
+from config_store import DeviceConfigStore
+from metrics import METRICS
+
+
+def load_readings(db, dev_id, reading_type, start_ts=None, end_ts=None):
+    """
+    Load a device's readings for one reading type into arrays, oldest first.
+
+    Args:
+        db:                   Connection to our MongoDB database
+        dev_id (str):         Device to load readings for
+        reading_type (str):   Metric; see metrics.py
+        start_ts (str):       Only readings at or after this time, if given
+        end_ts (str):         Only readings before this time, if given
+
+    Returns:
+        Tuple of (datetime64 ndarray of timestamps, ndarray of values, ndarray of repeat counts)
+    """
+    query = {'dev_id': dev_id}
+    if (start_ts is not None) or (end_ts is not None):
+        query['ts'] = {}
+        if start_ts is not None:
+            query['ts']['$gte'] = start_ts
+        if end_ts is not None:
+            query['ts']['$lt'] = end_ts
+
+    # Only pull back the fields we need, in big batches
+    timestamps = []
+    values = []
+    repeat_counts = []
+    docs = db.readings.find(query, {'_id': False, 'ts': True, reading_type: True, 'repeat_count': True},
+                            batch_size=50000).sort('ts', pymongo.ASCENDING)
+    for doc in docs:
+        value = doc.get(reading_type)
+        if value is None:
+            continue            # readings need not carry every metric
+        timestamps.append(doc['ts'])
+        values.append(value)
+        repeat_counts.append(doc.get('repeat_count', 1))
+
+    return pd.to_datetime(pd.Series(timestamps, dtype=str), format=main.TIMESTAMP_FORMAT).to_numpy(), \
+        np.array(values, dtype=np.float64), np.array(repeat_counts, dtype=np.int64)
+
+
+def candidate_rules(config, reading_type, candidates):
+    """
+    The alert rule each candidate setting makes, as the server would compile it from a device config.
+
+    Args:
+        config (dict):            The device's config (see config_store.py)
+        reading_type (str):       Metric; see metrics.py
+        candidates (DataFrame):   One row per candidate; columns range_min, range_max, hysteresis, num_readings
+
+    Returns:
+        DataFrame of rules (see device_state.metric_rule()), one row per candidate
+    """
+    return pd.DataFrame([device_state.metric_rule(dict(config, **{'{}_range_min'.format(reading_type): range_min,
+                                                                   '{}_range_max'.format(reading_type): range_max,
+                                                                   '{}_hysteresis'.format(reading_type): hysteresis,
+                                                                   '{}_num_readings'.format(reading_type): int(n)}),
+                                                  reading_type)
+                         for range_min, range_max, hysteresis, n in
+                         candidates[['range_min', 'range_max', 'hysteresis', 'num_readings']].itertuples(index=False)],
+                        columns=['range_min', 'range_max', 'clear_min', 'clear_max', 'num_readings'])
+
+
+def simulate(timestamps, values, candidates, rules, repeat_counts=None):
+    """
+    Evaluate the alert rule for every candidate setting.
+
+    Args:
+        timestamps (ndarray):     datetime64 timestamps of the readings, oldest first
+        values (ndarray):         Reading values
+        candidates (DataFrame):   One row per candidate; columns range_min, range_max, hysteresis, num_readings,
+                                    renotification_delay
+        rules (DataFrame):        Each candidate's rule; from candidate_rules()
+        repeat_counts (ndarray):  repeat_count per reading, if any stand for more than one
+
+    Returns:
+        candidates with added columns num_alerts, total_alert_minutes, mean_alert_minutes,
+        max_alert_minutes, num_renotifications, active_at_end
+    """
+    def column(name):
+        return rules[name].to_numpy(dtype=np.float64)[:, np.newaxis]
+
+    out_of_range = alert_replay.out_of_range_flags(values[np.newaxis, :], column('range_min'), column('range_max'))
+    clear = alert_replay.clear_flags(values[np.newaxis, :], column('clear_min'), column('clear_max'))
+    state = alert_replay.alert_state_matrix(out_of_range, rules['num_readings'].to_numpy(), clear, repeat_counts)
+
+    # Time in alert; each reading in an alert state accounts for the time until the next reading
+    minutes_to_next = np.diff(timestamps) / np.timedelta64(1, 'm')
+    in_alert_minutes = np.where(state[:, :-1], minutes_to_next[np.newaxis, :], 0.0)
+    previous = np.concatenate([np.zeros((len(candidates), 1), dtype=bool), state[:, :-1]], axis=1)
+    raised = state & ~previous
+    episode_id = np.cumsum(raised, axis=1)
+
+    results = candidates.copy()
+    results['num_alerts'] = raised.sum(axis=1)
+    results['total_alert_minutes'] = in_alert_minutes.sum(axis=1)
+    results['mean_alert_minutes'] = results['total_alert_minutes'] / results['num_alerts'].where(results['num_alerts'] > 0)
+    results['active_at_end'] = state[:, -1] if len(timestamps) else False
+
+    # Longest alert and renotifications; these need per-episode work, but only over the episodes themselves
+    max_alert_minutes = []
+    num_renotifications = []
+    no_devices = np.zeros(len(timestamps), dtype=np.int64)
+    episodes_cache = {}         # candidates differing only in renotification delay share the same episodes
+    for k, delay in enumerate(candidates['renotification_delay'].to_numpy()):
+        longest = 0.0
+        renotifications = 0
+        if results['num_alerts'].iat[k] > 0:
+            episode_minutes = np.bincount(episode_id[k, :-1], weights=in_alert_minutes[k])
+            longest = float(episode_minutes[1:].max()) if len(episode_minutes) > 1 else 0.0
+            key = tuple(candidates[['range_min', 'range_max', 'hysteresis', 'num_readings']].iloc[k])
+            if key not in episodes_cache:
+                episodes_cache[key] = alert_replay.alert_episodes(no_devices, timestamps, values, state[k])
+            episodes = episodes_cache[key]
+
+            # Most episodes are shorter than the delay, thus have no renotifications; only walk the long ones
+            last_reading_ts = timestamps[episodes['stop_idx'] - 1]
+            long_enough = (last_reading_ts - episodes['originated']) >= np.timedelta64(int(delay), 'm')
+            for start_idx, stop_idx in zip(episodes['start_idx'][long_enough], episodes['stop_idx'][long_enough]):
+                renotifications += len(alert_replay.notification_times(timestamps, start_idx, stop_idx, delay)) - 1
+        max_alert_minutes.append(longest)
+        num_renotifications.append(renotifications)
+    results['max_alert_minutes'] = max_alert_minutes
+    results['num_renotifications'] = num_renotifications
+
+    return results
+
+
+def parse_values(text, default):
+    """
+    Parse a comma separated list of numbers from the command line; [default] if not given.
+    """
+    if text is None:
+        return [default]
+    return [float(value) for value in text.split(',')]
+
+
+def main_simulate():
+    # Extract command line args
+    my_parser = argparse.ArgumentParser(description='What-if simulator for the alert thresholds')
+    my_parser.add_argument('-d', '--dev-id', required=True, help='device to simulate')
+    my_parser.add_argument('-r', '--reading-type', required=True, choices=list(METRICS))
+    my_parser.add_argument('--start-ts', help='only use readings at or after this time; e.g. 2020-01-01T00:00:00Z')
+    my_parser.add_argument('--end-ts', help='only use readings before this time')
+    my_parser.add_argument('--range-min', help='comma separated candidate range min values')
+    my_parser.add_argument('--range-max', help='comma separated candidate range max values')
+    my_parser.add_argument('--hysteresis', help='comma separated candidate hysteresis values')
+    my_parser.add_argument('--num-readings', help='comma separated candidate numbers of continuous readings to check')
+    my_parser.add_argument('--renotification-delay', help='comma separated candidate renotification delays (minutes)')
+    my_parser.add_argument('-o', '--output', help='also write the results to this CSV file')
+    args = my_parser.parse_args()
+
+    main.load_config()
+    mongodb = pymongo.MongoClient(main.SECRET_DATA['mongodb_server_url'])
+    db = mongodb[main.CONFIG_DATA['mongodb_database_name']]
+
+    device_config = DeviceConfigStore(main.CONFIG_DATA)
+    device_config.load(db)
+    config = device_config.get(args.dev_id)
+    rule = device_state.metric_rule(config, args.reading_type)
+    if rule is None:
+        rule = {'range_min': None, 'range_max': None, 'num_readings': config['num_continuous_readings_to_check']}
+
+    start_time = time.monotonic()
+    timestamps, values, repeat_counts = load_readings(db, args.dev_id, args.reading_type, args.start_ts, args.end_ts)
+    mongodb.close()
+    load_secs = time.monotonic() - start_time
+    if len(values) == 0:
+        print('No readings found for device \'{}\''.format(args.dev_id))
+        return
+
+    candidates = pd.DataFrame(list(itertools.product(
+        parse_values(args.range_min, rule['range_min']),
+        parse_values(args.range_max, rule['range_max']),
+        parse_values(args.hysteresis, config.get('{}_hysteresis'.format(args.reading_type)) or 0),
+        [int(n) for n in parse_values(args.num_readings, rule['num_readings'])],
+        parse_values(args.renotification_delay, config['alert_renotification_delay']))),
+        columns=['range_min', 'range_max', 'hysteresis', 'num_readings', 'renotification_delay'])
+    if candidates[['range_min', 'range_max']].isna().any(axis=None):
+        print('No range configured for \'{}\'; give --range-min and --range-max'.format(args.reading_type))
+        return
+    # As config_store.py validates; the hysteresis must leave some of the range to clear alerts in
+    candidates = candidates[candidates['range_min'] + candidates['hysteresis'] <=
+                            candidates['range_max'] - candidates['hysteresis']].reset_index(drop=True)
+
+    start_time = time.monotonic()
+    results = simulate(timestamps, values, candidates, candidate_rules(config, args.reading_type, candidates),
+                       repeat_counts)
+    simulate_secs = time.monotonic() - start_time
+
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(results.sort_values(['num_alerts', 'total_alert_minutes']).to_string(index=False))
+    print('\n{} readings loaded in {:.1f} seconds; {} candidates simulated in {:.2f} seconds'.format(
+        len(values), load_secs, len(candidates), simulate_secs))
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main_simulate()
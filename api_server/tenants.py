@@ -0,0 +1,268 @@
+# tenants.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Multi-tenant routing: each site (tenant) can have its own database, on the shared
+cluster or on a cluster of its own, so one site's load and slow queries do not hold
+up the others, and a big site can be moved to its own MongoDB.
+
+A request's tenant is picked from its headers: X-API-Key, matched against the tenants'
+API keys, or X-Tenant, naming a tenant that has no API key. Requests with neither go to
+the default tenant, which is the database the server has always used. The tenant is
+held in a context variable (CURRENT_TENANT) for the request, so code further down
+(e.g. main.get_db()) needs no extra arguments; the server's background threads set it
+for the tenant they are working for with tenant_scope().
+
+Tenants are defined in the 'tenants' environment variable, as JSON, as they hold secrets:
+
+    {"site_a": {"api_key": "...", "database_name": "site_a_data"},
+     "big_site": {"api_key": "...", "mongodb_server_url": "mongodb+srv://...", "max_pool_size": 50}}
+
+database_name defaults to the tenant's name, and mongodb_server_url to the default
+tenant's. Each tenant gets its own MongoClient, and so its own connection pool of at most
+max_pool_size connections; a tenant cannot take connections from the others. Clients are
+created on the tenant's first request, and the least recently used is closed once more
+than max_clients are open (after a delay, so requests using it can finish).
+
+TenantLocal holds per-tenant instances of the server's other per-device state (device
+config, admission control, timers and so on), created on each tenant's first use.
+"""
+
+import collections
+import contextlib
+import contextvars
+import json
+import threading
+import time
+
+
+DEFAULT_TENANT = 'default'
+TENANT_SETTINGS = {'api_key', 'mongodb_server_url', 'database_name', 'max_pool_size'}
+
+CURRENT_TENANT = contextvars.ContextVar('tenant', default=DEFAULT_TENANT)
+
+
+class TenantRejected(Exception):
+    """
+    Raised when a request's tenant headers do not name a tenant it may use.
+    """
+
+    def __init__(self, status_code, reason):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+
+
+@contextlib.contextmanager
+def tenant_scope(tenant):
+    """
+    Context manager making tenant the current tenant; for background threads working for a tenant.
+    """
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        yield
+    finally:
+        CURRENT_TENANT.reset(token)
+
+
+def parse_tenants(text):
+    """
+    Parse and check the tenant definitions.
+
+    Args:
+        text (str):   JSON, as described in the module docstring; None or '' for no tenants
+
+    Returns:
+        Dict of tenant name -> dict of settings
+
+    Raises:
+        ValueError:   If the definitions are not valid
+    """
+    if not text:
+        return {}
+    tenants = json.loads(text)
+    if not isinstance(tenants, dict):
+        raise ValueError('tenants must be a JSON object of tenant name -> settings')
+    api_keys = set()
+    for name, settings in tenants.items():
+        if name == DEFAULT_TENANT:
+            raise ValueError('\'{}\' is reserved for the default tenant'.format(DEFAULT_TENANT))
+        if not isinstance(settings, dict):
+            raise ValueError('Settings for tenant \'{}\' must be a JSON object'.format(name))
+        unknown = set(settings) - TENANT_SETTINGS
+        if unknown:
+            raise ValueError('Unknown settings for tenant \'{}\': {}'.format(name, ', '.join(sorted(unknown))))
+        if settings.get('api_key') is not None:
+            if settings['api_key'] in api_keys:
+                raise ValueError('Tenant \'{}\' has the same api_key as another tenant'.format(name))
+            api_keys.add(settings['api_key'])
+    return tenants
+
+
+class TenantRouter:
+    """
+    Picks a request's tenant and holds the tenants' MongoClients; see the module docstring. The
+    default tenant's database is not held here (the server has its own client for it).
+    """
+
+    def __init__(self, tenants, default_url, max_clients, max_pool_size, close_delay_secs,
+                 client_factory=None):
+        """
+        Args:
+            tenants (dict):               From parse_tenants()
+            default_url (str):            MongoDB connection string for tenants without their own
+            max_clients (int):            Max tenant clients open at once
+            max_pool_size (int):          Max connections per tenant client, unless the tenant sets its own
+            close_delay_secs (float):     Seconds an evicted client is kept open for the requests using it
+            client_factory:               Creates a client; pymongo.MongoClient if not given, or a stand-in for testing
+        """
+        self.tenants = tenants
+        self.default_url = default_url
+        self.max_clients = max_clients
+        self.max_pool_size = max_pool_size
+        self.close_delay_secs = close_delay_secs
+        self.client_factory = client_factory
+        self.tenants_by_api_key = {settings['api_key']: name for name, settings in tenants.items()
+                                   if settings.get('api_key') is not None}
+
+        self.lock = threading.Lock()
+        self.clients = collections.OrderedDict()       # tenant -> MongoClient; least recently used first
+        self.last_used = {}                             # tenant -> time.time() of its last request
+        self.num_created = 0
+        self.num_evicted = 0
+
+    def names(self):
+        return [DEFAULT_TENANT] + list(self.tenants)
+
+    def resolve(self, api_key, tenant):
+        """
+        Pick a request's tenant from its headers.
+
+        Args:
+            api_key (str):    X-API-Key header; None if not given
+            tenant (str):     X-Tenant header; None if not given
+
+        Returns:
+            The tenant name
+
+        Raises:
+            TenantRejected:   Unknown API key or tenant, or a tenant that needs its API key
+        """
+        if api_key is not None:
+            name = self.tenants_by_api_key.get(api_key)
+            if (name is None) or (tenant not in (None, name)):
+                raise TenantRejected(401, 'Invalid X-API-Key header')
+            return name
+        if (tenant is None) or (tenant == DEFAULT_TENANT):
+            return DEFAULT_TENANT
+        if tenant not in self.tenants:
+            raise TenantRejected(404, 'Unknown tenant \'{}\''.format(tenant))
+        if self.tenants[tenant].get('api_key') is not None:
+            raise TenantRejected(401, 'Tenant \'{}\' needs its X-API-Key header'.format(tenant))
+        return tenant
+
+    def location(self, tenant):
+        """
+        Returns:
+            Tuple of a tenant's MongoDB connection string and database name
+        """
+        settings = self.tenants[tenant]
+        return settings.get('mongodb_server_url') or self.default_url, settings.get('database_name') or tenant
+
+    def database(self, tenant):
+        """
+        A tenant's database, through its own client; created if need be, evicting the least recently
+        used client when there are too many.
+
+        Args:
+            tenant (str):     Tenant name; not the default tenant
+
+        Returns:
+            The pymongo Database
+        """
+        mongodb_url, database_name = self.location(tenant)
+        evicted = []
+        with self.lock:
+            client = self.clients.get(tenant)
+            if client is None:
+                if self.client_factory is None:
+                    import pymongo      # imported on first use; see the note on imports in main.py
+                    self.client_factory = pymongo.MongoClient
+                client = self.client_factory(mongodb_url,
+                                             maxPoolSize=self.tenants[tenant].get('max_pool_size', self.max_pool_size))
+                self.clients[tenant] = client
+                self.num_created += 1
+                while len(self.clients) > self.max_clients:
+                    evicted.append(self.clients.popitem(last=False)[1])
+                    self.num_evicted += 1
+            else:
+                self.clients.move_to_end(tenant)
+            self.last_used[tenant] = time.time()
+        for evicted_client in evicted:
+            timer = threading.Timer(self.close_delay_secs, evicted_client.close)
+            timer.daemon = True
+            timer.start()
+        return client[database_name]
+
+    def close(self):
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for client in clients:
+            client.close()
+
+    def status(self):
+        """
+        Returns:
+            Dict with each tenant's settings (less its API key and connection string), whether its
+            client is open and when it last had a request, plus client counters
+        """
+        with self.lock:
+            tenants = [{'tenant': name,
+                        'database_name': settings.get('database_name') or name,
+                        'own_cluster': bool(settings.get('mongodb_server_url')),
+                        'max_pool_size': settings.get('max_pool_size', self.max_pool_size),
+                        'client_open': name in self.clients,
+                        'last_used': self.last_used.get(name)}
+                       for name, settings in self.tenants.items()]
+            return {'tenants': tenants,
+                    'num_clients_open': len(self.clients),
+                    'max_clients': self.max_clients,
+                    'num_clients_created': self.num_created,
+                    'num_clients_evicted': self.num_evicted}
+
+
+class TenantLocal:
+    """
+    Per-tenant instances of something, created by factory(tenant) on each tenant's first use (with
+    that tenant current). Attributes are looked up on the current tenant's instance, so code written
+    for a single instance (e.g. DEVICE_CONFIG.get(dev_id)) works unchanged; cf. threading.local.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.RLock()
+        self._instances = {}
+
+    def current(self):
+        """
+        The current tenant's instance.
+        """
+        tenant = CURRENT_TENANT.get()
+        instance = self._instances.get(tenant)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(tenant)
+                if instance is None:
+                    instance = self._instances[tenant] = self._factory(tenant)
+        return instance
+
+    def instances(self):
+        """
+        Returns:
+            Dict of tenant -> instance, for the tenants that have one
+        """
+        with self._lock:
+            return dict(self._instances)
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
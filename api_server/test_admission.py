@@ -0,0 +1,133 @@
+# test_admission.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Tests for the ingest admission control. Unlike test_main.py, these do not need a
+running server; they exercise the AdmissionController directly.
+
+    pytest test_admission.py
+"""
+
+import asyncio
+import pytest
+import admission
+from admission import AdmissionController, AdmissionRejected, TokenBucket
+
+
+def test_token_bucket_burst_then_refill():
+    """
+    A bucket allows 'burst' requests back to back, then rejects until tokens refill.
+    """
+    bucket = TokenBucket(rate=2, burst=3)
+    now = bucket.last_refill
+    assert all(bucket.try_take(now)[0] for _ in range(3))
+
+    ok, wait_secs = bucket.try_take(now)
+    assert not ok
+    assert wait_secs == pytest.approx(0.5)
+
+    # Half a second later a token is available again
+    ok, _ = bucket.try_take(now + 0.5)
+    assert ok
+
+
+def test_device_rate_limit_is_per_device():
+    """
+    One device going over its rate does not affect another device.
+    """
+    async def run():
+        controller = AdmissionController(max_in_flight=10, max_queued=0, queue_timeout=0,
+                                         device_rate=0.001, device_burst=1)
+        await controller.acquire('dev_a')
+        controller.release()
+        with pytest.raises(AdmissionRejected) as e:
+            await controller.acquire('dev_a')
+        assert e.value.retry_after > 0
+
+        await controller.acquire('dev_b')
+        controller.release()
+        assert controller.stats()['num_rejected_rate_limited'] == 1
+
+    asyncio.run(run())
+
+
+def test_idle_device_buckets_are_dropped(monkeypatch):
+    """
+    A device's bucket is kept only until it has refilled, so buckets do not pile up for every device seen.
+    """
+    async def run():
+        controller = AdmissionController(max_in_flight=10, max_queued=0, queue_timeout=0,
+                                         device_rate=1, device_burst=2)
+        for i in range(100):
+            await controller.acquire('dev_{}'.format(i))
+            controller.release()
+        assert controller.stats()['num_device_buckets'] == 100
+
+        # Two seconds on every bucket is full again, and the next request sweeps them away
+        now = controller._last_sweep + admission.BUCKET_SWEEP_SECS
+        monkeypatch.setattr(admission.time, 'monotonic', lambda: now)
+        await controller.acquire('dev_new')
+        controller.release()
+        assert controller.stats()['num_device_buckets'] == 1
+
+    asyncio.run(run())
+
+
+def test_queue_full_rejects_immediately():
+    """
+    With all slots taken and no room to queue, a request is rejected without waiting.
+    """
+    async def run():
+        controller = AdmissionController(max_in_flight=1, max_queued=0, queue_timeout=5,
+                                         device_rate=0, device_burst=0)
+        await controller.acquire('dev_a')
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire('dev_b')
+        assert controller.retry_after_header(AdmissionRejected('x', 0.2)) == '1'
+        controller.release()
+        assert controller.stats()['num_rejected_queue_full'] == 1
+
+    asyncio.run(run())
+
+
+def test_queued_requests_admitted_when_slots_free():
+    """
+    Queued requests get a slot as in-flight requests release theirs; they wait on the event
+    loop, without a thread each.
+    """
+    async def run():
+        controller = AdmissionController(max_in_flight=1, max_queued=50, queue_timeout=5,
+                                         device_rate=0, device_burst=0)
+        await controller.acquire('dev_a')
+        results = []
+
+        async def waiter(i):
+            await controller.acquire('dev_{}'.format(i))
+            results.append(i)
+            await asyncio.sleep(0)
+            controller.release()
+
+        tasks = [asyncio.ensure_future(waiter(i)) for i in range(50)]
+        await asyncio.sleep(0)
+        assert controller.stats()['num_queued'] == 50
+        controller.release()
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        assert sorted(results) == list(range(50))
+        assert controller.stats()['num_queued'] == 0
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_rejects():
+    """
+    A queued request gives up after the queue timeout.
+    """
+    async def run():
+        controller = AdmissionController(max_in_flight=1, max_queued=1, queue_timeout=0.05,
+                                         device_rate=0, device_burst=0)
+        await controller.acquire('dev_a')
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire('dev_b')
+        controller.release()
+        assert controller.stats()['num_rejected_queue_timeout'] == 1
+
+    asyncio.run(run())
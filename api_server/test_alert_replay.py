@@ -0,0 +1,80 @@
+# test_alert_replay.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the vectorized alert rule. These do not need the server or MongoDB; the
+replay is checked against the live rule (device_state.evaluate_reading()). Run via:
+
+    pytest test_alert_replay.py
+"""
+
+import datetime
+import random
+import numpy as np
+import device_state
+import alert_replay
+
+
+def live_alert_state(dev_ids, values, config, repeat_counts=None):
+    """
+    The alert state after each reading, as the server works it out one reading at a time.
+    """
+    if repeat_counts is None:
+        repeat_counts = np.ones(len(values), dtype=np.int64)
+    states = {}
+    alerting = []
+    now = datetime.datetime(2020, 6, 18, 11, 0, 0)
+    now_ts = now.strftime(device_state.TIMESTAMP_FORMAT)
+    for dev_id, value, repeat_count in zip(dev_ids, values, repeat_counts):
+        state = states.setdefault(dev_id, {'dev_id': dev_id})
+        device_state.evaluate_reading(state, now_ts, {'temp': device_state.type_update(config, 'temp', int(value),
+                                                                                       int(repeat_count), now)})
+        alerting.append(state.get('temp_alert') is not None)
+    return alerting
+
+
+def replay_alert_state(dev_codes, values, config, repeat_counts=None):
+    rule = device_state.metric_rule(config, 'temp')
+    return alert_replay.alert_state(dev_codes, alert_replay.out_of_range_flags(values, rule['range_min'],
+                                                                               rule['range_max']),
+                                    rule['num_readings'],
+                                    alert_replay.clear_flags(values, rule['clear_min'], rule['clear_max']),
+                                    repeat_counts)
+
+
+def test_alert_does_not_carry_over_to_the_next_device():
+    config = {'num_continuous_readings_to_check': 1, 'temp_range_min': 65, 'temp_range_max': 70,
+              'temp_hysteresis': 1, 'alert_renotification_delay': 1440}
+    dev_codes, values = np.array([0, 1]), np.array([64, 70])
+    assert live_alert_state(dev_codes, values, config) == [True, False]
+    assert replay_alert_state(dev_codes, values, config).tolist() == [True, False]
+
+
+def test_replay_matches_the_live_rule():
+    rng = random.Random(42)
+    for num_readings in [1, 2, 4]:
+        for hysteresis in [0, 1, 2]:
+            config = {'num_continuous_readings_to_check': num_readings, 'temp_range_min': 65,
+                      'temp_range_max': 70, 'temp_hysteresis': hysteresis, 'alert_renotification_delay': 1440}
+            dev_codes = np.repeat(np.arange(20), [rng.randint(1, 30) for _ in range(20)])
+            values = np.array([rng.choice([60, 64, 65, 66, 67, 68, 69, 70, 71, 75]) for _ in dev_codes])
+            repeat_counts = np.array([rng.choice([1, 1, 1, 2, 5]) for _ in dev_codes])
+            assert replay_alert_state(dev_codes, values, config).tolist() == \
+                live_alert_state(dev_codes, values, config), (num_readings, hysteresis)
+            assert replay_alert_state(dev_codes, values, config, repeat_counts).tolist() == \
+                live_alert_state(dev_codes, values, config, repeat_counts), (num_readings, hysteresis)
+
+
+def test_candidate_matrix_matches_one_candidate_at_a_time():
+    rng = np.random.default_rng(42)
+    values = rng.choice([60, 64, 65, 66, 67, 68, 69, 70, 71, 75], size=300)
+    repeat_counts = rng.choice([1, 1, 1, 3], size=300)
+    range_min, range_max = np.array([[65], [65], [64], [62]]), np.array([[70], [70], [71], [72]])
+    hysteresis = np.array([[0], [2], [1], [0]])
+    num_readings = np.array([1, 4, 2, 8])
+    out_of_range = alert_replay.out_of_range_flags(values[np.newaxis, :], range_min, range_max)
+    clear = alert_replay.clear_flags(values[np.newaxis, :], range_min + hysteresis, range_max - hysteresis)
+    state = alert_replay.alert_state_matrix(out_of_range, num_readings, clear, repeat_counts)
+    no_devices = np.zeros(len(values), dtype=np.int64)
+    for k in range(len(num_readings)):
+        assert state[k].tolist() == alert_replay.alert_state(no_devices, out_of_range[k], num_readings[k], clear[k],
+                                                             repeat_counts).tolist()
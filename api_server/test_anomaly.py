@@ -0,0 +1,118 @@
+# test_anomaly.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the streaming anomaly detector. Like test_admission.py, these do not
+need a running server; they exercise the AnomalyDetector directly, and its pipeline
+update against mongomock (pip install mongomock; skipped without it). Run via:
+
+    pytest test_anomaly.py
+"""
+
+import statistics
+import pytest
+from anomaly import AnomalyDetector, RunningStats
+
+
+class TrackedDetector:
+    """
+    An AnomalyDetector along with the stats docs the state docs would hold.
+    """
+
+    def __init__(self, detector):
+        self.detector = detector
+        self.stats = {}
+
+    def update(self, dev_id, reading_type, value, num_readings_to_clear):
+        stats = self.detector.update_stats(self.stats.get((dev_id, reading_type)), value)
+        self.stats[(dev_id, reading_type)] = stats
+        return self.detector.verdict(stats, num_readings_to_clear)
+
+
+def new_detector(**kwargs):
+    settings = dict(alpha=0.01, z_threshold=4.0, min_samples=30, min_std=1.0)
+    settings.update(kwargs)
+    return TrackedDetector(AnomalyDetector(**settings))
+
+
+def test_warm_up_is_welfords_running_mean_and_variance():
+    """
+    Until 1/alpha readings have been seen, the statistics are exactly the plain mean and population variance.
+    """
+    values = [68, 69, 67, 70, 68, 66, 71, 68, 69, 67]
+    stats = RunningStats()
+    for count, value in enumerate(values, start=1):
+        stats.update(value, alpha=0.1)
+        assert stats.count == count
+        assert stats.mean == pytest.approx(statistics.fmean(values[:count]))
+        assert stats.var == pytest.approx(statistics.pvariance(values[:count]))
+
+
+def test_exponentially_weighted_once_warmed_up():
+    stats = RunningStats(count=100, mean=68.0, var=4.0)
+    stats.update(78, alpha=0.01)
+    assert stats.mean == pytest.approx(68.0 + 0.01 * 10)
+    assert stats.var == pytest.approx(0.99 * (4.0 + 10 * 0.01 * 10))
+
+
+def test_nothing_flagged_before_min_samples():
+    detector = new_detector(min_samples=30)
+    for _ in range(29):
+        assert detector.update('RazPi_01', 'temp', 68, 4) == (False, False)
+    assert detector.update('RazPi_01', 'temp', 95, 4) == (False, False)      # the 30th reading; not yet enough
+
+
+def test_spike_flagged_then_recently_anomalous_until_cleared():
+    detector = new_detector()
+    for _ in range(30):
+        detector.update('RazPi_01', 'temp', 68, 3)
+
+    assert detector.update('RazPi_01', 'temp', 95, 3) == (True, True)
+    assert detector.update('RazPi_01', 'temp', 68, 3) == (False, True)
+    assert detector.update('RazPi_01', 'temp', 68, 3) == (False, True)
+    assert detector.update('RazPi_01', 'temp', 68, 3) == (False, False)      # 3 normal readings since the spike
+
+
+def test_min_std_keeps_a_steady_device_from_flagging_small_changes():
+    """
+    A device reporting the same integer has a variance of 0; the floor stops a 1 degree change being flagged.
+    """
+    detector = new_detector(min_std=1.0, z_threshold=4.0)
+    for _ in range(50):
+        detector.update('RazPi_01', 'temp', 68, 4)
+    assert detector.update('RazPi_01', 'temp', 69, 4) == (False, False)
+    assert detector.update('RazPi_01', 'temp', 63, 4)[0]
+
+
+def test_statistics_kept_per_device_and_reading_type():
+    detector = new_detector()
+    for _ in range(30):
+        detector.update('RazPi_01', 'temp', 68, 4)
+        detector.update('RazPi_01', 'humidity', 45, 4)
+    for _ in range(30):
+        detector.update('RazPi_02', 'temp', 90, 4)
+
+    assert detector.update('RazPi_01', 'humidity', 68, 4)[0]
+    assert not detector.update('RazPi_02', 'temp', 90, 4)[0]
+    assert detector.update('RazPi_01', 'temp', 90, 4)[0]
+
+
+def test_pipeline_update_matches_and_any_process_can_apply_it():
+    """
+    The statistics are in the DB, so readings applied by different server processes (each with its
+    own detector) come to the same statistics as one process applying them all.
+    """
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient().db.device_state
+    collection.insert_one({'dev_id': 'RazPi_01'})
+    processes = [AnomalyDetector(alpha=0.1, z_threshold=3.0, min_samples=5, min_std=0.5) for _ in range(3)]
+    in_memory = new_detector(alpha=0.1, z_threshold=3.0, min_samples=5, min_std=0.5)
+    values = [68, 69, 67, 68, 70, 68, 69, 95, 68, 67, 68, 69, 68, 40, 68]
+    for i, value in enumerate(values):
+        detector = processes[i % len(processes)]
+        collection.update_one({'dev_id': 'RazPi_01'},
+                              [{'$set': {'temp_stats': detector.stats_update('temp_stats', value)}}])
+        verdict = in_memory.update('RazPi_01', 'temp', value, 2)
+        stats = collection.find_one({'dev_id': 'RazPi_01'})['temp_stats']
+        assert stats == in_memory.stats[('RazPi_01', 'temp')]
+        assert AnomalyDetector.verdict(stats, 2) == verdict
+    assert stats['count'] == len(values) and stats['since_anomaly'] == 1
@@ -0,0 +1,44 @@
+# test_benchmark_hot_path.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the hot path benchmarks' scenarios and baseline comparison. These do not
+need the server. Run via:
+
+    pytest test_benchmark_hot_path.py
+"""
+
+import datetime
+import device_state
+from benchmark_hot_path import scenario_readings, compare
+
+CONFIG = {'num_continuous_readings_to_check': 4, 'temp_range_min': 65, 'temp_range_max': 70,
+          'humidity_range_min': 40, 'humidity_range_max': 50, 'alert_renotification_delay': 1440}
+
+
+def count_transitions(readings):
+    states = {}
+    counts = {'raised': 0, 'cleared': 0}
+    for reading in readings:
+        now = datetime.datetime.strptime(reading['ts'], device_state.TIMESTAMP_FORMAT)
+        type_updates = {reading_type: device_state.type_update(CONFIG, reading_type, reading[reading_type], 1, now)
+                        for reading_type in ['temp', 'humidity']}
+        state = states.setdefault(reading['dev_id'], {'dev_id': reading['dev_id']})
+        for _, transition, _ in device_state.evaluate_reading(state, reading['ts'], type_updates):
+            counts[transition] = counts.get(transition, 0) + 1
+    return counts
+
+
+def test_scenarios_cause_the_alerts_they_are_named_for():
+    assert count_transitions(scenario_readings('steady', 1000)) == {'raised': 0, 'cleared': 0}
+    assert count_transitions(scenario_readings('storm', 1000)) == {'raised': 125, 'cleared': 0}
+    assert count_transitions(scenario_readings('flapping', 1000)) == {'raised': 125, 'cleared': 125}
+    assert len(scenario_readings('storm', 1000)) == 1000
+
+
+def test_regression_beyond_the_threshold():
+    baseline = {'validate': {'median_us': 10.0}, 'http/steady': {'median_us': 100.0}}
+    results = {'validate': {'median_us': 11.0}, 'http/steady': {'median_us': 130.0}, 'new': {'median_us': 1.0}}
+    changes, regressions = compare(results, baseline, 0.2)
+    assert sorted(changes) == ['http/steady', 'validate']
+    assert round(changes['http/steady'], 6) == 0.3
+    assert regressions == ['http/steady']
@@ -0,0 +1,142 @@
+# test_config_store.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the per-device config store and the admin key guarding its resource.
+These do not need the server or MongoDB; a minimal in-memory stand-in for the
+device_config collection is used. Run via:
+
+    pytest test_config_store.py
+"""
+
+import types
+import pytest
+from fastapi import HTTPException
+import main
+from config_store import DeviceConfigStore, DEFAULTS_DEV_ID
+
+
+DEFAULTS = {'mongodb_database_name': 'basement_data',
+            'num_continuous_readings_to_check': 4,
+            'temp_range_min': 65,
+            'temp_range_max': 70,
+            'humidity_range_min': 40,
+            'humidity_range_max': 50,
+            'alert_renotification_delay': 1440,
+            'device_offline_minutes': 150,
+            'device_heartbeat_minutes': 60,
+            'email_from': 'from@example.com',
+            'email_to': 'to@example.com'}
+
+
+class FakeDeviceConfigCollection:
+    """
+    Just enough of a pymongo collection for DeviceConfigStore.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.num_finds = 0
+
+    def find(self, query, projection):
+        self.num_finds += 1
+        return [dict(doc) for doc in self.docs.values()]
+
+    def update_one(self, query, update, upsert=False):
+        doc = self.docs.setdefault(query['dev_id'], {'dev_id': query['dev_id']})
+        doc.update(update.get('$set', {}))
+        for key in update.get('$unset', {}):
+            doc.pop(key, None)
+
+    def delete_many(self, query):
+        num_deleted = 1 if self.docs.pop(query['dev_id'], None) is not None else 0
+        return types.SimpleNamespace(deleted_count=num_deleted)
+
+
+def make_store():
+    db = types.SimpleNamespace(device_config=FakeDeviceConfigCollection())
+    store = DeviceConfigStore(DEFAULTS)
+    store.load(db)
+    return store, db
+
+
+def test_overrides_merge_with_defaults():
+    store, db = make_store()
+    store.set_overrides(db, 'RazPi_02', {'temp_range_min': 55, 'temp_range_max': 60})
+    store.set_overrides(db, DEFAULTS_DEV_ID, {'alert_renotification_delay': 60})
+
+    config = store.get('RazPi_02')
+    assert (config['temp_range_min'], config['temp_range_max']) == (55, 60)
+    assert config['alert_renotification_delay'] == 60          # changed default applies to overridden devices too
+    assert store.get('RazPi_01')['temp_range_min'] == 65
+    assert store.get('RazPi_01')['alert_renotification_delay'] == 60
+
+    # None goes back to the default; delete removes all of a device's overrides
+    store.set_overrides(db, 'RazPi_02', {'temp_range_min': None, 'temp_range_max': None, 'email_to': 'x@example.com'})
+    assert (store.get('RazPi_02')['temp_range_min'], store.get('RazPi_02')['temp_range_max']) == (65, 70)
+    store.delete_overrides(db, 'RazPi_02')
+    assert store.get('RazPi_02')['email_to'] == 'to@example.com'
+
+
+def test_lookups_do_not_touch_the_db():
+    store, db = make_store()
+    store.set_overrides(db, 'RazPi_02', {'humidity_range_max': 60})
+    num_finds = db.device_config.num_finds
+    for _ in range(1000):
+        store.get('RazPi_02')
+        store.get('RazPi_01')
+    assert db.device_config.num_finds == num_finds
+
+
+def test_invalid_changes_are_rejected():
+    store, db = make_store()
+    with pytest.raises(ValueError):
+        store.set_overrides(db, 'RazPi_02', {'temp_range_min': 80})          # above the default max
+    with pytest.raises(ValueError):
+        store.set_overrides(db, 'RazPi_02', {'bogus_setting': 1})
+    with pytest.raises(ValueError):
+        store.set_overrides(db, 'RazPi_02', {'num_continuous_readings_to_check': 0})
+    assert db.device_config.docs == {}
+    assert store.get('RazPi_02') is store.defaults
+
+
+def test_offline_timeout_stays_well_above_the_heartbeat():
+    store, db = make_store()
+    with pytest.raises(ValueError):
+        store.set_overrides(db, 'RazPi_02', {'device_offline_minutes': 60})       # races the hourly heartbeat
+    with pytest.raises(ValueError):
+        store.set_overrides(db, DEFAULTS_DEV_ID, {'device_heartbeat_minutes': 90})
+    assert store.set_overrides(db, 'RazPi_02', {'device_offline_minutes': 120})['device_offline_minutes'] == 120
+    assert store.set_overrides(db, 'RazPi_03', {'device_offline_minutes': 0,
+                                                'device_heartbeat_minutes': 240})['device_offline_minutes'] == 0
+
+
+def test_metric_settings_are_validated_and_rules_recompiled():
+    store, db = make_store()
+    default_rules = store.rules('RazPi_02')
+    assert [rule[0] for rule in default_rules.rules] == ['temp', 'humidity']        # only the metrics with a range
+    with pytest.raises(ValueError):
+        store.set_overrides(db, 'RazPi_02', {'temp_hysteresis': 3})             # 68 - 67; no range left to clear in
+    with pytest.raises(ValueError):
+        store.set_overrides(db, 'RazPi_02', {'co2_range_min': 0})               # needs a max as well
+
+    store.set_overrides(db, 'RazPi_02', {'co2_range_min': 0, 'co2_range_max': 1500, 'co2_hysteresis': 100,
+                                         'temp_hysteresis': 2})
+    rules = store.rules('RazPi_02')
+    assert rules is not default_rules
+    assert ('co2', 0, 1500, 100, 1400, 4, 32) in rules.rules
+    assert ('temp', 65, 70, 67, 68, 4, 32) in rules.rules
+    assert [rule[0] for rule in store.rules('RazPi_03').rules] == ['temp', 'humidity']      # other devices unchanged
+
+
+def test_admin_resources_are_off_without_an_admin_key(monkeypatch):
+    monkeypatch.setitem(main.SECRET_DATA, 'admin_api_key', None)
+    with pytest.raises(HTTPException) as e:
+        main.require_admin(None)
+    assert e.value.status_code == 403
+
+    monkeypatch.setitem(main.SECRET_DATA, 'admin_api_key', 'secret')
+    for admin_key in [None, 'wrong']:
+        with pytest.raises(HTTPException) as e:
+            main.require_admin(admin_key)
+        assert e.value.status_code == 401
+    main.require_admin('secret')
@@ -0,0 +1,65 @@
+# test_db_monitor.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the MongoDB command monitor. Like test_admission.py, these do not need
+a running server or MongoDB; the listener is fed events directly. Run via:
+
+    pytest test_db_monitor.py
+"""
+
+import types
+from db_monitor import CommandMonitor, command_shape
+
+
+def run_command(monitor, request_id, command_name, command, duration_ms):
+    monitor.started(types.SimpleNamespace(command_name=command_name, command=command,
+                                          connection_id=('localhost', 27017), request_id=request_id))
+    monitor.succeeded(types.SimpleNamespace(command_name=command_name, duration_micros=int(duration_ms * 1000),
+                                            connection_id=('localhost', 27017), request_id=request_id))
+
+
+def test_shapes_keep_structure_but_not_values():
+    shape = command_shape('find', {'find': 'readings',
+                                   'filter': {'dev_id': 'RazPi_01', 'ts': {'$gte': '2020-06-18T11:06:00Z'}},
+                                   'sort': {'ts': -1},
+                                   'limit': 4})
+    assert 'RazPi_01' not in shape
+    assert '2020' not in shape
+    assert '"$gte": "?"' in shape
+    assert '"sort": {"ts": -1}' in shape
+    assert command_shape('insert', {'insert': 'readings', 'documents': [{'dev_id': 'RazPi_01'}]}) == ''
+
+
+def test_stats_per_collection_command_and_shape():
+    monitor = CommandMonitor(slow_op_ms=50, verbose=False)
+    for i in range(10):
+        run_command(monitor, 2 * i, 'insert', {'insert': 'readings', 'documents': []}, 1.5)
+        run_command(monitor, 2 * i + 1, 'find', {'find': 'readings', 'filter': {'dev_id': 'RazPi_{}'.format(i)}},
+                    100 if i == 0 else 3)
+
+    report = monitor.report()
+    operations = {(operation['collection'], operation['command']): operation for operation in report['operations']}
+    assert operations[('readings', 'insert')]['count'] == 10
+    assert operations[('readings', 'insert')]['p50_ms'] == 2
+    assert operations[('readings', 'find')]['count'] == 10         # one shape regardless of the device
+    assert operations[('readings', 'find')]['max_ms'] == 100
+    assert report['operations'][0]['command'] == 'find'             # most total time first
+
+    assert len(report['slow_ops']) == 1
+    assert report['slow_ops'][0]['shape'] == '{"filter": {"dev_id": "?"}}'
+    assert monitor.in_flight == {}
+
+
+def test_commands_counted_per_server():
+    monitor = CommandMonitor(verbose=False)
+    for request_id, port in enumerate([27017, 27018, 27018, 27019]):
+        connection_id = ('localhost', port)
+        monitor.started(types.SimpleNamespace(command_name='count', command={'count': 'readings', 'query': {}},
+                                              connection_id=connection_id, request_id=request_id))
+        monitor.succeeded(types.SimpleNamespace(command_name='count', duration_micros=1000,
+                                                connection_id=connection_id, request_id=request_id))
+    run_command(monitor, 10, 'insert', {'insert': 'readings', 'documents': []}, 1)
+
+    operations = {operation['command']: operation for operation in monitor.report()['operations']}
+    assert operations['count']['servers'] == {'localhost:27017': 1, 'localhost:27018': 2, 'localhost:27019': 1}
+    assert operations['insert']['servers'] == {'localhost:27017': 1}
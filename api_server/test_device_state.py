@@ -0,0 +1,119 @@
+# test_device_state.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the per-device alert state. These do not need the server; the pipeline
+updates are run against mongomock (pip install mongomock), and skipped without it.
+Run via:
+
+    pytest test_device_state.py
+"""
+
+import datetime
+import pytest
+import device_state
+from anomaly import AnomalyDetector
+
+mongomock = pytest.importorskip('mongomock')
+
+RANGE_MIN, RANGE_MAX = 65, 70
+NUM_READINGS = 4
+NEVER = '2000-01-01T00:00:00Z'      # renotify_before; no renotifications
+
+
+def post(collection, minute, temp, repeat_count=1, renotify_before=NEVER, anomaly=None):
+    update = {'flags': device_state.window_flags((temp < RANGE_MIN) or (temp > RANGE_MAX), repeat_count, NUM_READINGS),
+              'value': temp,
+              'num_readings': NUM_READINGS,
+              'anomaly': anomaly,
+              'renotify_before': renotify_before}
+    now_ts = '2020-06-18T11:{:02d}:00Z'.format(minute)
+    return device_state.apply_reading(collection, 'RazPi_01', now_ts, {'temp': update})
+
+
+def test_raise_continue_and_clear_each_happen_once():
+    collection = mongomock.MongoClient().db.device_state
+    temps = [68, 80, 81, 82, 83, 84, 67, 85, 66, 66, 66, 66]
+    changes = [post(collection, minute, temp) for minute, temp in enumerate(temps)]
+
+    assert [minute for minute, change in enumerate(changes) if change] == [4, 11]
+    assert changes[4] == [('temp', 'raised', device_state.new_alert('2020-06-18T11:04:00Z', 83))]
+    reading_type, transition, alert = changes[11][0]
+    assert (reading_type, transition) == ('temp', 'cleared')
+    assert (alert['max_value'], alert['min_value'], alert['last_value']) == (85, 66, 66)
+    assert collection.find_one({'dev_id': 'RazPi_01'})['temp_alert'] is None
+
+
+def test_heartbeat_counts_as_repeated_readings_and_renotifies_when_due():
+    collection = mongomock.MongoClient().db.device_state
+    assert post(collection, 0, 90) == []
+    assert post(collection, 1, 90, repeat_count=3)[0][1] == 'raised'
+    assert post(collection, 2, 90, renotify_before='2020-06-18T11:00:00Z') == []
+    change = post(collection, 3, 91, renotify_before='2020-06-18T11:01:00Z')
+    assert change[0][1] == 'renotified'
+    assert change[0][2]['notification_ts'] == '2020-06-18T11:03:00Z'
+
+    # The scheduler's claim on the same renotification loses; its copy of the alert is stale
+    assert not device_state.renotify(collection, 'RazPi_01', 'temp', {'notification_ts': '2020-06-18T11:01:00Z'},
+                                     '2020-06-18T11:04:00Z')
+
+
+def test_offline_alert_raised_once_and_cleared_by_next_reading():
+    collection = mongomock.MongoClient().db.device_state
+    post(collection, 0, 68)
+
+    # Seen since the cutoff; not offline
+    assert device_state.raise_offline(collection, 'RazPi_01', '2020-06-18T10:00:00Z', '2020-06-18T12:00:00Z', 60) is None
+    assert device_state.raise_offline(collection, 'RazPi_01', '2020-06-18T11:00:00Z', '2020-06-18T12:00:00Z', 60)
+    assert device_state.raise_offline(collection, 'RazPi_01', '2020-06-18T11:00:00Z', '2020-06-18T12:00:00Z', 60) is None
+    assert ('offline', 'cleared') in [change[:2] for change in post(collection, 59, 68)]
+
+
+def test_compiled_rules_evaluate_every_metric_with_hysteresis():
+    collection = mongomock.MongoClient().db.device_state
+    config = {'num_continuous_readings_to_check': NUM_READINGS, 'alert_renotification_delay': 0,
+              'temp_range_min': RANGE_MIN, 'temp_range_max': RANGE_MAX,
+              'co2_range_min': 0, 'co2_range_max': 1500, 'co2_hysteresis': 100,
+              'water_leak_range_min': 0, 'water_leak_range_max': 0, 'water_leak_num_readings': 1}
+    rules = device_state.AlertRules(config)
+    now = datetime.datetime(2020, 6, 18, 11, 0, 0)
+
+    # Metrics the reading does not carry, or without a range, are left alone; the rest match type_update()
+    updates = rules.type_updates({'temp': 68, 'co2': 1450, 'humidity': 45, 'voc': 3}, 2, now)
+    assert list(updates) == ['temp', 'co2']
+    for metric, value in [('temp', 68), ('co2', 1450)]:
+        assert updates[metric] == device_state.type_update(config, metric, value, 2, now)
+    assert updates['co2']['flags'] == [None, None]          # in range, but within the hysteresis
+
+    def post_values(minute, values):
+        now_ts = '2020-06-18T11:{:02d}:00Z'.format(minute)
+        return device_state.apply_reading(collection, 'RazPi_01', now_ts, rules.type_updates(values, 1, now))
+
+    assert post_values(0, {'water_leak': 1}) == \
+        [('water_leak', 'raised', device_state.new_alert('2020-06-18T11:00:00Z', 1))]     # alerts on one reading
+    changes = [post_values(minute, {'co2': 1600, 'water_leak': 0}) for minute in range(1, 5)]
+    assert [change[:2] for change in changes[0]] == [('water_leak', 'cleared')]
+    assert [change[:2] for change in changes[3]] == [('co2', 'raised')]
+    assert all(post_values(minute, {'co2': 1450}) == [] for minute in range(5, 15))     # not cleared by 1450
+    changes = [post_values(minute, {'co2': 1400}) for minute in range(15, 19)]
+    assert [change[:2] for change in changes[3]] == [('co2', 'cleared')]
+
+
+def test_anomaly_statistics_kept_in_the_state_doc():
+    collection = mongomock.MongoClient().db.device_state
+    detector = AnomalyDetector(alpha=0.01, z_threshold=2.5, min_samples=30, min_std=0.5)
+    state = {'dev_id': 'RazPi_01'}
+    temps = [68, 67, 68, 69] * 10 + [66, 68, 68, 68, 68, 68]       # 66 is in range, but anomalous
+    changes = []
+    for minute, temp in enumerate(temps):
+        change = post(collection, minute, temp, anomaly=detector)
+        update = {'flags': device_state.window_flags(False, 1, NUM_READINGS), 'value': temp,
+                  'num_readings': NUM_READINGS, 'anomaly': detector, 'renotify_before': NEVER}
+        assert device_state.evaluate_reading(state, '2020-06-18T11:{:02d}:00Z'.format(minute), {'temp': update}) == change
+        changes.append(change)
+
+    # Raised at once, and cleared once NUM_READINGS normal readings have followed
+    assert [(minute, change[0][1]) for minute, change in enumerate(changes) if change] == [(40, 'raised'), (44, 'cleared')]
+    assert changes[40][0][2]['cause'] == 'anomaly'
+    doc = collection.find_one({'dev_id': 'RazPi_01'})
+    assert doc['temp_stats'] == state['temp_stats']
+    assert (doc['temp_stats']['count'], doc['temp_stats']['since_anomaly']) == (46, 5)
@@ -0,0 +1,60 @@
+# test_event_stream.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Tests for the in-process event broker behind the live stream resources. These do
+not need a running server.
+
+    pytest test_event_stream.py
+"""
+
+import asyncio
+import threading
+from event_stream import EventBroker
+
+
+def run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+
+def test_publish_from_another_thread_with_dev_id_filter():
+    """
+    Events published from a worker thread reach only the subscribers interested in that device.
+    """
+    async def scenario():
+        broker = EventBroker()
+        sub_all = broker.subscribe()
+        sub_dev2 = broker.subscribe(['dev_2'])
+
+        thread = threading.Thread(target=broker.publish, args=('reading', 'dev_1'), kwargs={'temp': 68})
+        thread.start()
+        thread.join()
+
+        event = await sub_all.next_event(1)
+        assert event['type'] == 'reading'
+        assert event['dev_id'] == 'dev_1'
+        assert event['temp'] == 68
+        assert await sub_dev2.next_event(0.05) is None
+
+    run(scenario())
+
+
+def test_slow_subscriber_drops_oldest():
+    """
+    A subscriber that falls behind loses the oldest events and is told how many were dropped.
+    """
+    async def scenario():
+        broker = EventBroker()
+        sub = broker.subscribe(max_queue_size=2)
+        for i in range(5):
+            broker.publish('reading', 'dev_1', seq=i)
+        await asyncio.sleep(0)      # let the queued call_soon_threadsafe callbacks run
+
+        event = await sub.next_event(1)
+        assert event == {'type': 'events_dropped', 'count': 3}
+        assert (await sub.next_event(1))['seq'] == 3
+        assert (await sub.next_event(1))['seq'] == 4
+
+        broker.unsubscribe(sub)
+        assert broker.num_subscribers() == 0
+
+    run(scenario())
@@ -0,0 +1,132 @@
+# test_export_data.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the Parquet export. These do not need the server; they run in this
+process against mongomock (pip install mongomock), and are skipped without it. Run via:
+
+    pytest test_export_data.py
+"""
+
+import io
+import bson
+import pytest
+import export_data
+
+pq = pytest.importorskip('pyarrow.parquet')
+mongomock = pytest.importorskip('mongomock')
+
+
+def readings_db(num_readings):
+    db = mongomock.MongoClient().db
+    db.readings.insert_many([{'dev_id': 'RazPi_0{}'.format(i % 2 + 1),
+                              'ts': '2020-06-18T11:{:02d}:00Z'.format(i),
+                              'temp': 60 + i,
+                              'humidity': 45,
+                              'repeat_count': 2}
+                             for i in range(num_readings)])
+    db.readings.insert_one({'dev_id': 'RazPi_03', 'ts': '2020-06-18T12:00:00Z', 'pressure': 1013.25})
+    return db
+
+
+class RawBatchCollection:
+    """
+    Stands in for a pymongo collection's find_raw_batches(), which mongomock does not have.
+    """
+
+    def __init__(self, collection, batch_size):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.codec_options = bson.codec_options.DEFAULT_CODEC_OPTIONS
+
+    def find_raw_batches(self, query, projection, batch_size):
+        docs = list(self.collection.find(query, projection))
+        for start in range(0, len(docs), self.batch_size):
+            yield b''.join(bson.encode(doc) for doc in docs[start:start + self.batch_size])
+
+
+def export(collection, query, schema, **kwargs):
+    output = io.BytesIO()
+    num_rows = export_data.export_parquet(collection, query, schema, output, **kwargs)
+    output.seek(0)
+    return num_rows, pq.ParquetFile(output)
+
+
+def test_build_query():
+    assert export_data.build_query('readings') == {}
+    assert export_data.build_query('readings', dev_id='RazPi_01', start_ts='2020-01-01T00:00:00Z') == \
+           {'dev_id': 'RazPi_01', 'ts': {'$gte': '2020-01-01T00:00:00Z'}}
+    assert export_data.build_query('alert_history', end_ts='2021-01-01T00:00:00Z') == \
+           {'originated_ts': {'$lt': '2021-01-01T00:00:00Z'}}
+
+
+def test_readings_export_has_a_column_per_metric_null_where_missing(monkeypatch):
+    monkeypatch.setattr(export_data, 'PyMongoArrowContext', None)
+    db = readings_db(4)
+    num_rows, parquet_file = export(db.readings, {}, export_data.EXPORT_SCHEMAS['readings'])
+    assert num_rows == 5
+
+    table = parquet_file.read()
+    assert table.schema == export_data.EXPORT_SCHEMAS['readings']
+    rows = sorted(table.to_pylist(), key=lambda row: row['ts'])
+    assert rows[0]['temp'] == 60 and rows[0]['humidity'] == 45 and rows[0]['pressure'] is None
+    assert rows[-1]['dev_id'] == 'RazPi_03' and rows[-1]['temp'] is None and rows[-1]['pressure'] == 1013.25
+
+
+def test_readings_export_keeps_the_readings_each_stands_for(monkeypatch):
+    monkeypatch.setattr(export_data, 'PyMongoArrowContext', None)
+    db = readings_db(4)
+    _, parquet_file = export(db.readings, {}, export_data.EXPORT_SCHEMAS['readings'])
+    rows = sorted(parquet_file.read().to_pylist(), key=lambda row: row['ts'])
+    # A deadband heartbeat stands for its repeat_count readings; a reading stored without one for 1
+    assert [row['repeat_count'] for row in rows] == [2, 2, 2, 2, 1]
+    assert sum(row['repeat_count'] for row in rows) == 9
+
+
+def test_only_the_queried_readings_are_exported(monkeypatch):
+    monkeypatch.setattr(export_data, 'PyMongoArrowContext', None)
+    db = readings_db(10)
+    query = export_data.build_query('readings', dev_id='RazPi_01', start_ts='2020-06-18T11:02:00Z',
+                                    end_ts='2020-06-18T11:08:00Z')
+    num_rows, parquet_file = export(db.readings, query, export_data.EXPORT_SCHEMAS['readings'])
+    assert num_rows == 3
+    assert parquet_file.read().column('ts').to_pylist() == ['2020-06-18T11:02:00Z', '2020-06-18T11:04:00Z',
+                                                            '2020-06-18T11:06:00Z']
+
+
+def test_row_groups_are_row_group_size_whatever_the_batch_size(monkeypatch):
+    monkeypatch.setattr(export_data, 'PyMongoArrowContext', None)
+    iter_arrow_tables = export_data.iter_arrow_tables
+    monkeypatch.setattr(export_data, 'iter_arrow_tables',
+                        lambda collection, query, schema, batch_size: iter_arrow_tables(collection, query, schema, 5))
+    db = readings_db(29)
+    num_rows, parquet_file = export(db.readings, {}, export_data.EXPORT_SCHEMAS['readings'], row_group_size=7)
+    assert num_rows == 30
+    assert [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)] == [7, 7, 7, 7, 2]
+    assert sorted(parquet_file.read().column('ts').to_pylist()) == sorted(doc['ts'] for doc in db.readings.find())
+
+
+def test_alert_values_exported_as_decimals(monkeypatch):
+    monkeypatch.setattr(export_data, 'PyMongoArrowContext', None)
+    db = mongomock.MongoClient().db
+    db.alert_history.insert_many([{'dev_id': 'RazPi_01', 'reading_type': 'temp', 'originated_ts': '2020-06-18T11:00:00Z',
+                                   'cleared_ts': '2020-06-18T11:30:00Z', 'duration_minutes': 30,
+                                   'max_value': 75, 'min_value': 71},
+                                  {'dev_id': 'RazPi_02', 'reading_type': 'pressure',
+                                   'originated_ts': '2020-06-18T12:00:00Z', 'cleared_ts': '2020-06-18T12:10:00Z',
+                                   'duration_minutes': 10, 'max_value': 900.5, 'min_value': 899.25}])
+    _, parquet_file = export(db.alert_history, {}, export_data.EXPORT_SCHEMAS['alert_history'])
+    rows = parquet_file.read().to_pylist()
+    assert [(row['max_value'], row['min_value']) for row in rows] == [(75.0, 71.0), (900.5, 899.25)]
+
+
+def test_raw_bson_batches_export_the_same_as_documents(monkeypatch):
+    pytest.importorskip('pymongoarrow')
+    if export_data.PyMongoArrowContext is None:
+        pytest.skip('pymongoarrow could not be loaded')
+    db = readings_db(12)
+    schema = export_data.EXPORT_SCHEMAS['readings']
+    _, fast = export(RawBatchCollection(db.readings, batch_size=5), {}, schema, row_group_size=7)
+
+    monkeypatch.setattr(export_data, 'PyMongoArrowContext', None)
+    _, naive = export(db.readings, {}, schema, row_group_size=7)
+    assert fast.read().equals(naive.read())
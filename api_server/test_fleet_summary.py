@@ -0,0 +1,99 @@
+# test_fleet_summary.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the fleet summary. These do not need the server; the aggregation is
+run against mongomock (pip install mongomock), and skipped without it. mongomock has
+no $unionWith, so each branch is run on its own collection and the merge stages on
+the combined results, as the DB would. Run via:
+
+    pytest test_fleet_summary.py
+"""
+
+import threading
+import time
+import pytest
+from fleet_summary import SummaryCache, summary_pipeline, device_summary
+
+
+def run_pipeline(db, pipeline):
+    """
+    Run summary_pipeline() on mongomock, standing in for $unionWith.
+    """
+    union_at = next(i for i, stage in enumerate(pipeline) if '$unionWith' in stage)
+    merge_at = max(i for i, stage in enumerate(pipeline) if '$unionWith' in stage) + 1
+    docs = list(db.readings.aggregate(pipeline[:union_at]))
+    for stage in pipeline[union_at:merge_at]:
+        docs.extend(db[stage['$unionWith']['coll']].aggregate(stage['$unionWith']['pipeline']))
+    db.union_results.insert_many([dict(doc, _src_id=doc['_id'], _id=i) for i, doc in enumerate(docs)])
+    fields = [field for field in pipeline[merge_at]['$group'] if field not in ('_id', 'history_counts')]
+    merge = [{'$project': dict({'_id': '$_src_id', 'history_count': True}, **{field: True for field in fields})}] + \
+        pipeline[merge_at:]
+    return list(db.union_results.aggregate(merge))
+
+
+def test_one_doc_per_device_with_latest_reading_alerts_and_counts():
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    db.readings.insert_many([{'dev_id': 'RazPi_01', 'ts': '2020-06-18T11:0{}:00Z'.format(minute), 'temp': 60 + minute,
+                              'humidity': 45} for minute in range(5)] +
+                            [{'dev_id': 'RazPi_02', 'ts': '2020-06-18T10:00:00Z', 'temp': 68, 'humidity': 41,
+                              'co2': 900}])
+    alert = {'originated_ts': '2020-06-18T11:04:00Z', 'notification_ts': '2020-06-18T11:04:00Z',
+             'max_value': 64, 'min_value': 64, 'last_value': 64}
+    db.device_state.insert_many([{'dev_id': 'RazPi_01', 'last_seen': '2020-06-18T11:04:05Z', 'temp_alert': alert,
+                                  'humidity_alert': None, 'offline_alert': None, 'temp_window': [True] * 4},
+                                 {'dev_id': 'RazPi_03', 'last_seen': '2020-06-17T09:00:00Z', 'offline_alert': alert}])
+    db.alert_history.insert_many([{'dev_id': 'RazPi_01', 'reading_type': reading_type}
+                                  for reading_type in ['temp', 'temp', 'temp', 'offline']])
+
+    devices = [device_summary(doc) for doc in run_pipeline(db, summary_pipeline())]
+    assert [device['dev_id'] for device in devices] == ['RazPi_01', 'RazPi_02', 'RazPi_03']
+    first, second, third = devices
+    assert first['latest_reading'] == {'ts': '2020-06-18T11:04:00Z', 'temp': 64, 'humidity': 45}
+    assert first['last_seen'] == '2020-06-18T11:04:05Z'
+    assert list(first['active_alerts']) == ['temp']
+    assert first['alert_history_counts'] == {'temp': 3, 'humidity': 0, 'co2': 0, 'pressure': 0, 'water_leak': 0,
+                                             'offline': 1}
+    assert (second['last_seen'], second['active_alerts']) == (None, {})
+    assert second['latest_reading'] == {'ts': '2020-06-18T10:00:00Z', 'temp': 68, 'humidity': 41, 'co2': 900}
+    assert third['latest_reading'] is None
+    assert list(third['active_alerts']) == ['offline']
+
+
+def test_cache_is_reused_until_invalidated_or_expired():
+    cache = SummaryCache(ttl_secs=60)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get(compute) == 1
+    assert cache.get(compute) == 1
+    cache.invalidate()
+    assert cache.get(compute) == 2
+
+    cache.ttl_secs = 0
+    cache.invalidate()
+    assert cache.get(compute) == 3
+    assert cache.get(compute) == 4
+    assert (cache.num_hits, cache.num_misses) == (1, 4)
+
+
+def test_concurrent_misses_share_one_computation():
+    cache = SummaryCache(ttl_secs=60)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'summary'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(compute))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['summary'] * 8
+    assert len(calls) == 1
@@ -0,0 +1,188 @@
+# test_import_readings.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the bulk importer's alert replay and summary. These do not need the server;
+they run in this process against mongomock (pip install mongomock), and are skipped without
+it. Run via:
+
+    pytest test_import_readings.py
+"""
+
+import datetime
+import random
+import pandas as pd
+import pytest
+import device_state
+from config_store import DeviceConfigStore
+
+pytest.importorskip('pyarrow')
+mongomock = pytest.importorskip('mongomock')
+import import_readings      # noqa: E402; needs pyarrow
+
+CONFIG = {'num_continuous_readings_to_check': 4, 'temp_range_min': 65, 'temp_range_max': 70,
+          'humidity_range_min': 40, 'humidity_range_max': 50, 'alert_renotification_delay': 10,
+          'device_offline_minutes': 0, 'device_heartbeat_minutes': 60,
+          'email_from': 'from@example.com', 'email_to': 'to@example.com'}
+
+
+def live_alerts(db, dev_id, readings):
+    """
+    Apply a device's readings the way the server does, keeping active_alerts and alert_history.
+    """
+    state = {'dev_id': dev_id}
+    for reading in readings:
+        now = datetime.datetime.strptime(reading['ts'], device_state.TIMESTAMP_FORMAT)
+        type_updates = {reading_type: device_state.type_update(CONFIG, reading_type, reading[reading_type],
+                                                               reading.get('repeat_count', 1), now)
+                        for reading_type in ['temp', 'humidity']}
+        for reading_type, transition, alert in device_state.evaluate_reading(state, reading['ts'], type_updates):
+            query = {'dev_id': dev_id, 'reading_type': reading_type}
+            if transition == 'raised':
+                db.active_alerts.insert_one(dict(query, originated_ts=alert['originated_ts'],
+                                                 notification_ts=alert['notification_ts']))
+            elif transition == 'renotified':
+                db.active_alerts.update_one(query, {'$set': {'notification_ts': alert['notification_ts']}})
+            elif transition == 'cleared':
+                db.alert_history.insert_one(dict(query, originated_ts=alert['originated_ts'], cleared_ts=reading['ts']))
+                db.active_alerts.delete_many(query)
+
+
+def random_readings(rng, num_readings):
+    start = datetime.datetime(2020, 6, 18, 0, 0, 0)
+    temp, readings = 68, []
+    for minute in range(num_readings):
+        temp = min(max(temp + rng.choice([-1, 0, 0, 1]), 60), 76)
+        reading = {'ts': (start + datetime.timedelta(minutes=minute)).strftime(device_state.TIMESTAMP_FORMAT),
+                   'temp': temp,
+                   'humidity': rng.choice([45, 45, 45, 55])}
+        if rng.random() < 0.05:
+            reading['repeat_count'] = rng.randint(2, 6)
+        readings.append(reading)
+    return readings
+
+
+def alerts(db, collection_name, keys):
+    return sorted(tuple(doc[key] for key in keys) for doc in db[collection_name].find())
+
+
+def readings_chunk(device_temps):
+    """
+    A chunk of readings as read from a file; a reading a minute from 11:00 for each device.
+    """
+    start = datetime.datetime(2020, 6, 18, 11, 0, 0)
+    rows = [{'dev_id': dev_id, 'ts': (start + datetime.timedelta(minutes=minute)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+             'temp': temp, 'humidity': 45}
+            for dev_id, temps in device_temps.items() for minute, temp in enumerate(temps)]
+    return pd.DataFrame(rows, columns=['dev_id', 'ts', 'temp', 'humidity'])
+
+
+def use_db(db):
+    # mongomock cannot bulk_write() with current pymongo, so the requests are applied one at a time
+    def bulk_write(collection, requests):
+        for request in requests:
+            collection.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    db.device_state.bulk_write = lambda requests, ordered, collection=db.device_state: bulk_write(collection, requests)
+
+
+def test_replay_records_cleared_and_active_alerts():
+    chunk = readings_chunk({'razpi_01': [68, 75, 76, 77, 78, 68, 68, 68, 68, 68],
+                            'razpi_02': [68] * 3 + [60] * 22})
+    db = mongomock.MongoClient().db
+    use_db(db)
+    device_config = DeviceConfigStore(CONFIG)
+    device_config.load(db)
+    all_episodes = import_readings.replay_alerts(db, import_readings.compact_chunk(chunk), device_config)
+
+    # razpi_01 is raised by its 4th out of range reading and cleared by its 4th in range one; the
+    #  in range readings before the clear are part of the alert
+    history = list(db.alert_history.find({}, {'_id': 0}))
+    assert history == [{'dev_id': 'razpi_01', 'reading_type': 'temp', 'originated_ts': '2020-06-18T11:04:00Z',
+                        'max_value': 78, 'min_value': 68, 'cleared_ts': '2020-06-18T11:08:00Z',
+                        'duration_minutes': 4}]
+
+    # razpi_02 is still in alert at the end of the readings; notified at 11:06 and renotified at 11:16,
+    #  and the readings end before the next renotification would be due at 11:26
+    active = list(db.active_alerts.find({}, {'_id': 0}))
+    assert active == [{'dev_id': 'razpi_02', 'reading_type': 'temp', 'originated_ts': '2020-06-18T11:06:00Z',
+                       'max_value': 60, 'min_value': 60, 'notification_ts': '2020-06-18T11:16:00Z'}]
+    assert [episode['dev_id'] for episode in all_episodes['temp']] == ['razpi_01', 'razpi_02']
+    assert all_episodes['humidity'] == []
+
+
+def test_replay_keeps_a_devices_existing_active_alert():
+    db = mongomock.MongoClient().db
+    use_db(db)
+    existing = {'dev_id': 'razpi_01', 'reading_type': 'temp', 'originated_ts': '2020-06-17T09:00:00Z',
+                'notification_ts': '2020-06-17T09:00:00Z'}
+    db.active_alerts.insert_one(dict(existing))
+    device_config = DeviceConfigStore(CONFIG)
+    device_config.load(db)
+    import_readings.replay_alerts(db, import_readings.compact_chunk(readings_chunk({'razpi_01': [80] * 6})),
+                                  device_config)
+    assert list(db.active_alerts.find({}, {'_id': 0})) == [existing]
+
+
+def test_partitioned_replay_matches_the_live_rule(tmp_path):
+    rng = random.Random(7)
+    device_readings = {'razpi_{:02d}'.format(i): random_readings(rng, 300) for i in range(12)}
+
+    live_db = mongomock.MongoClient().db
+    for dev_id, readings in device_readings.items():
+        live_alerts(live_db, dev_id, readings)
+
+    # The readings as the importer reads them; interleaved across devices, so each chunk has
+    #  part of every device's readings
+    rows = sorted((dict(reading, dev_id=dev_id) for dev_id, readings in device_readings.items() for reading in readings),
+                  key=lambda row: row['ts'])
+    frame = pd.DataFrame(rows, columns=['dev_id', 'ts', 'temp', 'humidity', 'repeat_count'])
+    frame = frame.astype({'temp': 'Int64', 'humidity': 'Int64', 'repeat_count': 'Int64'})
+    num_partitions = 5
+    for chunk_num, start in enumerate(range(0, len(frame), 500)):
+        import_readings.spill_chunk(import_readings.compact_chunk(frame[start:start + 500]), str(tmp_path),
+                                    num_partitions, chunk_num)
+
+    db = mongomock.MongoClient().db
+    use_db(db)
+    device_config = DeviceConfigStore(CONFIG)
+    device_config.load(db)
+    seen = []
+    for partition in range(num_partitions):
+        readings = import_readings.read_partition(str(tmp_path), partition)
+        if readings is not None:
+            assert len(readings) == sum(len(device_readings[dev_id]) for dev_id in readings['dev_id'].unique())
+            seen += list(readings['dev_id'].unique())
+            import_readings.replay_alerts(db, readings, device_config)
+    assert sorted(seen) == sorted(device_readings)      # each device in exactly one partition
+
+    history_keys = ['dev_id', 'reading_type', 'originated_ts', 'cleared_ts']
+    active_keys = ['dev_id', 'reading_type', 'originated_ts', 'notification_ts']
+    assert alerts(live_db, 'alert_history', history_keys)       # the readings do raise and clear alerts
+    assert alerts(db, 'alert_history', history_keys) == alerts(live_db, 'alert_history', history_keys)
+    assert alerts(db, 'active_alerts', active_keys) == alerts(live_db, 'active_alerts', active_keys)
+
+
+def test_a_device_always_lands_in_the_same_partition():
+    first = pd.Series(['a', 'b', 'c', 'a'], dtype='category')
+    second = pd.Series(['c', 'd', 'a'], dtype='category')      # different categories, so different codes
+    first_partitions = dict(zip(first, import_readings.device_partitions(first, 4)))
+    second_partitions = dict(zip(second, import_readings.device_partitions(second, 4)))
+    assert first_partitions['a'] == second_partitions['a']
+    assert first_partitions['c'] == second_partitions['c']
+
+
+def test_summary_lists_at_most_max_episodes(monkeypatch):
+    monkeypatch.setattr(import_readings, 'MAX_SUMMARY_EPISODES', 3)
+    episode = {'dev_id': 'razpi_01', 'originated_ts': '2020-06-18T11:00:00Z', 'max_value': 75, 'min_value': 71}
+    summary = {}
+    import_readings.add_to_summary(summary, {'temp': [episode] * 2})
+    import_readings.add_to_summary(summary, {'temp': [episode] * 4, 'humidity': [episode]})
+    assert summary['temp']['count'] == 6
+    assert len(summary['temp']['episodes']) == 3
+    assert summary['humidity'] == {'count': 1, 'episodes': [episode]}
+
+    html_content = import_readings.summary_html(100, 2, summary)
+    assert '6 temp alerts' in html_content
+    assert html_content.count('<li>razpi_01') == 4
+    assert '... and 3 more' in html_content
+    assert 'more' not in html_content.split('humidity')[1]
@@ -0,0 +1,159 @@
+# test_ingest_workers.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the sharded ingest workers. These do not need the server; the worker's
+logic is run in this process against mongomock (pip install mongomock), and skipped
+without it. Run via:
+
+    pytest test_ingest_workers.py
+"""
+
+import datetime
+import queue
+import random
+import threading
+import pytest
+from bson import ObjectId
+import device_state
+from anomaly import AnomalyDetector
+from ingest_workers import shard_for, evaluate_timer, Worker, WorkerHandle, ShardedIngest
+
+mongomock = pytest.importorskip('mongomock')
+
+CONFIG = {'num_continuous_readings_to_check': 4, 'temp_range_min': 65, 'temp_range_max': 70,
+          'humidity_range_min': 40, 'humidity_range_max': 50, 'alert_renotification_delay': 10}
+
+
+def test_shard_is_stable_and_spreads_devices():
+    assert shard_for('RazPi_01', 4) == shard_for('RazPi_01', 4) == 2
+    counts = [0] * 4
+    for i in range(4000):
+        counts[shard_for('RazPi_{:04d}'.format(i), 4)] += 1
+    assert min(counts) > 900
+
+
+def test_in_memory_evaluation_matches_the_pipeline():
+    collection = mongomock.MongoClient().db.device_state
+    state = {'dev_id': 'RazPi_01'}
+    rng = random.Random(42)
+    detector = AnomalyDetector(alpha=0.05, z_threshold=1.5, min_samples=10, min_std=1.0)
+    start = datetime.datetime(2020, 6, 18, 11, 0, 0)
+    for minute in range(300):
+        now = start + datetime.timedelta(minutes=minute)
+        now_ts = now.strftime(device_state.TIMESTAMP_FORMAT)
+        type_updates = {'temp': device_state.type_update(CONFIG, 'temp', rng.choice([60, 67, 68, 68, 68, 75, 80]),
+                                                         rng.choice([1, 1, 1, 3]), now, anomaly=detector),
+                        'humidity': device_state.type_update(dict(CONFIG, humidity_hysteresis=3), 'humidity',
+                                                             rng.randint(35, 55), 1, now)}
+        if minute % 50 == 49:
+            device_state.raise_offline(collection, 'RazPi_01', now_ts, now_ts, 60)
+            state['offline_alert'] = device_state.new_alert(now_ts, 60)
+        expected = device_state.apply_reading(collection, 'RazPi_01', now_ts, type_updates)
+        assert device_state.evaluate_reading(state, now_ts, type_updates) == expected
+
+    doc = collection.find_one({'dev_id': 'RazPi_01'})
+    assert None in doc['humidity_window']           # readings within the hysteresis
+    assert doc['temp_stats'] == state['temp_stats']
+    for reading_type in ['temp', 'humidity']:
+        assert state['{}_window'.format(reading_type)] == doc['{}_window'.format(reading_type)]
+        assert state['{}_alert'.format(reading_type)] == doc['{}_alert'.format(reading_type)]
+
+
+def test_worker_skips_replayed_readings_and_timers_are_idempotent():
+    worker = Worker(0, queue.Queue(), queue.Queue(), None, None, batch_size=100, flush_ms=50)
+    worker.db = mongomock.MongoClient().db
+    readings = [{'_id': ObjectId(), 'dev_id': 'RazPi_01', 'ts': '2020-06-18T11:00:00Z', 'temp': 90, 'humidity': 45}
+                for _ in range(4)]
+    now = datetime.datetime(2020, 6, 18, 11, 0, 0)
+    messages = [('reading', seq, reading, '2020-06-18T11:00:00Z',
+                 {'temp': device_state.type_update(CONFIG, 'temp', 90, 1, now)}) for seq, reading in enumerate(readings)]
+    for message in messages + messages[2:]:         # as resent to a restarted worker
+        worker.handle(message)
+    assert len(worker.readings) == 4
+    assert [result[1:4] for result in worker.results] == [('transition', 'temp', 'raised')]
+
+    # Offline once, however many times the timer message is delivered
+    timer = ('timer', 10, 'RazPi_01', 'offline', '2020-06-18T12:00:00Z', '2020-06-18T11:50:00Z',
+             '2020-06-18T11:00:00Z', 60)
+    worker.handle(timer)
+    worker.handle(timer)
+    assert [result[1:4] for result in worker.results[1:]] == [('transition', 'offline', 'raised'),
+                                                              ('not_due', 'offline', '2020-06-18T12:00:00Z')]
+    assert evaluate_timer({'last_seen': '2020-06-18T11:30:00Z'}, 'offline', '2020-06-18T12:00:00Z',
+                          '2020-06-18T11:50:00Z', '2020-06-18T11:00:00Z', 60) == \
+        [('seen', 'offline', '2020-06-18T11:30:00Z')]
+
+    # A batch partly inserted before a crash is inserted again without error
+    worker.insert_readings(readings[:2])
+    worker.insert_readings(readings)
+    assert worker.db.readings.count_documents({}) == 4
+
+
+def test_readings_submitted_concurrently_reach_the_worker_in_id_order():
+    ingest = ShardedIngest(1, None, None, on_results=None)
+    handle = WorkerHandle(0)
+    handle.inbox = queue.Queue()
+    ingest.handles = [handle]
+    now = datetime.datetime(2020, 6, 18, 11, 0, 0)
+
+    def submit(thread_num):
+        for i in range(50):
+            ingest.submit_reading({'dev_id': 'RazPi_01', 'ts': '2020-06-18T11:00:00Z', 'temp': 67, 'humidity': 45},
+                                  '2020-06-18T11:00:00Z', {'temp': device_state.type_update(CONFIG, 'temp', 67, 1, now)})
+
+    threads = [threading.Thread(target=submit, args=(thread_num,)) for thread_num in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    worker = Worker(0, handle.inbox, queue.Queue(), None, None, batch_size=1000, flush_ms=50)
+    worker.db = mongomock.MongoClient().db
+    while not handle.inbox.empty():
+        worker.handle(handle.inbox.get())
+    assert len(worker.seqs) == 400
+    assert len(worker.readings) == 400              # none taken for a replay, though all are acknowledged
+    assert worker.sketches[('RazPi_01', '2020-06-18')]['count'] == 400
+    assert worker.sketch_ids[('RazPi_01', '2020-06-18')] == worker.readings[-1]['_id']
+
+
+class FakeProcess:
+    pid = 0
+    exitcode = 0
+
+    def is_alive(self):
+        return False
+
+    def join(self, timeout=None):
+        pass
+
+    def terminate(self):
+        pass
+
+
+def test_resize_does_not_restart_a_worker_that_stopped_first(monkeypatch):
+    ingest = ShardedIngest(2, None, None, on_results=None)
+    started = []
+    monkeypatch.setattr(ingest, 'start_worker', lambda handle: started.append(handle))
+    handles = [WorkerHandle(shard) for shard in range(2)]
+    for handle in handles:
+        handle.inbox = queue.Queue()
+        handle.process = FakeProcess()
+    ingest.handles = handles
+
+    resizer = threading.Thread(target=ingest.resize, args=(1,), kwargs={'timeout': 5})
+    resizer.start()
+    stops = [handle.inbox.get(timeout=5) for handle in handles]
+    assert [stop[0] for stop in stops] == ['stop', 'stop']
+
+    # Worker 0 stops first; its results thread sees it exit while worker 1 is still being waited on
+    ingest.done(handles[0], [stops[0][1]], [])
+    ingest.receive(handles[0], handles[0].process, queue.Queue())
+    assert started == []
+    assert handles[0].inbox.empty()
+
+    ingest.done(handles[1], [stops[1][1]], [])
+    resizer.join(timeout=5)
+    assert not resizer.is_alive()
+    assert [handle.shard for handle in started] == [0]          # just the new pool
+    assert ingest.handles == started and not ingest.draining
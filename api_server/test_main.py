@@ -26,6 +26,8 @@ import sys
 import argparse
 import pandas as pd
 import os
+import json
+import time
 import requests
 
 # Probably a more elegant way to deal with this info; but for now, this will work...
@@ -38,6 +40,10 @@ CONFIG_DATA = {'get_count_url': {'readings':      'http://' + IP_ADDR + '/readin
                               'active_alerts': 'http://' + IP_ADDR + '/active-alerts/',
                               'alert_history': 'http://' + IP_ADDR + '/alert-history/'},
                'post_url': {'readings': 'http://' + IP_ADDR + '/readings/'},
+               'get_url': {'alert_history': 'http://' + IP_ADDR + '/alert-history/'},
+               # The server's read-only resources read from a secondary by default; these tests read
+               #  straight after writing, so read from the primary
+               'read_headers': {'X-Read-Preference': 'primary'},
                'test_data_subdir': 'test_data'}
 
 
@@ -101,7 +107,8 @@ def resource_count(resource_name, dev_id, reading_type=None):
     params = {'dev-id': dev_id}
     if reading_type is not None:
         params['reading-type'] = reading_type
-    response = requests.get(CONFIG_DATA['get_count_url'][resource_name], params=params)
+    response = requests.get(CONFIG_DATA['get_count_url'][resource_name], params=params,
+                            headers=CONFIG_DATA['read_headers'])
 
     if verbose:
         print('  count = {}'.format(int(response.content)), flush=True)
@@ -109,6 +116,27 @@ def resource_count(resource_name, dev_id, reading_type=None):
     return response.status_code, int(response.content)
 
 
+def post_reading(packaged_data):
+    """
+    Utility function to POST a sensor reading. The server limits how fast one device may send readings
+    (device_rate_limit_per_sec in main.py) and these tests send theirs as fast as they can, so like the
+    client, when the server returns 429 we wait the Retry-After seconds and resend.
+
+    Args:
+        packaged_data (dict):     The reading's message body
+
+    Returns:
+        Response object from the requests library
+    """
+    while True:
+        response = requests.post(CONFIG_DATA['post_url']['readings'], json=packaged_data)
+        if response.status_code != 429:
+            return response
+        if verbose:
+            print('  <= Status:429; resending in {} seconds'.format(response.headers.get('Retry-After')), flush=True)
+        time.sleep(int(response.headers.get('Retry-After', 1)))
+
+
 def send_sensor_reading_messages(message_filename):
     """
     Utility function to read the sensor reading data from a file and send via POST.
@@ -137,7 +165,7 @@ def send_sensor_reading_messages(message_filename):
                          'humidity': message_data['humidity']}
         if verbose:
             print('Sending Message {}...\n  =>Data :{}'.format((idx + 1), packaged_data), flush=True)
-        response = requests.post(CONFIG_DATA['post_url']['readings'], json=packaged_data)
+        response = post_reading(packaged_data)
         if verbose:
             print('  <= Status:{}\n     Content:{}'.format(response.status_code, response.content), flush=True)
         if response.status_code != 200:         # stop on the first failing POST
@@ -562,6 +590,66 @@ def test_trigger_temp_and_humidity_alert():
     assert count == 0
 
 
+def test_alert_history_query():
+    """
+    Test querying alert history after triggering then clearing a temperature alert. The
+    history record should carry its duration and peak values, and paging past it should
+    return nothing.
+
+    Data file: test_trigger_and_clear_temp_alert_pt1.csv & test_trigger_and_clear_temp_alert_pt2.csv
+    """
+    # Wipe the DB for our test device
+    delete_resources(['readings', 'active_alerts', 'alert_history'], 'razpi_sim_01')
+
+    # Trigger, then clear, a temperature alert
+    status = send_sensor_reading_messages('test_trigger_and_clear_temp_alert_pt1.csv')
+    assert status == 200
+    status = send_sensor_reading_messages('test_trigger_and_clear_temp_alert_pt2.csv')
+    assert status == 200
+
+    # Query the history; one record per line
+    params = {'dev-id': 'razpi_sim_01', 'reading-type': 'temp'}
+    response = requests.get(CONFIG_DATA['get_url']['alert_history'], params=params,
+                            headers=CONFIG_DATA['read_headers'])
+    assert response.status_code == 200
+    records = [json.loads(line) for line in response.text.splitlines()]
+    if verbose:
+        print('  records = {}'.format(records), flush=True)
+    assert len(records) == 1
+    assert records[0]['duration_minutes'] >= 0
+    assert records[0]['max_value'] is not None
+    assert records[0]['min_value'] is not None
+
+    # Nothing follows the last record
+    params['after'] = records[0]['cursor']
+    response = requests.get(CONFIG_DATA['get_url']['alert_history'], params=params,
+                            headers=CONFIG_DATA['read_headers'])
+    assert response.status_code == 200
+    assert response.text == ''
+
+
+def test_invalid_repeat_count_rejected():
+    """
+    Test that a reading claiming to stand for fewer than 1 readings is rejected with
+    a 422, and not stored.
+    """
+    # Wipe the DB for our test device
+    delete_resources(['readings', 'active_alerts', 'alert_history'], 'razpi_sim_01')
+
+    for repeat_count in [0, -3]:
+        packaged_data = {'dev_id': 'razpi_sim_01', 'ts': '2020-06-18T11:06:00Z', 'temp': 67, 'humidity': 45,
+                         'repeat_count': repeat_count}
+        response = post_reading(packaged_data)
+        if verbose:
+            print('  <= Status:{}\n     Content:{}'.format(response.status_code, response.content), flush=True)
+        assert response.status_code == 422
+
+    # Nothing got stored
+    status, count = resource_count('readings', 'razpi_sim_01')
+    assert status == 200
+    assert count == 0
+
+
 def main():
     global verbose     # I know, not good practice...
 
@@ -0,0 +1,60 @@
+# test_profiler.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the request profiler. Like test_admission.py, these do not need a
+running server. Run via:
+
+    pytest test_profiler.py
+"""
+
+import time
+from profiler import RequestProfiler, profiled
+
+
+def make_endpoints(profiler):
+    @profiled(profiler)
+    def post_readings(value):
+        return sum(range(value))
+
+    @profiled(profiler)
+    def get_readings_counts():
+        return 0
+
+    return post_readings, get_readings_counts
+
+
+def test_off_by_default_and_results_untouched():
+    profiler = RequestProfiler()
+    post_readings, _ = make_endpoints(profiler)
+    assert post_readings(10) == 45
+    assert profiler.status()['num_profiled'] == {}
+    assert profiler.text_report() is None
+
+
+def test_profiles_next_n_requests_to_targeted_endpoints():
+    profiler = RequestProfiler()
+    post_readings, get_readings_counts = make_endpoints(profiler)
+    profiler.start(targets={'post_readings'}, num_requests=2)
+    for _ in range(5):
+        assert post_readings(1000) == 499500
+        get_readings_counts()
+
+    status = profiler.status()
+    assert status['num_profiled'] == {'post_readings': 2}
+    assert not status['enabled']
+    assert 'post_readings' in profiler.text_report()
+
+
+def test_sample_mode_collects_stacks():
+    profiler = RequestProfiler()
+
+    @profiled(profiler)
+    def slow_endpoint():
+        time.sleep(0.1)
+
+    profiler.start(mode='sample', sample_interval=0.005)
+    slow_endpoint()
+    profiler.stop()
+    stacks = profiler.collapsed_stacks()
+    assert stacks.startswith('slow_endpoint;')
+    assert 'slow_endpoint (test_profiler.py' in stacks
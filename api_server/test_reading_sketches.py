@@ -0,0 +1,132 @@
+# test_reading_sketches.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the per-day reading sketches. These do not need the server; they run
+against mongomock (pip install mongomock), and are skipped without it. Run via:
+
+    pytest test_reading_sketches.py
+"""
+
+import queue
+import random
+import numpy as np
+import pytest
+from bson import ObjectId
+import reading_sketches
+from ingest_workers import Worker
+
+mongomock = pytest.importorskip('mongomock')
+
+
+def random_readings(rng, num_readings):
+    readings = []
+    for _ in range(num_readings):
+        reading = {'dev_id': rng.choice(['RazPi_01', 'RazPi_02']),
+                   'ts': '2020-06-{:02d}T{:02d}:{:02d}:00Z'.format(rng.randint(1, 30), rng.randint(0, 23),
+                                                                  rng.randint(0, 59)),
+                   'temp': rng.randint(55, 80),
+                   'humidity': rng.randint(30, 60)}
+        if rng.random() < 0.1:
+            reading['repeat_count'] = rng.randint(2, 5)
+        readings.append(reading)
+    return readings
+
+
+def exact_percentiles(readings, reading_type, percentiles):
+    values = np.repeat([reading[reading_type] for reading in readings],
+                       [reading.get('repeat_count', 1) for reading in readings])
+    return {percentile: int(np.percentile(values, percentile, method='inverted_cdf')) for percentile in percentiles}
+
+
+def test_percentiles_match_the_readings_for_any_range_of_days():
+    db = mongomock.MongoClient().db
+    readings = random_readings(random.Random(42), 3000)
+    for reading in readings:
+        reading_sketches.record_reading(db.reading_sketches, reading)
+    assert db.reading_sketches.count_documents({}) == 60
+
+    percentiles = [0, 5, 50, 95, 99.9, 100]
+    for dev_id, start_day, end_day in [(None, None, None), ('RazPi_01', '2020-06-10', '2020-06-20'),
+                                       ('RazPi_02', '2020-06-30', None)]:
+        included = [reading for reading in readings
+                    if (dev_id in (None, reading['dev_id'])) and (start_day or '') <= reading['ts'][:10] < (end_day or 'z')]
+        for reading_type in ['temp', 'humidity']:
+            result = reading_sketches.query_sketches(db.reading_sketches, reading_type, percentiles, dev_id,
+                                                     start_day, end_day)
+            assert result['percentiles'] == exact_percentiles(included, reading_type, percentiles)
+            assert result['count'] == sum(reading.get('repeat_count', 1) for reading in included)
+            assert result['min'] == min(reading[reading_type] for reading in included)
+
+    empty = reading_sketches.query_sketches(db.reading_sketches, 'temp', [50], 'RazPi_03')
+    assert (empty['count'], empty['percentiles']) == (0, {50: None})
+
+
+def test_rebuild_matches_the_incremental_sketches():
+    db = mongomock.MongoClient().db
+    readings = random_readings(random.Random(7), 500)
+    for reading in readings:
+        reading_sketches.record_reading(db.reading_sketches, reading)
+    db.readings.insert_many(readings)
+    incremental = sorted(db.reading_sketches.find({}, {'_id': False}), key=lambda doc: (doc['dev_id'], doc['day']))
+
+    assert reading_sketches.rebuild(db) == len(incremental)
+    rebuilt = sorted(db.reading_sketches.find({}, {'_id': False}), key=lambda doc: (doc['dev_id'], doc['day']))
+    assert rebuilt == incremental
+
+
+def flush_sketches(worker):
+    # The state docs are not under test here, and mongomock cannot bulk_write() with current pymongo, so
+    #  the sketch updates are applied one at a time
+    collection = worker.db.reading_sketches
+    collection.bulk_write = lambda requests, ordered: [collection.update_one(request._filter, request._doc,
+                                                                             upsert=request._upsert)
+                                                       for request in requests]
+    worker.dirty.clear()
+    worker.flush()
+
+
+def test_worker_replays_do_not_count_readings_twice():
+    db = mongomock.MongoClient().db
+    readings = [dict(reading, _id=ObjectId()) for reading in random_readings(random.Random(3), 200)]
+    messages = [('reading', seq, reading, '2020-07-01T00:00:00Z', {}) for seq, reading in enumerate(readings)]
+
+    worker = Worker(0, queue.Queue(), queue.Queue(), None, None, batch_size=100, flush_ms=50)
+    worker.db = db
+    for message in messages[:120]:
+        worker.handle(message)
+    flush_sketches(worker)
+
+    # A restarted worker is sent everything unacknowledged again, including some already written
+    worker = Worker(0, queue.Queue(), queue.Queue(), None, None, batch_size=100, flush_ms=50)
+    worker.db = db
+    for message in messages[80:]:
+        worker.handle(message)
+    flush_sketches(worker)
+
+    result = reading_sketches.query_sketches(db.reading_sketches, 'humidity', [50])
+    assert result['count'] == sum(reading.get('repeat_count', 1) for reading in readings)
+    assert result['percentiles'] == exact_percentiles(readings, 'humidity', [50])
+
+
+def test_decimal_metrics_are_within_the_relative_accuracy_in_bounded_buckets():
+    db = mongomock.MongoClient().db
+    rng = random.Random(11)
+    readings = [{'dev_id': 'RazPi_01', 'ts': '2020-06-18T{:02d}:{:02d}:00Z'.format(i // 60 % 24, i % 60),
+                 'pressure': rng.uniform(950.0, 1050.0)} for i in range(5000)]
+    for reading in readings:
+        reading_sketches.record_reading(db.reading_sketches, reading)
+
+    doc = db.reading_sketches.find_one({'dev_id': 'RazPi_01'})
+    assert len(doc['pressure']) <= 101             # 5000 distinct values, one bucket per 0.1%
+    values = np.array([reading['pressure'] for reading in readings])
+    result = reading_sketches.query_sketches(db.reading_sketches, 'pressure', [0, 5, 50, 95, 100])
+    for percentile, value in result['percentiles'].items():
+        exact = np.percentile(values, percentile, method='inverted_cdf')
+        assert abs(value - exact) <= exact * reading_sketches.RELATIVE_ACCURACY
+    assert abs(result['mean'] - values.mean()) <= values.mean() * reading_sketches.RELATIVE_ACCURACY
+
+    for value in [-12.5, -0.001, 0, 0.001, 3.2, 1013.25, 1e6]:
+        bucket = reading_sketches.bucket_value('pressure', reading_sketches.bucket_key('pressure', value))
+        assert abs(bucket - value) <= abs(value) * reading_sketches.RELATIVE_ACCURACY
+    assert reading_sketches.bucket_value('pressure', '1013') == 1013      # kept before decimal metrics had their own
+    assert reading_sketches.bucket_key('temp', 67.6) == '68'
@@ -0,0 +1,164 @@
+# test_rebuild_alerts.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the alert state rebuild. These do not need the server; they run in this
+process against mongomock (pip install mongomock), and are skipped without it. Run via:
+
+    pytest test_rebuild_alerts.py
+"""
+
+import datetime
+import random
+import pymongo
+import pytest
+import device_state
+import rebuild_alerts
+from anomaly import AnomalyDetector
+
+mongomock = pytest.importorskip('mongomock')
+
+CONFIG = {'num_continuous_readings_to_check': 4, 'temp_range_min': 65, 'temp_range_max': 70,
+          'humidity_range_min': 40, 'humidity_range_max': 50, 'alert_renotification_delay': 10}
+
+
+def post_readings(db, dev_id, config, readings, anomaly=None):
+    """
+    Apply readings the way the server does: the state doc decides, and the alert handlers keep
+    active_alerts and alert_history. If given, the anomaly detector weighs in on temp.
+    """
+    state = {'dev_id': dev_id}
+    for reading in readings:
+        db.readings.insert_one(dict(reading, dev_id=dev_id))
+        now = datetime.datetime.strptime(reading['ts'], device_state.TIMESTAMP_FORMAT)
+        type_updates = {reading_type: device_state.type_update(config, reading_type, reading[reading_type],
+                                                               reading.get('repeat_count', 1), now,
+                                                               anomaly if reading_type == 'temp' else None)
+                        for reading_type in ['temp', 'humidity']}
+        for reading_type, transition, alert in device_state.evaluate_reading(state, reading['ts'], type_updates):
+            query = {'dev_id': dev_id, 'reading_type': reading_type}
+            cause = {'cause': alert['cause']} if alert.get('cause') else {}
+            if transition == 'raised':
+                db.active_alerts.insert_one(dict(query, originated_ts=alert['originated_ts'],
+                                                 notification_ts=alert['notification_ts'],
+                                                 max_value=alert['max_value'], min_value=alert['min_value'], **cause))
+            elif transition == 'renotified':
+                db.active_alerts.update_one(query, {'$set': {'notification_ts': alert['notification_ts']}})
+            elif transition == 'cleared':
+                db.alert_history.insert_one(dict(query, originated_ts=alert['originated_ts'], cleared_ts=reading['ts'],
+                                                 **cause))
+                db.active_alerts.delete_many(query)
+    db.device_state.insert_one(state)
+
+
+def random_readings(rng, num_readings):
+    start = datetime.datetime(2020, 6, 18, 0, 0, 0)
+    temp, readings = 68, []
+    for minute in range(num_readings):
+        temp = min(max(temp + rng.choice([-1, 0, 0, 1]), 60), 76)
+        reading = {'ts': (start + datetime.timedelta(minutes=minute)).strftime(device_state.TIMESTAMP_FORMAT),
+                   'temp': temp,
+                   'humidity': rng.choice([45, 45, 45, 55])}
+        if rng.random() < 0.05:
+            reading['repeat_count'] = rng.randint(2, 6)
+        readings.append(reading)
+    return readings
+
+
+def use_db(db):
+    # mongomock cannot bulk_write() with current pymongo, so the requests are applied one at a time
+    def bulk_write(collection, requests):
+        for request in requests:
+            if isinstance(request, pymongo.InsertOne):
+                collection.insert_one(request._doc)
+            elif isinstance(request, pymongo.DeleteMany):
+                collection.delete_many(request._filter)
+            else:
+                collection.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    for name in ['alert_history', 'active_alerts', 'device_state']:
+        db[name].bulk_write = lambda requests, ordered, collection=db[name]: bulk_write(collection, requests)
+    rebuild_alerts.WORKER_DB = db
+
+
+def test_rebuild_agrees_with_the_server_then_repairs_deleted_alerts():
+    db = mongomock.MongoClient().db
+    use_db(db)
+    rng = random.Random(11)
+    wide_config = dict(CONFIG, temp_range_max=72, num_continuous_readings_to_check=2)
+    post_readings(db, 'RazPi_01', CONFIG, random_readings(rng, 3000))
+    post_readings(db, 'RazPi_02', wide_config, random_readings(rng, 3000))
+    devices = [('RazPi_01', CONFIG), ('RazPi_02', wide_config)]
+    assert db.alert_history.count_documents({'reading_type': 'temp'}) > 10
+    assert db.alert_history.count_documents({'reading_type': 'humidity'}) > 10
+
+    # Computed from the readings alone, the rebuild agrees exactly with what the server did
+    results = rebuild_alerts.rebuild_devices(devices, dry_run=True, tolerance_minutes=0)
+    assert [(dev_id, num_readings, differences) for dev_id, num_readings, differences in results] == \
+        [('RazPi_01', 3000, []), ('RazPi_02', 3000, [])]
+    expected_state = db.device_state.find_one({'dev_id': 'RazPi_01'}, {'_id': False})
+    expected_history = db.alert_history.count_documents({'dev_id': 'RazPi_01'})
+
+    # As after DELETE active-alerts/ for a device and losing some alert history
+    db.active_alerts.delete_many({'dev_id': 'RazPi_01'})
+    device_state.reset(db.device_state, {'dev_id': 'RazPi_01'}, alerts=True)
+    db.alert_history.delete_one({'dev_id': 'RazPi_01', 'reading_type': 'humidity'})
+    db.alert_history.insert_one({'dev_id': 'RazPi_01', 'reading_type': 'temp', 'originated_ts': '2019-01-01T00:00:00Z'})
+
+    results = rebuild_alerts.rebuild_devices(devices, dry_run=True, tolerance_minutes=0)
+    differences = results[0][2]
+    assert 'temp: unexpected alert history originated 2019-01-01T00:00:00Z' in differences
+    assert any(difference.startswith('humidity: missing alert history') for difference in differences)
+    assert results[1][2] == []
+    assert db.alert_history.count_documents({'originated_ts': '2019-01-01T00:00:00Z'}) == 1     # nothing written
+
+    results = rebuild_alerts.rebuild_devices(devices, dry_run=False, tolerance_minutes=0)
+    assert results[0][2] == differences
+    assert rebuild_alerts.rebuild_devices(devices, dry_run=True, tolerance_minutes=0)[0][2] == []
+    assert db.alert_history.count_documents({'dev_id': 'RazPi_01'}) == expected_history
+    state = db.device_state.find_one({'dev_id': 'RazPi_01'}, {'_id': False})
+    for reading_type in ['temp', 'humidity']:
+        assert state['{}_window'.format(reading_type)] == expected_state['{}_window'.format(reading_type)]
+        assert state['{}_alert'.format(reading_type)] == expected_state['{}_alert'.format(reading_type)]
+
+
+def test_anomaly_alerts_are_left_as_they_are():
+    db = mongomock.MongoClient().db
+    use_db(db)
+    start = datetime.datetime(2020, 6, 18, 0, 0, 0)
+    temps = {20: 65, 60: 80, 61: 80, 62: 80, 63: 80, 118: 63}
+    readings = [{'ts': (start + datetime.timedelta(minutes=minute)).strftime(device_state.TIMESTAMP_FORMAT),
+                 'temp': temps.get(minute, [67, 68, 69, 68][minute % 4]),
+                 'humidity': 45} for minute in range(120)]
+    # An alert raised by an in-range anomaly, one the range check would have raised a few readings later
+    #  (so the range check's alert never was), and one still active
+    post_readings(db, 'RazPi_01', CONFIG, readings,
+                  anomaly=AnomalyDetector(alpha=0.05, z_threshold=2.5, min_samples=10, min_std=0.5))
+    assert db.alert_history.count_documents({'cause': 'anomaly'}) == 2
+    assert db.active_alerts.count_documents({'cause': 'anomaly'}) == 1
+    assert db.device_state.find_one({'dev_id': 'RazPi_01'})['temp_alert']['cause'] == 'anomaly'
+    devices = [('RazPi_01', CONFIG)]
+    assert rebuild_alerts.rebuild_devices(devices, dry_run=True, tolerance_minutes=0) == [('RazPi_01', 120, [])]
+
+    # Fixing something else keeps them
+    db.alert_history.insert_one({'dev_id': 'RazPi_01', 'reading_type': 'temp', 'originated_ts': '2019-01-01T00:00:00Z'})
+    results = rebuild_alerts.rebuild_devices(devices, dry_run=False, tolerance_minutes=0)
+    assert results[0][2] == ['temp: unexpected alert history originated 2019-01-01T00:00:00Z']
+    assert rebuild_alerts.rebuild_devices(devices, dry_run=True, tolerance_minutes=0)[0][2] == []
+    assert db.alert_history.count_documents({}) == 2
+    assert db.active_alerts.count_documents({'cause': 'anomaly'}) == 1
+    assert db.device_state.find_one({'dev_id': 'RazPi_01'})['temp_alert']['cause'] == 'anomaly'
+
+
+def test_range_alerts_are_not_marked_as_anomalies():
+    state = {'dev_id': 'RazPi_01'}
+    detector = AnomalyDetector(alpha=0.05, z_threshold=2.5, min_samples=10, min_std=0.5)
+    now = datetime.datetime(2020, 6, 18, 11, 0, 0)
+    for temp in [68] * 10 + [80] * 3:                       # the 80s without the detector, so its mean stays at 68
+        anomaly = detector if temp == 68 else None
+        assert device_state.evaluate_reading(state, '2020-06-18T11:00:00Z',
+                                             {'temp': device_state.type_update(CONFIG, 'temp', temp, 1, now,
+                                                                               anomaly)}) == []
+    changes = device_state.evaluate_reading(state, '2020-06-18T11:00:00Z',
+                                            {'temp': device_state.type_update(CONFIG, 'temp', 80, 1, now, detector)})
+    assert detector.verdict(state['temp_stats'], 4)[0]           # anomalous, but out of range anyway
+    assert changes[0][:2] == ('temp', 'raised') and 'cause' not in changes[0][2]
@@ -0,0 +1,55 @@
+# test_scheduler.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the timer scheduler. Like test_admission.py, these do not need a
+running server. Run via:
+
+    pytest test_scheduler.py
+"""
+
+import threading
+import time
+from scheduler import TimerHeap, TimerScheduler
+
+
+def test_timers_fire_in_due_order_once():
+    timers = TimerHeap()
+    timers.schedule(('RazPi_01', 'temp'), 30)
+    timers.schedule(('RazPi_02', 'temp'), 10)
+    timers.schedule(('RazPi_03', 'temp'), 20)
+    timers.schedule(('RazPi_01', 'temp'), 5)            # rescheduled; the old entry must not fire
+    timers.cancel(('RazPi_03', 'temp'))
+
+    assert timers.pop_due(4) == []
+    assert timers.pop_due(100) == [('RazPi_01', 'temp'), ('RazPi_02', 'temp')]
+    assert len(timers) == 0
+    assert timers.next_due() is None
+
+
+def test_rescheduling_does_not_grow_the_heap_without_bound():
+    timers = TimerHeap()
+    for i in range(100000):
+        timers.schedule(('RazPi_{}'.format(i % 10), 'offline'), i)
+    assert len(timers) == 10
+    assert len(timers.heap) < 2 * len(timers) + 1001
+    assert timers.pop_due(99990) == [('RazPi_0', 'offline')]
+
+
+def test_scheduler_thread_fires_earlier_timer_scheduled_while_waiting():
+    fired = []
+    event = threading.Event()
+
+    def callback(keys):
+        fired.extend(keys)
+        event.set()
+
+    scheduler = TimerScheduler(callback)
+    scheduler.start()
+    try:
+        scheduler.schedule('later', time.time() + 60)
+        scheduler.schedule('sooner', time.time() + 0.05)
+        assert event.wait(5)
+        assert fired == ['sooner']
+        assert scheduler.due_time('later') is not None
+    finally:
+        scheduler.stop()
@@ -0,0 +1,88 @@
+# test_simulate_thresholds.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the what-if threshold simulator, against small series with known
+results. These do not need the server; loading readings is run against mongomock
+(pip install mongomock), and skipped without it. Run via:
+
+    pytest test_simulate_thresholds.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from simulate_thresholds import load_readings, candidate_rules, simulate
+
+CONFIG = {'num_continuous_readings_to_check': 2, 'co2_range_min': 0, 'co2_range_max': 1500,
+          'alert_renotification_delay': 1440}
+
+
+def minutes(*offsets):
+    return np.datetime64('2020-06-18T00:00') + np.array(offsets, dtype='timedelta64[m]')
+
+
+def candidates(**columns):
+    settings = dict(range_min=[0], range_max=[1500], hysteresis=[0], num_readings=[2], renotification_delay=[1440])
+    settings.update(columns)
+    count = max(len(values) for values in settings.values())
+    return pd.DataFrame({name: values * count if len(values) == 1 else values for name, values in settings.items()})
+
+
+def run(timestamps, values, candidate_settings, repeat_counts=None):
+    return simulate(timestamps, np.array(values, dtype=np.float64), candidate_settings,
+                    candidate_rules(CONFIG, 'co2', candidate_settings), repeat_counts)
+
+
+def test_alerts_counted_and_timed_per_candidate():
+    # Out of range for minutes 0-2, back in 3-5, out 6-7
+    results = run(minutes(0, 1, 2, 3, 4, 5, 6, 7), [1600, 1600, 1600, 1000, 1000, 1000, 1600, 1600],
+                  candidates(num_readings=[1, 2, 3, 4]))
+    assert results['num_alerts'].tolist() == [2, 2, 1, 0]
+    assert results['total_alert_minutes'].tolist() == [4.0, 3.0, 3.0, 0.0]       # N=1: 0-3 and 6-7 (the last reading)
+    assert results['max_alert_minutes'].tolist() == [3.0, 3.0, 3.0, 0.0]
+    assert results['active_at_end'].tolist() == [True, True, False, False]
+
+
+def test_range_limits_are_in_range():
+    results = run(minutes(0, 1, 2, 3), [1000, 1500, 900, 1600], candidates(num_readings=[1], range_min=[1000, 1100],
+                                                                          range_max=[1500, 1400]))
+    assert results['num_alerts'].tolist() == [1, 1]
+    assert results['total_alert_minutes'].tolist() == [1.0, 3.0]
+
+
+def test_hysteresis_delays_clearing():
+    # 1450 is in range, but within a hysteresis of 100 of the max; only 1300 clears then
+    results = run(minutes(0, 1, 2, 3, 4, 5), [1600, 1600, 1450, 1450, 1300, 1300], candidates(hysteresis=[0, 100]))
+    assert results['num_alerts'].tolist() == [1, 1]
+    assert results['total_alert_minutes'].tolist() == [2.0, 4.0]
+
+
+def test_repeat_counts_count_as_that_many_readings():
+    # A heartbeat standing for 3 out of range readings raises an alert with N=3 on its own
+    timestamps = minutes(0, 60, 120)
+    assert run(timestamps, [1000, 1600, 1000], candidates(num_readings=[3]))['num_alerts'].tolist() == [0]
+    assert run(timestamps, [1000, 1600, 1000], candidates(num_readings=[3]),
+               np.array([1, 3, 1]))['num_alerts'].tolist() == [1]
+
+
+def test_renotifications_every_delay_while_alerting():
+    # Out of range every 10 minutes for a day and a half, then cleared
+    offsets = list(range(0, 36 * 60, 10)) + [36 * 60, 36 * 60 + 10]
+    values = [1600] * (len(offsets) - 2) + [1000, 1000]
+    results = run(minutes(*offsets), values, candidates(renotification_delay=[600, 1440]))
+    assert results['num_alerts'].tolist() == [1, 1]
+    assert results['num_renotifications'].tolist() == [3, 1]      # at 10h, 20h, 30h / at 24h
+
+
+def test_readings_without_the_metric_are_skipped():
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    db.readings.insert_many([{'dev_id': 'RazPi_05', 'ts': '2020-06-18T00:00:00Z', 'temp': 67, 'co2': 900},
+                             {'dev_id': 'RazPi_05', 'ts': '2020-06-18T00:01:00Z', 'temp': 67},
+                             {'dev_id': 'RazPi_05', 'ts': '2020-06-18T00:02:00Z', 'co2': 1600, 'repeat_count': 4},
+                             {'dev_id': 'RazPi_01', 'ts': '2020-06-18T00:02:00Z', 'co2': 1200}])
+    timestamps, values, repeat_counts = load_readings(db, 'RazPi_05', 'co2')
+    assert values.tolist() == [900, 1600]
+    assert repeat_counts.tolist() == [1, 4]
+    assert len(timestamps) == 2
+    assert len(load_readings(db, 'RazPi_05', 'pressure')[1]) == 0
@@ -0,0 +1,39 @@
+# test_startup.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Tests for the server's cold start. Unlike test_main.py, these do not need a running
+server or database; the server's startup (and warm-up) is never run, so it stays
+not ready. Run via:
+
+    pytest test_startup.py
+
+For the actual timings, see benchmark_startup.py.
+"""
+
+import os
+import subprocess
+import sys
+from fastapi.testclient import TestClient
+import main
+
+
+def test_import_leaves_heavy_modules_for_later():
+    heavy_modules = ['pandas', 'pyarrow', 'sendgrid', 'export_data', 'pymongo', 'db_monitor', 'ingest_workers',
+                     'cProfile', 'pstats']
+    code = 'import sys, main; print(sorted(m for m in {!r} if m in sys.modules))'.format(heavy_modules)
+    output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.stdout.strip() == '[]'
+
+
+def test_live_at_once_but_requests_turned_away_until_ready():
+    client = TestClient(main.app)       # not used as a context manager, so startup does not run
+    assert client.get('/live/').status_code == 200
+
+    response = client.get('/ready/')
+    assert response.status_code == 503
+    assert response.json()['detail']['stage'] == 'starting'
+
+    response = client.get('/readings/counts/')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
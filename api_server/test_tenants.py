@@ -0,0 +1,107 @@
+# test_tenants.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for the tenant routing. These do not need the server or MongoDB; the tenants'
+clients are stand-ins. Run via:
+
+    pytest test_tenants.py
+"""
+
+import threading
+import types
+import pytest
+from db_monitor import CommandMonitor
+from tenants import DEFAULT_TENANT, CURRENT_TENANT, TenantRejected, TenantRouter, TenantLocal, tenant_scope, \
+    parse_tenants
+
+
+TENANTS = '''{"site_a": {"api_key": "key-a"},
+              "site_b": {"api_key": "key-b", "database_name": "b_data", "max_pool_size": 5},
+              "big_site": {"api_key": "key-big", "mongodb_server_url": "mongodb://big"},
+              "open_site": {}}'''
+
+
+class FakeClient:
+    def __init__(self, url, maxPoolSize):
+        self.url = url
+        self.max_pool_size = maxPoolSize
+        self.closed = threading.Event()
+
+    def __getitem__(self, name):
+        return (self, name)
+
+    def close(self):
+        self.closed.set()
+
+
+def test_requests_resolve_to_the_tenant_they_may_use():
+    router = TenantRouter(parse_tenants(TENANTS), 'mongodb://shared', max_clients=8, max_pool_size=20,
+                          close_delay_secs=0)
+    assert router.resolve(None, None) == DEFAULT_TENANT
+    assert router.resolve('key-a', None) == 'site_a'
+    assert router.resolve('key-b', 'site_b') == 'site_b'
+    assert router.resolve(None, 'open_site') == 'open_site'
+
+    for api_key, tenant, status_code in [('wrong', None, 401),
+                                         ('key-a', 'site_b', 401),      # one tenant's key for another
+                                         (None, 'site_a', 401),         # needs its key
+                                         (None, 'nope', 404)]:
+        with pytest.raises(TenantRejected) as e:
+            router.resolve(api_key, tenant)
+        assert e.value.status_code == status_code
+
+    with pytest.raises(ValueError):
+        parse_tenants('{"default": {}}')
+    with pytest.raises(ValueError):
+        parse_tenants('{"a": {"api_key": "k"}, "b": {"api_key": "k"}}')
+    with pytest.raises(ValueError):
+        parse_tenants('{"a": {"database": "x"}}')
+
+
+def test_clients_per_tenant_with_least_recently_used_closed():
+    router = TenantRouter(parse_tenants(TENANTS), 'mongodb://shared', max_clients=2, max_pool_size=20,
+                          close_delay_secs=0.05, client_factory=FakeClient)
+    client_a, name = router.database('site_a')
+    assert (client_a.url, client_a.max_pool_size, name) == ('mongodb://shared', 20, 'site_a')
+    client_b, name = router.database('site_b')
+    assert (client_b.url, client_b.max_pool_size, name) == ('mongodb://shared', 5, 'b_data')
+    assert router.database('site_a')[0] is client_a       # reused, and now the most recently used
+
+    client_big, name = router.database('big_site')
+    assert (client_big.url, name) == ('mongodb://big', 'big_site')
+    assert client_b.closed.wait(1)                          # evicted, after the delay
+    assert not client_a.closed.is_set()
+
+    status = router.status()
+    assert (status['num_clients_open'], status['num_clients_created'], status['num_clients_evicted']) == (2, 3, 1)
+    assert {tenant['tenant'] for tenant in status['tenants'] if tenant['client_open']} == {'site_a', 'big_site'}
+    assert 'key-a' not in str(status) and 'mongodb://big' not in str(status)
+
+    client_b_again = router.database('site_b')[0]          # reopened on its next request
+    assert client_b_again is not client_b
+    router.close()
+    assert client_b_again.closed.is_set() and client_big.closed.is_set()
+
+
+def test_tenant_local_instances_and_tenant_tagged_db_stats():
+    created = []
+    counters = TenantLocal(lambda tenant: created.append(tenant) or {'tenant': tenant, 'count': 0})
+    counters.current()['count'] += 1
+    with tenant_scope('site_a'):
+        counters.current()['count'] += 2
+        assert counters.get('tenant') == 'site_a'          # attributes are the current tenant's instance's
+    assert CURRENT_TENANT.get() == DEFAULT_TENANT
+    assert counters.current()['count'] == 1
+    assert created == [DEFAULT_TENANT, 'site_a']
+    assert {tenant: counter['count'] for tenant, counter in counters.instances().items()} == \
+        {DEFAULT_TENANT: 1, 'site_a': 2}
+
+    monitor = CommandMonitor(verbose=False, tenant_func=CURRENT_TENANT.get)
+    for request_id, tenant in enumerate(['site_a', 'site_a', 'site_b']):
+        with tenant_scope(tenant):
+            monitor.started(types.SimpleNamespace(command_name='find', command={'find': 'readings', 'filter': {}},
+                                                  connection_id=('localhost', 27017), request_id=request_id))
+        monitor.succeeded(types.SimpleNamespace(command_name='find', duration_micros=1000,
+                                                connection_id=('localhost', 27017), request_id=request_id))
+    assert {operation['tenant']: operation['count'] for operation in monitor.report()['operations']} == \
+        {'site_a': 2, 'site_b': 1}
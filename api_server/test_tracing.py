@@ -0,0 +1,68 @@
+# test_tracing.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Unit tests for request tracing. Like test_admission.py, these do not need a
+running server. Run via:
+
+    pytest test_tracing.py
+"""
+
+import pytest
+from tracing import Tracer, traced, parse_traceparent, format_trace
+
+
+class MemoryExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span_dict):
+        self.spans.append(span_dict)
+
+    def close(self):
+        pass
+
+
+def test_spans_join_the_callers_trace_and_nest():
+    exporter = MemoryExporter()
+    tracer = Tracer('test', exporter)
+
+    @traced(tracer, attributes=('dev_id',))
+    def range_check(db, dev_id):
+        with tracer.span('find_readings'):
+            pass
+
+    with tracer.span('POST /readings/', traceparent='00-' + 'a' * 32 + '-' + 'b' * 16 + '-01'):
+        range_check(None, 'RazPi_01')
+
+    find, check, root = exporter.spans         # exported as they finish; innermost first
+    assert {span['trace_id'] for span in exporter.spans} == {'a' * 32}
+    assert root['parent_span_id'] == 'b' * 16
+    assert check['parent_span_id'] == root['span_id']
+    assert find['parent_span_id'] == check['span_id']
+    assert check['attributes'] == {'dev_id': 'RazPi_01'}
+    assert 'find_readings' in format_trace(exporter.spans).splitlines()[2]
+
+
+def test_errors_are_recorded_and_reraised():
+    exporter = MemoryExporter()
+    tracer = Tracer('test', exporter)
+    with pytest.raises(ValueError):
+        with tracer.span('send_email'):
+            raise ValueError('no route to host')
+    assert exporter.spans[0]['status'] == 'ERROR'
+    assert exporter.spans[0]['attributes']['error'] == 'ValueError: no route to host'
+
+
+def test_nothing_exported_when_off_or_not_sampled():
+    exporter = MemoryExporter()
+    tracer = Tracer('test')
+    with tracer.span('POST /readings/') as span:
+        span.set_attribute('dev_id', 'RazPi_01')
+
+    tracer.enable(exporter)
+    with tracer.span('POST /readings/', traceparent='00-' + 'a' * 32 + '-' + 'b' * 16 + '-00'):
+        with tracer.span('insert_reading'):
+            pass
+    assert exporter.spans == []
+    assert parse_traceparent('00-' + '0' * 32 + '-' + 'b' * 16 + '-01') is None
+    assert parse_traceparent('garbage') is None
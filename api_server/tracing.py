@@ -0,0 +1,329 @@
+# tracing.py
+# Wade J Lykkehoy (WadeLykkehoy@gmail.com)
+"""
+Lightweight request tracing, so client-observed latency can be tied to the server-side
+stages (DB calls, alert handlers, email sends) that caused it.
+
+Traces follow the W3C Trace Context spec: the client sends a 'traceparent' header,
+
+    00-<32 hex digit trace ID>-<16 hex digit parent span ID>-<2 hex digit flags>
+
+and the server's spans join that trace. Finished spans are written as JSON lines with
+the OpenTelemetry span fields (trace_id, span_id, parent_span_id, name, start / end time
+in Unix nanoseconds, attributes, status), to a file or the console. Each line also
+carries the process ID, so spans from several uvicorn workers can share one file and
+still be told apart; the file is opened for append and each span is a single write.
+
+The current span is kept in a contextvar, so nested spans find their parent without it
+being passed around; FastAPI copies the context into the threadpool thread that runs a
+sync endpoint. When tracing is off (the default) span() returns a do-nothing span, and
+the cost per traced call is one attribute check.
+
+Run as a script to print a trace from a span file as an indented tree, e.g. the trace of
+one of the slow POSTs reported by the client or fleet_sim.py:
+
+    python tracing.py <trace ID> traces.jsonl [<client span file>]
+"""
+
+import argparse
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+
+TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+CURRENT_SPAN = contextvars.ContextVar('current_span', default=None)
+
+
+def new_trace_id():
+    return os.urandom(16).hex()
+
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+
+def parse_traceparent(header):
+    """
+    Parse a W3C traceparent header.
+
+    Args:
+        header (str):     The header value; may be None
+
+    Returns:
+        (trace ID, parent span ID, sampled) tuple; None if the header is missing or invalid
+    """
+    if not header:
+        return None
+    match = TRACEPARENT_RE.match(header.strip().lower())
+    if match is None:
+        return None
+    trace_id, parent_span_id, flags = match.groups()
+    if (trace_id == '0' * 32) or (parent_span_id == '0' * 16):
+        return None         # all zeros is invalid per the spec
+    return trace_id, parent_span_id, bool(int(flags, 16) & 0x01)
+
+
+def format_traceparent(trace_id, span_id, sampled=True):
+    return '00-{}-{}-{}'.format(trace_id, span_id, '01' if sampled else '00')
+
+
+class Span:
+    """
+    One timed operation within a trace.
+    """
+
+    def __init__(self, name, trace_id, parent_span_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes)
+        self.status = 'OK'
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, description):
+        self.status = 'ERROR'
+        self.attributes['error'] = description
+
+    def traceparent(self):
+        return format_traceparent(self.trace_id, self.span_id)
+
+    def to_dict(self):
+        return {'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_span_id': self.parent_span_id,
+                'name': self.name,
+                'start_time_unix_nano': self.start_ns,
+                'end_time_unix_nano': self.end_ns,
+                'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+                'attributes': self.attributes,
+                'status': self.status}
+
+
+class NoopSpan:
+    """
+    Stands in for a Span when tracing is off, or the trace is not sampled.
+    """
+    trace_id = None
+    span_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, description):
+        pass
+
+    def traceparent(self):
+        return None
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class JsonLinesExporter:
+    """
+    Writes finished spans as JSON lines to a file (appended to) or, with no filename, stdout.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.file = open(filename, 'a', buffering=1) if filename else sys.stdout
+
+    def export(self, span_dict):
+        line = json.dumps(span_dict, default=str) + '\n'
+        with self.lock:
+            self.file.write(line)       # one write per span, so lines from several processes do not interleave
+            self.file.flush()
+
+    def close(self):
+        if self.filename:
+            self.file.close()
+
+
+class Tracer:
+    """
+    Creates spans and hands the finished ones to an exporter; see the module docstring.
+    """
+
+    def __init__(self, service_name, exporter=None):
+        """
+        Args:
+            service_name (str):   Recorded on every span; e.g. 'api_server'
+            exporter:             Object with an export(span_dict) method; None leaves tracing off
+        """
+        self.service_name = service_name
+        self.exporter = None
+        self.enabled = False
+        if exporter is not None:
+            self.enable(exporter)
+
+    def enable(self, exporter):
+        self.exporter = exporter
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self.exporter is not None:
+            self.exporter.close()
+        self.exporter = None
+
+    @contextlib.contextmanager
+    def span(self, name, traceparent=None, **attributes):
+        """
+        Context manager timing a span. The span's parent is the current span, or for a new root span,
+        the span given by traceparent; with neither, a new trace is started. An exception raised in the
+        with block marks the span as an error, and is re-raised.
+
+        Args:
+            name (str):           Name of the span; e.g. 'POST /readings/' or 'insert_reading'
+            traceparent (str):    W3C traceparent header of the caller; only used when there is no current span
+            attributes:           Initial span attributes
+
+        Yields:
+            The Span (a NoopSpan when tracing is off or the caller's trace is not sampled)
+        """
+        parent = CURRENT_SPAN.get()
+        if (not self.enabled) or (parent is NOOP_SPAN):
+            yield NOOP_SPAN
+            return
+
+        if parent is not None:
+            trace_id, parent_span_id = parent.trace_id, parent.span_id
+        else:
+            parsed = parse_traceparent(traceparent)
+            if parsed is None:
+                trace_id, parent_span_id = new_trace_id(), None
+            elif not parsed[2]:
+                # The caller did not sample this trace, so neither do we (including any child spans)
+                token = CURRENT_SPAN.set(NOOP_SPAN)
+                try:
+                    yield NOOP_SPAN
+                finally:
+                    CURRENT_SPAN.reset(token)
+                return
+            else:
+                trace_id, parent_span_id = parsed[0], parsed[1]
+
+        span = Span(name, trace_id, parent_span_id, attributes)
+        token = CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error('{}: {}'.format(type(e).__name__, e))
+            raise
+        finally:
+            CURRENT_SPAN.reset(token)
+            span.end_ns = time.time_ns()
+            self.finish(span)
+
+    def finish(self, span):
+        exporter = self.exporter
+        if exporter is None:
+            return
+        span_dict = span.to_dict()
+        span_dict['service'] = self.service_name
+        span_dict['pid'] = os.getpid()
+        try:
+            exporter.export(span_dict)
+        except Exception as e:
+            print('WARNING: failed to export span: {}'.format(e), flush=True)     # tracing must never break a request
+
+
+def current_span():
+    """
+    The current span; a NoopSpan if there is none.
+    """
+    span = CURRENT_SPAN.get()
+    return NOOP_SPAN if span is None else span
+
+
+def traced(tracer, attributes=()):
+    """
+    Decorator running a function in a span named after it; e.g. for the alert handlers.
+
+    Args:
+        tracer (Tracer):      The tracer to use
+        attributes (tuple):   Names of the function's arguments to record as span attributes (as strings)
+
+    Returns:
+        Decorator
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            arguments = signature.bind(*args, **kwargs).arguments
+            span_attributes = {name: str(arguments[name]) for name in attributes if name in arguments}
+            with tracer.span(func.__name__, **span_attributes):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_trace(spans):
+    """
+    Format a trace's spans as an indented tree, children in start time order.
+
+    Args:
+        spans (list):     Span dicts of the trace, as exported
+
+    Returns:
+        The tree as a string; one line per span with its duration and offset from the trace's start
+    """
+    span_ids = {span['span_id'] for span in spans}
+    children = {}
+    for span in spans:
+        parent = span['parent_span_id'] if span['parent_span_id'] in span_ids else None
+        children.setdefault(parent, []).append(span)
+    trace_start = min(span['start_time_unix_nano'] for span in spans)
+
+    lines = []
+
+    def add(span, depth):
+        lines.append('{:>10.3f}ms {:>10.3f}ms  {}{} [{}]{}'.format(
+            (span['start_time_unix_nano'] - trace_start) / 1e6, span['duration_ms'], '  ' * depth, span['name'],
+            span.get('service', ''), '' if span['status'] == 'OK' else ' ' + span['status']))
+        for child in sorted(children.get(span['span_id'], []), key=lambda child: child['start_time_unix_nano']):
+            add(child, depth + 1)
+
+    for root in sorted(children.get(None, []), key=lambda root: root['start_time_unix_nano']):
+        add(root, 0)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    my_parser = argparse.ArgumentParser(description='Print one trace from span files as a tree')
+    my_parser.add_argument('trace_id')
+    my_parser.add_argument('span_files', nargs='+', help='JSON lines span files; e.g. the server\'s and the client\'s')
+    args = my_parser.parse_args()
+
+    trace_spans = []
+    for span_file in args.span_files:
+        with open(span_file) as f:
+            for line in f:
+                if args.trace_id in line:
+                    span = json.loads(line)
+                    if span['trace_id'] == args.trace_id:
+                        trace_spans.append(span)
+    if trace_spans:
+        print('     start   duration  span')
+        print(format_trace(trace_spans))
+    else:
+        print('No spans found for trace {}'.format(args.trace_id))
@@ -0,0 +1,254 @@
+# fleet_sim.py
+# Wade J Lykkehoy (wlykkehoy@gmail.com)
+"""
+Fleet simulator for soak-testing the server. Runs thousands of virtual clients in
+a single asyncio process, each with its own device ID and its own simulated sensor
+(see sensors.py) with drift, noise and faults. Each virtual client runs the real
+client's per-tick and per-upload logic (razpi_client.Sampler and UploadTracker), only
+with asyncio waits and aiohttp POSTs: it samples on fixed ticks and uploads separately,
+resends a reading after backing off when the server says to (429 + Retry-After),
+optionally only sends readings that changed (--deadband), and gives up when its most
+recent POSTs have all failed.
+
+Uses aiohttp for the HTTP requests (pip install aiohttp). It is run as follows:
+
+    python3 fleet_sim.py [-v] [options]
+
+Examples:
+
+    python3 fleet_sim.py --num-clients 2000 --delay 30 --duration 600
+    python3 fleet_sim.py --num-clients 2000 --delay 30 --deadband
+    python3 fleet_sim.py --num-clients 500 --fault-rate 0.01 --drift 0.5 --url http://localhost:8000/readings/
+"""
+
+import argparse
+import asyncio
+import collections
+import heapq
+import random
+import time
+import aiohttp
+from razpi_client import CONFIG_DATA, Sampler, UploadTracker, get_retry_after_secs, put_reading
+from sensors import SimulatedDriver, SensorReadError
+
+
+class FleetStats:
+    """
+    Counters shared by all the virtual clients.
+    """
+
+    def __init__(self):
+        self.num_sent = 0
+        self.num_ok = 0
+        self.num_throttled = 0          # 429 responses
+        self.num_failed = 0             # other non-200 responses and connection errors
+        self.num_sensor_errors = 0
+        self.num_missed = 0             # sampling ticks missed
+        self.num_dropped = 0            # readings dropped from a full upload queue
+        self.num_bailed = 0             # virtual clients that gave up
+        self.latencies = collections.deque(maxlen=100000)      # most recent POST latencies, in seconds
+        self.slowest = []               # min-heap of (latency, trace ID) of the slowest POSTs
+
+    def record_latency(self, latency, trace_id, num_slowest=5):
+        self.latencies.append(latency)
+        if len(self.slowest) < num_slowest:
+            heapq.heappush(self.slowest, (latency, trace_id))
+        elif latency > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (latency, trace_id))
+
+    def slowest_report(self):
+        return 'Slowest POSTs (look up the trace IDs in the server\'s trace file): ' + \
+            ', '.join('{:.0f}ms {}'.format(latency * 1000, trace_id) for latency, trace_id in sorted(self.slowest, reverse=True))
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))] * 1000 if latencies else 0
+
+        return ('{:.0f}s: sent={} ok={} throttled={} failed={} sensor_errors={} missed={} dropped={} bailed={} '
+                'rate={:.1f}/s latency_ms p50={:.0f} p95={:.0f} p99={:.0f}').format(
+                    elapsed, self.num_sent, self.num_ok, self.num_throttled, self.num_failed,
+                    self.num_sensor_errors, self.num_missed, self.num_dropped, self.num_bailed, self.num_sent / max(elapsed, 1e-6),
+                    percentile(50), percentile(95), percentile(99))
+
+
+async def sample_virtual_sensor(sensor, device_id, readings_queue, delay, deadband, stats):
+    """
+    Sampling loop of one virtual client; razpi_client.sample_sensor() with asyncio waits. The same
+    razpi_client.Sampler takes each tick's reading and works out the next tick, and the readings are
+    queued with razpi_client.put_reading().
+
+    Args:
+        sensor (SensorDriver):    Sensor to take readings from
+        device_id (str):          ID of this virtual device
+        readings_queue (Queue):   asyncio Queue the packaged readings are put on
+        delay (float):            Seconds between readings
+        deadband (bool):          If True, readings are run through a DeadbandFilter before being queued
+        stats (FleetStats):       Counters to update
+
+    Returns:
+        None; runs until cancelled
+    """
+    # Stagger the start so the fleet does not sample in lock step
+    await asyncio.sleep(random.uniform(0, delay))
+    sampler = Sampler(sensor, device_id, delay, deadband)
+    while True:
+        try:
+            messages = sampler.sample()
+        except SensorReadError:
+            stats.num_sensor_errors += 1
+        else:
+            for message in messages:
+                stats.num_dropped += put_reading(readings_queue, message)
+        wait_secs, num_missed = sampler.advance()
+        stats.num_missed += num_missed
+        await asyncio.sleep(wait_secs)
+
+
+async def upload_virtual_readings(session, url, device_id, readings_queue, stats, verbose):
+    """
+    Upload loop of one virtual client; razpi_client.upload_readings() with aiohttp POSTs and asyncio
+    waits. The same razpi_client.UploadTracker traces each reading, decides when to resend it after
+    a 429 and when to give up.
+
+    Args:
+        session:                  aiohttp ClientSession to POST with
+        url (str):                URL to POST readings to
+        device_id (str):          ID of this virtual device
+        readings_queue (Queue):   asyncio Queue of readings waiting to be uploaded
+        stats (FleetStats):       Counters to update
+        verbose (bool):           If True, each POST is echoed
+
+    Returns:
+        None; returns when the client gives up
+    """
+    tracker = UploadTracker()
+    while True:
+        if tracker.packaged_data is None:
+            tracker.start(await readings_queue.get())
+
+        packaged_data = tracker.packaged_data
+        _, traceparent = tracker.new_span()
+        start_time = time.monotonic()
+        retry_after = 0
+        try:
+            async with session.post(url, json=packaged_data, headers={'traceparent': traceparent}) as response:
+                status = response.status
+                if status == 429:
+                    retry_after = get_retry_after_secs(response)
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            status = None
+        stats.record_latency(time.monotonic() - start_time, tracker.trace_id)
+        stats.num_sent += 1
+        if verbose:
+            print('{} => {} <= {}'.format(device_id, packaged_data, status), flush=True)
+
+        retry_after = tracker.post_done(status, retry_after)
+        if retry_after is not None:
+            stats.num_throttled += 1
+            await asyncio.sleep(retry_after)
+            continue
+
+        if status == 200:
+            stats.num_ok += 1
+        else:
+            stats.num_failed += 1
+        if tracker.should_bail():
+            stats.num_bailed += 1
+            print('ERROR: {}: the most recent {} POSTs have failed; giving up'.format(
+                device_id, CONFIG_DATA['num_recent_post_status_codes_to_look_at']), flush=True)
+            return
+
+
+async def run_virtual_client(session, url, device_id, sensor, delay, deadband, stats, verbose):
+    """
+    One virtual client; razpi_client.main()'s sampling and upload loops, but asynchronous.
+
+    Args:
+        session:                  aiohttp ClientSession to POST with
+        url (str):                URL to POST readings to
+        device_id (str):          ID of this virtual device
+        sensor (SensorDriver):    Sensor to take readings from
+        delay (float):            Seconds between readings
+        deadband (bool):          If True, only send readings that changed, plus periodic heartbeats
+        stats (FleetStats):       Counters to update
+        verbose (bool):           If True, each POST is echoed
+
+    Returns:
+        None; returns when the client gives up
+    """
+    readings_queue = asyncio.Queue(maxsize=CONFIG_DATA['max_queued_readings'])
+    sampler = asyncio.ensure_future(sample_virtual_sensor(sensor, device_id, readings_queue, delay, deadband, stats))
+    try:
+        await upload_virtual_readings(session, url, device_id, readings_queue, stats, verbose)
+    finally:
+        sampler.cancel()
+        await asyncio.gather(sampler, return_exceptions=True)
+
+
+async def run_fleet(args):
+    """
+    Run the fleet until the duration expires or every virtual client has given up.
+    """
+    stats = FleetStats()
+    connector = aiohttp.TCPConnector(limit=args.max_connections)
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    start_time = time.monotonic()
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        clients = []
+        for i in range(args.num_clients):
+            seed = None if args.seed is None else args.seed + i
+            sensor = SimulatedDriver(drift_per_hour=args.drift, noise_std=args.noise, fault_rate=args.fault_rate,
+                                     seed=seed)
+            device_id = '{}_{:05d}'.format(args.device_prefix, i)
+            clients.append(asyncio.ensure_future(run_virtual_client(session, args.url, device_id, sensor,
+                                                                    args.delay, args.deadband, stats, args.v)))
+
+        # Periodic progress reports until done
+        deadline = start_time + args.duration if args.duration > 0 else None
+        try:
+            while not all(client.done() for client in clients):
+                if (deadline is not None) and (time.monotonic() >= deadline):
+                    break
+                await asyncio.sleep(args.report_interval)
+                print(stats.report(time.monotonic() - start_time), flush=True)
+        finally:
+            for client in clients:
+                client.cancel()
+            await asyncio.gather(*clients, return_exceptions=True)
+
+    print('Final: ' + stats.report(time.monotonic() - start_time), flush=True)
+    if stats.slowest:
+        print(stats.slowest_report(), flush=True)
+
+
+if __name__ == '__main__':
+    # Pull off command line args
+    my_parser = argparse.ArgumentParser(description='Run a fleet of simulated clients against the server')
+    my_parser.add_argument('-v', action='store_true', help='verbose mode; echoes every message')
+    my_parser.add_argument('--num-clients', type=int, default=1000)
+    my_parser.add_argument('--delay', type=float, default=CONFIG_DATA['delay_between_readings'],
+                           help='seconds between readings for each client')
+    my_parser.add_argument('--deadband', action='store_true',
+                           help='only send readings that changed, plus periodic heartbeats')
+    my_parser.add_argument('--duration', type=float, default=0, help='seconds to run; 0 runs until Ctrl-C')
+    my_parser.add_argument('--url', default=CONFIG_DATA['post_readings_url'])
+    my_parser.add_argument('--device-prefix', default='fleet_sim', help='virtual device IDs are <prefix>_<n>')
+    my_parser.add_argument('--drift', type=float, default=0.0, help='sensor drift per hour')
+    my_parser.add_argument('--noise', type=float, default=0.3, help='sensor noise std deviation')
+    my_parser.add_argument('--fault-rate', type=float, default=0.0, help='probability of a sensor fault per read')
+    my_parser.add_argument('--seed', type=int, help='random seed for repeatable runs')
+    my_parser.add_argument('--max-connections', type=int, default=200, help='max concurrent HTTP connections')
+    my_parser.add_argument('--request-timeout', type=float, default=30)
+    my_parser.add_argument('--report-interval', type=float, default=10)
+    args = my_parser.parse_args()
+
+    print('Fleet of {} clients started, press Ctrl-C to stop...'.format(args.num_clients), flush=True)
+    try:
+        asyncio.run(run_fleet(args))
+    except KeyboardInterrupt:
+        print('... Ctrl-C detected, ending ...', flush=True)
+    print('Fleet stopped', flush=True)
@@ -4,32 +4,63 @@
 This is the client-side code which runs on the Raspberry Pi. It is run
 as follows:
 
-  python3 razpi_client.py [-v]
+  python3 razpi_client.py [-v] [--simulate] [--deadband] [--device-id <id>] [--trace-log <file>]
   
 The -v option is for 'verbose' behavior; it prints messages prior to
 sending on to the RESTful API and prints return status info.
+
+The --simulate option uses simulated sensors (see sensors.py) in place of the
+real ones, so the client can be run on any machine. To run a whole fleet of
+simulated clients, see fleet_sim.py.
+
+Each sensor listed in CONFIG_DATA is sampled on its own thread on fixed ticks
+of the monotonic clock; readings are queued and uploaded separately, so a slow
+server delays uploads but never the readings themselves.
+
+The --deadband option only sends a reading when it changes (see DeadbandFilter),
+with periodic heartbeats in between; much less traffic for a steady sensor.
+
+Each POST carries a W3C traceparent header, so the server's trace of the request
+(when tracing is enabled there) can be matched to the client's view of it; the
+--trace-log option records the client's side.
 """
 
 import argparse
+import asyncio
 import datetime
+import json
+import os
+import queue
+import threading
 import time
-import board
-import busio
-import adafruit_si7021
 import requests
 import collections
+from sensors import make_driver, SensorReadError
 
 
 # Some configuration data
 # TODO: find a better way to deal with this info
 CONFIG_DATA = {
-    'device_id': 'RazPi_01',                      # name for the device; used in messages
+    'sensors': [                                  # sensors on this Pi; each reports under its own device ID
+        {'device_id': 'RazPi_01', 'driver': 'si7021'}
+    ],
     'delay_between_readings': 5,                  # delay in seconds between sensor readings; 900 = 15min
     'num_recent_post_status_codes_to_look_at': 4, # we might expect a failed POST periodically,
                                                   #  thus will look at this many most-recent POST reqeust
                                                   #   status codes to determine if there is an issue and
                                                   #   should bail
-    'post_readings_url': 'http://192.168.86.183:8000/readings/'
+    'post_readings_url': 'http://192.168.86.183:8000/readings/',
+    'post_timeout': 30,                           # seconds to wait on a POST before counting it as failed
+    'max_queued_readings': 10000,                 # readings held while the server is unreachable; oldest
+                                                  #  are dropped beyond this
+    'deadband_temp_delta': 0,                     # deadband mode (--deadband): only send a reading when temp
+    'deadband_humidity_delta': 0,                 #  or humidity changes by more than these deltas, ...
+    'deadband_heartbeat_interval': 3600,          #  or this many seconds have passed since the last send; the
+                                                  #   server's device_heartbeat_minutes, under half its offline timeout
+    'deadband_settle_readings': 4,                # readings always sent after a change; keep at least the server's
+                                                  #  num_continuous_readings_to_check so alerts are not delayed
+    'trace_log_file': None                        # if set, a span per POST is appended here (JSON lines), to match
+                                                  #  up with the server's spans via the trace ID; see --trace-log
 }
 
 TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
@@ -49,60 +80,463 @@ def c_to_f(temp_c):
     return temp_f
 
 
-def main(verbose):
+def get_retry_after_secs(response):
     """
-    Main loop of the app & where all the fun happens.
+    Utility function to pull the number of seconds to back off from a response's Retry-After
+    header. We only expect the 'number of seconds' form of the header from our server.
 
     Args:
-        verbose (bool): If True, a lot of info is printed during execution.
-    """
-    recent_post_status_codes_ok = collections.deque([True] * CONFIG_DATA['num_recent_post_status_codes_to_look_at'],
-                                                    maxlen=CONFIG_DATA['num_recent_post_status_codes_to_look_at'])
-        
-    # Our interface objects to the Adafruit SI7021 temp & humidity sensor
-    i2c = busio.I2C(board.SCL, board.SDA)
-    sensor = adafruit_si7021.SI7021(i2c)
+        response:   Response object from the requests library
 
+    Returns:
+        Number of seconds to wait; 0 if the header is missing or not understood
+    """
     try:
-        while True:      # Only way to exit is user hitting Ctrl-C
-            temp_c = sensor.temperature
-            temp_f = int(round(c_to_f(temp_c), 0))                  # only want integer portion
-            humidity = int(round(sensor.relative_humidity, 0))     # only want integer portion
-            now = datetime.datetime.now()
-            timestamp = now.strftime(TIMESTAMP_FORMAT)
-            
-            # Package up the data to send to the RESTful API
-            packaged_data = {'dev_id': CONFIG_DATA['device_id'],
-                             'ts': timestamp,
-                             'temp':  temp_f,
-                             'humidity': humidity}
-            if verbose:
-                print('Sending Message...\n  =>Data :{}'.format(packaged_data), flush=True)
-            response = requests.post(CONFIG_DATA['post_readings_url'], json=packaged_data)
+        return max(0, int(response.headers.get('Retry-After', 0)))
+    except ValueError:
+        return 0
+
+
+def new_traceparent(trace_id=None):
+    """
+    Utility function to start a span for a POST, as a W3C traceparent header value. The server's
+    spans for the request join the trace, so where the time went can be followed from the client.
+
+    Args:
+        trace_id (str):   Trace to add the span to; None starts a new trace
+
+    Returns:
+        (trace ID, span ID, traceparent header value) tuple
+    """
+    trace_id = os.urandom(16).hex() if trace_id is None else trace_id
+    span_id = os.urandom(8).hex()
+    return trace_id, span_id, '00-{}-{}-01'.format(trace_id, span_id)
+
+
+def log_client_span(trace_id, span_id, device_id, start_ns, end_ns, status_code):
+    """
+    Utility function to append a POST's span to the trace log file, in the same JSON lines
+    format as the server's spans (see api_server/tracing.py).
+
+    Args:
+        trace_id (str):       Trace ID
+        span_id (str):        Span ID
+        device_id (str):      ID of the device the reading is from
+        start_ns (int):       Start time, in Unix nanoseconds
+        end_ns (int):         End time, in Unix nanoseconds
+        status_code (int):    HTTP status code; None if the POST failed outright
+
+    Returns:
+        None
+    """
+    span = {'trace_id': trace_id,
+            'span_id': span_id,
+            'parent_span_id': None,
+            'name': 'client POST /readings/',
+            'start_time_unix_nano': start_ns,
+            'end_time_unix_nano': end_ns,
+            'duration_ms': round((end_ns - start_ns) / 1e6, 3),
+            'attributes': {'dev_id': device_id, 'status_code': status_code},
+            'status': 'OK' if status_code == 200 else 'ERROR',
+            'service': 'razpi_client',
+            'pid': os.getpid()}
+    with open(CONFIG_DATA['trace_log_file'], 'a') as trace_log:
+        trace_log.write(json.dumps(span) + '\n')
+
+
+def package_reading(device_id, temp_c, humidity):
+    """
+    Package up a sensor reading into the message body the RESTful API expects.
+
+    Args:
+        device_id (str):      ID of the device the reading is from
+        temp_c (float):       Temperature in Celsius
+        humidity (float):     Relative humidity percentage
+
+    Returns:
+        Dict with the message content
+    """
+    return {'dev_id': device_id,
+            'ts': datetime.datetime.now().strftime(TIMESTAMP_FORMAT),
+            'temp': int(round(c_to_f(temp_c), 0)),         # only want integer portion
+            'humidity': int(round(humidity, 0))}            # only want integer portion
+
+
+class DeadbandFilter:
+    """
+    Edge-side filter for deadband mode. Our sensors often report the same integer temp and humidity
+    for hours, so rather than sending every reading, a reading is only sent when a value changes by
+    more than a delta, or when the heartbeat interval expires. Suppressed readings are not lost to
+    the server: the next heartbeat repeats the last sent values with a repeat_count of the number of
+    readings it stands for, and the server counts it as that many readings.
+
+    To keep alerts as timely as they are without the filter, the first few readings after a change
+    are always sent.
+    """
+
+    def __init__(self, temp_delta, humidity_delta, heartbeat_interval, settle_readings, clock=time.monotonic):
+        """
+        Args:
+            temp_delta (int):               Send when temp changes by more than this
+            humidity_delta (int):           Send when humidity changes by more than this
+            heartbeat_interval (float):     Send a heartbeat when this many seconds pass without a send
+            settle_readings (int):          Number of readings always sent after a change
+            clock:                          Function returning the current time in seconds
+        """
+        self.temp_delta = temp_delta
+        self.humidity_delta = humidity_delta
+        self.heartbeat_interval = heartbeat_interval
+        self.settle_readings = settle_readings
+        self.clock = clock
+
+        self.last_sent = None               # last reading sent
+        self.last_sent_time = None
+        self.readings_since_change = 0
+        self.num_suppressed = 0             # readings suppressed since the last send
+        self.last_suppressed_ts = None
+
+    def heartbeat(self, ts, repeat_count):
+        return {'dev_id': self.last_sent['dev_id'],
+                'ts': ts,
+                'temp': self.last_sent['temp'],
+                'humidity': self.last_sent['humidity'],
+                'repeat_count': repeat_count,
+                'heartbeat': True}
+
+    def filter(self, packaged_data):
+        """
+        Run a reading through the filter.
+
+        Args:
+            packaged_data (dict):     The reading, as packaged by package_reading()
+
+        Returns:
+            List of messages to send; empty if the reading was suppressed
+        """
+        now = self.clock()
+        changed = (self.last_sent is None) or \
+                  (abs(packaged_data['temp'] - self.last_sent['temp']) > self.temp_delta) or \
+                  (abs(packaged_data['humidity'] - self.last_sent['humidity']) > self.humidity_delta)
+
+        messages = []
+        if changed or (self.readings_since_change < self.settle_readings):
+            # Account for any suppressed readings before moving on to the new value
+            if self.num_suppressed > 0:
+                messages.append(self.heartbeat(self.last_suppressed_ts, self.num_suppressed))
+            if changed:
+                self.readings_since_change = 0
+            messages.append(packaged_data)
+            self.last_sent = packaged_data
+            self.num_suppressed = 0
+        elif now - self.last_sent_time >= self.heartbeat_interval:
+            messages.append(self.heartbeat(packaged_data['ts'], self.num_suppressed + 1))
+            self.num_suppressed = 0
+        else:
+            self.num_suppressed += 1
+            self.last_suppressed_ts = packaged_data['ts']
+
+        self.readings_since_change += 1
+        if messages:
+            self.last_sent_time = now
+        return messages
+
+
+def make_deadband_filter():
+    """
+    Create a DeadbandFilter with the deltas and intervals in CONFIG_DATA.
+
+    Returns:
+        DeadbandFilter
+    """
+    return DeadbandFilter(CONFIG_DATA['deadband_temp_delta'], CONFIG_DATA['deadband_humidity_delta'],
+                          CONFIG_DATA['deadband_heartbeat_interval'], CONFIG_DATA['deadband_settle_readings'])
+
+
+def next_sample_tick(next_tick, period, now):
+    """
+    Advance a sampling schedule by one period. Ticks are fixed points of the monotonic clock, so
+    the schedule does not drift with how long a reading takes; ticks already overrun are skipped
+    rather than taken in a burst.
+
+    Args:
+        next_tick (float):    Tick just taken
+        period (float):       Seconds between ticks
+        now (float):          Current monotonic time
+
+    Returns:
+        (next tick, number of ticks missed) tuple
+    """
+    next_tick += period
+    num_missed = 0
+    if next_tick <= now:
+        num_missed = int((now - next_tick) // period) + 1
+        next_tick += num_missed * period
+    return next_tick, num_missed
+
+
+def put_reading(readings_queue, packaged_data):
+    """
+    Queue a reading for upload. If the queue is full (the server has been unreachable for
+    a while), the oldest reading is dropped to make room; the most recent readings matter most.
+
+    Args:
+        readings_queue (Queue):   Queue of readings waiting to be uploaded; a queue.Queue or an asyncio.Queue
+        packaged_data (dict):     Reading to queue
+
+    Returns:
+        Number of readings dropped
+    """
+    num_dropped = 0
+    while True:
+        try:
+            readings_queue.put_nowait(packaged_data)
+            return num_dropped
+        except (queue.Full, asyncio.QueueFull):
+            try:
+                readings_queue.get_nowait()
+                num_dropped += 1
+            except (queue.Empty, asyncio.QueueEmpty):
+                pass
+
+
+class Sampler:
+    """
+    Per-tick logic of a sensor's sampling loop: take a reading, run it through the deadband filter
+    (if any), and work out when the next tick is. Shared by sample_sensor() and the fleet simulator's
+    virtual clients (see fleet_sim.py), which differ only in how they wait and what they report.
+    """
+
+    def __init__(self, sensor, device_id, period, deadband=False, verbose=False):
+        """
+        Args:
+            sensor (SensorDriver):    Sensor to take readings from
+            device_id (str):          ID used in messages for this sensor's readings
+            period (float):           Seconds between readings
+            deadband (bool):          If True, readings are run through a DeadbandFilter
+            verbose (bool):           If True, each reading is printed
+        """
+        self.sensor = sensor
+        self.device_id = device_id
+        self.period = period
+        self.deadband_filter = make_deadband_filter() if deadband else None
+        self.verbose = verbose
+        self.next_tick = time.monotonic()
+
+    def sample(self):
+        """
+        Take this tick's reading.
+
+        Returns:
+            List of messages to queue; empty if the deadband filter suppressed the reading
+
+        Raises:
+            SensorReadError:  If the sensor could not be read; the reading is skipped, not the schedule
+        """
+        temp_c, humidity = self.sensor.read()
+        packaged_data = package_reading(self.device_id, temp_c, humidity)
+        if self.verbose:
+            print('Reading taken\n  Data:{}'.format(packaged_data), flush=True)
+        return [packaged_data] if self.deadband_filter is None else self.deadband_filter.filter(packaged_data)
+
+    def advance(self):
+        """
+        Move on to the next tick; see next_sample_tick().
+
+        Returns:
+            (seconds until the next tick, number of ticks missed) tuple
+        """
+        now = time.monotonic()
+        self.next_tick, num_missed = next_sample_tick(self.next_tick, self.period, now)
+        return self.next_tick - now, num_missed
+
+
+def sample_sensor(sensor, device_id, readings_queue, stop_event, verbose, deadband=False):
+    """
+    Sampling loop for one sensor; runs on its own thread. Readings are taken on fixed ticks
+    of the monotonic clock, so the sampling period does not drift with how long a read (or
+    an upload) takes. If a tick is overrun, the missed ticks are skipped rather than taken
+    in a burst.
+
+    Args:
+        sensor (SensorDriver):    Sensor to take readings from
+        device_id (str):          ID used in messages for this sensor's readings
+        readings_queue (Queue):   Queue the packaged readings are put on
+        stop_event (Event):       Set to stop sampling
+        verbose (bool):           If True, each reading is printed
+        deadband (bool):          If True, readings are run through a DeadbandFilter before being queued
+    """
+    sampler = Sampler(sensor, device_id, CONFIG_DATA['delay_between_readings'], deadband, verbose)
+    while not stop_event.is_set():
+        try:
+            messages = sampler.sample()
+        except SensorReadError as e:
+            # Skip this reading; a sensor hiccup is not a reason to stop
+            print('WARNING: Unable to read sensor {}: {}'.format(device_id, e), flush=True)
+        else:
+            for message in messages:
+                put_reading(readings_queue, message)
+
+        wait_secs, num_missed = sampler.advance()
+        if num_missed > 0:
+            print('WARNING: Sensor {} missed {} reading(s)'.format(device_id, num_missed), flush=True)
+        stop_event.wait(wait_secs)
+
+
+class UploadTracker:
+    """
+    Per-POST logic of an upload loop: the reading being uploaded and its trace, resending it after
+    a 429, and the most recent POST outcomes that decide when to give up. Shared by upload_readings()
+    and the fleet simulator's virtual clients (see fleet_sim.py), which differ only in how they POST
+    and wait.
+    """
+
+    def __init__(self):
+        num_to_look_at = CONFIG_DATA['num_recent_post_status_codes_to_look_at']
+        self.recent_post_status_codes_ok = collections.deque([True] * num_to_look_at, maxlen=num_to_look_at)
+        self.packaged_data = None           # reading being uploaded; None when the next is to be taken off the queue
+        self.trace_id = None
+
+    def start(self, packaged_data):
+        self.packaged_data = packaged_data
+        self.trace_id = None
+
+    def new_span(self):
+        """
+        Start a span for a POST of the reading. One trace per reading; a resend after a 429 is another
+        span in the same trace.
+
+        Returns:
+            (span ID, traceparent header value) tuple
+        """
+        self.trace_id, span_id, traceparent = new_traceparent(self.trace_id)
+        return span_id, traceparent
+
+    def post_done(self, status_code, retry_after_secs=0):
+        """
+        Record how a POST of the reading went. A 429 means the server is busy (or we are sending too
+        fast) and it tells us how long to back off; this is not a failure, so it does not count toward
+        giving up, and the reading is resent.
+
+        Args:
+            status_code (int):        HTTP status code; None if the POST failed outright
+            retry_after_secs (int):   Seconds to back off from a 429's Retry-After header; see get_retry_after_secs()
+
+        Returns:
+            Seconds to back off before resending the reading; None if the reading is done with
+        """
+        if status_code == 429:
+            return max(1, retry_after_secs)
+        self.packaged_data = None
+        self.recent_post_status_codes_ok.append(status_code == 200)
+        return None
+
+    def should_bail(self):
+        """
+        Returns:
+            True if none of the most recent POSTs succeeded
+        """
+        return not any(self.recent_post_status_codes_ok)
+
+
+def upload_readings(readings_queue, stop_event, verbose):
+    """
+    Upload loop; POSTs queued readings to the RESTful API in the order they were taken. Runs
+    independently of the sampling, so a slow or busy server only delays uploads, not readings.
+
+    Args:
+        readings_queue (Queue):   Queue of readings waiting to be uploaded
+        stop_event (Event):       Set to stop uploading; also set here if we bail
+        verbose (bool):           If True, a lot of info is printed during execution.
+    """
+    tracker = UploadTracker()
+    while not stop_event.is_set():
+        if tracker.packaged_data is None:
+            try:
+                tracker.start(readings_queue.get(timeout=1.0))
+            except queue.Empty:
+                continue
+
+        packaged_data = tracker.packaged_data
+        span_id, traceparent = tracker.new_span()
+        if verbose:
+            print('Sending Message...\n  =>Data :{}\n  =>Trace:{}'.format(packaged_data, tracker.trace_id), flush=True)
+        start_ns = time.time_ns()
+        try:
+            response = requests.post(CONFIG_DATA['post_readings_url'], json=packaged_data,
+                                     headers={'traceparent': traceparent},
+                                     timeout=CONFIG_DATA['post_timeout'])
+            status_code = response.status_code
+        except requests.RequestException as e:
+            response = None
+            status_code = None
+            print('WARNING: POST failed: {}'.format(e), flush=True)
+        if CONFIG_DATA['trace_log_file'] is not None:
+            log_client_span(tracker.trace_id, span_id, packaged_data['dev_id'], start_ns, time.time_ns(), status_code)
+        if verbose and (response is not None):
+            print('  <=Status:{}\n    Content:{}'.format(status_code, response.content), flush=True)
+
+        retry_after = tracker.post_done(status_code, get_retry_after_secs(response) if status_code == 429 else 0)
+        if retry_after is not None:
             if verbose:
-                print('  <=Status:{}\n    Content:{}'.format(response.status_code, response.content), flush=True)
-
-            # Keep track of the most recent status codes; if none were successful, bail
-            recent_post_status_codes_ok.append(response.status_code == 200)
-            if not any(recent_post_status_codes_ok):
-                print('ERROR: The most recent {} POSTs have failed; halting execution'.format(CONFIG_DATA['num_recent_post_status_codes_to_look_at']))
-                break
-           
-            # A delay before sending the next reading
-            time.sleep(CONFIG_DATA['delay_between_readings'])
-            
+                print('  Server busy; waiting {} seconds before resending'.format(retry_after), flush=True)
+            stop_event.wait(retry_after)
+            continue
+
+        # If none of the most recent POSTs were successful, bail
+        if tracker.should_bail():
+            print('ERROR: The most recent {} POSTs have failed; halting execution'.format(CONFIG_DATA['num_recent_post_status_codes_to_look_at']))
+            stop_event.set()
+
+
+def main(verbose, sensors, deadband=False):
+    """
+    Main loop of the app & where all the fun happens. Each sensor is sampled on its own
+    thread; the readings are queued and uploaded from this thread.
+
+    Args:
+        verbose (bool):       If True, a lot of info is printed during execution.
+        sensors (list):       List of (device ID, SensorDriver) tuples; one per sensor on this Pi
+        deadband (bool):      If True, only send readings that changed, plus periodic heartbeats
+    """
+    readings_queue = queue.Queue(maxsize=CONFIG_DATA['max_queued_readings'])
+    stop_event = threading.Event()
+    samplers = [threading.Thread(target=sample_sensor, args=(sensor, device_id, readings_queue, stop_event, verbose, deadband),
+                                 name='sampler_{}'.format(device_id), daemon=True)
+                for device_id, sensor in sensors]
+    for sampler in samplers:
+        sampler.start()
+
+    try:
+        upload_readings(readings_queue, stop_event, verbose)
     except KeyboardInterrupt:
         # Just fall back to main
         print('... Ctrl-C detected, ending ...', flush=True)
+    finally:
+        stop_event.set()
+        for sampler in samplers:
+            sampler.join()
         
 
 if __name__ == '__main__':
     # Pull off command line args
     my_parser = argparse.ArgumentParser()
     my_parser.add_argument('-v', action='store_true', help='verboase mode; echoes message contents')
+    my_parser.add_argument('--simulate', action='store_true', help='use simulated sensors in place of the real ones')
+    my_parser.add_argument('--deadband', action='store_true',
+                           help='only send readings that changed, plus periodic heartbeats')
+    my_parser.add_argument('--device-id', help='ID of this device; overrides the configured sensor list with one sensor')
+    my_parser.add_argument('--trace-log', help='append a span per POST to this file, for request tracing')
     args = my_parser.parse_args()
     verbose = args.v
+    if args.trace_log is not None:
+        CONFIG_DATA['trace_log_file'] = args.trace_log
+
+    sensor_configs = CONFIG_DATA['sensors']
+    if args.device_id is not None:
+        sensor_configs = [{'device_id': args.device_id, 'driver': sensor_configs[0]['driver']}]
+    sensors = [(sensor_config['device_id'], make_driver('simulated' if args.simulate else sensor_config['driver']))
+               for sensor_config in sensor_configs]
 
     print('Client started, press Ctrl-C to stop...', flush=True)
-    main(verbose)
+    main(verbose, sensors, args.deadband)
     print('Client stopped', flush=True)
@@ -0,0 +1,151 @@
+# sensors.py
+# Wade J Lykkehoy (wlykkehoy@gmail.com)
+"""
+Sensor drivers for the client. The client only talks to a SensorDriver, so it can
+run against the real Adafruit SI7021 on a Raspberry Pi or against a simulated
+sensor anywhere (e.g. for soak-testing the server from a Linux box).
+
+The Adafruit libraries are only imported when an SI7021Driver is created, so
+nothing here needs the Pi hardware unless that driver is used.
+"""
+
+import abc
+import math
+import random
+import time
+
+
+class SensorReadError(Exception):
+    """
+    Raised when the sensor could not be read.
+    """
+    pass
+
+
+class SensorDriver(abc.ABC):
+    """
+    Interface for a temperature & humidity sensor.
+    """
+
+    @abc.abstractmethod
+    def read(self):
+        """
+        Take a reading.
+
+        Returns:
+            Tuple of (temperature in Celsius, relative humidity as a percentage)
+
+        Raises:
+            SensorReadError if the sensor could not be read
+        """
+
+
+class SI7021Driver(SensorDriver):
+    """
+    Adafruit SI7021 temperature & humidity sensor on the Pi's I2C bus.
+    """
+
+    def __init__(self):
+        # Imported here as these are only available on the Pi
+        import board
+        import busio
+        import adafruit_si7021
+
+        i2c = busio.I2C(board.SCL, board.SDA)
+        self.sensor = adafruit_si7021.SI7021(i2c)
+
+    def read(self):
+        try:
+            return self.sensor.temperature, self.sensor.relative_humidity
+        except (OSError, RuntimeError) as e:
+            raise SensorReadError(str(e))
+
+
+class SimulatedDriver(SensorDriver):
+    """
+    Simulated sensor producing realistic looking readings: a daily temperature cycle, slow drift,
+    random noise, and the occasional fault. Faults come in three kinds:
+
+        'spike'   - a single wildly out of range reading
+        'stuck'   - the sensor repeats the same reading for a while
+        'dropout' - the sensor fails to read for a while (read() raises SensorReadError)
+    """
+
+    def __init__(self, base_temp_c=19.5, base_humidity=45.0, daily_temp_amplitude_c=1.5,
+                 drift_per_hour=0.0, noise_std=0.3, fault_rate=0.0, fault_duration=4,
+                 seed=None, clock=time.time):
+        """
+        Args:
+            base_temp_c (float):              Temperature the readings center on
+            base_humidity (float):            Humidity the readings center on
+            daily_temp_amplitude_c (float):   Amplitude of the daily temperature cycle
+            drift_per_hour (float):           Drift, in degrees C / percent humidity per hour
+            noise_std (float):                Std deviation of the random noise added to each reading
+            fault_rate (float):               Probability of a fault starting on any given read
+            fault_duration (int):             Number of reads a 'stuck' or 'dropout' fault lasts
+            seed (int):                       Random seed; for repeatable simulations
+            clock:                            Function returning the current time in seconds
+        """
+        self.base_temp_c = base_temp_c
+        self.base_humidity = base_humidity
+        self.daily_temp_amplitude_c = daily_temp_amplitude_c
+        self.drift_per_hour = drift_per_hour
+        self.noise_std = noise_std
+        self.fault_rate = fault_rate
+        self.fault_duration = fault_duration
+        self.random = random.Random(seed)
+        self.clock = clock
+
+        self.start_time = clock()
+        self.phase = self.random.uniform(0, 2 * math.pi)      # so a fleet of sensors is not in lock step
+        self.fault = None           # current fault kind, if any
+        self.fault_reads_left = 0
+        self.last_reading = None
+
+    def _ideal_reading(self):
+        hours = (self.clock() - self.start_time) / 3600.0
+        drift = self.drift_per_hour * hours
+        cycle = self.daily_temp_amplitude_c * math.sin((2 * math.pi * hours / 24.0) + self.phase)
+        temp_c = self.base_temp_c + drift + cycle + self.random.gauss(0, self.noise_std)
+        humidity = self.base_humidity + drift - (2 * cycle) + self.random.gauss(0, self.noise_std)
+        return temp_c, min(100.0, max(0.0, humidity))
+
+    def read(self):
+        # Maybe start a new fault
+        if (self.fault is None) and (self.random.random() < self.fault_rate):
+            self.fault = self.random.choice(['spike', 'stuck', 'dropout'])
+            self.fault_reads_left = 1 if self.fault == 'spike' else self.fault_duration
+
+        if self.fault is not None:
+            fault = self.fault
+            self.fault_reads_left -= 1
+            if self.fault_reads_left <= 0:
+                self.fault = None
+
+            if fault == 'dropout':
+                raise SensorReadError('simulated sensor dropout')
+            elif (fault == 'stuck') and (self.last_reading is not None):
+                return self.last_reading
+            elif fault == 'spike':
+                temp_c, humidity = self._ideal_reading()
+                return temp_c + self.random.choice([-1, 1]) * self.random.uniform(10, 30), humidity
+
+        self.last_reading = self._ideal_reading()
+        return self.last_reading
+
+
+def make_driver(name):
+    """
+    Create a sensor driver by name, as used in the client's configuration.
+
+    Args:
+        name (str):   'si7021' or 'simulated'
+
+    Returns:
+        SensorDriver
+    """
+    if name == 'si7021':
+        return SI7021Driver()
+    elif name == 'simulated':
+        return SimulatedDriver()
+    raise ValueError('Unknown sensor driver \'{}\''.format(name))
@@ -0,0 +1,114 @@
+# test_fleet_sim.py
+# Wade J Lykkehoy (wlykkehoy@gmail.com)
+"""
+Unit tests for the fleet simulator's virtual clients, which run the client's own per-tick and
+per-upload logic; the sensor and the POSTs are stood in for. Needs aiohttp (pip install aiohttp),
+and is skipped without it. Run via:
+
+    pytest test_fleet_sim.py
+"""
+
+import asyncio
+import pytest
+from sensors import SensorDriver, SensorReadError
+
+pytest.importorskip('aiohttp')
+import fleet_sim        # noqa: E402; needs aiohttp
+
+
+class FailingSensor(SensorDriver):
+    """
+    Sensor whose reads fail on the given read numbers.
+    """
+
+    def __init__(self, fail_reads=()):
+        self.fail_reads = fail_reads
+        self.num_reads = 0
+
+    def read(self):
+        self.num_reads += 1
+        if self.num_reads in self.fail_reads:
+            raise SensorReadError('simulated')
+        return 20.0, 45.0
+
+
+class FakeResponse:
+    def __init__(self, status, retry_after=None):
+        self.status = status
+        self.headers = {} if retry_after is None else {'Retry-After': str(retry_after)}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return b''
+
+
+class FakeSession:
+    """
+    Gives the POSTs the responses in turn; records the POSTs as (reading, traceparent) tuples.
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.posts = []
+
+    def post(self, url, json, headers):
+        self.posts.append((json, headers['traceparent']))
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    asyncio.sleep() that returns at once; records the seconds asked for.
+    """
+    sleeps = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(secs):
+        sleeps.append(secs)
+        await real_sleep(0)
+
+    monkeypatch.setattr(fleet_sim.asyncio, 'sleep', sleep)
+    monkeypatch.setitem(fleet_sim.CONFIG_DATA, 'num_recent_post_status_codes_to_look_at', 3)
+    return sleeps
+
+
+def test_virtual_client_resends_after_429_and_gives_up_like_the_client(sleeps):
+    session = FakeSession([FakeResponse(200), FakeResponse(429, retry_after=7), FakeResponse(200),
+                           FakeResponse(500), FakeResponse(429), FakeResponse(500), FakeResponse(500)])
+    readings_queue = asyncio.Queue()
+    for i in range(5):
+        readings_queue.put_nowait({'dev_id': 'fleet_sim_00000', 'temp': i})
+    stats = fleet_sim.FleetStats()
+    asyncio.run(fleet_sim.upload_virtual_readings(session, 'url', 'fleet_sim_00000', readings_queue, stats,
+                                                  verbose=False))
+
+    assert [reading['temp'] for reading, _ in session.posts] == [0, 1, 1, 2, 3, 3, 4]
+    assert sleeps == [7, 1]             # Retry-After, else at least a second
+    trace_ids = [traceparent.split('-')[1] for _, traceparent in session.posts]
+    assert trace_ids[1] == trace_ids[2] and trace_ids[4] == trace_ids[5]
+    assert (stats.num_sent, stats.num_ok, stats.num_throttled, stats.num_failed, stats.num_bailed) == (7, 2, 2, 3, 1)
+
+
+def test_virtual_sensor_counts_errors_and_drops_the_oldest_reading(sleeps):
+    readings_queue = asyncio.Queue(maxsize=2)
+    stats = fleet_sim.FleetStats()
+    sensor = FailingSensor(fail_reads=(2,))
+
+    async def sample_for(num_reads):
+        sampler = asyncio.ensure_future(fleet_sim.sample_virtual_sensor(sensor, 'fleet_sim_00000', readings_queue, 5,
+                                                                        False, stats))
+        while sensor.num_reads < num_reads:
+            await asyncio.sleep(0)
+        sampler.cancel()
+        await asyncio.gather(sampler, return_exceptions=True)
+
+    asyncio.run(sample_for(5))
+    assert stats.num_sensor_errors == 1
+    assert readings_queue.qsize() == 2
+    assert stats.num_dropped == 2
@@ -0,0 +1,244 @@
+# test_razpi_client.py
+# Wade J Lykkehoy (wlykkehoy@gmail.com)
+"""
+Unit tests for the client's sampling and upload loops and its deadband filter. These need
+neither a Pi nor the server; the clock, the sensor and the POSTs are all stood in for.
+Run via:
+
+    pytest test_razpi_client.py
+"""
+
+import queue
+import pytest
+import requests
+import razpi_client
+from sensors import SensorDriver, SensorReadError
+
+
+class FakeClock:
+    """
+    Monotonic clock that only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeStopEvent:
+    """
+    Stands in for the stop Event; wait() moves the clock on rather than sleeping, and the event is
+    set once the clock passes stop_at.
+    """
+
+    def __init__(self, clock, stop_at=None):
+        self.clock = clock
+        self.stop_at = stop_at
+        self.stopped = False
+        self.waits = []
+
+    def is_set(self):
+        return self.stopped or ((self.stop_at is not None) and (self.clock.now >= self.stop_at))
+
+    def set(self):
+        self.stopped = True
+
+    def wait(self, secs):
+        self.waits.append(secs)
+        self.clock.now += secs
+        return self.is_set()
+
+
+class SlowSensor(SensorDriver):
+    """
+    Sensor taking read_secs[i] seconds over its i-th read (the last one repeated); records when each read started.
+    """
+
+    def __init__(self, clock, read_secs, fail_reads=()):
+        self.clock = clock
+        self.read_secs = read_secs
+        self.fail_reads = fail_reads
+        self.read_times = []
+
+    def read(self):
+        self.read_times.append(self.clock.now)
+        num_reads = len(self.read_times)
+        self.clock.now += self.read_secs[min(num_reads, len(self.read_secs)) - 1]
+        if num_reads in self.fail_reads:
+            raise SensorReadError('simulated')
+        return 20.0, 45.0
+
+
+class FakeResponse:
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {} if retry_after is None else {'Retry-After': str(retry_after)}
+        self.content = b''
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(razpi_client.time, 'monotonic', clock)
+    monkeypatch.setitem(razpi_client.CONFIG_DATA, 'delay_between_readings', 5)
+    monkeypatch.setitem(razpi_client.CONFIG_DATA, 'trace_log_file', None)
+    return clock
+
+
+def test_next_sample_tick_skips_overrun_ticks():
+    assert razpi_client.next_sample_tick(100, 5, 101) == (105, 0)
+    assert razpi_client.next_sample_tick(100, 5, 105) == (110, 1)       # exactly on the next tick; it is missed
+    assert razpi_client.next_sample_tick(100, 5, 117) == (120, 3)
+
+
+def test_sampling_stays_on_fixed_ticks_however_long_a_read_takes(clock):
+    sensor = SlowSensor(clock, read_secs=[0.5, 2.0, 1.0])
+    readings_queue = queue.Queue()
+    razpi_client.sample_sensor(sensor, 'RazPi_01', readings_queue, FakeStopEvent(clock, stop_at=1030), verbose=False)
+    assert sensor.read_times == [1000, 1005, 1010, 1015, 1020, 1025]
+    assert readings_queue.qsize() == 6
+
+
+def test_overrun_ticks_are_skipped_not_taken_in_a_burst(clock, capsys):
+    sensor = SlowSensor(clock, read_secs=[1.0, 12.0, 1.0])
+    razpi_client.sample_sensor(sensor, 'RazPi_01', queue.Queue(), FakeStopEvent(clock, stop_at=1030), verbose=False)
+    assert sensor.read_times == [1000, 1005, 1020, 1025]
+    assert 'missed 2 reading(s)' in capsys.readouterr().out
+
+
+def test_sensor_errors_skip_the_reading_not_the_schedule(clock):
+    sensor = SlowSensor(clock, read_secs=[0.5], fail_reads=(2,))
+    readings_queue = queue.Queue()
+    razpi_client.sample_sensor(sensor, 'RazPi_01', readings_queue, FakeStopEvent(clock, stop_at=1015), verbose=False)
+    assert sensor.read_times == [1000, 1005, 1010]
+    assert readings_queue.qsize() == 2
+
+
+def test_full_queue_drops_the_oldest_reading():
+    readings_queue = queue.Queue(maxsize=3)
+    for i in range(5):
+        razpi_client.put_reading(readings_queue, {'temp': i})
+    assert [readings_queue.get_nowait()['temp'] for _ in range(3)] == [2, 3, 4]
+
+
+def run_upload(monkeypatch, clock, readings, responses):
+    """
+    Run the upload loop over the readings, the POSTs getting the responses in turn (None for a
+    connection error); stops once the responses run out. Returns the POSTs as (reading, traceparent) tuples.
+    """
+    posts = []
+    stop_event = FakeStopEvent(clock)
+    responses = list(responses)
+
+    def post(url, json, headers, timeout):
+        posts.append((json, headers['traceparent']))
+        response = responses.pop(0)
+        if not responses:
+            stop_event.set()
+        if response is None:
+            raise requests.ConnectionError('simulated')
+        return response
+
+    monkeypatch.setattr(razpi_client.requests, 'post', post)
+    readings_queue = queue.Queue()
+    for reading in readings:
+        readings_queue.put(reading)
+    razpi_client.upload_readings(readings_queue, stop_event, verbose=False)
+    return posts, stop_event
+
+
+def test_upload_resends_a_reading_after_429_in_the_same_trace(monkeypatch, clock):
+    readings = [{'dev_id': 'RazPi_01', 'temp': i} for i in range(3)]
+    posts, stop_event = run_upload(monkeypatch, clock, readings,
+                                   [FakeResponse(200), FakeResponse(429, retry_after=7), FakeResponse(429),
+                                    FakeResponse(200), FakeResponse(200)])
+    assert [reading['temp'] for reading, _ in posts] == [0, 1, 1, 1, 2]
+    assert stop_event.waits == [7, 1]             # Retry-After, else at least a second
+    trace_ids = [traceparent.split('-')[1] for _, traceparent in posts]
+    assert trace_ids[1] == trace_ids[2] == trace_ids[3]
+    assert len(set(trace_ids)) == 3
+    assert len(set(traceparent.split('-')[2] for _, traceparent in posts)) == 5     # a new span per POST
+
+
+def test_upload_bails_after_the_most_recent_posts_all_fail(monkeypatch, clock):
+    monkeypatch.setitem(razpi_client.CONFIG_DATA, 'num_recent_post_status_codes_to_look_at', 3)
+    readings = [{'dev_id': 'RazPi_01', 'temp': i} for i in range(10)]
+    posts, stop_event = run_upload(monkeypatch, clock, readings,
+                                   [FakeResponse(500), None, FakeResponse(429), FakeResponse(500)] +
+                                   [FakeResponse(200)] * 6)
+    # The 429 is resent and does not count; the third failure stops the upload
+    assert [reading['temp'] for reading, _ in posts] == [0, 1, 2, 2]
+    assert stop_event.is_set()
+
+
+def test_upload_keeps_going_while_some_posts_succeed(monkeypatch, clock):
+    monkeypatch.setitem(razpi_client.CONFIG_DATA, 'num_recent_post_status_codes_to_look_at', 3)
+    readings = [{'dev_id': 'RazPi_01', 'temp': i} for i in range(6)]
+    posts, _ = run_upload(monkeypatch, clock, readings,
+                          [FakeResponse(500), FakeResponse(500), FakeResponse(200), None, FakeResponse(500),
+                           FakeResponse(200)])
+    assert [reading['temp'] for reading, _ in posts] == [0, 1, 2, 3, 4, 5]
+
+
+# =================================================================================================
+# DeadbandFilter
+# =================================================================================================
+
+def deadband_reading(minute, temp, humidity=45):
+    return {'dev_id': 'RazPi_01', 'ts': '2020-06-18T11:{:02d}:00Z'.format(minute), 'temp': temp, 'humidity': humidity}
+
+
+def run_deadband(deadband_filter, clock, temps, period=60):
+    """
+    Feed a reading a minute apart per temp; returns the list of messages sent for each.
+    """
+    sent = []
+    for minute, temp in enumerate(temps):
+        sent.append(deadband_filter.filter(deadband_reading(minute, temp)))
+        clock.now += period
+    return sent
+
+
+def test_deadband_sends_changes_and_settle_readings_only(clock):
+    deadband_filter = razpi_client.DeadbandFilter(temp_delta=0, humidity_delta=0, heartbeat_interval=3600,
+                                                  settle_readings=2, clock=clock)
+    sent = run_deadband(deadband_filter, clock, [68, 68, 68, 68, 68])
+    assert [len(messages) for messages in sent] == [1, 1, 0, 0, 0]
+    assert sent[0] == [deadband_reading(0, 68)]
+
+
+def test_deadband_accounts_for_suppressed_readings_before_a_change(clock):
+    deadband_filter = razpi_client.DeadbandFilter(temp_delta=0, humidity_delta=0, heartbeat_interval=3600,
+                                                  settle_readings=2, clock=clock)
+    sent = run_deadband(deadband_filter, clock, [68, 68, 68, 68, 68, 70, 70])
+    heartbeat, changed = sent[5]
+    assert heartbeat == {'dev_id': 'RazPi_01', 'ts': '2020-06-18T11:04:00Z', 'temp': 68, 'humidity': 45,
+                         'repeat_count': 3, 'heartbeat': True}
+    assert changed == deadband_reading(5, 70)
+    assert sent[6] == [deadband_reading(6, 70)]          # a settle reading after the change
+
+    # Every reading is accounted for by what was sent
+    assert sum(message.get('repeat_count', 1) for messages in sent for message in messages) == 7
+
+
+def test_deadband_heartbeat_when_the_interval_expires(clock):
+    deadband_filter = razpi_client.DeadbandFilter(temp_delta=0, humidity_delta=0, heartbeat_interval=300,
+                                                  settle_readings=1, clock=clock)
+    sent = run_deadband(deadband_filter, clock, [68] * 12)
+    assert [len(messages) for messages in sent] == [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0]
+    assert sent[5] == [{'dev_id': 'RazPi_01', 'ts': '2020-06-18T11:05:00Z', 'temp': 68, 'humidity': 45,
+                        'repeat_count': 5, 'heartbeat': True}]
+    assert sent[10][0]['repeat_count'] == 5
+    assert sum(message.get('repeat_count', 1) for messages in sent for message in messages) == 11
+
+
+def test_deadband_changes_within_the_delta_are_suppressed(clock):
+    deadband_filter = razpi_client.DeadbandFilter(temp_delta=1, humidity_delta=2, heartbeat_interval=3600,
+                                                  settle_readings=1, clock=clock)
+    assert deadband_filter.filter(deadband_reading(0, 68)) == [deadband_reading(0, 68)]
+    assert deadband_filter.filter(deadband_reading(1, 69, humidity=47)) == []
+    assert deadband_filter.filter(deadband_reading(2, 67, humidity=43)) == []
+    assert len(deadband_filter.filter(deadband_reading(3, 70))) == 2         # more than the delta from the last sent
+    assert len(deadband_filter.filter(deadband_reading(4, 70, humidity=48))) == 1